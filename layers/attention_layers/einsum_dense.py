@@ -28,6 +28,7 @@ from tensorflow.python.keras import regularizers
 from tensorflow.python.keras.engine.base_layer import Layer
 from tensorflow.python.ops import special_math_ops
 from tensorflow.python.util.tf_export import keras_export
+from layers import utils
 
 
 @keras_export("keras.layers.experimental.EinsumDense")
@@ -197,10 +198,14 @@ class EinsumDense(Layer):
         base_config = super(EinsumDense, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
 
-    def call(self, inputs):
-        ret = special_math_ops.einsum(self.equation, inputs, self.kernel)
+    def call(self, inputs, layer_index=None):
+        """
+        :param layer_index: 不为 None 时 kernel 和 bias 为多层 stacked 的权重，只使用其中第 layer_index 层，
+            见 layers.utils.stacked_variable_creator
+        """
+        ret = special_math_ops.einsum(self.equation, inputs, utils.get_layer_weight(self.kernel, layer_index))
         if self.bias is not None:
-            ret += self.bias
+            ret += utils.get_layer_weight(self.bias, layer_index)
         if self.activation is not None:
             ret = self.activation(ret)
         return ret
@@ -0,0 +1,321 @@
+# -*- coding: utf - 8 -*-
+
+import tensorflow as tf
+from layers.attention_layers.multi_head_attention_layer import MultiHeadAttention
+
+_FEATURE_MAPS = ('elu', 'random')
+_EPSILON = 1e-6
+# causal 时分块计算的默认块长
+_CAUSAL_CHUNK_SIZE = 64
+
+
+def get_feature_size(feature_map, size_per_head, num_random_features=None):
+    """
+        核函数 feature map 的输出维度
+
+    :param feature_map: 'elu' 时与 size_per_head 相同，'random' 时为 num_random_features (默认 2 * size_per_head)
+    """
+    if feature_map == 'elu':
+        return size_per_head
+    return num_random_features or 2 * size_per_head
+
+
+def create_cache(batch_size, num_heads, size_per_head, feature_size):
+    """
+        创建 CacheLinearAttention 使用的 cache
+
+        cache 只保存 key / value 的累加和，大小与已解码的长度无关：
+            {
+                'key_value_sum': (batch_size, num_heads, feature_size, size_per_head)，sum(phi(k) v^T)
+                'key_sum': (batch_size, num_heads, feature_size)，sum(phi(k))
+            }
+        累加和总是使用 float32
+    """
+    return {
+        'key_value_sum': tf.zeros([batch_size, num_heads, feature_size, size_per_head], dtype=tf.float32),
+        'key_sum': tf.zeros([batch_size, num_heads, feature_size], dtype=tf.float32)
+    }
+
+
+def _causal_linear_attention_chunk(query_features, key_features, value, key_value_state, key_state):
+    """
+        一个块内的 causal linear attention：块内按下三角的 phi(q) phi(k)^T 直接计算，之前的块通过累加和计算
+
+    :param query_features: (batch_size, chunk_size, num_heads, feature_size)
+    :param key_features: (batch_size, chunk_size, num_heads, feature_size)
+    :param value: (batch_size, chunk_size, num_heads, size_per_head)
+    :param key_value_state: (batch_size, num_heads, feature_size, size_per_head)，之前所有块的累加和
+    :param key_state: (batch_size, num_heads, feature_size)
+    :return: attention_output: (batch_size, chunk_size, num_heads, size_per_head)，以及包括当前块的累加和
+    """
+    chunk_size = tf.shape(query_features)[1]
+    # (batch_size, num_heads, chunk_size, chunk_size)
+    scores = tf.einsum('bqhm,bkhm->bhqk', query_features, key_features)
+    scores *= tf.linalg.band_part(tf.ones([chunk_size, chunk_size], dtype=scores.dtype), -1, 0)
+
+    numerator = tf.einsum('bhqk,bkhd->bqhd', scores, value) + \
+        tf.einsum('bqhm,bhmd->bqhd', query_features, key_value_state)
+    denominator = tf.transpose(tf.reduce_sum(scores, axis=-1), [0, 2, 1]) + \
+        tf.einsum('bqhm,bhm->bqh', query_features, key_state)
+
+    key_value_state += tf.einsum('bkhm,bkhd->bhmd', key_features, value)
+    key_state += tf.reduce_sum(key_features, axis=1)
+    return numerator / (denominator[..., tf.newaxis] + _EPSILON), key_value_state, key_state
+
+
+def _causal_linear_attention(
+        query_features,
+        key_features,
+        value,
+        key_value_state=None,
+        key_state=None,
+        chunk_size=_CAUSAL_CHUNK_SIZE
+):
+    """
+        causal linear attention，第 i 个 query 只使用前 i 个 key / value 的累加和
+
+        按 chunk_size 分块，依次计算每个块并把 (feature_size, size_per_head) 的累加和传给下一个块，
+        不保存每个位置的累加和 (batch_size, seq_len, num_heads, feature_size, size_per_head)
+        seq_len 不超过 chunk_size 时 (例如逐步解码) 只有一个块，不需要循环
+
+    :param query_features: (batch_size, seq_len, num_heads, feature_size)
+    :param key_features: (batch_size, seq_len, num_heads, feature_size)
+    :param value: (batch_size, seq_len, num_heads, size_per_head)
+    :param key_value_state: (batch_size, num_heads, feature_size, size_per_head)，之前所有位置的累加和
+    :param key_state: (batch_size, num_heads, feature_size)
+    :param chunk_size: 块的长度
+    :return: attention_output: (batch_size, seq_len, num_heads, size_per_head)，以及包括当前所有位置的累加和
+    """
+    batch_size = tf.shape(query_features)[0]
+    _, _, num_heads, feature_size = query_features.shape
+    size_per_head = value.shape[-1]
+    if key_value_state is None:
+        key_value_state = tf.zeros([batch_size, num_heads, feature_size, size_per_head], dtype=value.dtype)
+        key_state = tf.zeros([batch_size, num_heads, feature_size], dtype=value.dtype)
+
+    seq_len = query_features.shape[1]
+    if seq_len is not None and seq_len <= chunk_size:
+        return _causal_linear_attention_chunk(query_features, key_features, value, key_value_state, key_state)
+
+    # 补齐为 chunk_size 的整数倍，补齐的 key 为 0，不改变累加和
+    seq_len = tf.shape(query_features)[1]
+    num_chunks = (seq_len + chunk_size - 1) // chunk_size
+    paddings = [[0, 0], [0, num_chunks * chunk_size - seq_len], [0, 0], [0, 0]]
+    query_features, key_features, value = [
+        tf.pad(tensor, paddings) for tensor in (query_features, key_features, value)
+    ]
+    outputs = tf.TensorArray(
+        value.dtype,
+        size=num_chunks,
+        element_shape=tf.TensorShape([value.shape[0], chunk_size, num_heads, size_per_head])
+    )
+
+    def body(i, outputs, key_value_state, key_state):
+        chunk = slice(None), slice(i * chunk_size, (i + 1) * chunk_size)
+        chunk_outputs, key_value_state, key_state = _causal_linear_attention_chunk(
+            query_features[chunk], key_features[chunk], value[chunk], key_value_state, key_state
+        )
+        return i + 1, outputs.write(i, chunk_outputs), key_value_state, key_state
+
+    _, outputs, key_value_state, key_state = tf.while_loop(
+        lambda i, *_: i < num_chunks,
+        body,
+        loop_vars=(tf.constant(0), outputs, key_value_state, key_state)
+    )
+    # (num_chunks, batch_size, chunk_size, num_heads, size_per_head) -> (batch_size, seq_len, num_heads, size_per_head)
+    outputs = tf.transpose(outputs.stack(), [1, 0, 2, 3, 4])
+    outputs = tf.reshape(outputs, [batch_size, num_chunks * chunk_size, num_heads, size_per_head])
+    return outputs[:, :seq_len], key_value_state, key_state
+
+
+class LinearAttention(MultiHeadAttention):
+    """
+        kernelized linear attention
+
+        用核函数 feature map phi 近似 softmax 中的 exp(q k^T)：
+            attention(q, k, v) = phi(q) (sum phi(k) v^T) / (phi(q) sum phi(k))
+        先计算 sum phi(k) v^T (feature_size, size_per_head)，计算量与 seq_len 成线性关系
+
+        feature_map:
+            1. 'elu': phi(x) = elu(x) + 1 (Transformers are RNNs)
+            2. 'random': positive random features (Performer FAVOR+)，
+               phi(x) = exp(w x - |x|^2 / 2) / sqrt(m)，其期望为 exp(q k^T / sqrt(size_per_head))
+               w 为 (num_random_features, size_per_head) 的高斯随机矩阵，作为不可训练的权重保存在 checkpoint 中
+
+        causal 为 True 时第 i 个位置只与前 i 个位置计算 attention，通过累加和实现：
+        按 causal_chunk_size 分块，块内直接计算，块之间只传递 (feature_size, size_per_head) 的累加和
+
+        attention_mask 与 MultiHeadAttention 的输入相同，但只使用其中 key 的 padding 信息：
+            非 causal 时为第一行，causal 时为最后一行 (look ahead mask 的最后一行可以看到所有未被 padding 的 key)
+        不计算 attention score，因此不支持 attention_dropout_rate
+        不支持 num_kv_heads、attention_chunk_size、attention_axes 和返回 attention score
+    """
+    def __init__(
+            self,
+            num_attention_heads,
+            size_per_head_for_query_and_key,
+            feature_map='elu',
+            num_random_features=None,
+            causal=False,
+            causal_chunk_size=_CAUSAL_CHUNK_SIZE,
+            **kwargs
+    ):
+        """
+        :param feature_map: 'elu' 或 'random'
+        :param num_random_features: feature_map 为 'random' 时随机特征的个数，默认为 2 * size_per_head
+        :param causal: 是否只与之前的位置计算 attention
+        :param causal_chunk_size: causal 时分块计算的块长
+        """
+        super(LinearAttention, self).__init__(
+            num_attention_heads=num_attention_heads,
+            size_per_head_for_query_and_key=size_per_head_for_query_and_key,
+            causal=causal,
+            **kwargs
+        )
+        if feature_map not in _FEATURE_MAPS:
+            raise ValueError('feature_map should be one of %s, got %s' % (_FEATURE_MAPS, feature_map))
+        if (
+            self._num_kv_heads != self._num_attention_heads
+            or self._attention_chunk_size is not None
+            or self._attention_axes is not None
+            or self._return_attention_scores
+        ):
+            raise ValueError(
+                'LinearAttention does not support num_kv_heads, attention_chunk_size, '
+                'attention_axes or return_attention_scores'
+            )
+        if self._attention_dropout_rate:
+            raise ValueError(
+                'LinearAttention does not support attention_dropout_rate, got %s' % self._attention_dropout_rate
+            )
+        self._feature_map = feature_map
+        self._feature_size = get_feature_size(feature_map, size_per_head_for_query_and_key, num_random_features)
+        self._causal_chunk_size = causal_chunk_size
+
+    @property
+    def feature_size(self):
+        return self._feature_size
+
+    def _build_from_signature(self, query, value, key=None):
+        super(LinearAttention, self)._build_from_signature(query=query, value=value, key=key)
+        if self._feature_map == 'random':
+            with tf.init_scope():
+                self._random_features = self.add_weight(
+                    'random_features',
+                    shape=[self._feature_size, self._size_per_head_for_query_and_key],
+                    initializer=tf.keras.initializers.RandomNormal(),
+                    trainable=False,
+                    dtype=tf.float32
+                )
+
+    def _compute_features(self, inputs, is_query):
+        """
+        :param inputs: (batch_size, seq_len, num_heads, size_per_head)
+        :return: (batch_size, seq_len, num_heads, feature_size) float32
+        """
+        inputs = tf.cast(inputs, tf.float32)
+        if self._feature_map == 'elu':
+            return tf.nn.elu(inputs) + 1.0
+
+        # q 和 k 各乘以 size_per_head ** -0.25，内积即为 q k^T / sqrt(size_per_head)
+        inputs = inputs * float(self._size_per_head_for_query_and_key) ** -0.25
+        projection = tf.einsum('blhd,md->blhm', inputs, self._random_features)
+        norm = tf.reduce_sum(tf.square(inputs), axis=-1, keepdims=True) / 2.0
+        # 减去最大值避免溢出，query 的每一行、非 causal 时 key 的每个头分别减去同一个数，在归一化时抵消
+        # causal 时 key 的最大值与之后的位置有关，不做处理
+        if is_query:
+            projection -= tf.stop_gradient(tf.reduce_max(projection, axis=-1, keepdims=True))
+        elif not self._causal:
+            projection -= tf.stop_gradient(tf.reduce_max(projection, axis=[1, 3], keepdims=True))
+        return (tf.exp(projection - norm) + _EPSILON) * float(self._feature_size) ** -0.5
+
+    def compute_attention(self, query, key, value, training, attention_mask=None):
+        """
+        :param query: (batch_size, seq_len_q, num_heads, size_per_head)
+        :param key: (batch_size, seq_len_k, num_heads, size_per_head)
+        :param value: (batch_size, seq_len_k, num_heads, size_per_head_for_value)
+        :param attention_mask: (batch_size, seq_len_q or 1, seq_len_k)
+        :return: (batch_size, seq_len_q, num_heads, size_per_head_for_value), None
+        """
+        dtype = query.dtype
+        query_features = self._compute_features(query, is_query=True)
+        key_features = self._compute_features(key, is_query=False)
+        value = tf.cast(value, tf.float32)
+
+        if attention_mask is not None:
+            key_mask = attention_mask[:, -1] if self._causal else attention_mask[:, 0]
+            key_features *= (1.0 - tf.cast(key_mask, tf.float32))[:, :, tf.newaxis, tf.newaxis]
+
+        if self._causal:
+            attention_output, _, _ = _causal_linear_attention(
+                query_features, key_features, value, chunk_size=self._causal_chunk_size
+            )
+        else:
+            # (batch_size, num_heads, feature_size, size_per_head_for_value)
+            key_value = tf.einsum('bkhm,bkhd->bhmd', key_features, value)
+            # (batch_size, num_heads, feature_size)
+            key_sum = tf.reduce_sum(key_features, axis=1)
+            numerator = tf.einsum('bqhm,bhmd->bqhd', query_features, key_value)
+            denominator = tf.einsum('bqhm,bhm->bqh', query_features, key_sum)
+            attention_output = numerator / (denominator[..., tf.newaxis] + _EPSILON)
+
+        return tf.cast(attention_output, dtype), None
+
+
+class CacheLinearAttention(LinearAttention):
+    """
+        用于自回归解码器的 causal linear attention
+
+        解码时 cache 只保存 key / value 的累加和 (见 create_cache)，每一步的计算量和 cache 大小都与已解码的长度无关
+        cache 的形状在解码过程中不变，decode_loop_step 不起作用，也不需要 attention_mask
+        不支持 cache_indirection
+    """
+    def __init__(self, num_attention_heads, size_per_head_for_query_and_key, **kwargs):
+        kwargs['causal'] = True
+        super(CacheLinearAttention, self).__init__(
+            num_attention_heads=num_attention_heads,
+            size_per_head_for_query_and_key=size_per_head_for_query_and_key,
+            **kwargs
+        )
+
+    def call(
+            self,
+            query,
+            value,
+            training,
+            key=None,
+            attention_mask=None,
+            cache=None,
+            decode_loop_step=None,
+            cache_indirection=None,
+            layer_index=None
+    ):
+        if cache_indirection is not None:
+            raise ValueError('CacheLinearAttention does not support cache_indirection')
+        if not cache:
+            attention_output = super(CacheLinearAttention, self).call(
+                query, value, training=training, key=key, attention_mask=attention_mask, layer_index=layer_index
+            )
+            return attention_output, cache
+
+        if not self._built_from_signature:
+            self._build_from_signature(query=query, value=value, key=key)
+        if self._can_fuse_qkv_projection(query, value, key):
+            query, key, value = self._project_qkv(query, layer_index)
+        else:
+            if key is None:
+                key = value
+            query = self._project(query, 0, layer_index)
+            key = self._project(key, 1, layer_index)
+            value = self._project(value, 2, layer_index)
+
+        attention_output, cache['key_value_sum'], cache['key_sum'] = _causal_linear_attention(
+            self._compute_features(query, is_query=True),
+            self._compute_features(key, is_query=False),
+            tf.cast(value, tf.float32),
+            cache['key_value_sum'],
+            cache['key_sum'],
+            chunk_size=self._causal_chunk_size
+        )
+        attention_output = self._output_dense(tf.cast(attention_output, query.dtype), layer_index=layer_index)
+        return attention_output, cache
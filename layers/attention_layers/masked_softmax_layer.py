@@ -3,27 +3,55 @@
 import tensorflow as tf
 
 
+def get_causal_mask(from_seq_len, to_seq_len, dtype=tf.float32):
+    """
+        causal mask，1 为 mask
+
+        第 i 个 query 对应第 i + to_seq_len - from_seq_len 个 key (query 与 key 的末尾对齐)，
+        只能看到该位置及之前的 key
+
+    :return: (from_seq_len, to_seq_len)
+    """
+    query_positions = tf.range(from_seq_len)[:, tf.newaxis] + (to_seq_len - from_seq_len)
+    return tf.cast(tf.range(to_seq_len)[tf.newaxis, :] > query_positions, dtype)
+
+
 class MaskedSoftmax(tf.keras.layers.Layer):
-    def __init__(self, mask_expansion_axes=None, normalization_axes=None, **kwargs):
+    """
+        mask 可以是完整的 (batch_size, seq_len_q, seq_len_k)，
+        也可以是只包含 key padding 信息的 (batch_size, 1, seq_len_k) 或 (batch_size, seq_len_k)，dtype 可以为 bool
+        causal 为 True 时额外屏蔽每个 query 之后的 key，scores 的最后两维为 (seq_len_q, seq_len_k)
+        mask 和 causal mask 都只在这里与 scores 相加时才 broadcast
+    """
+    def __init__(self, mask_expansion_axes=None, normalization_axes=None, causal=False, **kwargs):
         self._mask_expansion_axes = mask_expansion_axes
         # 默认只标准化最后一层
         if normalization_axes is None:
             self._normalization_axes = (-1,)
         else:
             self._normalization_axes = normalization_axes
+        self._causal = causal
         super(MaskedSoftmax, self).__init__(**kwargs)
 
     def call(self, scores, mask=None):
         """
         :param scores: [batch_size, num_heads, seq_len, seq_len]
-        :param mask: [batch_size, seq_len or 1, seq_len]
+        :param mask: [batch_size, seq_len or 1, seq_len] or [batch_size, seq_len]
         :return:
         """
         if mask is not None:
             for _ in range(len(scores.shape) - len(mask.shape)):
                 mask = tf.expand_dims(mask, axis=self._mask_expansion_axes)
+            mask = tf.cast(mask, scores.dtype)
+
+        if self._causal:
+            scores_shape = tf.shape(scores)
+            causal_mask = get_causal_mask(scores_shape[-2], scores_shape[-1], dtype=scores.dtype)
+            # 两个 mask 先合并，只与 scores 相加一次
+            mask = causal_mask if mask is None else tf.maximum(mask, causal_mask)
 
-            adder = tf.cast(mask, scores.dtype) * -10000.0
+        if mask is not None:
+            adder = mask * -10000.0
             scores += adder
 
         # softmax
@@ -37,7 +65,8 @@ class MaskedSoftmax(tf.keras.layers.Layer):
     def get_config(self):
         config = {
             'mask_expansion_axes': self._mask_expansion_axes,
-            'normalization_axes': self._normalization_axes
+            'normalization_axes': self._normalization_axes,
+            'causal': self._causal
         }
         base_config = super(MaskedSoftmax, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
@@ -5,10 +5,14 @@ import string
 import collections
 import numpy as np
 import tensorflow as tf
+from layers import utils
 from layers.attention_layers.einsum_dense import EinsumDense
 from layers.attention_layers import masked_softmax_layer
 
 _CHR_IDX = string.ascii_lowercase
+# checkpoint 中 query / key / value 投影以及合并投影的名字，见 MultiHeadAttention._build_from_signature
+_QKV_DENSE_NAMES = ('_query_dense', '_key_dense', '_value_dense')
+_FUSED_QKV_DENSE_NAME = '_qkv_dense'
 
 
 def _build_attention_equation(rank, attention_axes):
@@ -116,6 +120,147 @@ def _get_output_shape(output_rank, known_last_dims):
     return [None] * (output_rank - len(known_last_dims)) + list(known_last_dims)
 
 
+def _split_initializer(initializer, num_heads):
+    """合并投影的权重在头所在的维度 (倒数第二维) 上按 num_heads 分成几部分分别初始化后再拼接"""
+    def initialize(shape, dtype=None):
+        return tf.concat([
+            initializer(list(shape[:-2]) + [heads, shape[-1]], dtype=dtype) for heads in num_heads
+        ], axis=-2)
+    return initialize
+
+
+def merge_qkv_weights(query_weight, key_weight, value_weight):
+    """
+        把 query、key、value 投影的权重合并为合并投影的权重
+
+    :param query_weight: kernel (hidden_size, num_heads, size_per_head) 或 bias (num_heads, size_per_head)
+    :param key_weight: kernel (hidden_size, num_kv_heads, size_per_head) 或 bias (num_kv_heads, size_per_head)
+    :param value_weight: 与 key_weight 相同
+    :return: kernel (hidden_size, num_heads + 2 * num_kv_heads, size_per_head) 或对应的 bias
+    """
+    return tf.concat([query_weight, key_weight, value_weight], axis=-2)
+
+
+def split_qkv_weight(weight, num_attention_heads, num_kv_heads):
+    """
+        merge_qkv_weights 的逆变换
+
+    :return: query、key、value 投影的权重
+    """
+    return tf.split(weight, [num_attention_heads, num_kv_heads, num_kv_heads], axis=-2)
+
+
+def convert_qkv_checkpoint_weight(name, shape, reader):
+    """
+        按 checkpoint 中的名字在分别投影与合并投影之间转换权重，用于 utils.convert_checkpoint
+
+        合并投影的 .../_qkv_dense/kernel 由原 checkpoint 中的 .../_query_dense/kernel、.../_key_dense/kernel、
+        .../_value_dense/kernel 拼接得到，bias 相同；反之从 .../_qkv_dense/kernel 中切出对应的部分
+
+    :param name: 目标 checkpoint 中的名字
+    :param shape: 目标权重的形状
+    :param reader: 原 checkpoint 的 tf.train.load_checkpoint
+    :return: 目标权重，不是投影的权重或原 checkpoint 中没有对应的权重时返回 None
+    """
+    parts = name.split('/')
+    if _FUSED_QKV_DENSE_NAME in parts:
+        index = parts.index(_FUSED_QKV_DENSE_NAME)
+        source_names = [
+            '/'.join(parts[:index] + [dense_name] + parts[index + 1:]) for dense_name in _QKV_DENSE_NAMES
+        ]
+        if all(reader.has_tensor(source_name) for source_name in source_names):
+            return merge_qkv_weights(*[reader.get_tensor(source_name) for source_name in source_names])
+        return None
+
+    for i, dense_name in enumerate(_QKV_DENSE_NAMES):
+        if dense_name in parts:
+            index = parts.index(dense_name)
+            source_name = '/'.join(parts[:index] + [_FUSED_QKV_DENSE_NAME] + parts[index + 1:])
+            if not reader.has_tensor(source_name):
+                return None
+            source = reader.get_tensor(source_name)
+            # 合并的头数为 num_heads + 2 * num_kv_heads
+            if i == 0:
+                num_attention_heads = shape[-2]
+                num_kv_heads = (source.shape[-2] - num_attention_heads) // 2
+            else:
+                num_kv_heads = shape[-2]
+                num_attention_heads = source.shape[-2] - 2 * num_kv_heads
+            return split_qkv_weight(source, num_attention_heads, num_kv_heads)[i]
+    return None
+
+
+def _pad_to_multiple(tensor, axis, multiple, constant_values=0):
+    """在 axis 维的末尾补齐为 multiple 的整数倍"""
+    length = tf.shape(tensor)[axis]
+    paddings = [[0, 0] for _ in range(tensor.shape.rank)]
+    paddings[axis] = [0, (multiple - length % multiple) % multiple]
+    return tf.pad(tensor, paddings, constant_values=constant_values)
+
+
+def _attend_query_chunk(query, attention_mask, key, value, seed, chunk_size, dropout_rate, query_start=None):
+    """
+        一个 query 块对所有 key 块的 online softmax attention，见 MultiHeadAttention._compute_chunked_attention
+
+    :param query: (batch_size, chunk_size, num_kv_heads, group_size, size_per_head)，已经 scale
+    :param attention_mask: (batch_size, chunk_size or 1, seq_len_k)，seq_len_k 为 chunk_size 的整数倍
+    :param key: (batch_size, seq_len_k, num_kv_heads, size_per_head)
+    :param value: (batch_size, seq_len_k, num_kv_heads, size_per_head_for_value)
+    :param seed: (2,) stateless dropout 的 seed
+    :param query_start: causal 时该 query 块第一个 query 对应的 key 位置，之后的 key 被屏蔽，
+        完全位于其后的 key 块直接跳过；None 表示不使用 causal mask
+    :return: (batch_size, chunk_size, num_kv_heads, group_size, size_per_head_for_value)
+    """
+    num_key_chunks = tf.shape(key)[1] // chunk_size
+    if query_start is not None:
+        num_key_chunks = tf.clip_by_value((query_start + chunk_size - 1) // chunk_size + 1, 1, num_key_chunks)
+    # (batch_size, num_kv_heads, group_size, chunk_size)
+    scores_shape = tf.shape(tf.einsum('bqgrd->bgrq', query))
+    max_scores = tf.fill(scores_shape, query.dtype.min)
+    sum_exp = tf.zeros(scores_shape, dtype=query.dtype)
+    # (batch_size, num_kv_heads, group_size, chunk_size, size_per_head_for_value)
+    outputs = tf.zeros(tf.concat([scores_shape, tf.shape(value)[-1:]], axis=0), dtype=query.dtype)
+
+    def body(i, max_scores, sum_exp, outputs):
+        key_chunk = key[:, i * chunk_size:(i + 1) * chunk_size]
+        value_chunk = value[:, i * chunk_size:(i + 1) * chunk_size]
+        # (batch_size, 1, 1, chunk_size or 1, chunk_size)
+        mask_chunk = attention_mask[:, tf.newaxis, tf.newaxis, :, i * chunk_size:(i + 1) * chunk_size]
+        if query_start is not None:
+            # (chunk_size, chunk_size)
+            causal_mask = tf.cast(
+                tf.range(chunk_size)[tf.newaxis, :] + i * chunk_size >
+                tf.range(chunk_size)[:, tf.newaxis] + query_start,
+                mask_chunk.dtype
+            )
+            mask_chunk = tf.maximum(mask_chunk, causal_mask)
+
+        # (batch_size, num_kv_heads, group_size, chunk_size, chunk_size)
+        scores = tf.einsum('bqgrd,bkgd->bgrqk', query, key_chunk) + mask_chunk * -10000.0
+        new_max_scores = tf.maximum(max_scores, tf.reduce_max(scores, axis=-1))
+        exp_scores = tf.exp(scores - new_max_scores[..., tf.newaxis])
+        correction = tf.exp(max_scores - new_max_scores)
+        sum_exp = sum_exp * correction + tf.reduce_sum(exp_scores, axis=-1)
+
+        # dropout 作用在未归一化的概率上，与对 softmax 的结果做 dropout 等价
+        if dropout_rate > 0:
+            keep = tf.random.stateless_uniform(
+                tf.shape(exp_scores), seed=seed + tf.stack([0, i]), dtype=exp_scores.dtype
+            ) >= dropout_rate
+            exp_scores = exp_scores * tf.cast(keep, exp_scores.dtype) / (1.0 - dropout_rate)
+
+        outputs = outputs * correction[..., tf.newaxis] + tf.einsum('bgrqk,bkgd->bgrqd', exp_scores, value_chunk)
+        return i + 1, new_max_scores, sum_exp, outputs
+
+    _, _, sum_exp, outputs = tf.while_loop(
+        lambda i, *_: i < num_key_chunks,
+        body,
+        [tf.constant(0), max_scores, sum_exp, outputs]
+    )
+    outputs = outputs / sum_exp[..., tf.newaxis]
+    return tf.einsum('bgrqd->bqgrd', outputs)
+
+
 class MultiHeadAttention(tf.keras.layers.Layer):
     def __init__(
             self,
@@ -134,9 +279,49 @@ class MultiHeadAttention(tf.keras.layers.Layer):
             activity_regularizer=None,
             kernel_constraint=None,
             bias_constraint=None,
+            num_kv_heads=None,
+            fuse_qkv_projection=False,
+            attention_chunk_size=None,
+            causal=False,
             **kwargs
     ):
+        """
+        :param num_kv_heads: key / value 的头数，为 None 时与 num_attention_heads 相同
+            小于 num_attention_heads 时为 grouped-query attention，每 num_attention_heads // num_kv_heads 个
+            query 头共用一个 key / value 头，为 1 时即 multi-query attention
+            解码时 key / value cache 的大小按 num_kv_heads 计算
+            只支持默认的 attention_axes (输入为 (batch_size, seq_len, hidden_size))
+        :param fuse_qkv_projection: 是否只创建一个合并的 query、key、value 投影，self attention 时只做一次投影，详见 _project_qkv
+            只用于 self attention 的层 (只为部分位置计算 query 时 query 与 key / value 不是同一个张量，仍然可以合并)
+            query、key、value 的 hidden_size 或 size_per_head 不同时不合并
+            合并投影与分别投影的 checkpoint 可以通过 convert_qkv_checkpoint_weight 相互转换
+        :param attention_chunk_size: 不为 None 时按该大小对 query 和 key 分块计算 attention，
+            不保存完整的 attention score，详见 _compute_chunked_attention
+            只支持默认的 attention_axes，且不能返回 attention score
+        :param causal: 是否屏蔽每个 query 之后的 key (query 与 key 的末尾对齐)，
+            causal mask 在 softmax 时才生成，attention_mask 只需要包含 key 的 padding 信息，例如 (batch_size, 1, seq_len_k)
+            只支持默认的 attention_axes
+        """
         super(MultiHeadAttention, self).__init__(**kwargs)
+        if num_kv_heads is None:
+            num_kv_heads = num_attention_heads
+        if num_attention_heads % num_kv_heads != 0:
+            raise ValueError(
+                'num_attention_heads (%d) must be divisible by num_kv_heads (%d)'
+                % (num_attention_heads, num_kv_heads)
+            )
+        if num_kv_heads != num_attention_heads and attention_axes is not None:
+            raise ValueError('num_kv_heads is not supported with custom attention_axes')
+        if attention_chunk_size is not None and (attention_axes is not None or return_attention_scores):
+            raise ValueError(
+                'attention_chunk_size is not supported with custom attention_axes or return_attention_scores'
+            )
+        if causal and attention_axes is not None:
+            raise ValueError('causal is not supported with custom attention_axes')
+        self._num_kv_heads = num_kv_heads
+        self._fuse_qkv_projection = fuse_qkv_projection
+        self._attention_chunk_size = attention_chunk_size
+        self._causal = causal
         self._num_attention_heads = num_attention_heads
         self._size_per_head_for_query_and_key = size_per_head_for_query_and_key
         self._size_per_head_for_value = size_per_head_for_value if size_per_head_for_value else \
@@ -194,6 +379,15 @@ class MultiHeadAttention(tf.keras.layers.Layer):
             bias_constraint=self._bias_constraint
         )
 
+        # self attention 只创建一个合并的投影，见 _project_qkv
+        fuse_qkv_projection = (
+            self._fuse_qkv_projection
+            and query_shape.rank == 3
+            and query_shape[-1] == key_shape[-1] == value_shape[-1]
+            and self._attention_axes is None
+            and self._size_per_head_for_value == self._size_per_head_for_query_and_key
+        )
+
         with tf.init_scope():
             # 默认情况下只在 hidden_size 那个维度作变换
             # 因此前两个维度固定不变，pin_dims 为 query/key/value's shape - 1
@@ -203,48 +397,69 @@ class MultiHeadAttention(tf.keras.layers.Layer):
             einsum_equation, bias_axes, output_rank = _build_projection_equation(
                 query_shape.rank - 1, bound_dims=1, output_dims=2
             )
-            self._query_dense = EinsumDense(
-                einsum_equation,
-                output_shape=_get_output_shape(
-                    output_rank - 1,  # -1 是因为 batch_size
-                    [self._num_attention_heads, self._size_per_head_for_query_and_key]
-                ),
-                bias_axes=bias_axes if self._use_bias else None,
-                name='query',
-                **common_kwargs
-            )
-
-            # 构造 key dense
-            einsum_equation, bias_axes, output_rank = _build_projection_equation(
-                key_shape.rank - 1, bound_dims=1, output_dims=2
-            )
-            self._key_dense = EinsumDense(
-                einsum_equation,
-                output_shape=_get_output_shape(
-                    output_rank - 1,
-                    [self._num_attention_heads, self._size_per_head_for_query_and_key]
-                ),
-                bias_axes=bias_axes if self._use_bias else None,
-                name="key",
-                **common_kwargs
-            )
-
-            # 构造 value dense
-            einsum_equation, bias_axes, output_rank = _build_projection_equation(
-                value_shape.rank - 1,
-                bound_dims=1,
-                output_dims=2
-            )
-            self._value_dense = EinsumDense(
-                einsum_equation,
-                output_shape=_get_output_shape(
-                    output_rank - 1,
-                    [self._num_attention_heads, self._size_per_head_for_value]
-                ),
-                bias_axes=bias_axes if self._use_bias else None,
-                name="value",
-                **common_kwargs
-            )
+            if fuse_qkv_projection:
+                # query、key、value 的 kernel 在头所在的维度上合并为 (hidden_size, num_heads + 2 * num_kv_heads, size_per_head)
+                # 三部分按各自的形状初始化后再拼接，与分别投影时的初始化相同
+                num_heads = self._get_qkv_num_heads()
+                fused_kwargs = dict(
+                    common_kwargs,
+                    kernel_initializer=_split_initializer(self._kernel_initializer, num_heads),
+                    bias_initializer=_split_initializer(self._bias_initializer, num_heads)
+                )
+                self._qkv_dense = EinsumDense(
+                    einsum_equation,
+                    output_shape=_get_output_shape(
+                        output_rank - 1, [sum(num_heads), self._size_per_head_for_query_and_key]
+                    ),
+                    bias_axes=bias_axes if self._use_bias else None,
+                    name='qkv',
+                    **fused_kwargs
+                )
+                self._query_dense = self._key_dense = self._value_dense = None
+            else:
+                self._qkv_dense = None
+                self._query_dense = EinsumDense(
+                    einsum_equation,
+                    output_shape=_get_output_shape(
+                        output_rank - 1,  # -1 是因为 batch_size
+                        [self._num_attention_heads, self._size_per_head_for_query_and_key]
+                    ),
+                    bias_axes=bias_axes if self._use_bias else None,
+                    name='query',
+                    **common_kwargs
+                )
+
+                # 构造 key dense
+                einsum_equation, bias_axes, output_rank = _build_projection_equation(
+                    key_shape.rank - 1, bound_dims=1, output_dims=2
+                )
+                self._key_dense = EinsumDense(
+                    einsum_equation,
+                    output_shape=_get_output_shape(
+                        output_rank - 1,
+                        [self._num_kv_heads, self._size_per_head_for_query_and_key]
+                    ),
+                    bias_axes=bias_axes if self._use_bias else None,
+                    name="key",
+                    **common_kwargs
+                )
+
+                # 构造 value dense
+                einsum_equation, bias_axes, output_rank = _build_projection_equation(
+                    value_shape.rank - 1,
+                    bound_dims=1,
+                    output_dims=2
+                )
+                self._value_dense = EinsumDense(
+                    einsum_equation,
+                    output_shape=_get_output_shape(
+                        output_rank - 1,
+                        [self._num_kv_heads, self._size_per_head_for_value]
+                    ),
+                    bias_axes=bias_axes if self._use_bias else None,
+                    name="value",
+                    **common_kwargs
+                )
 
             self.build_attention(output_rank)
 
@@ -286,11 +501,20 @@ class MultiHeadAttention(tf.keras.layers.Layer):
             range(attention_scores_rank - len(self._attention_axes), attention_scores_rank)
         )
         self._masked_softmax = masked_softmax_layer.MaskedSoftmax(
-            mask_expansion_axes=[1], normalization_axes=norm_axes
+            mask_expansion_axes=[1], normalization_axes=norm_axes, causal=self._causal
         )
         self._dropout_layer = tf.keras.layers.Dropout(rate=self._attention_dropout_rate)
 
     def compute_attention(self, query, key, value, training, attention_mask=None):
+        if self._attention_chunk_size is not None:
+            return self._compute_chunked_attention(
+                query, key, value, training=training, attention_mask=attention_mask
+            )
+        if self._num_kv_heads != self._num_attention_heads:
+            return self._compute_grouped_attention(
+                query, key, value, training=training, attention_mask=attention_mask
+            )
+
         # do scale
         # [batch_size, seq_len, num_heads, size_per_head]
         query = tf.multiply(query, 1.0 / math.sqrt(float(self._size_per_head_for_query_and_key)))
@@ -313,12 +537,233 @@ class MultiHeadAttention(tf.keras.layers.Layer):
         # return
         return attention_output, attention_scores
 
-    def call(self, query, value, training, key=None, attention_mask=None):
+    def _compute_grouped_attention(self, query, key, value, training, attention_mask=None):
+        """
+            grouped-query attention，第 h 个 query 头使用第 h // (num_attention_heads // num_kv_heads) 个 key / value 头
+
+        :param query: (batch_size, seq_len_q, num_heads, size_per_head)
+        :param key: (batch_size, seq_len_k, num_kv_heads, size_per_head)
+        :param value: (batch_size, seq_len_v, num_kv_heads, size_per_head_for_value)
+        """
+        group_size = self._num_attention_heads // self._num_kv_heads
+        query = tf.multiply(query, 1.0 / math.sqrt(float(self._size_per_head_for_query_and_key)))
+
+        # (batch_size, seq_len_q, num_kv_heads, group_size, size_per_head)
+        query = tf.reshape(
+            query,
+            tf.concat([tf.shape(query)[:2], [self._num_kv_heads, group_size, query.shape[-1]]], axis=0)
+        )
+        # (batch_size, num_kv_heads, group_size, seq_len_q, seq_len_k)
+        attention_scores = tf.einsum('bqgrd,bkgd->bgrqk', query, key)
+        # (batch_size, num_heads, seq_len_q, seq_len_k)
+        attention_scores = tf.reshape(
+            attention_scores,
+            tf.concat([[-1, self._num_attention_heads], tf.shape(attention_scores)[3:]], axis=0)
+        )
+
+        attention_scores = self._masked_softmax(attention_scores, attention_mask)
+
+        if training:
+            attention_scores = self._dropout_layer(attention_scores)
+
+        # (batch_size, seq_len_q, num_kv_heads, group_size, size_per_head_for_value)
+        attention_output = tf.einsum(
+            'bgrqk,bkgd->bqgrd',
+            tf.reshape(
+                attention_scores,
+                tf.concat([[-1, self._num_kv_heads, group_size], tf.shape(attention_scores)[2:]], axis=0)
+            ),
+            value
+        )
+        attention_output = tf.reshape(
+            attention_output,
+            tf.concat([tf.shape(attention_output)[:2], [self._num_attention_heads, value.shape[-1]]], axis=0)
+        )
+        return attention_output, attention_scores
+
+    def _compute_chunked_attention(self, query, key, value, training, attention_mask=None):
+        """
+            分块计算 attention，显存 / 内存与 seq_len_q * seq_len_k 无关
+
+            query 和 key 都按 attention_chunk_size 切分，对每个 query 块依次遍历 key 块，
+            使用 online softmax 累积结果：
+                m = max(m, max(s))
+                l = l * exp(m_old - m) + sum(exp(s - m))
+                o = o * exp(m_old - m) + exp(s - m) @ v
+            最后 o / l 即为 softmax(s) @ v，同一时刻只保存一个 (chunk_size, chunk_size) 的 attention score
+
+            训练时每个 query 块通过 tf.recompute_grad 在反向传播时重新计算，不保存中间的 attention score
+            dropout 使用由 seed 决定的 stateless 随机数，保证重新计算时的 dropout mask 与前向时相同
+
+            不足 attention_chunk_size 的部分补齐，补齐的 key 通过 mask 屏蔽
+            返回的 attention_scores 为 None
+
+        :param query: (batch_size, seq_len_q, num_heads, size_per_head)
+        :param key: (batch_size, seq_len_k, num_kv_heads, size_per_head)
+        :param value: (batch_size, seq_len_k, num_kv_heads, size_per_head_for_value)
+        :param attention_mask: (batch_size, seq_len_q or 1, seq_len_k)
+        """
+        chunk_size = self._attention_chunk_size
+        group_size = self._num_attention_heads // self._num_kv_heads
+        dropout_rate = self._attention_dropout_rate if training else 0.0
+
+        query = tf.multiply(query, 1.0 / math.sqrt(float(self._size_per_head_for_query_and_key)))
+        query_shape = tf.shape(query)
+        batch_size, seq_len_q = query_shape[0], query_shape[1]
+        seq_len_k = tf.shape(key)[1]
+
+        if attention_mask is None:
+            attention_mask = tf.zeros([batch_size, 1, seq_len_k], dtype=query.dtype)
+        attention_mask = tf.cast(attention_mask, query.dtype)
+        # 补齐的 key 被 mask
+        attention_mask = _pad_to_multiple(attention_mask, axis=2, multiple=chunk_size, constant_values=1)
+        key = _pad_to_multiple(key, axis=1, multiple=chunk_size)
+        value = _pad_to_multiple(value, axis=1, multiple=chunk_size)
+        query = _pad_to_multiple(query, axis=1, multiple=chunk_size)
+        num_query_chunks = tf.shape(query)[1] // chunk_size
+
+        # (num_query_chunks, batch_size, chunk_size, num_kv_heads, group_size, size_per_head)
+        query_chunks = tf.transpose(
+            tf.reshape(
+                query,
+                [batch_size, num_query_chunks, chunk_size, self._num_kv_heads, group_size, query.shape[-1]]
+            ),
+            [1, 0, 2, 3, 4, 5]
+        )
+        # (num_query_chunks, batch_size, chunk_size or 1, seq_len_k)
+        if attention_mask.shape[1] == 1:
+            mask_chunks = tf.tile(attention_mask[tf.newaxis], [num_query_chunks, 1, 1, 1])
+        else:
+            attention_mask = tf.broadcast_to(attention_mask, [batch_size, seq_len_q, tf.shape(attention_mask)[2]])
+            attention_mask = _pad_to_multiple(attention_mask, axis=1, multiple=chunk_size)
+            mask_chunks = tf.transpose(
+                tf.reshape(attention_mask, [batch_size, num_query_chunks, chunk_size, -1]),
+                [1, 0, 2, 3]
+            )
+
+        if dropout_rate > 0:
+            seed = tf.random.uniform([2], maxval=tf.int32.max, dtype=tf.int32)
+        else:
+            seed = tf.zeros([2], dtype=tf.int32)
+        # 每个 query 块使用不同的 seed
+        seeds = seed + tf.stack([tf.range(num_query_chunks), tf.zeros([num_query_chunks], tf.int32)], axis=1)
+
+        # causal 时每个 query 块第一个 query 对应的 key 位置
+        query_starts = tf.range(num_query_chunks) * chunk_size + (seq_len_k - seq_len_q)
+
+        def attend(elems):
+            query_chunk, mask_chunk, chunk_seed, query_start = elems
+            # seed 和 query_start 不需要梯度，不作为 recompute_grad 的输入
+            return tf.recompute_grad(
+                lambda query_chunk, mask_chunk, key, value: _attend_query_chunk(
+                    query_chunk, mask_chunk, key, value, chunk_seed, chunk_size, dropout_rate,
+                    query_start=query_start if self._causal else None
+                )
+            )(query_chunk, mask_chunk, key, value)
+
+        # (num_query_chunks, batch_size, chunk_size, num_kv_heads, group_size, size_per_head_for_value)
+        attention_output = tf.map_fn(
+            attend, (query_chunks, mask_chunks, seeds, query_starts), fn_output_signature=query.dtype
+        )
+
+        # (batch_size, seq_len_q, num_heads, size_per_head_for_value)
+        attention_output = tf.transpose(attention_output, [1, 0, 2, 3, 4, 5])
+        attention_output = tf.reshape(
+            attention_output,
+            [batch_size, num_query_chunks * chunk_size, self._num_attention_heads, value.shape[-1]]
+        )
+        return attention_output[:, :seq_len_q], None
+
+    def _get_qkv_num_heads(self):
+        return [self._num_attention_heads, self._num_kv_heads, self._num_kv_heads]
+
+    def _can_fuse_qkv_projection(self, query, value, key):
+        return self._qkv_dense is not None and query is value and (key is None or key is value)
+
+    def _project_qkv(self, inputs, layer_index=None):
+        """
+            self attention 时 query、key、value 的投影合并为一次
+
+            合并投影的 kernel 为 (hidden_size, num_heads + 2 * num_kv_heads, size_per_head)，
+            与 inputs 相乘一次后再按头所在的维度拆分
+
+        :param inputs: (batch_size, seq_len, hidden_size)
+        :param layer_index: 投影的权重为多层 stacked 的权重时使用的层，见 layers.utils.stacked_variable_creator
+        :return: query: (batch_size, seq_len, num_heads, size_per_head)
+                 key / value: (batch_size, seq_len, num_kv_heads, size_per_head)
+        """
+        return tf.split(self._qkv_dense(inputs, layer_index=layer_index), self._get_qkv_num_heads(), axis=-2)
+
+    def _project(self, inputs, index, layer_index=None):
+        """
+            query (index 为 0)、key (1) 或 value (2) 的投影
+
+            使用合并投影时 (例如 self attention 的层单独计算 query 或 key / value)，只使用合并投影中对应的部分
+        """
+        if self._qkv_dense is None:
+            return (self._query_dense, self._key_dense, self._value_dense)[index](inputs, layer_index=layer_index)
+
+        if not self._qkv_dense.built:
+            # 与直接调用时相同，变量创建在合并投影的 name scope 下
+            with tf.name_scope(self._qkv_dense.name):
+                self._qkv_dense.build(inputs.shape)
+        num_heads = self._get_qkv_num_heads()
+        start = sum(num_heads[:index])
+        kernel = utils.get_layer_weight(self._qkv_dense.kernel, layer_index)[:, start:start + num_heads[index]]
+        outputs = tf.einsum(self._qkv_dense.equation, inputs, tf.cast(kernel, inputs.dtype))
+        if self._use_bias:
+            bias = utils.get_layer_weight(self._qkv_dense.bias, layer_index)[start:start + num_heads[index]]
+            outputs += tf.cast(bias, inputs.dtype)
+        return outputs
+
+    def project_key_value(self, query, value, key=None, layer_index=None):
+        """
+            只计算 key 和 value 的投影
+
+            在解码时 encoder-decoder attention 的 key / value 来自 encoder 输出，在每一步都不变
+            可以预先计算一次并放入 cache，之后通过 call 的 projected_key / projected_value 传入
+
+        :param query: query Tensor or TensorShape，仅用于构建 layer
+        :param value: (batch_size, seq_len_v, hidden_size_v)
+        :param key: (batch_size, seq_len_k, hidden_size_k) if not given, will use value
+        :param layer_index: 权重为多层 stacked 的权重时使用的层，见 layers.utils.stacked_variable_creator
+        :return: key: (batch_size, seq_len_k, num_heads, size_per_head_for_query_and_key)
+                 value: (batch_size, seq_len_v, num_heads, size_per_head_for_value)
+        """
+        # 不经过 __call__ 调用，需要手动进入该层的 name scope
+        with tf.name_scope(self.name):
+            if not self._built_from_signature:
+                self._build_from_signature(query=query, value=value, key=key)
+            if key is None:
+                key = value
+
+            return self._project(key, 1, layer_index), self._project(value, 2, layer_index)
+
+    def call(
+            self,
+            query,
+            value,
+            training,
+            key=None,
+            attention_mask=None,
+            projected_key=None,
+            projected_value=None,
+            token_indices=None,
+            layer_index=None
+    ):
         """
         :param query: (batch_size, seq_len_q, hidden_size_q)
         :param value: (batch_size, seq_len_v, hidden_size_v)
         :param key: (batch_size, seq_len_k, hidden_size_k) if not given, will use value
         :param attention_mask: (batch_size, seq_len_q or 1, seq_len_v)
+        :param projected_key: 由 project_key_value 预先计算的 key 投影，给定时跳过 key 的投影
+        :param projected_value: 由 project_key_value 预先计算的 value 投影，给定时跳过 value 的投影
+        :param token_indices: 不为 None 时为去掉 padding 的 self attention，见 utils.pack_tokens
+            query / key / value 为 (1, num_tokens, hidden_size)，token_indices 为 (num_tokens, 2)，
+            attention_mask 仍为 (batch_size, 1 or seq_len, seq_len)
+            投影只对 num_tokens 个 token 计算，只有 compute_attention 时按 attention_mask 的形状恢复 padding
+        :param layer_index: 不为 None 时投影的权重为多层 stacked 的权重 (num_layers, ...)，只使用其中第 layer_index 层，
+            用于 scan_layers 时结构相同的多层共用一个层对象，见 layers.utils.stacked_variable_creator
         :return: [batch_size, seq_len_q, output_shape]
         """
         # 为了加快运算速度，这里使用了自定义的运算
@@ -326,28 +771,105 @@ class MultiHeadAttention(tf.keras.layers.Layer):
         # _build_from_signature 就是在构造自定义点积运算
         if not self._built_from_signature:
             self._build_from_signature(query=query, value=value, key=key)
-        if key is None:
-            key = value
+        if projected_key is None and projected_value is None and self._can_fuse_qkv_projection(query, value, key):
+            query, key, value = self._project_qkv(query, layer_index)
+        else:
+            if key is None:
+                key = value
 
-        # (batch_size, seq_len_q, num_heads, size_per_head_for_query_and_key)
-        query = self._query_dense(query)
+            # (batch_size, seq_len_q, num_heads, size_per_head_for_query_and_key)
+            query = self._project(query, 0, layer_index)
 
-        # (batch_size, seq_len_k, num_heads, size_per_head_for_query_and_key)
-        key = self._key_dense(key)
+            # (batch_size, seq_len_k, num_heads, size_per_head_for_query_and_key)
+            if projected_key is None:
+                key = self._project(key, 1, layer_index)
+            else:
+                key = projected_key
 
-        # (batch_size, seq_len_v, num_heads, size_per_head_for_value)
-        value = self._value_dense(value)
+            # (batch_size, seq_len_v, num_heads, size_per_head_for_value)
+            if projected_value is None:
+                value = self._project(value, 2, layer_index)
+            else:
+                value = projected_value
+
+        if token_indices is not None:
+            batch_size, seq_len = tf.shape(attention_mask)[0], tf.shape(attention_mask)[2]
+            query, key, value = [
+                utils.unpack_tokens(tensor, token_indices, batch_size, seq_len) for tensor in (query, key, value)
+            ]
 
         attention_output, attention_scores = self.compute_attention(
             query, key, value, training=training, attention_mask=attention_mask
         )
-        attention_output = self._output_dense(attention_output)
+        if token_indices is not None:
+            attention_output = utils.pack_tokens(attention_output, token_indices)
+        attention_output = self._output_dense(attention_output, layer_index=layer_index)
 
         if self._return_attention_scores:
             return attention_output, attention_scores
         return attention_output
 
 
+def quantize(tensor):
+    """
+        按最后一维对称量化为 int8，每个 (batch, position, head) 使用一个 scale
+
+    :param tensor: (batch_size, seq_len, num_heads, size_per_head)
+    :return: quantized: (batch_size, seq_len, num_heads, size_per_head) int8
+             scale: (batch_size, seq_len, num_heads)
+    """
+    scale = tf.reduce_max(tf.abs(tensor), axis=-1) / 127.0
+    # 全 0 的向量 scale 为 0，避免除以 0
+    safe_scale = tf.where(scale > 0, scale, tf.ones_like(scale))
+    quantized = tf.clip_by_value(tf.round(tensor / safe_scale[..., tf.newaxis]), -127.0, 127.0)
+    return tf.cast(quantized, tf.int8), scale
+
+
+def dequantize(quantized, scale):
+    """quantize 的逆操作，返回 scale 的 dtype"""
+    return tf.cast(quantized, scale.dtype) * scale[..., tf.newaxis]
+
+
+def gather_indirect(tensor, cache_indirection):
+    """
+        按 cache_indirection 读取 cache，每个 beam 在每个位置读取该位置的内容所在的行
+
+    :param tensor: (batch_size * beam_size, max_decode_len, ...)，第 j 行固定属于第 j 个 beam 位置
+    :param cache_indirection: (batch_size, beam_size, max_decode_len)
+    :return: (batch_size * beam_size, max_decode_len, ...)
+    """
+    beam_size = cache_indirection.shape[1]
+    shape = tf.shape(tensor)
+    max_decode_len = shape[1]
+    # (batch_size, beam_size * max_decode_len, ...)
+    tensor = tf.reshape(tensor, tf.concat([[-1, beam_size * max_decode_len], shape[2:]], axis=0))
+    # 第 j 个 beam 在位置 t 读取 cache_indirection[b, j, t] 行的位置 t
+    # (batch_size, beam_size, max_decode_len)
+    indices = tf.cast(cache_indirection, tf.int32) * max_decode_len + tf.range(max_decode_len)
+    return tf.reshape(tf.gather(tensor, indices, batch_dims=1), shape)
+
+
+def create_cache(batch_size, seq_len, num_heads, size_per_head, dtype=tf.float32, quantized=False):
+    """
+        创建 CacheAttention 使用的空 cache
+
+    :param seq_len: 动态模式下为 0，预分配模式下为 max_decode_len
+    :param quantized: 是否使用 int8 量化的 cache，key / value 为 int8，另外保存每个位置每个头的 scale
+    """
+    shape = [batch_size, seq_len, num_heads, size_per_head]
+    if not quantized:
+        return {
+            'key': tf.zeros(shape, dtype=dtype),
+            'value': tf.zeros(shape, dtype=dtype)
+        }
+    return {
+        'key': tf.zeros(shape, dtype=tf.int8),
+        'value': tf.zeros(shape, dtype=tf.int8),
+        'key_scale': tf.zeros(shape[:-1], dtype=dtype),
+        'value_scale': tf.zeros(shape[:-1], dtype=dtype)
+    }
+
+
 class CacheAttention(MultiHeadAttention):
     """
         用于自回归解码器的 Attention
@@ -360,23 +882,150 @@ class CacheAttention(MultiHeadAttention):
                 'key': (batch_size, seq_len_key, num_heads, hidden_size),
                 'value': (batch_size, seq_len_value, num_heads, hidden_size)
             }
-        其中 decoded_len 会随着解码的进行不断增加
-        初始情况下应该使用 tf.zeros 初始化，表示 [START]
+
+        cache 有两种模式：
+            1. 动态模式 (decode_loop_step is None)
+               初始时 seq_len 为 0，每解码一步通过 concat 增加一个位置
+               第 i 步需要拷贝之前的 i 个位置，整体内存开销为 O(n^2)
+            2. 预分配模式 (decode_loop_step 为当前解码步)
+               初始时就分配好 (batch_size, max_decode_len, num_heads, hidden_size) 的 tf.zeros
+               每一步只按下标写入当前位置，cache 的形状在整个解码过程中保持不变
+               此时 attention_mask 需要覆盖整个 max_decode_len，屏蔽尚未解码的位置
+               decode_loop_step 可以是标量，也可以是 (batch_size,)，后者用于各个样本解码进度不同的场景
+
+        预分配模式下还可以通过 cache_indirection 间接读取 cache，用于 beam search：
+            cache 的第 j 行固定属于第 j 个 beam 位置，beam 重排时不移动 cache
+            cache_indirection (batch_size, beam_size, max_decode_len) 给出每个 beam 在每个位置的内容所在的行
+            计算 attention 前按 cache_indirection 读取每个位置所在的行 (见 gather_indirect)，
+            计算量与直接使用 cache 相同，cache 本身不需要随 beam 重排
+
+        cache 也可以是 int8 量化的 (见 create_cache)：
+            {
+                'key': (batch_size, seq_len_key, num_heads, hidden_size) int8,
+                'value': (batch_size, seq_len_value, num_heads, hidden_size) int8,
+                'key_scale': (batch_size, seq_len_key, num_heads),
+                'value_scale': (batch_size, seq_len_value, num_heads)
+            }
+            新的 key / value 量化后写入 cache，attention 直接在 int8 cache 上计算，
+            key 的 scale 乘到 attention score 上，value 的 scale 乘到 attention 概率上，不反量化整个 cache
+            cache 占用的内存约为原来的 1/4 (float32) 或 1/2 (float16)
+
+        使用 num_kv_heads 时 cache 中的 num_heads 为 num_kv_heads
     """
     def _update_cache(
             self,
             key,
             value,
-            cache
+            cache,
+            decode_loop_step=None
     ):
-        key = tf.concat([tf.cast(cache['key'], key.dtype), key], axis=1)
-        value = tf.concat([tf.cast(cache['value'], value.dtype), value], axis=1)
+        if 'key_scale' in cache:
+            return self._update_quantized_cache(key, value, cache, decode_loop_step)
+
+        if decode_loop_step is not None:
+            # (batch_size, 2)
+            # 每个样本要写入的坐标为 (batch_index, decode_loop_step)
+            # decode_loop_step 也可以是 (batch_size,)，此时每个样本写入各自的位置
+            batch_size = tf.shape(key)[0]
+            indices = tf.stack(
+                [tf.range(batch_size), tf.broadcast_to(decode_loop_step, [batch_size])],
+                axis=1
+            )
+
+            # 当前步只有一个位置：(batch_size, 1, num_heads, size) -> (batch_size, num_heads, size)
+            key = tf.tensor_scatter_nd_update(
+                tf.cast(cache['key'], key.dtype), indices, key[:, 0]
+            )
+            value = tf.tensor_scatter_nd_update(
+                tf.cast(cache['value'], value.dtype), indices, value[:, 0]
+            )
+        else:
+            key = tf.concat([tf.cast(cache['key'], key.dtype), key], axis=1)
+            value = tf.concat([tf.cast(cache['value'], value.dtype), value], axis=1)
 
         cache['key'] = key
         cache['value'] = value
 
         return key, value
 
+    def _update_quantized_cache(self, key, value, cache, decode_loop_step=None):
+        """将新的 key / value 量化后写入 cache，返回 int8 的整个 cache，scale 在计算 attention 时使用"""
+        for name, tensor in [('key', key), ('value', value)]:
+            quantized, scale = quantize(tensor)
+            scale = tf.cast(scale, cache[name + '_scale'].dtype)
+            if decode_loop_step is not None:
+                batch_size = tf.shape(tensor)[0]
+                indices = tf.stack(
+                    [tf.range(batch_size), tf.broadcast_to(decode_loop_step, [batch_size])],
+                    axis=1
+                )
+                cache[name] = tf.tensor_scatter_nd_update(cache[name], indices, quantized[:, 0])
+                cache[name + '_scale'] = tf.tensor_scatter_nd_update(
+                    cache[name + '_scale'], indices, scale[:, 0]
+                )
+            else:
+                cache[name] = tf.concat([cache[name], quantized], axis=1)
+                cache[name + '_scale'] = tf.concat([cache[name + '_scale'], scale], axis=1)
+
+        return cache['key'], cache['value']
+
+    def _compute_quantized_attention(
+            self, query, key, value, key_scale, value_scale, training, attention_mask=None
+    ):
+        """
+            直接在 int8 cache 上计算 attention，不生成反量化后的 key / value
+            key 的 scale 乘到 attention score 上：q · (k * s_k) = (q · k) * s_k
+            value 的 scale 乘到 attention 概率上：sum_t p_t * (v_t * s_v_t) = sum_t (p_t * s_v_t) * v_t
+            int8 只在 einsum 的输入处转换为计算的类型 (einsum 没有 int8 的实现)
+
+        :param query: (batch_size, seq_len_q, num_heads, size_per_head)
+        :param key: (batch_size, seq_len_k, num_kv_heads, size_per_head) int8
+        :param value: (batch_size, seq_len_k, num_kv_heads, size_per_head_for_value) int8
+        :param key_scale: (batch_size, seq_len_k, num_kv_heads)
+        :param value_scale: (batch_size, seq_len_k, num_kv_heads)
+        """
+        dtype = query.dtype
+        group_size = self._num_attention_heads // self._num_kv_heads
+        query = tf.multiply(query, 1.0 / math.sqrt(float(self._size_per_head_for_query_and_key)))
+
+        # query 头按 key / value 头分组，没有分组时 group_size 为 1
+        # (batch_size, seq_len_q, num_kv_heads, group_size, size_per_head)
+        query = tf.reshape(
+            query,
+            tf.concat([tf.shape(query)[:2], [self._num_kv_heads, group_size, query.shape[-1]]], axis=0)
+        )
+        # (batch_size, num_kv_heads, 1, 1, seq_len_k)
+        key_scale, value_scale = [
+            tf.transpose(tf.cast(scale, dtype), [0, 2, 1])[:, :, tf.newaxis, tf.newaxis]
+            for scale in [key_scale, value_scale]
+        ]
+
+        # (batch_size, num_kv_heads, group_size, seq_len_q, seq_len_k)
+        attention_scores = tf.einsum('bqgrd,bkgd->bgrqk', query, tf.cast(key, dtype)) * key_scale
+        # (batch_size, num_heads, seq_len_q, seq_len_k)
+        attention_scores = tf.reshape(
+            attention_scores,
+            tf.concat([[-1, self._num_attention_heads], tf.shape(attention_scores)[3:]], axis=0)
+        )
+
+        attention_scores = self._masked_softmax(attention_scores, attention_mask)
+
+        if training:
+            attention_scores = self._dropout_layer(attention_scores)
+
+        # (batch_size, num_kv_heads, group_size, seq_len_q, seq_len_k)
+        weights = tf.reshape(
+            attention_scores,
+            tf.concat([[-1, self._num_kv_heads, group_size], tf.shape(attention_scores)[2:]], axis=0)
+        ) * value_scale
+        # (batch_size, seq_len_q, num_kv_heads, group_size, size_per_head_for_value)
+        attention_output = tf.einsum('bgrqk,bkgd->bqgrd', weights, tf.cast(value, dtype))
+        attention_output = tf.reshape(
+            attention_output,
+            tf.concat([tf.shape(attention_output)[:2], [self._num_attention_heads, value.shape[-1]]], axis=0)
+        )
+        return attention_output, attention_scores
+
     def call(
             self,
             query,
@@ -384,34 +1033,52 @@ class CacheAttention(MultiHeadAttention):
             training,
             key=None,
             attention_mask=None,
-            cache=None
+            cache=None,
+            decode_loop_step=None,
+            cache_indirection=None,
+            layer_index=None
     ):
+        """
+        :param decode_loop_step: 预分配 cache 模式下当前的解码步，为 None 时使用 concat 增长 cache
+        :param cache_indirection: (batch_size, beam_size, max_decode_len)，不为 None 时通过它间接读取 cache
+        :param layer_index: 权重为多层 stacked 的权重时使用的层，见 MultiHeadAttention.call
+        """
         if not self._built_from_signature:
             self._build_from_signature(query=query, value=value, key=key)
-        if key is None:
-            key = value
+        if self._can_fuse_qkv_projection(query, value, key):
+            query, key, value = self._project_qkv(query, layer_index)
+        else:
+            if key is None:
+                key = value
 
-        query = self._query_dense(query)
+            query = self._project(query, 0, layer_index)
 
-        key = self._key_dense(key)
+            key = self._project(key, 1, layer_index)
 
-        value = self._value_dense(value)
+            value = self._project(value, 2, layer_index)
 
         if cache:
-            key, value = self._update_cache(key, value, cache)
-
-        query = tf.multiply(query, 1.0 / math.sqrt(float(self._size_per_head_for_query_and_key)))
+            key, value = self._update_cache(key, value, cache, decode_loop_step)
 
-        attention_scores = tf.einsum(self._dot_product_equation, key, query)
+        # int8 cache 的 scale
+        scales = [cache['key_scale'], cache['value_scale']] if cache and 'key_scale' in cache else None
 
-        attention_scores = self._masked_softmax(attention_scores, attention_mask)
+        if cache_indirection is not None:
+            key = gather_indirect(key, cache_indirection)
+            value = gather_indirect(value, cache_indirection)
+            if scales is not None:
+                scales = [gather_indirect(scale, cache_indirection) for scale in scales]
 
-        if training:
-            attention_scores = self._dropout_layer(attention_scores)
-
-        attention_output = tf.einsum(self._combine_equation, attention_scores, value)
+        if scales is not None:
+            attention_output, attention_scores = self._compute_quantized_attention(
+                query, key, value, scales[0], scales[1], training=training, attention_mask=attention_mask
+            )
+        else:
+            attention_output, attention_scores = self.compute_attention(
+                query, key, value, training=training, attention_mask=attention_mask
+            )
 
-        attention_output = self._output_dense(attention_output)
+        attention_output = self._output_dense(attention_output, layer_index=layer_index)
 
         if self._return_attention_scores:
             return attention_output, attention_scores, cache
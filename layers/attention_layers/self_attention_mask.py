@@ -5,12 +5,23 @@ from layers import utils
 
 
 class SelfAttentionMask(tf.keras.layers.Layer):
+    """
+        由 key 的 padding mask 构造 self attention 的 mask
+
+        compact 为 False 时返回完整的 (batch_size, seq_len_from, seq_len_to) mask，每一行都相同
+        compact 为 True 时只返回 (batch_size, 1, seq_len_to) 的 bool mask，
+        由 MaskedSoftmax 在与 attention score 相加时 broadcast，不需要为每一层保存 O(batch_size * seq_len ^ 2) 的 mask
+    """
+    def __init__(self, compact=False, **kwargs):
+        super(SelfAttentionMask, self).__init__(**kwargs)
+        self._compact = compact
+
     def call(self, inputs):
 
         # (batch_size, seq_len_from, hidden_size)
         from_tensor = inputs[0]
 
-        # (batch_size, seq_len_from, seq_len_to)
+        # (batch_size, seq_len_to)
         to_mask = inputs[1]
 
         from_shape = utils.get_shape_list(from_tensor, expected_rank=[2, 3])
@@ -20,6 +31,9 @@ class SelfAttentionMask(tf.keras.layers.Layer):
         to_shape = utils.get_shape_list(to_mask, expected_rank=2)
         to_seq_len = to_shape[1]
 
+        if self._compact:
+            return tf.cast(tf.reshape(to_mask, [batch_size, 1, to_seq_len]), dtype=tf.bool)
+
         to_mask = tf.cast(
             tf.reshape(to_mask, [batch_size, 1, to_seq_len]),
             dtype=from_tensor.dtype
@@ -30,4 +44,11 @@ class SelfAttentionMask(tf.keras.layers.Layer):
         )
         mask = broadcast_ones * to_mask
 
-        return mask
\ No newline at end of file
+        return mask
+
+    def get_config(self):
+        config = {
+            'compact': self._compact
+        }
+        base_config = super(SelfAttentionMask, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
@@ -0,0 +1,156 @@
+# -*- coding: utf - 8 -*-
+
+import math
+import numpy as np
+import tensorflow as tf
+from layers.attention_layers.multi_head_attention_layer import MultiHeadAttention
+from layers.attention_layers.multi_head_attention_layer import _pad_to_multiple
+
+
+def _sliding_blocks(tensor, block_size, constant_values=0):
+    """
+        把 seq_len 维切分为块，每个块与前后相邻的块拼接
+
+    :param tensor: (batch_size, seq_len, ...)，seq_len 为 block_size 的整数倍
+    :return: (batch_size, num_blocks, 3 * block_size, ...)，第一块之前和最后一块之后用 constant_values 填充
+    """
+    blocks = tf.reshape(
+        tensor, tf.concat([[tf.shape(tensor)[0], -1, block_size], tf.shape(tensor)[2:]], axis=0)
+    )
+    paddings = [[0, 0] for _ in range(blocks.shape.rank)]
+    paddings[1] = [1, 1]
+    blocks = tf.pad(blocks, paddings, constant_values=constant_values)
+    return tf.concat([blocks[:, :-2], blocks[:, 1:-1], blocks[:, 2:]], axis=2)
+
+
+class SlidingWindowAttention(MultiHeadAttention):
+    """
+        局部窗口 + 全局 token 的稀疏 self attention (Longformer)
+
+        1. 每个 token 只与前后各 window_size 个 token 计算 attention
+        2. 前 num_global_tokens 个 token (例如 [CLS]) 为全局 token：
+           所有 token 都会与全局 token 计算 attention，全局 token 与所有 token 计算 attention
+
+        局部窗口按块计算：序列切分为长度为 window_size 的块，每个块的 query 只与相邻的三个块的 key 计算，
+        attention score 为 (batch_size, num_heads, num_blocks, window_size, 3 * window_size + num_global_tokens)
+        计算量和内存与 seq_len 成线性关系，而不是构造 (seq_len, seq_len) 的 mask
+
+        投影的权重与 MultiHeadAttention 相同，可以直接加载普通 self attention 的 checkpoint
+        attention_mask 只使用 key 的 padding 信息 (第一行)，即 (batch_size, 1 or seq_len, seq_len) 中的 [:, 0]
+        只支持 self attention，不支持 num_kv_heads、attention_chunk_size、attention_axes、causal 和返回 attention score
+    """
+    def __init__(
+            self,
+            num_attention_heads,
+            size_per_head_for_query_and_key,
+            window_size,
+            num_global_tokens=1,
+            **kwargs
+    ):
+        """
+        :param window_size: 每个 token 向前、向后各看 window_size 个 token，同时也是分块的大小
+        :param num_global_tokens: 序列开头的全局 token 数
+        """
+        super(SlidingWindowAttention, self).__init__(
+            num_attention_heads=num_attention_heads,
+            size_per_head_for_query_and_key=size_per_head_for_query_and_key,
+            **kwargs
+        )
+        if (
+            self._num_kv_heads != self._num_attention_heads
+            or self._attention_chunk_size is not None
+            or self._attention_axes is not None
+            or self._return_attention_scores
+            or self._causal
+        ):
+            raise ValueError(
+                'SlidingWindowAttention does not support num_kv_heads, attention_chunk_size, '
+                'attention_axes, return_attention_scores or causal'
+            )
+        self._window_size = window_size
+        self._num_global_tokens = num_global_tokens
+
+        # 块内第 i 个 query 与相邻三个块中第 j 个 key 的距离为 j - window_size - i
+        distance = np.arange(3 * window_size)[np.newaxis, :] - window_size - np.arange(window_size)[:, np.newaxis]
+        # (window_size, 3 * window_size)，1 为 mask
+        self._band_mask = (np.abs(distance) > window_size).astype(np.float32)
+
+    def compute_attention(self, query, key, value, training, attention_mask=None):
+        """
+        :param query: (batch_size, seq_len, num_heads, size_per_head)
+        :param key: (batch_size, seq_len, num_heads, size_per_head)
+        :param value: (batch_size, seq_len, num_heads, size_per_head_for_value)
+        :param attention_mask: (batch_size, seq_len or 1, seq_len)
+        :return: (batch_size, seq_len, num_heads, size_per_head_for_value), None
+        """
+        window_size = self._window_size
+        query = tf.multiply(query, 1.0 / math.sqrt(float(self._size_per_head_for_query_and_key)))
+        batch_size, seq_len = tf.shape(query)[0], tf.shape(query)[1]
+        num_global_tokens = tf.minimum(self._num_global_tokens, seq_len)
+
+        # (batch_size, seq_len)，1 为 mask
+        if attention_mask is None:
+            key_mask = tf.zeros([batch_size, seq_len], dtype=query.dtype)
+        else:
+            key_mask = tf.cast(attention_mask[:, 0], query.dtype)
+        global_key = key[:, :num_global_tokens]
+        global_value = value[:, :num_global_tokens]
+        global_key_mask = key_mask[:, :num_global_tokens]
+
+        # 全局 token 单独计算，在局部窗口中被 mask，避免重复
+        local_key_mask = tf.maximum(
+            key_mask,
+            tf.cast(tf.range(seq_len) < num_global_tokens, query.dtype)[tf.newaxis]
+        )
+        local_key_mask = _pad_to_multiple(local_key_mask, axis=1, multiple=window_size, constant_values=1)
+        # (batch_size, num_blocks, 3 * window_size)
+        local_key_mask = _sliding_blocks(local_key_mask, window_size, constant_values=1)
+
+        # (batch_size, num_blocks, window_size, num_heads, size_per_head)
+        query_blocks = _pad_to_multiple(query, axis=1, multiple=window_size)
+        query_blocks = tf.reshape(
+            query_blocks, [batch_size, -1, window_size, self._num_attention_heads, query.shape[-1]]
+        )
+        # (batch_size, num_blocks, 3 * window_size, num_heads, size_per_head)
+        key_blocks = _sliding_blocks(_pad_to_multiple(key, axis=1, multiple=window_size), window_size)
+        value_blocks = _sliding_blocks(_pad_to_multiple(value, axis=1, multiple=window_size), window_size)
+
+        # (batch_size, num_heads, num_blocks, window_size, 3 * window_size)
+        local_mask = tf.maximum(
+            tf.cast(self._band_mask, query.dtype)[tf.newaxis, tf.newaxis, tf.newaxis],
+            local_key_mask[:, tf.newaxis, :, tf.newaxis, :]
+        )
+        local_scores = tf.einsum('bnqhd,bnkhd->bhnqk', query_blocks, key_blocks) + local_mask * -10000.0
+        # (batch_size, num_heads, num_blocks, window_size, num_global_tokens)
+        global_scores = tf.einsum('bnqhd,bkhd->bhnqk', query_blocks, global_key) + \
+            global_key_mask[:, tf.newaxis, tf.newaxis, tf.newaxis, :] * -10000.0
+
+        attention_scores = tf.nn.softmax(tf.concat([global_scores, local_scores], axis=-1), axis=-1)
+        if training:
+            attention_scores = self._dropout_layer(attention_scores)
+
+        # (batch_size, num_blocks, window_size, num_heads, size_per_head_for_value)
+        attention_output = tf.einsum(
+            'bhnqk,bkhd->bnqhd', attention_scores[..., :num_global_tokens], global_value
+        ) + tf.einsum(
+            'bhnqk,bnkhd->bnqhd', attention_scores[..., num_global_tokens:], value_blocks
+        )
+        # (batch_size, seq_len, num_heads, size_per_head_for_value)
+        attention_output = tf.reshape(
+            attention_output, [batch_size, -1, self._num_attention_heads, value.shape[-1]]
+        )[:, :seq_len]
+
+        if self._num_global_tokens > 0:
+            # 全局 token 与所有 token 计算 attention
+            # (batch_size, num_heads, num_global_tokens, seq_len)
+            global_attention_scores = tf.einsum('bqhd,bkhd->bhqk', query[:, :num_global_tokens], key) + \
+                key_mask[:, tf.newaxis, tf.newaxis, :] * -10000.0
+            global_attention_scores = tf.nn.softmax(global_attention_scores, axis=-1)
+            if training:
+                global_attention_scores = self._dropout_layer(global_attention_scores)
+            global_attention_output = tf.einsum('bhqk,bkhd->bqhd', global_attention_scores, value)
+            attention_output = tf.concat(
+                [global_attention_output, attention_output[:, num_global_tokens:]], axis=1
+            )
+
+        return attention_output, None
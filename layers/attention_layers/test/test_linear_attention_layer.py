@@ -0,0 +1,116 @@
+# -*- coding: utf - 8 -*-
+
+import numpy as np
+import tensorflow as tf
+from absl.testing import parameterized
+from layers.attention_layers import linear_attention_layer
+from layers.attention_layers.multi_head_attention_layer import MultiHeadAttention
+
+
+class LinearAttentionTest(tf.test.TestCase, parameterized.TestCase):
+
+    @parameterized.parameters('elu', 'random')
+    def test_padding_mask(self, feature_map):
+        test_layer = linear_attention_layer.LinearAttention(
+            num_attention_heads=2, size_per_head_for_query_and_key=4, feature_map=feature_map
+        )
+        query = tf.random.normal([2, 3, 8])
+        value = tf.random.normal([2, 5, 8])
+        mask = np.zeros([2, 1, 5], dtype=np.float32)
+        mask[:, :, 3:] = 1
+
+        # 被 mask 的 key / value 不影响输出
+        output = test_layer(query, value, attention_mask=mask, training=False)
+        self.assertEqual([2, 3, 8], output.shape.as_list())
+        changed_value = tf.concat([value[:, :3], tf.random.normal([2, 2, 8])], axis=1)
+        self.assertAllClose(output, test_layer(query, changed_value, attention_mask=mask, training=False))
+        self.assertAllClose(output, test_layer(query, value[:, :3], training=False))
+
+    @parameterized.parameters('elu', 'random')
+    def test_causal_with_cache(self, feature_map):
+        test_layer = linear_attention_layer.CacheLinearAttention(
+            num_attention_heads=2, size_per_head_for_query_and_key=4, feature_map=feature_map
+        )
+        inputs = tf.random.normal([2, 6, 8])
+        output, _ = test_layer(inputs, inputs, training=False)
+
+        # 之后的位置不影响之前的输出
+        changed_inputs = tf.concat([inputs[:, :4], tf.random.normal([2, 2, 8])], axis=1)
+        changed_output, _ = test_layer(changed_inputs, changed_inputs, training=False)
+        self.assertAllClose(output[:, :4], changed_output[:, :4])
+
+        # 逐步解码时 cache 的大小不变，结果与一次计算整个序列相同
+        cache = linear_attention_layer.create_cache(2, 2, 4, test_layer.feature_size)
+        for i in range(6):
+            step_output, cache = test_layer(inputs[:, i:i + 1], inputs[:, i:i + 1], training=False, cache=cache)
+            self.assertAllClose(output[:, i:i + 1], step_output)
+        self.assertEqual([2, 2, test_layer.feature_size, 4], cache['key_value_sum'].shape.as_list())
+        self.assertEqual([2, 2, test_layer.feature_size], cache['key_sum'].shape.as_list())
+
+    @parameterized.parameters(1, 3, 7, 16)
+    def test_causal_chunks(self, chunk_size):
+        query_features = tf.random.uniform([2, 7, 2, 3])
+        key_features = tf.random.uniform([2, 7, 2, 3])
+        value = tf.random.normal([2, 7, 2, 4])
+        key_value_state = tf.random.uniform([2, 2, 3, 4])
+        key_state = tf.random.uniform([2, 2, 3])
+
+        # 逐个位置计算累加和
+        key_value = tf.cumsum(tf.einsum('bkhm,bkhd->bkhmd', key_features, value), axis=1) + key_value_state[:, None]
+        key_sum = tf.cumsum(key_features, axis=1) + key_state[:, None]
+        expected = tf.einsum('bqhm,bqhmd->bqhd', query_features, key_value) / (
+            tf.einsum('bqhm,bqhm->bqh', query_features, key_sum)[..., None] + linear_attention_layer._EPSILON
+        )
+
+        def attention_fn(*inputs):
+            return linear_attention_layer._causal_linear_attention(*inputs, chunk_size=chunk_size)
+
+        # seq_len 未知时总是按块循环，最后一个块补齐
+        dynamic_attention_fn = tf.function(attention_fn, input_signature=[
+            tf.TensorSpec([None, None, 2, 3]),
+            tf.TensorSpec([None, None, 2, 3]),
+            tf.TensorSpec([None, None, 2, 4]),
+            tf.TensorSpec([None, 2, 3, 4]),
+            tf.TensorSpec([None, 2, 3])
+        ])
+        for fn in (attention_fn, dynamic_attention_fn):
+            output, output_key_value_state, output_key_state = fn(
+                query_features, key_features, value, key_value_state, key_state
+            )
+            self.assertAllClose(expected, output)
+            self.assertAllClose(key_value[:, -1], output_key_value_state)
+            self.assertAllClose(key_sum[:, -1], output_key_state)
+
+    def test_random_features_approximate_softmax(self):
+        softmax_layer = MultiHeadAttention(num_attention_heads=2, size_per_head_for_query_and_key=8)
+        test_layer = linear_attention_layer.LinearAttention(
+            num_attention_heads=2, size_per_head_for_query_and_key=8, feature_map='random', num_random_features=4096
+        )
+        inputs = tf.random.normal([2, 10, 16]) * 0.3
+        softmax_layer(inputs, inputs, training=False)
+        test_layer(inputs, inputs, training=False)
+        # 随机特征为最后一个 (不可训练的) 权重
+        self.assertEqual([4096, 8], test_layer.non_trainable_weights[0].shape.as_list())
+        test_layer.set_weights(softmax_layer.get_weights() + test_layer.get_weights()[-1:])
+
+        self.assertAllClose(
+            softmax_layer(inputs, inputs, training=False), test_layer(inputs, inputs, training=False), atol=1e-2
+        )
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            linear_attention_layer.LinearAttention(
+                num_attention_heads=2, size_per_head_for_query_and_key=4, feature_map='relu'
+            )
+        with self.assertRaises(ValueError):
+            linear_attention_layer.LinearAttention(
+                num_attention_heads=4, size_per_head_for_query_and_key=4, num_kv_heads=2
+            )
+        with self.assertRaises(ValueError):
+            linear_attention_layer.LinearAttention(
+                num_attention_heads=2, size_per_head_for_query_and_key=4, attention_dropout_rate=0.1
+            )
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -82,9 +82,40 @@ class MaskedSoftmaxLayerTest(tf.test.TestCase):
         is_zeros = np.less(output_data, 0)
         self.assertAllEqual(expected_zeros, is_zeros)
 
+    def test_compact_mask(self):
+        test_layer = masked_softmax_layer.MaskedSoftmax(mask_expansion_axes=[1])
+        input_data = 10 * np.random.random_sample((3, 2, 4, 8))
+        mask_data = np.random.randint(2, size=(3, 1, 8))
+
+        dense_mask = np.ones((3, 4, 1)) * mask_data
+        self.assertAllClose(
+            test_layer(input_data, dense_mask),
+            test_layer(input_data, tf.constant(mask_data, dtype=tf.bool))
+        )
+
+    def test_causal_masked_softmax(self):
+        test_layer = masked_softmax_layer.MaskedSoftmax(mask_expansion_axes=[1], causal=True)
+        input_data = 10 * np.random.random_sample((3, 2, 4, 6))
+        mask_data = np.random.randint(2, size=(3, 1, 6))
+        mask_data[:, :, 0] = 0
+
+        # query 与 key 的末尾对齐，第 i 个 query 可以看到前 i + 2 个 key
+        causal_mask = np.triu(np.ones((4, 6)), k=3)
+        dense_mask = np.maximum(mask_data, causal_mask)
+        output_data = test_layer(input_data, tf.constant(mask_data, dtype=tf.bool))
+        self.assertAllClose(masked_softmax_layer.MaskedSoftmax(mask_expansion_axes=[1])(
+            input_data, dense_mask
+        ), output_data)
+        self.assertAllClose(np.zeros((3, 2, 4, 6)), np.where(dense_mask[:, np.newaxis] == 1, output_data, 0))
+
+        self.assertAllClose(
+            test_layer(input_data),
+            masked_softmax_layer.MaskedSoftmax(mask_expansion_axes=[1])(input_data, causal_mask[np.newaxis])
+        )
+
     def test_serialize_deserialize(self):
         test_layer = masked_softmax_layer.MaskedSoftmax(
-            mask_expansion_axes=1, normalization_axes=[6, 7]
+            mask_expansion_axes=1, normalization_axes=[6, 7], causal=True
         )
         new_layer = masked_softmax_layer.MaskedSoftmax.from_config(
             test_layer.get_config()
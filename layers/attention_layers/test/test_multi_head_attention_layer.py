@@ -1,9 +1,11 @@
 # -*- coding: utf - 8 -*-
 
+import os
 import numpy as np
 import tensorflow as tf
 from absl.testing import parameterized
 from tensorflow.python.keras import keras_parameterized
+from layers import utils
 from layers.attention_layers import multi_head_attention_layer
 
 
@@ -162,6 +164,329 @@ class MultiHeadAttentionTest(keras_parameterized.TestCase):
         )
         self.assertNotAllClose(output, unmasked_output)
 
+    def test_grouped_query_attention(self):
+        grouped_layer = multi_head_attention_layer.MultiHeadAttention(
+            num_attention_heads=4,
+            size_per_head_for_query_and_key=8,
+            num_kv_heads=2,
+            return_attention_scores=True
+        )
+        full_layer = multi_head_attention_layer.MultiHeadAttention(
+            num_attention_heads=4,
+            size_per_head_for_query_and_key=8,
+            return_attention_scores=True
+        )
+        query = tf.random.normal([3, 5, 16])
+        value = tf.random.normal([3, 7, 16])
+        mask = tf.constant(np.random.randint(2, size=[3, 5, 7]), dtype=tf.float32)
+        grouped_output, grouped_scores = grouped_layer(query, value, attention_mask=mask, training=False)
+        full_layer(query, value, attention_mask=mask, training=False)
+
+        # key / value 只有 num_kv_heads 个头
+        self.assertEqual([16, 2, 8], grouped_layer._key_dense.kernel.shape.as_list())
+        self.assertEqual([16, 2, 8], grouped_layer._value_dense.kernel.shape.as_list())
+        self.assertEqual([3, 4, 5, 7], grouped_scores.shape.as_list())
+
+        # 每组的 key / value 复制给组内的每个头后，与普通的 multi-head attention 等价
+        full_layer.set_weights([
+            np.repeat(w, 2, axis=-2) if w.shape != v.shape else w
+            for w, v in zip(grouped_layer.get_weights(), full_layer.get_weights())
+        ])
+        full_output, full_scores = full_layer(query, value, attention_mask=mask, training=False)
+        self.assertAllClose(full_output, grouped_output)
+        self.assertAllClose(full_scores, grouped_scores)
+
+    @parameterized.parameters(
+        dict(num_kv_heads=None, use_bias=True),
+        dict(num_kv_heads=None, use_bias=False),
+        dict(num_kv_heads=2, use_bias=True)
+    )
+    def test_fuse_qkv_projection(self, num_kv_heads, use_bias):
+        kwargs = dict(
+            num_attention_heads=4, size_per_head_for_query_and_key=8, num_kv_heads=num_kv_heads, use_bias=use_bias
+        )
+        test_layer = multi_head_attention_layer.MultiHeadAttention(**kwargs)
+        fused_layer = multi_head_attention_layer.MultiHeadAttention(fuse_qkv_projection=True, **kwargs)
+        query = tf.random.normal([3, 5, 16])
+        value = tf.random.normal([3, 7, 16])
+        mask = tf.constant(np.random.randint(2, size=[3, 5, 5]), dtype=tf.float32)
+        test_layer(query, query, attention_mask=mask, training=False)
+        fused_layer(query, query, attention_mask=mask, training=False)
+
+        # 只创建一个合并的投影
+        self.assertIsNone(fused_layer._query_dense)
+        self.assertEqual([16, 4 + 2 * (num_kv_heads or 4), 8], fused_layer._qkv_dense.kernel.shape.as_list())
+        self._convert_weights(test_layer, fused_layer)
+
+        # self attention 时使用合并的投影，结果与分别投影一致
+        self.assertAllClose(
+            test_layer(query, query, key=query, attention_mask=mask, training=False),
+            fused_layer(query, query, key=query, attention_mask=mask, training=False)
+        )
+        # query 与 key / value 不同时使用合并投影中对应的部分
+        self.assertAllClose(
+            test_layer(query, value, training=False),
+            fused_layer(query, value, training=False)
+        )
+
+        # 转换回分别投影
+        separate_layer = multi_head_attention_layer.MultiHeadAttention(**kwargs)
+        separate_layer(query, query, training=False)
+        self._convert_weights(fused_layer, separate_layer)
+        self.assertAllClose(
+            test_layer(query, query, attention_mask=mask, training=False),
+            separate_layer(query, query, attention_mask=mask, training=False)
+        )
+
+    def test_fuse_qkv_projection_for_cross_attention(self):
+        kwargs = dict(num_attention_heads=4, size_per_head_for_query_and_key=8)
+        query = tf.random.normal([3, 5, 16])
+        value = tf.random.normal([3, 7, 16])
+
+        # 默认不合并，self attention 时也分别投影，与已有的 checkpoint 兼容
+        self_layer = multi_head_attention_layer.MultiHeadAttention(**kwargs)
+        self_layer(query, query, training=False)
+        self.assertIsNone(self_layer._qkv_dense)
+        self.assertIsNotNone(self_layer._query_dense)
+
+        # fuse_qkv_projection 为 True 时总是合并，key / value 的 hidden_size 不同时不合并
+        fused_layer = multi_head_attention_layer.MultiHeadAttention(fuse_qkv_projection=True, **kwargs)
+        fused_layer(query, value, training=False)
+        self.assertIsNotNone(fused_layer._qkv_dense)
+        different_layer = multi_head_attention_layer.MultiHeadAttention(fuse_qkv_projection=True, **kwargs)
+        different_layer(query, tf.random.normal([3, 7, 12]), training=False)
+        self.assertIsNone(different_layer._qkv_dense)
+
+    def _convert_weights(self, source_layer, target_layer):
+        """通过 checkpoint 转换把 source_layer 的权重写入投影结构不同的 target_layer"""
+        checkpoint_path = tf.train.Checkpoint(layer=source_layer).write(os.path.join(self.get_temp_dir(), 'source'))
+        output_path = utils.convert_checkpoint(
+            checkpoint_path,
+            os.path.join(self.get_temp_dir(), 'target'),
+            tf.train.Checkpoint(layer=target_layer),
+            convert_fns=[multi_head_attention_layer.convert_qkv_checkpoint_weight]
+        )
+        tf.train.Checkpoint(layer=target_layer).restore(output_path).expect_partial()
+
+    @parameterized.parameters(
+        dict(num_kv_heads=None, mask_seq_len=1),
+        dict(num_kv_heads=None, mask_seq_len=13),
+        dict(num_kv_heads=2, mask_seq_len=13)
+    )
+    def test_chunked_attention(self, num_kv_heads, mask_seq_len):
+        kwargs = dict(num_attention_heads=4, size_per_head_for_query_and_key=8, num_kv_heads=num_kv_heads)
+        test_layer = multi_head_attention_layer.MultiHeadAttention(**kwargs)
+        # 块大小不整除 seq_len，需要补齐
+        chunked_layer = multi_head_attention_layer.MultiHeadAttention(attention_chunk_size=5, **kwargs)
+        query = tf.random.normal([2, 13, 16])
+        value = tf.random.normal([2, 11, 16])
+        mask = tf.constant(np.random.randint(2, size=[2, mask_seq_len, 11]), dtype=tf.float32)
+        test_layer(query, value, attention_mask=mask, training=False)
+        chunked_layer(query, value, attention_mask=mask, training=False)
+        chunked_layer.set_weights(test_layer.get_weights())
+
+        with tf.GradientTape(persistent=True) as tape:
+            tape.watch(query)
+            output = test_layer(query, value, attention_mask=mask, training=False)
+            chunked_output = chunked_layer(query, value, attention_mask=mask, training=False)
+            loss = tf.reduce_sum(output ** 2)
+            chunked_loss = tf.reduce_sum(chunked_output ** 2)
+        self.assertAllClose(output, chunked_output)
+        self.assertAllClose(tape.gradient(loss, query), tape.gradient(chunked_loss, query))
+        self.assertAllClose(
+            tape.gradient(loss, test_layer.trainable_weights),
+            tape.gradient(chunked_loss, chunked_layer.trainable_weights)
+        )
+
+    def test_chunked_attention_with_dropout(self):
+        test_layer = multi_head_attention_layer.MultiHeadAttention(
+            num_attention_heads=2, size_per_head_for_query_and_key=4, attention_dropout_rate=0.5,
+            attention_chunk_size=4
+        )
+        query = tf.random.normal([2, 9, 8])
+        self.assertAllClose(
+            test_layer(query, query, training=False), test_layer(query, query, training=False)
+        )
+        with tf.GradientTape() as tape:
+            tape.watch(query)
+            output = test_layer(query, query, training=True)
+        self.assertNotAllClose(test_layer(query, query, training=False), output)
+        self.assertTrue(np.all(np.isfinite(tape.gradient(output, query))))
+
+    @parameterized.parameters(
+        dict(num_kv_heads=None, attention_chunk_size=None, seq_len_q=11),
+        dict(num_kv_heads=2, attention_chunk_size=None, seq_len_q=11),
+        dict(num_kv_heads=None, attention_chunk_size=4, seq_len_q=11),
+        dict(num_kv_heads=2, attention_chunk_size=4, seq_len_q=6)
+    )
+    def test_causal_attention(self, num_kv_heads, attention_chunk_size, seq_len_q):
+        kwargs = dict(num_attention_heads=4, size_per_head_for_query_and_key=8, num_kv_heads=num_kv_heads)
+        test_layer = multi_head_attention_layer.MultiHeadAttention(**kwargs)
+        causal_layer = multi_head_attention_layer.MultiHeadAttention(
+            causal=True, attention_chunk_size=attention_chunk_size, **kwargs
+        )
+        query = tf.random.normal([2, seq_len_q, 16])
+        value = tf.random.normal([2, 11, 16])
+        # 只包含 key padding 信息的 bool mask
+        padding_mask = np.zeros([2, 1, 11], dtype=bool)
+        padding_mask[1, :, 8:] = True
+        # query 与 key 的末尾对齐
+        causal_mask = np.triu(np.ones([seq_len_q, 11]), k=11 - seq_len_q + 1)
+        dense_mask = tf.constant(np.maximum(padding_mask, causal_mask), dtype=tf.float32)
+
+        output = test_layer(query, value, attention_mask=dense_mask, training=False)
+        causal_layer(query, value, attention_mask=padding_mask, training=False)
+        causal_layer.set_weights(test_layer.get_weights())
+        self.assertAllClose(output, causal_layer(query, value, attention_mask=padding_mask, training=False))
+
+    def test_invalid_causal_attention(self):
+        with self.assertRaises(ValueError):
+            multi_head_attention_layer.MultiHeadAttention(
+                num_attention_heads=4, size_per_head_for_query_and_key=8, causal=True, attention_axes=[2]
+            )
+
+    def test_invalid_num_kv_heads(self):
+        with self.assertRaises(ValueError):
+            multi_head_attention_layer.MultiHeadAttention(
+                num_attention_heads=4, size_per_head_for_query_and_key=8, num_kv_heads=3
+            )
+
+    @parameterized.parameters(None, 1)
+    def test_cache_attention_with_cache_indirection(self, num_kv_heads):
+        batch_size, beam_size, max_decode_len, hidden_size = 2, 3, 5, 8
+        test_layer = multi_head_attention_layer.CacheAttention(
+            num_attention_heads=2, size_per_head_for_query_and_key=4, num_kv_heads=num_kv_heads
+        )
+        query = tf.random.normal([batch_size * beam_size, 1, hidden_size])
+        cache_heads = num_kv_heads or 2
+        cache = {
+            'key': tf.random.normal([batch_size * beam_size, max_decode_len, cache_heads, 4]),
+            'value': tf.random.normal([batch_size * beam_size, max_decode_len, cache_heads, 4])
+        }
+        # 当前为第 2 步，之后的位置被屏蔽
+        decode_loop_step = 2
+        mask = tf.constant([[[0., 0., 0., 1., 1.]]])
+        cache_indirection = np.random.randint(beam_size, size=[batch_size, beam_size, max_decode_len])
+        cache_indirection[:, :, decode_loop_step] = np.arange(beam_size)
+
+        output, new_cache = test_layer(
+            query=query, value=query, attention_mask=mask, training=False, cache=dict(cache),
+            decode_loop_step=decode_loop_step, cache_indirection=tf.constant(cache_indirection)
+        )
+
+        # 按 cache_indirection 把 cache 实际 gather 出来后直接计算，结果一致
+        rows = cache_indirection + np.arange(batch_size)[:, np.newaxis, np.newaxis] * beam_size
+        positions = np.broadcast_to(np.arange(max_decode_len), rows.shape)
+        indices = np.stack([rows, positions], axis=-1).reshape([batch_size * beam_size, max_decode_len, 2])
+        gathered_cache = {
+            'key': tf.gather_nd(new_cache['key'], indices),
+            'value': tf.gather_nd(new_cache['value'], indices)
+        }
+        expected_output, _ = test_layer(
+            query=query, value=query, attention_mask=mask, training=False, cache=gathered_cache,
+            decode_loop_step=decode_loop_step
+        )
+        self.assertAllClose(expected_output, output)
+
+    def test_quantize(self):
+        tensor = tf.random.normal([2, 5, 3, 8])
+        quantized, scale = multi_head_attention_layer.quantize(tensor)
+        self.assertEqual(tf.int8, quantized.dtype)
+        self.assertEqual([2, 5, 3], scale.shape.as_list())
+        # 误差不超过半个量化步长
+        error = tf.abs(multi_head_attention_layer.dequantize(quantized, scale) - tensor)
+        self.assertAllLessEqual(error - scale[..., tf.newaxis] / 2, 1e-6)
+
+        # 全 0 的向量量化后仍为 0
+        quantized, scale = multi_head_attention_layer.quantize(tf.zeros([1, 1, 1, 4]))
+        self.assertAllEqual(tf.zeros([1, 1, 1, 4]), multi_head_attention_layer.dequantize(quantized, scale))
+
+    def test_cache_attention_with_quantized_cache(self):
+        batch_size, max_decode_len, hidden_size = 2, 4, 8
+        test_layer = multi_head_attention_layer.CacheAttention(
+            num_attention_heads=2, size_per_head_for_query_and_key=4
+        )
+        look_ahead_mask = tf.constant([[[0., 1., 1., 1.], [0., 0., 1., 1.], [0., 0., 0., 1.], [0., 0., 0., 0.]]])
+        inputs = tf.random.normal([batch_size, max_decode_len, hidden_size])
+
+        for decode_loop_step in [True, False]:
+            seq_len = max_decode_len if decode_loop_step else 0
+            cache = multi_head_attention_layer.create_cache(batch_size, seq_len, 2, 4)
+            quantized_cache = multi_head_attention_layer.create_cache(batch_size, seq_len, 2, 4, quantized=True)
+            for i in range(max_decode_len):
+                mask = look_ahead_mask[:, i:i + 1] if decode_loop_step else look_ahead_mask[:, i:i + 1, :i + 1]
+                kwargs = dict(
+                    query=inputs[:, i:i + 1],
+                    value=inputs[:, i:i + 1],
+                    attention_mask=mask,
+                    training=False,
+                    decode_loop_step=i if decode_loop_step else None
+                )
+                output, cache = test_layer(cache=cache, **kwargs)
+                quantized_output, quantized_cache = test_layer(cache=quantized_cache, **kwargs)
+                self.assertAllClose(output, quantized_output, atol=0.05)
+
+            self.assertEqual(tf.int8, quantized_cache['key'].dtype)
+            self.assertEqual(tf.int8, quantized_cache['value'].dtype)
+            self.assertEqual([batch_size, max_decode_len, 2], quantized_cache['key_scale'].shape.as_list())
+
+    @parameterized.parameters(None, 1)
+    def test_quantized_attention(self, num_kv_heads):
+        batch_size, seq_len, hidden_size = 2, 6, 8
+        test_layer = multi_head_attention_layer.CacheAttention(
+            num_attention_heads=2, size_per_head_for_query_and_key=4, num_kv_heads=num_kv_heads
+        )
+        query = tf.random.normal([batch_size, 1, hidden_size])
+        test_layer(query, query, training=False)
+
+        cache_heads = num_kv_heads or 2
+        key, key_scale = multi_head_attention_layer.quantize(tf.random.normal([batch_size, seq_len, cache_heads, 4]))
+        value, value_scale = multi_head_attention_layer.quantize(
+            tf.random.normal([batch_size, seq_len, cache_heads, 4])
+        )
+        projected_query = tf.random.normal([batch_size, 1, 2, 4])
+        mask = tf.constant([[[0., 0., 0., 0., 1., 1.]]])
+
+        # 与在反量化后的 cache 上计算 attention 一致
+        expected_output, expected_scores = test_layer.compute_attention(
+            projected_query,
+            multi_head_attention_layer.dequantize(key, key_scale),
+            multi_head_attention_layer.dequantize(value, value_scale),
+            training=False,
+            attention_mask=mask
+        )
+        output, scores = test_layer._compute_quantized_attention(
+            projected_query, key, value, key_scale, value_scale, training=False, attention_mask=mask
+        )
+        self.assertAllClose(expected_output, output)
+        self.assertAllClose(expected_scores, scores)
+
+
+    def test_cache_attention_with_fused_qkv_projection(self):
+        batch_size, max_decode_len, hidden_size = 2, 4, 8
+        test_layer = multi_head_attention_layer.CacheAttention(
+            num_attention_heads=2, size_per_head_for_query_and_key=4
+        )
+        fused_layer = multi_head_attention_layer.CacheAttention(
+            num_attention_heads=2, size_per_head_for_query_and_key=4, fuse_qkv_projection=True
+        )
+        look_ahead_mask = tf.constant([[[0., 1., 1., 1.], [0., 0., 1., 1.], [0., 0., 0., 1.], [0., 0., 0., 0.]]])
+        inputs = tf.random.normal([batch_size, max_decode_len, hidden_size])
+        test_layer(inputs, inputs, training=False)
+        fused_layer(inputs, inputs, training=False)
+        self._convert_weights(test_layer, fused_layer)
+
+        cache = multi_head_attention_layer.create_cache(batch_size, max_decode_len, 2, 4)
+        fused_cache = multi_head_attention_layer.create_cache(batch_size, max_decode_len, 2, 4)
+        for i in range(max_decode_len):
+            step_inputs = inputs[:, i:i + 1]
+            kwargs = dict(attention_mask=look_ahead_mask[:, i:i + 1], training=False, decode_loop_step=i)
+            output, cache = test_layer(step_inputs, step_inputs, cache=cache, **kwargs)
+            fused_output, fused_cache = fused_layer(step_inputs, step_inputs, cache=fused_cache, **kwargs)
+            self.assertAllClose(output, fused_output)
+        self.assertAllClose(cache['key'], fused_cache['key'])
+        self.assertAllClose(cache['value'], fused_cache['value'])
+
 
 if __name__ == '__main__':
     tf.test.main()
@@ -0,0 +1,27 @@
+# -*- coding: utf - 8 -*-
+
+import numpy as np
+import tensorflow as tf
+from layers.attention_layers import self_attention_mask
+
+
+class SelfAttentionMaskTest(tf.test.TestCase):
+    def test_self_attention_mask(self):
+        inputs = tf.random.normal([2, 5, 8])
+        mask_data = np.random.randint(2, size=(2, 5))
+
+        output = self_attention_mask.SelfAttentionMask()([inputs, mask_data])
+        self.assertAllEqual([2, 5, 5], output.shape)
+        self.assertAllEqual(np.tile(mask_data[:, np.newaxis], [1, 5, 1]), output)
+
+    def test_compact_self_attention_mask(self):
+        inputs = tf.random.normal([2, 5, 8])
+        mask_data = np.random.randint(2, size=(2, 5))
+
+        output = self_attention_mask.SelfAttentionMask(compact=True)([inputs, mask_data])
+        self.assertEqual(tf.bool, output.dtype)
+        self.assertAllEqual(mask_data[:, np.newaxis].astype(bool), output)
+
+
+if __name__ == '__main__':
+    tf.test.main()
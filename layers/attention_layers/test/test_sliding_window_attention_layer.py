@@ -0,0 +1,69 @@
+# -*- coding: utf - 8 -*-
+
+import numpy as np
+import tensorflow as tf
+from absl.testing import parameterized
+from layers.attention_layers.multi_head_attention_layer import MultiHeadAttention
+from layers.attention_layers.sliding_window_attention_layer import SlidingWindowAttention
+
+
+class SlidingWindowAttentionTest(tf.test.TestCase, parameterized.TestCase):
+
+    @parameterized.parameters(
+        dict(seq_len=13, window_size=3, num_global_tokens=1),
+        dict(seq_len=16, window_size=4, num_global_tokens=2),
+        dict(seq_len=7, window_size=4, num_global_tokens=0),
+        # 窗口大于序列长度时等价于完整的 self attention
+        dict(seq_len=5, window_size=8, num_global_tokens=1)
+    )
+    def test_equivalent_to_dense_mask(self, seq_len, window_size, num_global_tokens):
+        dense_layer = MultiHeadAttention(num_attention_heads=2, size_per_head_for_query_and_key=4)
+        test_layer = SlidingWindowAttention(
+            num_attention_heads=2,
+            size_per_head_for_query_and_key=4,
+            window_size=window_size,
+            num_global_tokens=num_global_tokens
+        )
+        inputs = tf.random.normal([2, seq_len, 8])
+        dense_layer(inputs, inputs, training=False)
+        test_layer(inputs, inputs, training=False)
+        test_layer.set_weights(dense_layer.get_weights())
+
+        # padding 的长度不超过 window_size，保证每个 query 的窗口内至少有一个可见的 key
+        valid_lens = np.random.randint(max(seq_len - window_size, 1), seq_len + 1, size=[2, 1, 1])
+        padding_mask = (np.arange(seq_len)[np.newaxis, np.newaxis, :] >= valid_lens).astype(np.float32)
+        query_positions = np.arange(seq_len)[:, np.newaxis]
+        key_positions = np.arange(seq_len)[np.newaxis, :]
+        visible = (np.abs(query_positions - key_positions) <= window_size) \
+            | (key_positions < num_global_tokens) | (query_positions < num_global_tokens)
+        dense_mask = np.maximum(1 - visible[np.newaxis].astype(np.float32), padding_mask)
+
+        self.assertAllClose(
+            dense_layer(inputs, inputs, attention_mask=dense_mask, training=False),
+            test_layer(inputs, inputs, attention_mask=padding_mask, training=False)
+        )
+
+    def test_training(self):
+        test_layer = SlidingWindowAttention(
+            num_attention_heads=2, size_per_head_for_query_and_key=4, window_size=2, attention_dropout_rate=0.5
+        )
+        inputs = tf.random.normal([2, 9, 8])
+        with tf.GradientTape() as tape:
+            tape.watch(inputs)
+            output = test_layer(inputs, inputs, training=True)
+        self.assertEqual([2, 9, 8], output.shape.as_list())
+        self.assertTrue(np.all(np.isfinite(tape.gradient(output, inputs))))
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            SlidingWindowAttention(
+                num_attention_heads=4, size_per_head_for_query_and_key=4, window_size=2, num_kv_heads=2
+            )
+        with self.assertRaises(ValueError):
+            SlidingWindowAttention(
+                num_attention_heads=4, size_per_head_for_query_and_key=4, window_size=2, return_attention_scores=True
+            )
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -20,6 +20,17 @@ class WordEmbeddingTest(tf.test.TestCase):
         self.assertEqual(expected_output_shape, output_tensor.shape.as_list())
         self.assertEqual(output_tensor.dtype, tf.float32)
 
+    def test_linear_with_vocab_ids(self):
+        test_layer = word_embedding_layer.WordEmbedding(vocab_size=31, embedding_size=8)
+        inputs = tf.random.normal([2, 3, 8])
+        logits = test_layer(inputs, mode='linear')
+        self.assertEqual([2, 3, 31], logits.shape.as_list())
+
+        # 只计算部分词的 logits，与完整 logits 中对应的列一致
+        vocab_ids = tf.constant([0, 1, 5, 30])
+        partial_logits = test_layer(inputs, mode='linear', vocab_ids=vocab_ids)
+        self.assertAllClose(tf.gather(logits, vocab_ids, axis=-1), partial_logits)
+
 
 if __name__ == '__main__':
     tf.test.main()
\ No newline at end of file
@@ -40,11 +40,15 @@ class WordEmbedding(tf.keras.layers.Layer):
         )
         super(WordEmbedding, self).build(input_shape)
 
-    def call(self, inputs, mode='embedding'):
+    def call(self, inputs, mode='embedding', vocab_ids=None):
+        """
+        :param vocab_ids: (num_ids,)，只在 mode 为 'linear' 时使用
+            不为 None 时只与这些词的 embedding 相乘，输出 (batch_size, seq_len, num_ids)，第 j 个为 vocab_ids[j] 的 logits
+        """
         if mode == 'embedding':
             return self._embedding(inputs)
         elif mode == 'linear':
-            return self._linear(inputs)
+            return self._linear(inputs, vocab_ids)
         else:
             raise ValueError('mode {} is invalid'.format(mode))
 
@@ -83,15 +87,21 @@ class WordEmbedding(tf.keras.layers.Layer):
 
             return embeddings
 
-    def _linear(self, inputs):
+    def _linear(self, inputs, vocab_ids=None):
         with tf.name_scope('pre_softmax_linear'):
             batch_size = tf.shape(inputs)[0]
             length = tf.shape(inputs)[1]
 
+            embeddings = self.embeddings
+            vocab_size = self._vocab_size
+            if vocab_ids is not None:
+                embeddings = tf.gather(embeddings, vocab_ids)
+                vocab_size = tf.size(vocab_ids)
+
             x = tf.reshape(inputs, [-1, self._embedding_size])
             logits = tf.matmul(
-                x, self.embeddings,
+                x, embeddings,
                 transpose_b=True
             )
 
-            return tf.reshape(logits, [batch_size, length, self._vocab_size])
+            return tf.reshape(logits, [batch_size, length, vocab_size])
@@ -0,0 +1,43 @@
+# -*- coding: utf - 8 -*-
+
+import tensorflow as tf
+from layers import utils
+
+
+class LayerNormalization(tf.keras.layers.LayerNormalization):
+    """
+        与 tf.keras.layers.LayerNormalization 相同，另外可以只使用多层 stacked 的 gamma 和 beta 中的一层，
+        用于 scan_layers 时结构相同的多层共用一个层对象，见 layers.utils.stacked_variable_creator
+    """
+    def call(self, inputs, layer_index=None):
+        """
+        :param layer_index: 不为 None 时 gamma 和 beta 为 (num_layers, ...)，只使用其中第 layer_index 层
+            与 tf.keras.layers.LayerNormalization 的非 fused 实现相同
+        """
+        if layer_index is None:
+            return super(LayerNormalization, self).call(inputs)
+
+        input_dtype = inputs.dtype
+        if input_dtype in (tf.float16, tf.bfloat16) and self.dtype == 'float32':
+            inputs = tf.cast(inputs, tf.float32)
+        ndims = len(inputs.shape)
+        broadcast_shape = [1] * ndims
+        for dim in self.axis:
+            broadcast_shape[dim] = inputs.shape[dim]
+
+        def get_weight(weight):
+            weight = utils.get_layer_weight(weight, layer_index)
+            if self.axis != [ndims - 1]:
+                weight = tf.reshape(weight, broadcast_shape)
+            return weight
+
+        mean, variance = tf.nn.moments(inputs, self.axis, keepdims=True)
+        outputs = tf.nn.batch_normalization(
+            inputs,
+            mean,
+            variance,
+            offset=get_weight(self.beta) if self.center else None,
+            scale=get_weight(self.gamma) if self.scale else None,
+            variance_epsilon=self.epsilon
+        )
+        return tf.cast(outputs, input_dtype)
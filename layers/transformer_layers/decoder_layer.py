@@ -8,7 +8,9 @@ import tensorflow as tf
 
 from layers.attention_layers.multi_head_attention_layer import MultiHeadAttention
 from layers.attention_layers.multi_head_attention_layer import CacheAttention
+from layers.attention_layers.linear_attention_layer import CacheLinearAttention
 from layers.attention_layers.einsum_dense import EinsumDense
+from layers.normalization_layers.layer_normalization import LayerNormalization
 
 
 class TransformerDecoderLayer(tf.keras.layers.Layer):
@@ -19,6 +21,13 @@ class TransformerDecoderLayer(tf.keras.layers.Layer):
             1. self attention layer
             2. encoder decoder attention layer / cross attention layer
             3. position-wise feed-forward network
+
+        num_kv_heads 不为 None 时，self attention 与 encoder decoder attention 都使用 grouped-query attention
+        解码时 cache 中的 key / value 只有 num_kv_heads 个头，详见 MultiHeadAttention
+        fuse_qkv_projection 为 True 时 self attention 的 query、key、value 投影合并为一次，详见 MultiHeadAttention
+        linear_attention 不为 None 时 self attention 使用 causal kernelized linear attention，
+        解码时 cache 只保存 key / value 的累加和，详见 CacheLinearAttention
+        encoder decoder attention 仍然为 softmax attention，linear attention 不计算 attention score，attention_dropout_rate 必须为 0
     """
     def __init__(
             self,
@@ -37,11 +46,21 @@ class TransformerDecoderLayer(tf.keras.layers.Layer):
             use_bias=True,
             norm_first=False,
             norm_epsilon=1e-12,
+            num_kv_heads=None,
+            fuse_qkv_projection=False,
+            linear_attention=None,
+            num_random_features=None,
             **kwargs
     ):
         super(TransformerDecoderLayer, self).__init__(**kwargs)
+        if linear_attention is not None and attention_dropout_rate:
+            raise ValueError('attention_dropout_rate is not supported with linear_attention')
 
         self._num_attention_heads = num_attention_heads
+        self._num_kv_heads = num_kv_heads
+        self._fuse_qkv_projection = fuse_qkv_projection
+        self._linear_attention = linear_attention
+        self._num_random_features = num_random_features
         self._attention_dropout_rate = attention_dropout_rate
         self._norm_first = norm_first
         self._use_bias = use_bias
@@ -83,14 +102,24 @@ class TransformerDecoderLayer(tf.keras.layers.Layer):
         )
 
         # self attention
-        self.self_attention = CacheAttention(
+        self_attention_kwargs = dict(
             num_attention_heads=self._num_attention_heads,
             size_per_head_for_query_and_key=self._size_per_head_for_query_and_key,
             attention_dropout_rate=self._attention_dropout_rate,
             use_bias=self._use_bias,
+            num_kv_heads=self._num_kv_heads,
+            fuse_qkv_projection=self._fuse_qkv_projection,
             name='self_attention',
             **common_kwargs
         )
+        if self._linear_attention is not None:
+            self.self_attention = CacheLinearAttention(
+                feature_map=self._linear_attention,
+                num_random_features=self._num_random_features,
+                **self_attention_kwargs
+            )
+        else:
+            self.self_attention = CacheAttention(**self_attention_kwargs)
         self.self_attention_output_dense = EinsumDense(
             'abc,cd->abd',
             output_shape=(None, hidden_size),
@@ -102,7 +131,7 @@ class TransformerDecoderLayer(tf.keras.layers.Layer):
         self.self_attention_dropout = tf.keras.layers.Dropout(
             rate=self._hidden_dropout_rate
         )
-        self.self_attention_layer_norm = tf.keras.layers.LayerNormalization(
+        self.self_attention_layer_norm = LayerNormalization(
             name='self_attention_layer_norm',
             axis=-1,
             epsilon=self._norm_epsilon
@@ -114,6 +143,7 @@ class TransformerDecoderLayer(tf.keras.layers.Layer):
             attention_dropout_rate=self._attention_dropout_rate,
             output_shape=hidden_size,
             use_bias=self._use_bias,
+            num_kv_heads=self._num_kv_heads,
             name='attention/encoder_decoder',
             **common_kwargs
         )
@@ -121,7 +151,7 @@ class TransformerDecoderLayer(tf.keras.layers.Layer):
         self.encoder_decoder_attention_dropout = tf.keras.layers.Dropout(
             rate=self._hidden_dropout_rate
         )
-        self.encoder_decoder_attention_layer_norm = tf.keras.layers.LayerNormalization(
+        self.encoder_decoder_attention_layer_norm = LayerNormalization(
             name='attention/encoder_decoder_output_layer_norm',
             axis=-1,
             epsilon=self._norm_epsilon
@@ -150,25 +180,77 @@ class TransformerDecoderLayer(tf.keras.layers.Layer):
         self.output_dropout = tf.keras.layers.Dropout(
             rate=self._hidden_dropout_rate
         )
-        self.output_layer_norm = tf.keras.layers.LayerNormalization(
+        self.output_layer_norm = LayerNormalization(
             name='output_layer_norm',
             axis=-1,
             epsilon=self._norm_epsilon
         )
         super(TransformerDecoderLayer, self).build(input_shape)
 
-    def call(self, inputs, training, cache=None):
+    def compute_encoder_decoder_cache(self, encoder_output, layer_index=None):
+        """
+            预先计算 encoder-decoder attention 的 key / value 投影
+
+            解码时 encoder_output 在每一步都不变，投影只需要计算一次
+            返回的结果放入该层的 cache 中，在 call 中直接使用
+
+        :param encoder_output: (batch_size, inputs_seq_len, hidden_size)
+        :param layer_index: 权重为多层 stacked 的权重时使用的层，见 call
+        :return: {
+            'encoder_decoder_key': (batch_size, inputs_seq_len, num_kv_heads, size_per_head),
+            'encoder_decoder_value': (batch_size, inputs_seq_len, num_kv_heads, size_per_head)
+        }
+        """
+        with tf.name_scope(self.name):
+            if not self.built:
+                # 解码前 decoder 可能还未被调用过
+                # targets 与 encoder 输出的 hidden_size 相同，可以直接用 encoder 输出的形状构建
+                self.build([encoder_output.shape])
+
+            key, value = self.encoder_decoder_attention.project_key_value(
+                query=encoder_output, value=encoder_output, key=encoder_output, layer_index=layer_index
+            )
+        return {
+            'encoder_decoder_key': key,
+            'encoder_decoder_value': value
+        }
+
+    def call(
+            self,
+            inputs,
+            training,
+            cache=None,
+            decode_loop_step=None,
+            cache_indirection=None,
+            beam_size=None,
+            layer_index=None
+    ):
+        """
+        :param inputs: [targets_tensor, encoder_output, encoder_decoder_attention_mask, self_attention_mask]
+        :param cache: self attention 的 cache，仅在解码时使用
+            若包含 compute_encoder_decoder_cache 的结果，则 encoder-decoder attention 直接使用缓存的 key / value
+        :param decode_loop_step: 使用预分配 cache 时当前的解码步，详见 CacheAttention
+        :param cache_indirection: beam search 时间接读取 self attention cache 的 backpointer 表，详见 CacheAttention
+        :param beam_size: 不为 None 时 targets_tensor 为 (batch_size * beam_size, seq_len, hidden_size)
+            而 encoder_output、encoder_decoder_attention_mask 以及 cache 中的 encoder-decoder key / value
+            只有 batch_size 份，encoder-decoder attention 对 beam 广播，不需要把 encoder 的输出复制 beam_size 份
+        :param layer_index: 不为 None 时所有权重为多层 stacked 的权重 (num_layers, ...)，只使用其中第 layer_index 层，
+            用于 scan_layers 时结构相同的多层共用一个层对象，见 layers.utils.stacked_variable_creator
+        """
         targets_tensor, encoder_output, encoder_decoder_attention_mask, self_attention_mask = inputs[:4]
         source_tensor = targets_tensor
         if self._norm_first:
-            targets_tensor = self.self_attention_layer_norm(targets_tensor)
+            targets_tensor = self.self_attention_layer_norm(targets_tensor, layer_index=layer_index)
 
         # 新的 cache 会被返回，用于下一轮解码
         self_attention_output, cache = self.self_attention(
             query=targets_tensor,
             value=targets_tensor,
             attention_mask=self_attention_mask,
-            cache=cache
+            cache=cache,
+            decode_loop_step=decode_loop_step,
+            cache_indirection=cache_indirection,
+            layer_index=layer_index
         )
 
         if training:
@@ -178,23 +260,38 @@ class TransformerDecoderLayer(tf.keras.layers.Layer):
             self_attention_output = source_tensor + self_attention_output
         else:
             self_attention_output = self.self_attention_layer_norm(
-                targets_tensor + self_attention_output
+                targets_tensor + self_attention_output, layer_index=layer_index
             )
 
         if self._norm_first:
             source_self_attention_output = self_attention_output
             self_attention_output = self.encoder_decoder_attention_layer_norm(
-                self_attention_output
+                self_attention_output, layer_index=layer_index
+            )
+        query = self_attention_output
+        if beam_size is not None:
+            # 同一个 batch item 的所有 beam 的 query 合并到 seq_len 维度
+            # (batch_size, beam_size * seq_len, hidden_size)
+            query = tf.reshape(
+                query, [-1, beam_size * tf.shape(query)[1], query.shape[-1]]
             )
         encoder_decoder_attention_inputs = dict(
-            query=self_attention_output,
+            query=query,
             value=encoder_output,
             key=encoder_output,
-            attention_mask=encoder_decoder_attention_mask
+            attention_mask=encoder_decoder_attention_mask,
+            layer_index=layer_index
         )
+        if cache is not None and 'encoder_decoder_key' in cache:
+            encoder_decoder_attention_inputs.update(
+                projected_key=cache['encoder_decoder_key'],
+                projected_value=cache['encoder_decoder_value']
+            )
         attention_output = self.encoder_decoder_attention(
             **encoder_decoder_attention_inputs
         )
+        if beam_size is not None:
+            attention_output = tf.reshape(attention_output, tf.shape(self_attention_output))
 
         if training:
             attention_output = self.encoder_decoder_attention_dropout(attention_output)
@@ -203,19 +300,19 @@ class TransformerDecoderLayer(tf.keras.layers.Layer):
             attention_output = source_self_attention_output + attention_output
         else:
             attention_output = self.encoder_decoder_attention_layer_norm(
-                self_attention_output + attention_output
+                self_attention_output + attention_output, layer_index=layer_index
             )
         if self._norm_first:
             source_self_attention_output = attention_output
-            attention_output = self.output_layer_norm(attention_output)
+            attention_output = self.output_layer_norm(attention_output, layer_index=layer_index)
 
-        intermediate_output = self.intermediate_dense(attention_output)
+        intermediate_output = self.intermediate_dense(attention_output, layer_index=layer_index)
         intermediate_output = self.intermediate_activation_layer(intermediate_output)
 
         if training:
             intermediate_output = self.intermediate_dropout_layer(intermediate_output)
 
-        layer_output = self.output_dense(intermediate_output)
+        layer_output = self.output_dense(intermediate_output, layer_index=layer_index)
 
         if training:
             layer_output = self.output_dropout(layer_output)
@@ -223,6 +320,6 @@ class TransformerDecoderLayer(tf.keras.layers.Layer):
         if self._norm_first:
             layer_output = source_self_attention_output + layer_output
         else:
-            layer_output = self.output_layer_norm(layer_output + attention_output)
+            layer_output = self.output_layer_norm(layer_output + attention_output, layer_index=layer_index)
 
         return layer_output, cache
@@ -1,6 +1,7 @@
 # -*- coding: utf - 8 -*-
 
 import tensorflow as tf
+from layers import utils
 from layers.transformer_layers import decoder_layer
 
 
@@ -24,12 +25,33 @@ class TransformerDecoderStack(tf.keras.layers.Layer):
             activity_regularizer=None,
             kernel_constraint=None,
             bias_constraint=None,
+            num_kv_heads=None,
+            fuse_qkv_projection=False,
+            linear_attention=None,
+            num_random_features=None,
+            scan_layers=False,
             **kwargs
     ):
+        """
+        :param num_kv_heads: 每一层 attention 的 key / value 头数，为 None 时与 num_attention_heads 相同
+            小于 num_attention_heads 时为 grouped-query attention，解码时 cache 按 num_kv_heads 分配
+        :param fuse_qkv_projection: self attention 的 query、key、value 投影是否合并为一次，详见 MultiHeadAttention
+        :param linear_attention: 不为 None 时 self attention 使用 causal kernelized linear attention，
+            取值为核函数 feature map ('elu' 或 'random')，解码时 cache 需要由 linear_attention_layer.create_cache 创建
+        :param num_random_features: linear_attention 为 'random' 时随机特征的个数
+        :param scan_layers: 不使用 cache 时 (训练) 是否用一个 tf.while_loop 执行所有层而不是展开 python 循环，详见 utils.scan_layers
+            所有层共用一个层对象 stacked_layer，每个权重为 (num_hidden_layers, ...) 的变量，
+            与展开执行时的 checkpoint 可以通过 utils.convert_stacked_checkpoint_weight 相互转换
+            解码时每一层的 cache 不同，仍然展开执行，第 i 层使用 stacked_layer 的第 i 层权重
+            不支持 linear_attention 为 'random'
+        """
         super(TransformerDecoderStack, self).__init__(**kwargs)
+        if scan_layers and linear_attention == 'random':
+            raise ValueError('scan_layers is not supported with random feature linear attention')
 
         self._num_hidden_layers = num_hidden_layers
         self._num_attention_heads = num_attention_heads
+        self._num_kv_heads = num_kv_heads if num_kv_heads is not None else num_attention_heads
         self._intermediate_size = intermediate_size
         self._intermediate_activation = intermediate_activation
         self._attention_dropout_rate = attention_dropout_rate
@@ -37,6 +59,10 @@ class TransformerDecoderStack(tf.keras.layers.Layer):
         self._use_bias = use_bias
         self._norm_first = norm_first
         self._norm_epsilon = norm_epsilon
+        self._fuse_qkv_projection = fuse_qkv_projection
+        self._linear_attention = linear_attention
+        self._num_random_features = num_random_features
+        self._scan_layers = scan_layers
         self._kernel_initializer = tf.keras.initializers.get(kernel_initializer)
         self._bias_initializer = tf.keras.initializers.get(bias_initializer)
         self._kernel_regularizer = tf.keras.regularizers.get(kernel_regularizer)
@@ -57,22 +83,38 @@ class TransformerDecoderStack(tf.keras.layers.Layer):
             bias_constraint=self._bias_constraint
         )
 
-        self.decoder_layers = []
-        for i in range(self._num_hidden_layers):
-            self.decoder_layers.append(
-                decoder_layer.TransformerDecoderLayer(
-                    num_attention_heads=self._num_attention_heads,
-                    intermediate_size=self._intermediate_size,
-                    intermediate_activation=self._intermediate_activation,
-                    hidden_dropout_rate=self._hidden_dropout_rate,
-                    attention_dropout_rate=self._attention_dropout_rate,
-                    use_bias=self._use_bias,
-                    norm_first=self._norm_first,
-                    norm_epsilon=self._norm_epsilon,
-                    **common_kwargs,
-                    name=('layer_%d' % i)
+        layer_kwargs = dict(
+            num_attention_heads=self._num_attention_heads,
+            intermediate_size=self._intermediate_size,
+            intermediate_activation=self._intermediate_activation,
+            hidden_dropout_rate=self._hidden_dropout_rate,
+            attention_dropout_rate=self._attention_dropout_rate,
+            use_bias=self._use_bias,
+            norm_first=self._norm_first,
+            norm_epsilon=self._norm_epsilon,
+            num_kv_heads=self._num_kv_heads,
+            fuse_qkv_projection=self._fuse_qkv_projection,
+            linear_attention=self._linear_attention,
+            num_random_features=self._num_random_features,
+            **common_kwargs
+        )
+
+        if self._scan_layers:
+            # 属性名为 utils.STACKED_LAYER_NAME，checkpoint 按名字与展开执行时的 decoder_layers 对应
+            self.stacked_layer = decoder_layer.TransformerDecoderLayer(**layer_kwargs, name='stacked_layer')
+            # 用长度为 1 的输入调用一次，创建 (num_hidden_layers, ...) 的权重
+            # 在 init_scope 中执行，不会加入到调用者的 graph 中
+            with tf.init_scope(), tf.variable_creator_scope(utils.stacked_variable_creator(self._num_hidden_layers)):
+                dummy_inputs = tf.zeros([1, 1, input_shape[-1]], dtype=self._compute_dtype)
+                dummy_mask = tf.zeros([1, 1, 1], dtype=self._compute_dtype)
+                self.stacked_layer(
+                    [dummy_inputs, dummy_inputs, dummy_mask, dummy_mask], training=False, layer_index=0
                 )
-            )
+        else:
+            self.decoder_layers = [
+                decoder_layer.TransformerDecoderLayer(**layer_kwargs, name=('layer_%d' % i))
+                for i in range(self._num_hidden_layers)
+            ]
 
         super(TransformerDecoderStack, self).build(input_shape)
 
@@ -80,6 +122,7 @@ class TransformerDecoderStack(tf.keras.layers.Layer):
         config = {
             'num_hidden_layers': self._num_hidden_layers,
             'num_attention_heads': self._num_attention_heads,
+            'num_kv_heads': self._num_kv_heads,
             'intermedia_size': self._intermediate_size,
             'intermediate_activation': self._intermediate_activation,
             'hidden_dropout_rate': self._hidden_dropout_rate,
@@ -98,34 +141,107 @@ class TransformerDecoderStack(tf.keras.layers.Layer):
                 tf.keras.constraints.serialize(self._bias_constraint),
             'use_bias': self._use_bias,
             'norm_first': self._norm_first,
-            'norm_epsilon': self._norm_epsilon
+            'norm_epsilon': self._norm_epsilon,
+            'fuse_qkv_projection': self._fuse_qkv_projection,
+            'linear_attention': self._linear_attention,
+            'num_random_features': self._num_random_features,
+            'scan_layers': self._scan_layers
         }
 
-        base_config = super(TransformerEncoderStack, self).get_config()
+        base_config = super(TransformerDecoderStack, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
 
     @property
     def num_attention_heads(self):
         return self._num_attention_heads
 
+    @property
+    def num_kv_heads(self):
+        return self._num_kv_heads
+
     @property
     def num_hidden_layers(self):
         return self._num_hidden_layers
 
-    def call(self, targets_embeddings, encoder_outputs, padding_mask, look_ahead_mask, training, cache=None):
+    @property
+    def linear_attention(self):
+        return self._linear_attention
+
+    @property
+    def num_random_features(self):
+        return self._num_random_features
+
+    def compute_encoder_decoder_cache(self, encoder_outputs):
+        """
+            预先计算每一层 encoder-decoder attention 的 key / value 投影，详见 TransformerDecoderLayer
+
+        :param encoder_outputs: (batch_size, inputs_seq_len, hidden_size)
+        :return: {layer_idx: {'encoder_decoder_key': ..., 'encoder_decoder_value': ...}}
+        """
+        with tf.name_scope(self.name):
+            if not self.built:
+                self.build(encoder_outputs.shape)
+
+            if self._scan_layers:
+                return {
+                    str(i): self.stacked_layer.compute_encoder_decoder_cache(encoder_outputs, layer_index=i)
+                    for i in range(self._num_hidden_layers)
+                }
+            return {
+                str(i): self.decoder_layers[i].compute_encoder_decoder_cache(encoder_outputs)
+                for i in range(self._num_hidden_layers)
+            }
+
+    def _call_layer(self, i, inputs, **kwargs):
+        """第 i 层，scan_layers 时为 stacked_layer 使用第 i 层的权重"""
+        if self._scan_layers:
+            return self.stacked_layer(inputs, layer_index=i, **kwargs)
+        return self.decoder_layers[i](inputs, **kwargs)
+
+    def call(
+            self,
+            targets_embeddings,
+            encoder_outputs,
+            padding_mask,
+            look_ahead_mask,
+            training,
+            cache=None,
+            decode_loop_step=None,
+            cache_indirection=None,
+            beam_size=None
+    ):
+        """
+        :param cache_indirection: (batch_size, beam_size, max_decode_len)，所有层共用，详见 CacheAttention
+        :param beam_size: encoder_outputs 和 padding_mask 只有 batch_size 份时的 beam_size，详见 TransformerDecoderLayer
+        """
+
+        if self._scan_layers and cache is None:
+            return utils.scan_layers(
+                lambda layer_index, decoder_outputs: self.stacked_layer(
+                    [decoder_outputs, encoder_outputs, padding_mask, look_ahead_mask],
+                    training=training,
+                    layer_index=layer_index
+                )[0],
+                targets_embeddings,
+                self._num_hidden_layers
+            )
 
         decoder_outputs = targets_embeddings
 
         for i in range(self._num_hidden_layers):
             decoder_inputs = [decoder_outputs, encoder_outputs, padding_mask, look_ahead_mask]
             if cache is None:
-                decoder_outputs, _ = self.decoder_layers[i](decoder_inputs)
+                decoder_outputs, _ = self._call_layer(i, decoder_inputs)
             else:
                 # 对 cache 进行覆盖修改
                 cache_layer_idx = str(i)
-                decoder_outputs, cache[cache_layer_idx] = self.decoder_layers[i](
+                decoder_outputs, cache[cache_layer_idx] = self._call_layer(
+                    i,
                     decoder_inputs,
-                    cache=cache[cache_layer_idx]
+                    cache=cache[cache_layer_idx],
+                    decode_loop_step=decode_loop_step,
+                    cache_indirection=cache_indirection,
+                    beam_size=beam_size
                 )
 
         return decoder_outputs
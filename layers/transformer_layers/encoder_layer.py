@@ -7,7 +7,10 @@ from __future__ import print_function
 import tensorflow as tf
 
 from layers.attention_layers.multi_head_attention_layer import MultiHeadAttention
+from layers.attention_layers.sliding_window_attention_layer import SlidingWindowAttention
+from layers.attention_layers.linear_attention_layer import LinearAttention
 from layers.attention_layers.einsum_dense import EinsumDense
+from layers.normalization_layers.layer_normalization import LayerNormalization
 
 
 class TransformerEncoderLayer(tf.keras.layers.Layer):
@@ -26,6 +29,24 @@ class TransformerEncoderLayer(tf.keras.layers.Layer):
                     2. intermediate activation
                     3. hidden dropout rate
 
+        fuse_qkv_projection 为 True 时 self attention 的 query、key、value 投影合并为一次，详见 MultiHeadAttention
+        attention_chunk_size 不为 None 时 self attention 分块计算，不保存完整的 attention score，用于长序列，
+        详见 MultiHeadAttention
+        attention_window_size 不为 None 时使用局部窗口 + 全局 token 的稀疏 self attention，
+        前 num_global_tokens 个 token 为全局 token，详见 SlidingWindowAttention
+        linear_attention 不为 None 时使用 kernelized linear attention，取值为核函数 feature map ('elu' 或 'random')，
+        详见 LinearAttention，此时不计算 attention score，attention_dropout_rate 必须为 0
+
+        输入为 [inputs, mask, token_indices] 时为去掉 padding 的计算：
+        inputs 为 utils.pack_tokens 得到的 (1, num_tokens, hidden_size)，layer norm 和全连接层只对非 padding 的 token 计算，
+        只有 self attention 内部按 mask 的形状恢复 padding，输出同样为 (1, num_tokens, hidden_size)
+
+        只需要部分位置的输出时 (例如分类只需要 [CLS]，masked LM 只需要被 mask 的位置)，
+        可以只为这些位置计算 query、全连接层和输出，key / value 仍使用所有位置：
+            1. output_range 为 N 时只计算前 N 个位置，输出为 (batch_size, N, hidden_size)
+            2. call 时给定 output_positions (batch_size, num_positions) 时只计算这些位置，
+               输出为 (batch_size, num_positions, hidden_size)，优先于 output_range
+        不支持与去掉 padding 的计算以及 attention_window_size 同时使用
     """
     def __init__(
             self,
@@ -44,9 +65,20 @@ class TransformerEncoderLayer(tf.keras.layers.Layer):
             activity_regularizer=None,
             kernel_constraint=None,
             bias_constraint=None,
+            fuse_qkv_projection=False,
+            attention_chunk_size=None,
+            attention_window_size=None,
+            num_global_tokens=1,
+            linear_attention=None,
+            num_random_features=None,
+            output_range=None,
             **kwargs
     ):
         super(TransformerEncoderLayer, self).__init__(**kwargs)
+        if output_range is not None and attention_window_size is not None:
+            raise ValueError('output_range is not supported with attention_window_size')
+        if linear_attention is not None and attention_dropout_rate:
+            raise ValueError('attention_dropout_rate is not supported with linear_attention')
 
         # attention
         self._num_attention_heads = num_attention_heads
@@ -54,6 +86,13 @@ class TransformerEncoderLayer(tf.keras.layers.Layer):
         self._use_bias = use_bias
         self._norm_first = norm_first
         self._norm_epsilon = norm_epsilon
+        self._fuse_qkv_projection = fuse_qkv_projection
+        self._attention_chunk_size = attention_chunk_size
+        self._attention_window_size = attention_window_size
+        self._num_global_tokens = num_global_tokens
+        self._linear_attention = linear_attention
+        self._num_random_features = num_random_features
+        self._output_range = output_range
 
         # position-wise feed-forward network
         self._intermediate_size = intermediate_size
@@ -71,14 +110,16 @@ class TransformerEncoderLayer(tf.keras.layers.Layer):
 
     def build(self, input_shape):
         """
-        :param input_shape: 包含 inputs shape 和 mask shape 或仅包含 inputs shape
+        :param input_shape: 包含 inputs shape 和 mask shape (以及 token_indices shape) 或仅包含 inputs shape
         其中 inputs shape 应该为 (batch_size, seq_len, hidden_size)
-        mask shape 应该为 (batch_size, seq_len, seq_len)
+        mask shape 应该为 (batch_size, 1, seq_len)，只包含 key 的 padding 信息，可以为 bool
         因为是 self-attention，所以两个 seq_len 相同
         """
 
         # 获取 inputs shape
-        inputs_tensor_shape = input_shape[0] if len(input_shape) == 2 else input_shape
+        has_mask = isinstance(input_shape, (list, tuple)) and len(input_shape) in (2, 3) and \
+            isinstance(input_shape[0], (list, tuple, tf.TensorShape))
+        inputs_tensor_shape = input_shape[0] if has_mask else input_shape
         inputs_tensor_shape = tf.TensorShape(inputs_tensor_shape)
         if len(inputs_tensor_shape) != 3:
             raise ValueError(
@@ -88,7 +129,8 @@ class TransformerEncoderLayer(tf.keras.layers.Layer):
         batch_size, seq_len, hidden_size = inputs_tensor_shape
 
         # 获取 attention mask 相关参数
-        if len(input_shape) == 2:
+        # 去掉 padding 时 inputs 为 (1, num_tokens, hidden_size)，与 mask 的形状无关
+        if has_mask and len(input_shape) == 2:
             mask_tensor_shape = tf.TensorShape(input_shape[1])
             expected_mask_tensor_shape = tf.TensorShape(
                 [batch_size, 1, seq_len]
@@ -126,21 +168,37 @@ class TransformerEncoderLayer(tf.keras.layers.Layer):
         )
 
         # attention layer
-        self.attention_layer = MultiHeadAttention(
+        attention_kwargs = dict(
             num_attention_heads=self._num_attention_heads,
             size_per_head_for_query_and_key=self._size_per_head,
             size_per_head_for_value=self._size_per_head,
             attention_dropout_rate=self._attention_dropout_rate,
             use_bias=self._use_bias,
+            fuse_qkv_projection=self._fuse_qkv_projection,
+            attention_chunk_size=self._attention_chunk_size,
             name='self_attention',
             **common_kwargs
         )
+        if self._attention_window_size is not None:
+            self.attention_layer = SlidingWindowAttention(
+                window_size=self._attention_window_size,
+                num_global_tokens=self._num_global_tokens,
+                **attention_kwargs
+            )
+        elif self._linear_attention is not None:
+            self.attention_layer = LinearAttention(
+                feature_map=self._linear_attention,
+                num_random_features=self._num_random_features,
+                **attention_kwargs
+            )
+        else:
+            self.attention_layer = MultiHeadAttention(**attention_kwargs)
         # attention 后接的 dropout
         self.attention_dropout = tf.keras.layers.Dropout(
             rate=self._hidden_dropout_rate
         )
         # attention 后接的 layer norm
-        self.attention_layer_norm = tf.keras.layers.LayerNormalization(
+        self.attention_layer_norm = LayerNormalization(
             name='self_attention_layer_norm',
             axis=-1,
             epsilon=self._norm_epsilon,
@@ -180,7 +238,7 @@ class TransformerEncoderLayer(tf.keras.layers.Layer):
         self.output_dropout = tf.keras.layers.Dropout(
             rate=self._hidden_dropout_rate
         )
-        self.output_layer_norm = tf.keras.layers.LayerNormalization(
+        self.output_layer_norm = LayerNormalization(
             name='output_layer_norm',
             axis=-1,
             epsilon=self._norm_epsilon,
@@ -188,26 +246,58 @@ class TransformerEncoderLayer(tf.keras.layers.Layer):
         )
         super(TransformerEncoderLayer, self).build(input_shape)
 
-    def call(self, inputs, training):
-        # input: (batch_size, seq_len, hidden_size)
+    def call(self, inputs, training, output_positions=None, layer_index=None):
+        """
+        :param layer_index: 不为 None 时所有权重为多层 stacked 的权重 (num_layers, ...)，只使用其中第 layer_index 层，
+            用于 scan_layers 时结构相同的多层共用一个层对象，见 layers.utils.stacked_variable_creator
+        """
+        # input: (batch_size, seq_len, hidden_size) or (1, num_tokens, hidden_size)
         # mask: (batch_size, 1, seq_len)
-        if isinstance(inputs, (list, tuple)) and len(inputs) == 2:
+        # token_indices: (num_tokens, 2)
+        token_indices = None
+        if isinstance(inputs, (list, tuple)) and len(inputs) == 3:
+            inputs_tensor, inputs_padding_mask, token_indices = inputs
+        elif isinstance(inputs, (list, tuple)) and len(inputs) == 2:
             inputs_tensor, inputs_padding_mask = inputs
         else:
             inputs_tensor, inputs_padding_mask = (inputs, None)
 
+        # 选出需要输出的位置，作为 query 和残差连接的输入
+        if output_positions is not None or self._output_range is not None:
+            if token_indices is not None or self._attention_window_size is not None:
+                raise ValueError(
+                    'output_range and output_positions are not supported with '
+                    'token_indices or attention_window_size'
+                )
+            if output_positions is not None:
+                def select_outputs(tensor):
+                    return tf.gather(tensor, output_positions, axis=1, batch_dims=1)
+            else:
+                def select_outputs(tensor):
+                    return tensor[:, :self._output_range]
+            # 完整的 mask 需要选出对应的行
+            if inputs_padding_mask is not None and inputs_padding_mask.shape[1] != 1:
+                inputs_padding_mask = select_outputs(inputs_padding_mask)
+        else:
+            def select_outputs(tensor):
+                return tensor
+
         if self._norm_first:
-            source_tensor = inputs_tensor  # 保留操作前的数据，用于后面残差连接
-            inputs_tensor = self.attention_layer_norm(inputs_tensor)
+            source_tensor = select_outputs(inputs_tensor)  # 保留操作前的数据，用于后面残差连接
+            inputs_tensor = self.attention_layer_norm(inputs_tensor, layer_index=layer_index)
+        # (batch_size, num_outputs, hidden_size)，不选择位置时与 inputs_tensor 是同一个张量
+        target_tensor = select_outputs(inputs_tensor)
 
         # self-attention
-        # query = key = value
-        # (batch_size, seq_len, hidden_size)
+        # key = value
+        # (batch_size, num_outputs, hidden_size)
         attention_output = self.attention_layer(
-            query=inputs_tensor,
+            query=target_tensor,
             value=inputs_tensor,
             key=inputs_tensor,
-            attention_mask=inputs_padding_mask
+            attention_mask=inputs_padding_mask,
+            token_indices=token_indices,
+            layer_index=layer_index
         )
         if training:
             attention_output = self.attention_dropout(attention_output)
@@ -218,17 +308,17 @@ class TransformerEncoderLayer(tf.keras.layers.Layer):
         # 否则先残差连接，然后 layer norm
         else:
             attention_output = self.attention_layer_norm(
-                inputs_tensor + attention_output
+                target_tensor + attention_output, layer_index=layer_index
             )
 
         if self._norm_first:
             source_attention_output = attention_output
-            attention_output = self.output_layer_norm(attention_output)
+            attention_output = self.output_layer_norm(attention_output, layer_index=layer_index)
 
-        feed_forward_net_output = self.intermediate_dense(attention_output)
+        feed_forward_net_output = self.intermediate_dense(attention_output, layer_index=layer_index)
         feed_forward_net_output = self.intermediate_dense_activation(feed_forward_net_output)
 
-        layer_output = self.output_dense(feed_forward_net_output)
+        layer_output = self.output_dense(feed_forward_net_output, layer_index=layer_index)
 
         if training:
             layer_output = self.output_dropout(layer_output)
@@ -237,7 +327,7 @@ class TransformerEncoderLayer(tf.keras.layers.Layer):
         if self._norm_first:
             layer_output = source_attention_output + layer_output
         else:
-            layer_output = self.output_layer_norm(layer_output + attention_output)
+            layer_output = self.output_layer_norm(layer_output + attention_output, layer_index=layer_index)
 
         return layer_output
 
@@ -262,7 +352,14 @@ class TransformerEncoderLayer(tf.keras.layers.Layer):
                 tf.keras.constraints.serialize(self._bias_constraint),
             'use_bias': self._use_bias,
             'norm_first': self._norm_first,
-            'norm_epsilon': self._norm_epsilon
+            'norm_epsilon': self._norm_epsilon,
+            'fuse_qkv_projection': self._fuse_qkv_projection,
+            'attention_chunk_size': self._attention_chunk_size,
+            'attention_window_size': self._attention_window_size,
+            'num_global_tokens': self._num_global_tokens,
+            'linear_attention': self._linear_attention,
+            'num_random_features': self._num_random_features,
+            'output_range': self._output_range
         }
         base_config = super(TransformerEncoderLayer, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
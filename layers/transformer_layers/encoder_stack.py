@@ -1,6 +1,7 @@
 # -*- coding: utf - 8 -*-
 
 import tensorflow as tf
+from layers import utils
 from layers.transformer_layers import encoder_layer
 
 
@@ -24,9 +25,29 @@ class TransformerEncoderStack(tf.keras.layers.Layer):
             activity_regularizer=None,
             kernel_constraint=None,
             bias_constraint=None,
+            fuse_qkv_projection=False,
+            linear_attention=None,
+            num_random_features=None,
+            unpadded=False,
+            scan_layers=False,
             **kwargs
     ):
+        """
+        :param fuse_qkv_projection: self attention 的 query、key、value 投影是否合并为一次，详见 MultiHeadAttention
+        :param linear_attention: 不为 None 时 self attention 使用 kernelized linear attention，
+            取值为核函数 feature map ('elu' 或 'random')，详见 LinearAttention
+        :param num_random_features: linear_attention 为 'random' 时随机特征的个数
+        :param unpadded: 是否去掉 padding 计算，在第一层之前把非 padding 的 token 拼接在一起，
+            最后一层之后恢复 padding (padding 位置的输出为 0)，详见 TransformerEncoderLayer
+        :param scan_layers: 是否用一个 tf.while_loop 执行所有层而不是展开 python 循环，
+            tracing 时间和 graph 大小与层数无关，详见 utils.scan_layers
+            所有层共用一个层对象 stacked_layer，每个权重为 (num_hidden_layers, ...) 的变量，
+            与展开执行时的 checkpoint 可以通过 utils.convert_stacked_checkpoint_weight 相互转换
+            不支持 linear_attention 为 'random'
+        """
         super(TransformerEncoderStack, self).__init__(**kwargs)
+        if scan_layers and linear_attention == 'random':
+            raise ValueError('scan_layers is not supported with random feature linear attention')
         self._num_hidden_layers = num_hidden_layers
         self._num_attention_heads = num_attention_heads
         self._intermediate_size = intermediate_size
@@ -36,6 +57,11 @@ class TransformerEncoderStack(tf.keras.layers.Layer):
         self._use_bias = use_bias
         self._norm_first = norm_first
         self._norm_epsilon = norm_epsilon
+        self._fuse_qkv_projection = fuse_qkv_projection
+        self._linear_attention = linear_attention
+        self._num_random_features = num_random_features
+        self._unpadded = unpadded
+        self._scan_layers = scan_layers
         self._kernel_initializer = tf.keras.initializers.get(kernel_initializer)
         self._bias_initializer = tf.keras.initializers.get(bias_initializer)
         self._kernel_regularizer = tf.keras.regularizers.get(kernel_regularizer)
@@ -56,23 +82,35 @@ class TransformerEncoderStack(tf.keras.layers.Layer):
             bias_constraint=self._bias_constraint
         )
 
-        self.encoder_layers = []
-        for i in range(self._num_hidden_layers):
-            self.encoder_layers.append(
-                encoder_layer.TransformerEncoderLayer(
-                    num_attention_heads=self._num_attention_heads,
-                    intermediate_size=self._intermediate_size,
-                    intermediate_activation=self._intermediate_activation,
-                    hidden_dropout_rate=self._hidden_dropout_rate,
-                    attention_dropout_rate=self._attention_dropout_rate,
-                    use_bias=self._use_bias,
-                    norm_first=self._norm_first,
-                    norm_epsilon=self._norm_epsilon,
-                    **common_kwargs,
-                    name=('layer_%d' % i)
-                )
-            )
-        
+        layer_kwargs = dict(
+            num_attention_heads=self._num_attention_heads,
+            intermediate_size=self._intermediate_size,
+            intermediate_activation=self._intermediate_activation,
+            hidden_dropout_rate=self._hidden_dropout_rate,
+            attention_dropout_rate=self._attention_dropout_rate,
+            use_bias=self._use_bias,
+            norm_first=self._norm_first,
+            norm_epsilon=self._norm_epsilon,
+            fuse_qkv_projection=self._fuse_qkv_projection,
+            linear_attention=self._linear_attention,
+            num_random_features=self._num_random_features,
+            **common_kwargs
+        )
+
+        if self._scan_layers:
+            # 属性名为 utils.STACKED_LAYER_NAME，checkpoint 按名字与展开执行时的 encoder_layers 对应
+            self.stacked_layer = encoder_layer.TransformerEncoderLayer(**layer_kwargs, name='stacked_layer')
+            # 用长度为 1 的输入调用一次，创建 (num_hidden_layers, ...) 的权重
+            # 在 init_scope 中执行，不会加入到调用者的 graph 中
+            with tf.init_scope(), tf.variable_creator_scope(utils.stacked_variable_creator(self._num_hidden_layers)):
+                dummy_inputs = tf.zeros([1, 1, input_shape[-1]], dtype=self._compute_dtype)
+                self.stacked_layer(dummy_inputs, training=False, layer_index=0)
+        else:
+            self.encoder_layers = [
+                encoder_layer.TransformerEncoderLayer(**layer_kwargs, name=('layer_%d' % i))
+                for i in range(self._num_hidden_layers)
+            ]
+
         super(TransformerEncoderStack, self).build(input_shape)
 
     def get_config(self):
@@ -97,20 +135,46 @@ class TransformerEncoderStack(tf.keras.layers.Layer):
                 tf.keras.constraints.serialize(self._bias_constraint),
             'use_bias': self._use_bias,
             'norm_first': self._norm_first,
-            'norm_epsilon': self._norm_epsilon
+            'norm_epsilon': self._norm_epsilon,
+            'fuse_qkv_projection': self._fuse_qkv_projection,
+            'linear_attention': self._linear_attention,
+            'num_random_features': self._num_random_features,
+            'unpadded': self._unpadded,
+            'scan_layers': self._scan_layers
         }
 
         base_config = super(TransformerEncoderStack, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
 
-    def call(self, inputs_embeddings, padding_mask, training):
+    def _run_layers(self, inputs_embeddings, other_inputs, training):
+        """
+            依次执行所有层
 
-        for i in range(self._num_hidden_layers):
-            inputs_embeddings = self.encoder_layers[i](
-                inputs=[inputs_embeddings, padding_mask],
-                training=training
+        :param other_inputs: 每一层除 inputs_embeddings 之外的输入，所有层相同
+        """
+        if self._scan_layers:
+            return utils.scan_layers(
+                lambda layer_index, layer_inputs: self.stacked_layer(
+                    inputs=[layer_inputs] + other_inputs, training=training, layer_index=layer_index
+                ),
+                inputs_embeddings,
+                self._num_hidden_layers
             )
 
-        encoder_outputs = inputs_embeddings
+        for i in range(self._num_hidden_layers):
+            inputs_embeddings = self.encoder_layers[i](inputs=[inputs_embeddings] + other_inputs, training=training)
+        return inputs_embeddings
+
+    def call(self, inputs_embeddings, padding_mask, training):
+
+        if self._unpadded and padding_mask is not None:
+            batch_size, seq_len = tf.shape(inputs_embeddings)[0], tf.shape(inputs_embeddings)[1]
+            token_indices = utils.get_token_indices(padding_mask)
+            # (1, num_tokens, hidden_size)
+            inputs_embeddings = utils.pack_tokens(inputs_embeddings, token_indices)
+            inputs_embeddings = self._run_layers(inputs_embeddings, [padding_mask, token_indices], training)
+            return utils.unpack_tokens(inputs_embeddings, token_indices, batch_size, seq_len)
+
+        encoder_outputs = self._run_layers(inputs_embeddings, [padding_mask], training)
 
         return encoder_outputs
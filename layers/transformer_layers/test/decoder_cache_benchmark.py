@@ -0,0 +1,120 @@
+# -*- coding: utf - 8 -*-
+
+"""
+    对比 CacheAttention 两种 cache 模式下逐步解码的单 token 延迟
+
+    1. concat: cache 每一步通过 tf.concat 增长，第 i 步需要拷贝之前的 i 个位置
+    2. padded: cache 预分配为 max_decode_len，每一步按下标写入
+
+    运行方式：
+        python -m layers.transformer_layers.test.decoder_cache_benchmark --benchmarks=.
+"""
+
+import time
+import tensorflow as tf
+from layers import utils
+from layers.transformer_layers.decoder_stack import TransformerDecoderStack
+
+_BATCH_SIZE = 16
+_HIDDEN_SIZE = 256
+_NUM_HIDDEN_LAYERS = 4
+_NUM_ATTENTION_HEADS = 8
+_INPUTS_SEQ_LEN = 32
+_MAX_DECODE_LEN = 256
+_DECODE_LENS = (32, 64, 128, 256)
+_NUM_ITERS = 3
+
+
+def _create_cache(batch_size, init_decode_len, num_layers, num_heads, size_per_head):
+    return {
+        str(layer): {
+            'key': tf.zeros([batch_size, init_decode_len, num_heads, size_per_head]),
+            'value': tf.zeros([batch_size, init_decode_len, num_heads, size_per_head])
+        } for layer in range(num_layers)
+    }
+
+
+class DecoderCacheBenchmark(tf.test.Benchmark):
+
+    def _build_decode_fn(self, decoder_stack, padded_decode, decode_len):
+        size_per_head = _HIDDEN_SIZE // _NUM_ATTENTION_HEADS
+        look_ahead_mask = utils.get_look_ahead_mask(_MAX_DECODE_LEN)
+        encoder_outputs = tf.random.normal([_BATCH_SIZE, _INPUTS_SEQ_LEN, _HIDDEN_SIZE])
+        padding_mask = tf.zeros([_BATCH_SIZE, 1, _INPUTS_SEQ_LEN])
+
+        @tf.function
+        def decode():
+            init_decode_len = _MAX_DECODE_LEN if padded_decode else 0
+            cache = _create_cache(
+                _BATCH_SIZE, init_decode_len, _NUM_HIDDEN_LAYERS, _NUM_ATTENTION_HEADS, size_per_head
+            )
+            decoder_inputs = tf.zeros([_BATCH_SIZE, 1, _HIDDEN_SIZE])
+
+            def body(i, decoder_inputs, cache):
+                if padded_decode:
+                    mask = look_ahead_mask[:, i: i + 1, :]
+                else:
+                    mask = look_ahead_mask[:, i: i + 1, :i + 1]
+                decoder_outputs = decoder_stack(
+                    decoder_inputs,
+                    encoder_outputs,
+                    padding_mask,
+                    mask,
+                    training=False,
+                    cache=cache,
+                    decode_loop_step=i if padded_decode else None
+                )
+                return i + 1, decoder_outputs, cache
+
+            if padded_decode:
+                cache_shapes = tf.nest.map_structure(lambda t: t.shape, cache)
+            else:
+                cache_shapes = tf.nest.map_structure(
+                    lambda t: tf.TensorShape([_BATCH_SIZE, None, _NUM_ATTENTION_HEADS, size_per_head]),
+                    cache
+                )
+            _, decoder_outputs, _ = tf.while_loop(
+                lambda i, *_: i < decode_len,
+                body,
+                loop_vars=[tf.constant(0), decoder_inputs, cache],
+                shape_invariants=[
+                    tf.TensorShape([]), tf.TensorShape([_BATCH_SIZE, None, _HIDDEN_SIZE]), cache_shapes
+                ]
+            )
+            return decoder_outputs
+
+        return decode
+
+    def _run_benchmark(self, padded_decode):
+        decoder_stack = TransformerDecoderStack(
+            num_hidden_layers=_NUM_HIDDEN_LAYERS,
+            num_attention_heads=_NUM_ATTENTION_HEADS,
+            intermediate_size=_HIDDEN_SIZE * 4
+        )
+        mode = 'padded' if padded_decode else 'concat'
+        for decode_len in _DECODE_LENS:
+            decode = self._build_decode_fn(decoder_stack, padded_decode, decode_len)
+            # 预热，排除 tracing 时间
+            decode()
+
+            start = time.time()
+            for _ in range(_NUM_ITERS):
+                decode()
+            wall_time = (time.time() - start) / _NUM_ITERS
+
+            self.report_benchmark(
+                iters=_NUM_ITERS,
+                wall_time=wall_time,
+                extras={'ms_per_token': wall_time / decode_len * 1000},
+                name='decode_%s_cache_len_%d' % (mode, decode_len)
+            )
+
+    def benchmark_concat_cache(self):
+        self._run_benchmark(padded_decode=False)
+
+    def benchmark_padded_cache(self):
+        self._run_benchmark(padded_decode=True)
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -0,0 +1,198 @@
+# -*- coding: utf - 8 -*-
+
+"""
+    对比 softmax attention 与 kernelized linear attention 随序列长度的变化
+
+    1. encoder: TransformerEncoderStack 前向计算，报告 tokens_per_second
+    2. causal: TransformerDecoderStack 训练时的前向计算 (teacher forcing)，报告 tokens_per_second
+       causal linear attention 分块计算累加和
+    3. decode: TransformerDecoderStack 逐步解码，报告 ms_per_token
+       softmax attention 使用预分配的 key / value cache，每一步与全部 max_decode_len 个位置计算 attention
+       linear attention 的 cache 只保存累加和，每一步的计算量与解码长度无关
+
+    运行方式：
+        python -m layers.transformer_layers.test.linear_attention_benchmark --benchmarks=.
+"""
+
+import time
+import tensorflow as tf
+from layers import utils
+from layers.attention_layers import linear_attention_layer
+from layers.attention_layers import multi_head_attention_layer
+from layers.transformer_layers.encoder_stack import TransformerEncoderStack
+from layers.transformer_layers.decoder_stack import TransformerDecoderStack
+
+_HIDDEN_SIZE = 256
+_NUM_HIDDEN_LAYERS = 2
+_NUM_ATTENTION_HEADS = 8
+_ENCODER_BATCH_SIZE = 2
+_ENCODER_SEQ_LENS = (512, 1024, 2048, 4096)
+_DECODER_BATCH_SIZE = 8
+_INPUTS_SEQ_LEN = 32
+_DECODE_LENS = (128, 512, 1024)
+_NUM_ITERS = 3
+
+
+def _get_mode(linear_attention):
+    return 'softmax' if linear_attention is None else 'linear_%s' % linear_attention
+
+
+class LinearAttentionBenchmark(tf.test.Benchmark):
+
+    def _run_encoder_benchmark(self, linear_attention):
+        encoder_stack = TransformerEncoderStack(
+            num_hidden_layers=_NUM_HIDDEN_LAYERS,
+            num_attention_heads=_NUM_ATTENTION_HEADS,
+            intermediate_size=_HIDDEN_SIZE * 4,
+            linear_attention=linear_attention
+        )
+
+        @tf.function(experimental_relax_shapes=True)
+        def encode(inputs, padding_mask):
+            return encoder_stack(inputs, padding_mask, training=False)
+
+        for seq_len in _ENCODER_SEQ_LENS:
+            inputs = tf.random.normal([_ENCODER_BATCH_SIZE, seq_len, _HIDDEN_SIZE], seed=1)
+            padding_mask = tf.zeros([_ENCODER_BATCH_SIZE, 1, seq_len])
+            # 预热，排除 tracing 时间
+            encode(inputs, padding_mask).numpy()
+
+            start = time.time()
+            for _ in range(_NUM_ITERS):
+                encode(inputs, padding_mask).numpy()
+            wall_time = (time.time() - start) / _NUM_ITERS
+
+            self.report_benchmark(
+                iters=_NUM_ITERS,
+                wall_time=wall_time,
+                extras={'tokens_per_second': _ENCODER_BATCH_SIZE * seq_len / wall_time},
+                name='encoder_%s_seq_len_%d' % (_get_mode(linear_attention), seq_len)
+            )
+
+    def _run_causal_benchmark(self, linear_attention):
+        decoder_stack = TransformerDecoderStack(
+            num_hidden_layers=_NUM_HIDDEN_LAYERS,
+            num_attention_heads=_NUM_ATTENTION_HEADS,
+            intermediate_size=_HIDDEN_SIZE * 4,
+            linear_attention=linear_attention
+        )
+        encoder_outputs = tf.random.normal([_ENCODER_BATCH_SIZE, _INPUTS_SEQ_LEN, _HIDDEN_SIZE], seed=2)
+        padding_mask = tf.zeros([_ENCODER_BATCH_SIZE, 1, _INPUTS_SEQ_LEN])
+
+        @tf.function(experimental_relax_shapes=True)
+        def decode(inputs, look_ahead_mask):
+            return decoder_stack(inputs, encoder_outputs, padding_mask, look_ahead_mask, training=False)
+
+        for seq_len in _ENCODER_SEQ_LENS:
+            inputs = tf.random.normal([_ENCODER_BATCH_SIZE, seq_len, _HIDDEN_SIZE], seed=1)
+            look_ahead_mask = utils.get_look_ahead_mask(seq_len)
+            # 预热，排除 tracing 时间
+            decode(inputs, look_ahead_mask).numpy()
+
+            start = time.time()
+            for _ in range(_NUM_ITERS):
+                decode(inputs, look_ahead_mask).numpy()
+            wall_time = (time.time() - start) / _NUM_ITERS
+
+            self.report_benchmark(
+                iters=_NUM_ITERS,
+                wall_time=wall_time,
+                extras={'tokens_per_second': _ENCODER_BATCH_SIZE * seq_len / wall_time},
+                name='causal_%s_seq_len_%d' % (_get_mode(linear_attention), seq_len)
+            )
+
+    def _build_decode_fn(self, decoder_stack, linear_attention, decode_len):
+        size_per_head = _HIDDEN_SIZE // _NUM_ATTENTION_HEADS
+        look_ahead_mask = utils.get_look_ahead_mask(decode_len)
+        encoder_outputs = tf.random.normal([_DECODER_BATCH_SIZE, _INPUTS_SEQ_LEN, _HIDDEN_SIZE])
+        padding_mask = tf.zeros([_DECODER_BATCH_SIZE, 1, _INPUTS_SEQ_LEN])
+
+        @tf.function
+        def decode():
+            if linear_attention is None:
+                cache = {
+                    str(layer): multi_head_attention_layer.create_cache(
+                        _DECODER_BATCH_SIZE, decode_len, _NUM_ATTENTION_HEADS, size_per_head
+                    ) for layer in range(_NUM_HIDDEN_LAYERS)
+                }
+            else:
+                feature_size = linear_attention_layer.get_feature_size(linear_attention, size_per_head)
+                cache = {
+                    str(layer): linear_attention_layer.create_cache(
+                        _DECODER_BATCH_SIZE, _NUM_ATTENTION_HEADS, size_per_head, feature_size
+                    ) for layer in range(_NUM_HIDDEN_LAYERS)
+                }
+            decoder_inputs = tf.zeros([_DECODER_BATCH_SIZE, 1, _HIDDEN_SIZE])
+
+            def body(i, decoder_inputs, cache):
+                decoder_outputs = decoder_stack(
+                    decoder_inputs,
+                    encoder_outputs,
+                    padding_mask,
+                    look_ahead_mask[:, i: i + 1, :],
+                    training=False,
+                    cache=cache,
+                    decode_loop_step=i
+                )
+                return i + 1, tf.reshape(decoder_outputs, [_DECODER_BATCH_SIZE, 1, _HIDDEN_SIZE]), cache
+
+            _, decoder_outputs, _ = tf.while_loop(
+                lambda i, *_: i < decode_len,
+                body,
+                loop_vars=[tf.constant(0), decoder_inputs, cache]
+            )
+            return decoder_outputs
+
+        return decode
+
+    def _run_decode_benchmark(self, linear_attention):
+        decoder_stack = TransformerDecoderStack(
+            num_hidden_layers=_NUM_HIDDEN_LAYERS,
+            num_attention_heads=_NUM_ATTENTION_HEADS,
+            intermediate_size=_HIDDEN_SIZE * 4,
+            linear_attention=linear_attention
+        )
+        for decode_len in _DECODE_LENS:
+            decode = self._build_decode_fn(decoder_stack, linear_attention, decode_len)
+            # 预热，排除 tracing 时间
+            decode().numpy()
+
+            start = time.time()
+            for _ in range(_NUM_ITERS):
+                decode().numpy()
+            wall_time = (time.time() - start) / _NUM_ITERS
+
+            self.report_benchmark(
+                iters=_NUM_ITERS,
+                wall_time=wall_time,
+                extras={'ms_per_token': wall_time / decode_len * 1000},
+                name='decode_%s_len_%d' % (_get_mode(linear_attention), decode_len)
+            )
+
+    def benchmark_softmax_encoder(self):
+        self._run_encoder_benchmark(linear_attention=None)
+
+    def benchmark_linear_elu_encoder(self):
+        self._run_encoder_benchmark(linear_attention='elu')
+
+    def benchmark_linear_random_encoder(self):
+        self._run_encoder_benchmark(linear_attention='random')
+
+    def benchmark_softmax_causal(self):
+        self._run_causal_benchmark(linear_attention=None)
+
+    def benchmark_linear_elu_causal(self):
+        self._run_causal_benchmark(linear_attention='elu')
+
+    def benchmark_linear_random_causal(self):
+        self._run_causal_benchmark(linear_attention='random')
+
+    def benchmark_softmax_decode(self):
+        self._run_decode_benchmark(linear_attention=None)
+
+    def benchmark_linear_elu_decode(self):
+        self._run_decode_benchmark(linear_attention='elu')
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -0,0 +1,99 @@
+# -*- coding: utf - 8 -*-
+
+"""
+    对比 TransformerEncoderStack / TransformerDecoderStack 展开执行与 scan_layers 随层数的冷启动开销
+
+    每次使用新的 tf.function 对 encoder + decoder (teacher forcing) 的前向计算：
+        1. trace_seconds: tracing 得到 concrete function 的时间
+        2. graph_nodes: graph 及其函数库中的节点数
+        3. wall_time: 第一次请求的延迟，包括 tracing、graph 优化和执行
+        4. step_seconds: 预热之后每次请求的时间
+    权重在计时之前创建，不计入冷启动时间
+
+    运行方式：
+        python -m layers.transformer_layers.test.scan_layers_benchmark --benchmarks=.
+"""
+
+import time
+import tensorflow as tf
+from layers import utils
+from layers.transformer_layers.encoder_stack import TransformerEncoderStack
+from layers.transformer_layers.decoder_stack import TransformerDecoderStack
+
+_BATCH_SIZE = 8
+_SEQ_LEN = 64
+_HIDDEN_SIZE = 256
+_NUM_ATTENTION_HEADS = 8
+_NUM_HIDDEN_LAYERS = (6, 12, 24)
+_NUM_ITERS = 5
+
+
+def _count_graph_nodes(concrete_function):
+    graph_def = concrete_function.graph.as_graph_def()
+    return len(graph_def.node) + sum(len(function.node_def) for function in graph_def.library.function)
+
+
+class ScanLayersBenchmark(tf.test.Benchmark):
+
+    def _run_benchmark(self, scan_layers):
+        mode = 'scan' if scan_layers else 'unrolled'
+        inputs = tf.random.normal([_BATCH_SIZE, _SEQ_LEN, _HIDDEN_SIZE], seed=1)
+        padding_mask = tf.zeros([_BATCH_SIZE, 1, _SEQ_LEN])
+        look_ahead_mask = utils.get_look_ahead_mask(_SEQ_LEN)
+        # 预热，排除进程中第一次 tracing 的初始化时间
+        tf.function(TransformerEncoderStack(num_hidden_layers=1, scan_layers=scan_layers))(
+            inputs, padding_mask, training=False
+        )
+
+        for num_hidden_layers in _NUM_HIDDEN_LAYERS:
+            stack_kwargs = dict(
+                num_hidden_layers=num_hidden_layers,
+                num_attention_heads=_NUM_ATTENTION_HEADS,
+                intermediate_size=_HIDDEN_SIZE * 4,
+                scan_layers=scan_layers
+            )
+            encoder_stack = TransformerEncoderStack(**stack_kwargs)
+            decoder_stack = TransformerDecoderStack(**stack_kwargs)
+
+            def forward(inputs, padding_mask, look_ahead_mask):
+                encoder_outputs = encoder_stack(inputs, padding_mask, training=False)
+                return decoder_stack(inputs, encoder_outputs, padding_mask, look_ahead_mask, training=False)
+
+            # 创建权重
+            forward(inputs, padding_mask, look_ahead_mask)
+
+            start = time.time()
+            concrete_function = tf.function(forward).get_concrete_function(inputs, padding_mask, look_ahead_mask)
+            trace_seconds = time.time() - start
+            graph_nodes = _count_graph_nodes(concrete_function)
+
+            serve = tf.function(forward)
+            start = time.time()
+            serve(inputs, padding_mask, look_ahead_mask).numpy()
+            first_request_seconds = time.time() - start
+
+            start = time.time()
+            for _ in range(_NUM_ITERS):
+                serve(inputs, padding_mask, look_ahead_mask).numpy()
+            step_seconds = (time.time() - start) / _NUM_ITERS
+
+            self.report_benchmark(
+                iters=1,
+                wall_time=first_request_seconds,
+                extras={
+                    'trace_seconds': trace_seconds,
+                    'graph_nodes': graph_nodes,
+                    'step_seconds': step_seconds
+                },
+                name='%s_layers_%d' % (mode, num_hidden_layers)
+            )
+
+    def benchmark_unrolled(self):
+        self._run_benchmark(scan_layers=False)
+
+    def benchmark_scan(self):
+        self._run_benchmark(scan_layers=True)
+
+
+if __name__ == '__main__':
+    tf.test.main()
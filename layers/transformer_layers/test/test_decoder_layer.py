@@ -42,6 +42,95 @@ class TransformerDecoderLayerTest(tf.test.TestCase):
         self.assertEqual(output.shape, (2, 4, hidden_size))
         self.assertEqual(cache['value'].shape, (2, 4, 2, 8))
 
+    def test_decoder_block_with_preallocated_cache(self):
+        num_attention_heads = 2
+        hidden_size = 16
+        max_decode_len = 4
+        decoder_block = TransformerDecoderLayer(
+            num_attention_heads=num_attention_heads,
+            intermediate_size=32,
+            intermediate_activation='relu'
+        )
+        inputs_tensor = tf.ones([2, 1, 16], dtype=tf.float32)
+        encoder_tensor = tf.ones([2, 3, 16], dtype=tf.float32)
+        encoder_mask = tf.zeros([2, 1, 3], dtype=tf.float32)
+        # 只允许看到前两个位置
+        self_attention_mask = tf.constant([[[0, 0, 1, 1]]], dtype=tf.float32)
+        inputs = [inputs_tensor, encoder_tensor, encoder_mask, self_attention_mask]
+        cache = _create_cache(2, max_decode_len, num_attention_heads, hidden_size // num_attention_heads)
+        output, cache = decoder_block(
+            inputs=inputs, training=False, cache=cache, decode_loop_step=1
+        )
+        self.assertEqual(output.shape, (2, 1, hidden_size))
+        # cache 的形状保持不变，只有第 1 个位置被写入
+        self.assertEqual(cache['key'].shape, (2, max_decode_len, 2, 8))
+        self.assertEqual(cache['value'].shape, (2, max_decode_len, 2, 8))
+        self.assertAllEqual(cache['key'][:, 0], tf.zeros([2, 2, 8]))
+        self.assertAllEqual(cache['key'][:, 2:], tf.zeros([2, 2, 2, 8]))
+        self.assertNotAllClose(cache['key'][:, 1], tf.zeros([2, 2, 8]))
+
+    def test_decoder_block_with_encoder_decoder_cache(self):
+        num_attention_heads = 2
+        hidden_size = 16
+        decoder_block = TransformerDecoderLayer(
+            num_attention_heads=num_attention_heads,
+            intermediate_size=32,
+            intermediate_activation='relu'
+        )
+        targets_tensor = tf.random.normal([2, 1, hidden_size])
+        encoder_tensor = tf.random.normal([2, 3, hidden_size])
+        encoder_mask = tf.constant([[[0, 0, 1]], [[0, 0, 0]]], dtype=tf.float32)
+        self_attention_mask = tf.zeros([1, 1, 1], dtype=tf.float32)
+        inputs = [targets_tensor, encoder_tensor, encoder_mask, self_attention_mask]
+
+        encoder_decoder_cache = decoder_block.compute_encoder_decoder_cache(encoder_tensor)
+        self.assertEqual(encoder_decoder_cache['encoder_decoder_key'].shape, (2, 3, 2, 8))
+        self.assertEqual(encoder_decoder_cache['encoder_decoder_value'].shape, (2, 3, 2, 8))
+
+        cache = _create_cache(2, 0, num_attention_heads, hidden_size // num_attention_heads)
+        output, _ = decoder_block(inputs=inputs, training=False, cache=cache)
+
+        # 使用预先计算的 key / value 与每一步重新投影的结果一致
+        cache = _create_cache(2, 0, num_attention_heads, hidden_size // num_attention_heads)
+        cache.update(encoder_decoder_cache)
+        cached_output, _ = decoder_block(inputs=inputs, training=False, cache=cache)
+        self.assertAllClose(output, cached_output)
+
+    def test_decoder_block_with_beam_broadcast(self):
+        num_attention_heads = 2
+        hidden_size = 16
+        batch_size, beam_size = 2, 3
+        decoder_block = TransformerDecoderLayer(
+            num_attention_heads=num_attention_heads,
+            intermediate_size=32,
+            intermediate_activation='relu'
+        )
+        targets_tensor = tf.random.normal([batch_size * beam_size, 1, hidden_size])
+        encoder_tensor = tf.random.normal([batch_size, 3, hidden_size])
+        encoder_mask = tf.constant([[[0, 0, 1]], [[0, 0, 0]]], dtype=tf.float32)
+        self_attention_mask = tf.zeros([1, 1, 1], dtype=tf.float32)
+        encoder_decoder_cache = decoder_block.compute_encoder_decoder_cache(encoder_tensor)
+
+        # encoder 相关的输入复制 beam_size 份
+        cache = _create_cache(batch_size * beam_size, 0, num_attention_heads, hidden_size // num_attention_heads)
+        cache.update({
+            name: tf.repeat(tensor, beam_size, axis=0) for name, tensor in encoder_decoder_cache.items()
+        })
+        inputs = [
+            targets_tensor,
+            tf.repeat(encoder_tensor, beam_size, axis=0),
+            tf.repeat(encoder_mask, beam_size, axis=0),
+            self_attention_mask
+        ]
+        tiled_output, _ = decoder_block(inputs=inputs, training=False, cache=cache)
+
+        # encoder 相关的输入只有 batch_size 份，对 beam 广播
+        cache = _create_cache(batch_size * beam_size, 0, num_attention_heads, hidden_size // num_attention_heads)
+        cache.update(encoder_decoder_cache)
+        inputs = [targets_tensor, encoder_tensor, encoder_mask, self_attention_mask]
+        output, _ = decoder_block(inputs=inputs, training=False, cache=cache, beam_size=beam_size)
+        self.assertAllClose(tiled_output, output)
+
     def test_use_bias_norm_first(self):
         num_attention_heads = 2
         hidden_size = 16
@@ -4,10 +4,13 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
 import numpy as np
 import tensorflow as tf
 from absl.testing import parameterized
 from tensorflow.python.keras import keras_parameterized
+from layers import utils
+from layers.attention_layers import multi_head_attention_layer
 from layers.transformer_layers import encoder_layer
 
 
@@ -58,6 +61,114 @@ class EncoderLayerTest(keras_parameterized.TestCase):
         with self.assertRaisesRegex(ValueError, 'When passing a mask tensor.*'):
             _ = test_layer([data_tensor, mask_tensor], training=True)
 
+    def test_attention_chunk_size(self, transformer_cls):
+        kwargs = dict(num_attention_heads=4, intermediate_size=32, intermediate_activation='relu')
+        test_layer = transformer_cls(**kwargs)
+        chunked_layer = transformer_cls(attention_chunk_size=4, **kwargs)
+        data = tf.random.normal([2, 10, 16])
+        mask = tf.constant(np.random.randint(2, size=[2, 1, 10]), dtype=tf.float32)
+        test_layer([data, mask], training=False)
+        chunked_layer([data, mask], training=False)
+        chunked_layer.set_weights(test_layer.get_weights())
+        self.assertAllClose(
+            test_layer([data, mask], training=False), chunked_layer([data, mask], training=False)
+        )
+        self.assertEqual(4, chunked_layer.get_config()['attention_chunk_size'])
+
+    def test_unpadded(self, transformer_cls):
+        kwargs = dict(num_attention_heads=4, intermediate_size=32, intermediate_activation='relu')
+        test_layer = transformer_cls(**kwargs)
+        unpadded_layer = transformer_cls(**kwargs)
+        data = tf.random.normal([3, 10, 16])
+        mask = np.zeros([3, 1, 10], dtype=bool)
+        mask[1, :, 6:] = True
+        mask[2, :, 2:] = True
+        token_indices = utils.get_token_indices(mask)
+        packed_data = utils.pack_tokens(data, token_indices)
+
+        output = test_layer([data, mask], training=False)
+        packed_output = unpadded_layer([packed_data, mask, token_indices], training=False)
+        unpadded_layer.set_weights(test_layer.get_weights())
+        packed_output = unpadded_layer([packed_data, mask, token_indices], training=False)
+        self.assertEqual([1, 18, 16], packed_output.shape.as_list())
+        self.assertAllClose(utils.pack_tokens(output, token_indices), packed_output)
+
+    def test_output_range(self, transformer_cls):
+        data = tf.random.normal([3, 10, 16])
+        mask = tf.constant(np.random.randint(2, size=[3, 1, 10]), dtype=tf.float32)
+        positions = tf.constant([[0, 3, 9], [1, 1, 2], [8, 0, 5]])
+        for norm_first in (False, True):
+            kwargs = dict(
+                num_attention_heads=4, intermediate_size=32, intermediate_activation='relu', norm_first=norm_first
+            )
+            test_layer = transformer_cls(**kwargs)
+            sparse_layer = transformer_cls(output_range=2, **kwargs)
+            output = test_layer([data, mask], training=False)
+            sparse_layer([data, mask], training=False)
+            sparse_layer.set_weights(test_layer.get_weights())
+
+            self.assertAllClose(output[:, :2], sparse_layer([data, mask], training=False))
+            # output_positions 优先于 output_range
+            self.assertAllClose(
+                tf.gather(output, positions, batch_dims=1),
+                sparse_layer([data, mask], training=False, output_positions=positions)
+            )
+            self.assertAllClose(
+                tf.gather(output, positions, batch_dims=1),
+                test_layer([data, mask], training=False, output_positions=positions)
+            )
+        self.assertEqual(2, sparse_layer.get_config()['output_range'])
+
+    def test_fuse_qkv_projection(self, transformer_cls):
+        kwargs = dict(num_attention_heads=4, intermediate_size=32, intermediate_activation='relu')
+        test_layer = transformer_cls(**kwargs)
+        fused_layer = transformer_cls(fuse_qkv_projection=True, **kwargs)
+        # 只计算部分位置时 query 与 key / value 不同，仍然使用合并投影
+        sparse_layer = transformer_cls(fuse_qkv_projection=True, output_range=2, **kwargs)
+        data = tf.random.normal([2, 6, 16])
+        mask = tf.constant(np.random.randint(2, size=[2, 1, 6]), dtype=tf.float32)
+        output = test_layer([data, mask], training=False)
+        fused_layer([data, mask], training=False)
+        sparse_layer([data, mask], training=False)
+        self.assertEqual(
+            [w.shape for w in fused_layer.weights], [w.shape for w in sparse_layer.weights]
+        )
+
+        # 分别投影的 checkpoint 按名字转换为合并投影
+        checkpoint_path = tf.train.Checkpoint(layer=test_layer).write(
+            os.path.join(self.get_temp_dir(), 'encoder_layer')
+        )
+        for layer in (fused_layer, sparse_layer):
+            output_path = utils.convert_checkpoint(
+                checkpoint_path,
+                os.path.join(self.get_temp_dir(), 'fused_encoder_layer'),
+                tf.train.Checkpoint(layer=layer),
+                convert_fns=[multi_head_attention_layer.convert_qkv_checkpoint_weight]
+            )
+            tf.train.Checkpoint(layer=layer).restore(output_path).expect_partial()
+        self.assertAllClose(output, fused_layer([data, mask], training=False))
+        self.assertAllClose(output[:, :2], sparse_layer([data, mask], training=False))
+
+
+    def test_stacked_weights(self, transformer_cls):
+        kwargs = dict(num_attention_heads=4, intermediate_size=32, intermediate_activation='relu')
+        layers = [transformer_cls(**kwargs) for _ in range(3)]
+        stacked_layer = transformer_cls(**kwargs)
+        data = tf.random.normal([2, 6, 16])
+        mask = tf.constant(np.random.randint(2, size=[2, 1, 6]), dtype=tf.float32)
+        outputs = [layer([data, mask], training=False) for layer in layers]
+        with tf.variable_creator_scope(utils.stacked_variable_creator(len(layers))):
+            stacked_layer([data, mask], training=False, layer_index=0)
+        self.assertEqual(
+            [[len(layers)] + w.shape.as_list() for w in layers[0].weights],
+            [w.shape.as_list() for w in stacked_layer.weights]
+        )
+
+        for weights, stacked_weight in zip(zip(*[layer.weights for layer in layers]), stacked_layer.weights):
+            stacked_weight.assign(tf.stack(weights))
+        for i, output in enumerate(outputs):
+            self.assertAllClose(output, stacked_layer([data, mask], training=False, layer_index=tf.constant(i)))
+
 
 if __name__ == '__main__':
     tf.test.main()
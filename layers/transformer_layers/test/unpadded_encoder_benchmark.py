@@ -0,0 +1,79 @@
+# -*- coding: utf - 8 -*-
+
+"""
+    对比 TransformerEncoderStack 在不同 padding 比例下，带 padding 计算与去掉 padding 计算 (unpadded) 的吞吐
+
+    batch 中的序列长度在 [min_len, max_len] 之间均匀分布，平均 padding 比例为 padding_ratio
+    报告 tokens_per_second，只统计非 padding 的 token
+
+    运行方式：
+        python -m layers.transformer_layers.test.unpadded_encoder_benchmark --benchmarks=.
+"""
+
+import time
+import numpy as np
+import tensorflow as tf
+from layers.transformer_layers.encoder_stack import TransformerEncoderStack
+
+_BATCH_SIZE = 16
+_SEQ_LEN = 256
+_HIDDEN_SIZE = 256
+_NUM_HIDDEN_LAYERS = 4
+_NUM_ATTENTION_HEADS = 8
+_PADDING_RATIOS = (0.0, 0.25, 0.5, 0.75)
+_NUM_ITERS = 5
+
+
+def _get_padding_mask(padding_ratio):
+    """
+    :return: (batch_size, 1, seq_len)，1 为 padding，以及非 padding 的 token 数
+    """
+    max_len = min(_SEQ_LEN, 2 * _SEQ_LEN * (1 - padding_ratio))
+    min_len = max(1, _SEQ_LEN - 2 * _SEQ_LEN * padding_ratio)
+    lengths = np.round(np.linspace(min_len, max_len, _BATCH_SIZE)).astype(np.int32)
+    padding_mask = (np.arange(_SEQ_LEN)[np.newaxis, :] >= lengths[:, np.newaxis]).astype(np.float32)
+    return tf.constant(padding_mask[:, np.newaxis, :]), int(lengths.sum())
+
+
+class UnpaddedEncoderBenchmark(tf.test.Benchmark):
+
+    def _run_benchmark(self, unpadded):
+        mode = 'unpadded' if unpadded else 'padded'
+        encoder_stack = TransformerEncoderStack(
+            num_hidden_layers=_NUM_HIDDEN_LAYERS,
+            num_attention_heads=_NUM_ATTENTION_HEADS,
+            intermediate_size=_HIDDEN_SIZE * 4,
+            unpadded=unpadded
+        )
+
+        @tf.function(experimental_relax_shapes=True)
+        def encode(inputs, padding_mask):
+            return encoder_stack(inputs, padding_mask, training=False)
+
+        inputs = tf.random.normal([_BATCH_SIZE, _SEQ_LEN, _HIDDEN_SIZE], seed=1)
+        for padding_ratio in _PADDING_RATIOS:
+            padding_mask, num_tokens = _get_padding_mask(padding_ratio)
+            # 预热，排除 tracing 时间
+            encode(inputs, padding_mask).numpy()
+
+            start = time.time()
+            for _ in range(_NUM_ITERS):
+                encode(inputs, padding_mask).numpy()
+            wall_time = (time.time() - start) / _NUM_ITERS
+
+            self.report_benchmark(
+                iters=_NUM_ITERS,
+                wall_time=wall_time,
+                extras={'tokens_per_second': num_tokens / wall_time},
+                name='encoder_%s_padding_%d' % (mode, int(padding_ratio * 100))
+            )
+
+    def benchmark_padded(self):
+        self._run_benchmark(unpadded=False)
+
+    def benchmark_unpadded(self):
+        self._run_benchmark(unpadded=True)
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -4,11 +4,22 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+import re
 import six
+import shutil
+import tempfile
 import numpy as np
 import tensorflow as tf
 from activations import gelu, swish
 
+# checkpoint 中保存对象结构的项，见 tf.train.Checkpoint
+_OBJECT_GRAPH_KEY = '_CHECKPOINTABLE_OBJECT_GRAPH'
+# tf.train.Checkpoint 的保存次数，Checkpoint.write 写出的 checkpoint 中没有该项
+_SAVE_COUNTER_KEY = 'save_counter/.ATTRIBUTES/VARIABLE_VALUE'
+# 多层共用 stacked 权重的层的属性名，见 stacked_variable_creator 和 convert_stacked_checkpoint_weight
+STACKED_LAYER_NAME = 'stacked_layer'
+
 
 def get_activation(identifier):
     if isinstance(identifier, six.string_types):
@@ -88,3 +99,216 @@ def get_look_ahead_mask(length, dtype=tf.float32):
 
 def get_combine_mask(seqs, padding_value=0, dtype=tf.float32):
     return tf.maximum(get_padding_mask(seqs, padding_value, dtype), get_look_ahead_mask(tf.shape(seqs)[1]))
+
+
+def get_token_indices(padding_mask):
+    """
+        非 padding 的 token 在 (batch_size, seq_len) 中的位置，用于去掉 padding 后只对这些 token 计算
+
+    :param padding_mask: (batch_size, seq_len) or (batch_size, 1, seq_len)，1 为 padding
+    :return: (num_tokens, 2)，按 batch、seq_len 的顺序排列
+    """
+    with tf.name_scope('token_indices'):
+        if len(padding_mask.shape) == 3:
+            padding_mask = padding_mask[:, 0]
+        return tf.cast(tf.where(tf.logical_not(tf.cast(padding_mask, tf.bool))), tf.int32)
+
+
+def pack_tokens(inputs, token_indices):
+    """
+        去掉 padding，把所有序列的 token 拼接在一起
+
+    :param inputs: (batch_size, seq_len, ...)
+    :param token_indices: (num_tokens, 2)，见 get_token_indices
+    :return: (1, num_tokens, ...)，保留 batch 维度，position-wise 的层可以直接使用
+    """
+    return tf.gather_nd(inputs, token_indices)[tf.newaxis]
+
+
+def unpack_tokens(packed, token_indices, batch_size, seq_len):
+    """
+        pack_tokens 的逆运算，padding 的位置为 0
+
+    :param packed: (1, num_tokens, ...)
+    :return: (batch_size, seq_len, ...)
+    """
+    return tf.scatter_nd(
+        token_indices, packed[0], tf.concat([[batch_size, seq_len], tf.shape(packed)[2:]], axis=0)
+    )
+
+
+def convert_checkpoint(checkpoint_path, output_path, checkpoint, convert_fns):
+    """
+        按名字转换 checkpoint，使其可以由权重结构不同的模型读取 (例如投影权重合并或拆分之后)
+
+        checkpoint 中的名字为对象的属性路径，例如 model/.../_query_dense/kernel/.ATTRIBUTES/VARIABLE_VALUE，与 layer 的名字无关
+        先写出目标的 checkpoint 得到所有名字、形状和对象结构，对每个名字：
+            1. 原 checkpoint 中有形状相同的同名权重时直接复制
+            2. 否则依次尝试 convert_fns，都返回 None 时报错 (原 checkpoint 中没有的 save_counter 使用目标的值)
+        只转换目标 checkpoint 中的权重，例如目标只包含模型时不会写入优化器的状态
+
+    :param checkpoint_path: 原 checkpoint
+    :param output_path: 输出 checkpoint 的前缀
+    :param checkpoint: 目标 tf.train.Checkpoint，其中的权重都已经创建
+    :param convert_fns: [convert_fn(name, shape, reader)]，返回名字为 name 的目标权重，无法转换时返回 None，
+        reader 为原 checkpoint 的 tf.train.load_checkpoint
+    :return: output_path
+    """
+    reader = tf.train.load_checkpoint(checkpoint_path)
+    source_shapes = reader.get_variable_to_shape_map()
+    template_dir = tempfile.mkdtemp()
+    try:
+        template_path = checkpoint.write(os.path.join(template_dir, 'template'))
+        template_reader = tf.train.load_checkpoint(template_path)
+        dtypes = template_reader.get_variable_to_dtype_map()
+        names, tensors = [], []
+        for name, shape in tf.train.list_variables(template_path):
+            if name == _OBJECT_GRAPH_KEY:
+                tensor = template_reader.get_tensor(name)
+            elif name in source_shapes and list(source_shapes[name]) == shape:
+                tensor = reader.get_tensor(name)
+            elif name == _SAVE_COUNTER_KEY and name not in source_shapes:
+                tensor = template_reader.get_tensor(name)
+            else:
+                tensor = None
+                for convert_fn in convert_fns:
+                    tensor = convert_fn(name, shape, reader)
+                    if tensor is not None:
+                        break
+                if tensor is None or list(tensor.shape) != shape:
+                    raise ValueError('can not convert %s %s from %s' % (name, shape, checkpoint_path))
+                tensor = tf.cast(tensor, dtypes[name])
+            names.append(name)
+            tensors.append(tensor)
+    finally:
+        shutil.rmtree(template_dir)
+
+    tf.raw_ops.SaveV2(prefix=output_path, tensor_names=names, shape_and_slices=[''] * len(names), tensors=tensors)
+    return output_path
+
+
+def restore_checkpoint(checkpoint, checkpoint_path, convert_fns):
+    """
+        restore 权重结构可能与当前模型不同的 checkpoint，例如 scan_layers 的 stacked 权重与展开执行的逐层权重
+
+        目标中已经创建的权重在原 checkpoint 中都有形状相同的同名权重时直接 restore，
+        否则先用 convert_checkpoint 按名字转换到临时目录再 restore，
+        转换后只包含目标中已经创建的权重，例如优化器的状态没有创建时不会读取
+
+    :param checkpoint: 目标 tf.train.Checkpoint，其中模型的权重都已经创建 (否则无法发现结构不同)
+    :param checkpoint_path: 原 checkpoint
+    :param convert_fns: 见 convert_checkpoint
+    :return: 是否经过了转换
+    """
+    source_shapes = tf.train.load_checkpoint(checkpoint_path).get_variable_to_shape_map()
+    converted_dir = tempfile.mkdtemp()
+    try:
+        template_path = checkpoint.write(os.path.join(converted_dir, 'template'))
+        if all(
+            name in (_OBJECT_GRAPH_KEY, _SAVE_COUNTER_KEY)
+            or (name in source_shapes and list(source_shapes[name]) == shape)
+            for name, shape in tf.train.list_variables(template_path)
+        ):
+            checkpoint.restore(checkpoint_path)
+            return False
+
+        converted_path = convert_checkpoint(
+            checkpoint_path, os.path.join(converted_dir, 'converted'), checkpoint, convert_fns
+        )
+        checkpoint.restore(converted_path)
+        return True
+    finally:
+        shutil.rmtree(converted_dir)
+
+
+def stacked_variable_creator(num_layers):
+    """
+        用于 tf.variable_creator_scope，把结构相同的 num_layers 层的权重创建为一个 (num_layers, ...) 的变量
+
+        每一层的部分按原来的形状分别初始化，与 num_layers 个层分别创建时的分布相同
+        在该 scope 中 build 的层需要通过 layer_index 读取其中一层的权重，见 get_layer_weight
+
+    :param num_layers: 层数
+    :return: variable creator
+    """
+    def creator(next_creator, **kwargs):
+        initial_value = kwargs['initial_value']
+
+        def stacked_initial_value():
+            if callable(initial_value):
+                return tf.stack([initial_value() for _ in range(num_layers)])
+            return tf.stack([initial_value] * num_layers)
+
+        kwargs['initial_value'] = stacked_initial_value
+        if kwargs.get('shape') is not None:
+            kwargs['shape'] = tf.TensorShape([num_layers]).concatenate(kwargs['shape'])
+        return next_creator(**kwargs)
+
+    return creator
+
+
+def get_layer_weight(weight, layer_index=None):
+    """
+    :param weight: 权重，layer_index 不为 None 时为 stacked_variable_creator 创建的 (num_layers, ...)
+    :param layer_index: 层的下标，可以是 tensor
+    :return: 第 layer_index 层的权重
+    """
+    if layer_index is None:
+        return weight
+    return tf.gather(weight, layer_index)
+
+
+def scan_layers(layer_fn, inputs, num_layers):
+    """
+        用一个 tf.while_loop 依次执行 num_layers 层，代替 python 循环展开
+        graph 中只有一份层的计算，tracing 时间和 graph 大小与层数无关
+
+        每一层的权重通过 layer_index 从 stacked_variable_creator 创建的 (num_layers, ...) 变量中读取，
+        所有层共用一个层对象 (共享参数) 时可以忽略 layer_index
+
+    :param layer_fn: layer_fn(layer_index, inputs) -> outputs，outputs 的结构和形状与 inputs 相同
+    :param inputs: 第一层的输入，tensor 或 tensor 的嵌套结构
+    :param num_layers: 层数
+    :return: 最后一层的输出
+    """
+    _, outputs = tf.while_loop(
+        lambda i, _: i < num_layers,
+        lambda i, layer_inputs: (i + 1, layer_fn(i, layer_inputs)),
+        loop_vars=(tf.constant(0), inputs),
+        maximum_iterations=num_layers
+    )
+    return outputs
+
+
+def convert_stacked_checkpoint_weight(name, shape, reader):
+    """
+        用于 convert_checkpoint，在逐层的权重与 stacked 的权重 (见 stacked_variable_creator) 之间转换
+
+        按 checkpoint 中的名字对应，stacked 的权重保存在属性 STACKED_LAYER_NAME 之下：
+            .../<layers>/<i>/<path> (逐层) <-> .../stacked_layer/<path> (num_layers, ...) 的第 i 个
+        其中 <layers> 为保存各层的 list 的属性名
+
+    :return: 名字为 name 的权重，不是这两种名字时返回 None
+    """
+    source_shapes = reader.get_variable_to_shape_map()
+
+    # 逐层 -> stacked
+    prefix, separator, path = name.partition('/%s/' % STACKED_LAYER_NAME)
+    if separator:
+        pattern = re.compile(r'%s/\w+/(\d+)/%s$' % (re.escape(prefix), re.escape(path)))
+        layer_names = {}
+        for source_name in source_shapes:
+            match = pattern.match(source_name)
+            if match:
+                layer_names[int(match.group(1))] = source_name
+        if sorted(layer_names) != list(range(shape[0])):
+            return None
+        return np.stack([reader.get_tensor(layer_names[i]) for i in range(shape[0])])
+
+    # stacked -> 逐层
+    for match in re.finditer(r'/\w+/(\d+)/', name):
+        source_name = '%s/%s/%s' % (name[:match.start()], STACKED_LAYER_NAME, name[match.end():])
+        layer_index = int(match.group(1))
+        if source_name in source_shapes and layer_index < source_shapes[source_name][0]:
+            return reader.get_tensor(source_name)[layer_index]
+    return None
@@ -54,15 +54,28 @@ class BertPretrainer(tf.keras.Model):
                 % (sequence_output_length, num_token_predictions)
             )
 
-        # 在做 pretrain 的时候还有一个额外输入
-        # 就是每个句子需要预测多少个词
-        # (batch_size, num_token_predictions)
-        masked_lm_positions = tf.keras.Input(
-            shape=(num_token_predictions,),
-            name='masked_lm_positions',
-            dtype=tf.int32
-        )
-        inputs.append(masked_lm_positions)
+        num_output_positions = self.encoder.get_config().get('num_output_positions')
+        if num_output_positions is not None:
+            # encoder 最后一层只计算 masked_lm_positions (encoder 的第四个输入)，
+            # sequence_output 的第 j 个位置即 masked_lm_positions[:, j] 的输出
+            if num_output_positions != num_token_predictions:
+                raise ValueError(
+                    'The passed network\'s num_output_positions %s does not match '
+                    'num_token_predictions %s.' % (num_output_positions, num_token_predictions)
+                )
+            masked_lm_positions = tf.keras.layers.Lambda(
+                lambda x: tf.broadcast_to(tf.range(tf.shape(x)[1]), tf.shape(x))
+            )(network_inputs[3])
+        else:
+            # 在做 pretrain 的时候还有一个额外输入
+            # 就是每个句子需要预测多少个词
+            # (batch_size, num_token_predictions)
+            masked_lm_positions = tf.keras.Input(
+                shape=(num_token_predictions,),
+                name='masked_lm_positions',
+                dtype=tf.int32
+            )
+            inputs.append(masked_lm_positions)
 
         if embedding_table is None:
             embedding_table = self.encoder.get_embedding_table()
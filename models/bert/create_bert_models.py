@@ -102,7 +102,8 @@ def get_transformer_encoder(
         bert_config,
         seq_len,
         transformer_encoder_cls=None,
-        output_range=None
+        output_range=None,
+        num_output_positions=None
 ):
     del seq_len
     if transformer_encoder_cls is not None:
@@ -159,6 +160,7 @@ def get_transformer_encoder(
     else:
         assert isinstance(bert_config, BertConfig)
         kwargs['output_range'] = output_range
+        kwargs['num_output_positions'] = num_output_positions
         return BertEncoder(**kwargs)
 
 
@@ -200,7 +202,10 @@ def create_pretrain_model(
             shape=(1,), name='next_sentence_labels', dtype=tf.int32
         )
 
-    transformer_encoder = get_transformer_encoder(bert_config, seq_len)
+    # 最后一层只计算被 mask 的位置
+    transformer_encoder = get_transformer_encoder(
+        bert_config, seq_len, num_output_positions=max_predictions_per_seq
+    )
     if initializer is None:
         initializer = tf.keras.initializers.TruncatedNormal(
             stddev=bert_config.initializer_range
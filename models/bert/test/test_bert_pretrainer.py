@@ -45,6 +45,27 @@ class BertPretrainerTest(tf.test.TestCase):
         self.assertAllEqual(expected_lm_shape, outputs['masked_lm'].shape.as_list())
         self.assertAllEqual(expected_classification_shape, outputs['classification'].shape.as_list())
 
+    def test_bert_pretrainer_with_output_positions(self):
+        test_network = BertEncoder(vocab_size=100, hidden_size=32, num_attention_heads=2, num_layers=2)
+        sparse_network = BertEncoder(
+            vocab_size=100, hidden_size=32, num_attention_heads=2, num_layers=2, num_output_positions=3
+        )
+        bert_trainer_model = BertPretrainer(test_network, num_classes=2, num_token_predictions=3)
+        sparse_trainer_model = BertPretrainer(sparse_network, num_classes=2, num_token_predictions=3)
+        sparse_trainer_model.set_weights(bert_trainer_model.get_weights())
+
+        word_ids = tf.random.uniform([2, 8], maxval=100, dtype=tf.int32)
+        mask = tf.zeros([2, 8], dtype=tf.int32)
+        type_ids = tf.zeros([2, 8], dtype=tf.int32)
+        masked_lm_positions = tf.constant([[1, 4, 7], [2, 3, 0]])
+        outputs = bert_trainer_model([word_ids, mask, type_ids, masked_lm_positions])
+        sparse_outputs = sparse_trainer_model([word_ids, mask, type_ids, masked_lm_positions])
+        self.assertAllClose(outputs['masked_lm'], sparse_outputs['masked_lm'], atol=1e-5)
+        self.assertAllClose(outputs['classification'], sparse_outputs['classification'], atol=1e-5)
+
+        with self.assertRaises(ValueError):
+            BertPretrainer(sparse_network, num_classes=2, num_token_predictions=2)
+
     def test_bert_trainer_tensor_call(self):
         test_network = BertEncoder(
             vocab_size=100, num_layers=2, max_seq_len=2
@@ -4,9 +4,13 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+import numpy as np
 import tensorflow as tf
 from models.bert import create_bert_models
 from models.bert.configs import BertConfig
+from models.albert.configs import ALBertConfig
+from networks.encoders.albert_encoder import ALBertEncoder
 
 
 class BertModelsTest(tf.test.TestCase):
@@ -43,6 +47,32 @@ class BertModelsTest(tf.test.TestCase):
         self.assertEqual(core_model.output[0].shape.as_list(), [None, None, 16])
         self.assertEqual(core_model.output[1].shape.as_list(), [None, 16])
 
+    def test_albert_encoder(self):
+        albert_config = ALBertConfig(
+            hidden_act='relu',
+            hidden_size=16,
+            intermediate_size=32,
+            max_position_embeddings=128,
+            num_attention_heads=2,
+            num_hidden_layers=4,
+            type_vocab_size=2,
+            vocab_size=30522,
+            embedding_size=8
+        )
+        encoder = create_bert_models.get_transformer_encoder(albert_config, seq_len=5)
+        self.assertIsInstance(encoder, ALBertEncoder)
+        self.assertEqual(8, encoder.get_config()['embedding_size'])
+
+        inputs = [
+            np.random.randint(30522, size=(2, 5)),
+            np.zeros((2, 5), dtype=np.int32),
+            np.zeros((2, 5), dtype=np.int32)
+        ]
+        path = tf.train.Checkpoint(model=encoder).save(os.path.join(self.get_temp_dir(), 'albert'))
+        new_encoder = create_bert_models.get_transformer_encoder(albert_config, seq_len=5)
+        tf.train.Checkpoint(model=new_encoder).restore(path).assert_existing_objects_matched()
+        self.assertAllClose(encoder(inputs, training=False), new_encoder(inputs, training=False))
+
 
 if __name__ == '__main__':
     tf.test.main()
\ No newline at end of file
@@ -0,0 +1,82 @@
+# -*- coding: utf - 8 -*-
+
+"""
+    在 self attention 的 query、key、value 分别投影与合并投影 (fuse_qkv_projection) 的 checkpoint 之间转换
+
+    按 checkpoint 中的名字对应：合并投影的 .../_qkv_dense/kernel (hidden_size, num_heads + 2 * num_kv_heads, size_per_head)
+    由 .../_query_dense/kernel、.../_key_dense/kernel、.../_value_dense/kernel 在头所在的维度上拼接得到，bias 相同，反之拆分
+    其余权重原样复制，转换前后的模型等价
+
+    运行方式：
+        python -m models.transformer.fused_qkv_conversion \\
+            --checkpoint=<原 checkpoint> --output=<输出路径> --fuse_qkv_projection=true
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import tensorflow as tf
+from absl import app
+from absl import flags
+from absl import logging
+from layers import utils
+from layers.attention_layers import multi_head_attention_layer
+from models.transformer import transformerV2
+from models.transformer.transformer_params import PARAMS
+
+
+
+def convert_checkpoint(checkpoint_path, output_path, fuse_qkv_projection, params=None):
+    """
+        转换 transformer_keras 训练得到的 checkpoint
+
+        只转换模型权重，不写入优化器的状态
+
+    :param checkpoint_path: 原 checkpoint
+    :param output_path: 输出 checkpoint 的前缀
+    :param fuse_qkv_projection: 转换后是否为合并投影
+    :param params: 模型的参数，默认为 transformer_params.PARAMS，其中的 fuse_qkv_projection 不起作用
+    :return: 写入的 checkpoint 路径
+    """
+    params = (params or PARAMS).copy()
+    params['fuse_qkv_projection'] = fuse_qkv_projection
+    target_model = transformerV2.create_model(params, is_train=True)
+
+    return utils.convert_checkpoint(
+        checkpoint_path,
+        output_path,
+        tf.train.Checkpoint(model=target_model),
+        convert_fns=[multi_head_attention_layer.convert_qkv_checkpoint_weight]
+    )
+
+
+def define_flags():
+    flags.DEFINE_string(
+        name='checkpoint',
+        default=None,
+        help='checkpoint to convert'
+    )
+    flags.DEFINE_string(
+        name='output',
+        default=None,
+        help='output checkpoint prefix'
+    )
+    flags.DEFINE_boolean(
+        name='fuse_qkv_projection',
+        default=True,
+        help='whether the converted checkpoint uses the fused query / key / value projection'
+    )
+    flags.mark_flags_as_required(['checkpoint', 'output'])
+
+
+def main(_):
+    flags_obj = flags.FLAGS
+    output_path = convert_checkpoint(flags_obj.checkpoint, flags_obj.output, flags_obj.fuse_qkv_projection)
+    logging.info('Write converted checkpoint to %s' % output_path)
+
+
+if __name__ == '__main__':
+    logging.set_verbosity(logging.INFO)
+    define_flags()
+    app.run(main)
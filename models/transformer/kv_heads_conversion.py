@@ -0,0 +1,163 @@
+# -*- coding: utf - 8 -*-
+
+"""
+    将普通 multi-head attention 的 checkpoint 转换为 grouped-query attention (num_kv_heads)
+
+    key / value 投影的每个头对应 kernel (hidden_size, num_heads, size_per_head) 和 bias (num_heads, size_per_head)
+    的一个切片，连续的 num_heads // num_kv_heads 个头组成一组，转换时对组内的头取平均，作为该组共用的 key / value 头
+    self attention 使用合并投影 (fuse_qkv_projection) 时只转换合并投影中 key / value 的部分
+    其余权重原样复制
+
+    转换后的模型与原模型并不等价，通常需要少量训练恢复效果
+
+    运行方式：
+        python -m models.transformer.kv_heads_conversion \\
+            --checkpoint=<原 checkpoint> --output=<输出路径> --num_kv_heads=2
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import tensorflow as tf
+from absl import app
+from absl import flags
+from absl import logging
+from layers.attention_layers import multi_head_attention_layer
+from models.transformer import transformerV2
+from models.transformer.transformer_params import PARAMS
+
+
+# attention 层中 key / value 投影的名字，见 MultiHeadAttention
+_KEY_VALUE_LAYER_NAMES = ('key', 'value')
+_FUSED_QKV_LAYER_NAME = 'qkv'
+
+
+def mean_pool_kv_heads(weight, num_kv_heads):
+    """
+        对 key / value 投影的权重按组取平均
+
+    :param weight: kernel (hidden_size, num_heads, size_per_head) 或 bias (num_heads, size_per_head)
+    :param num_kv_heads: 转换后的头数，需要整除 num_heads
+    :return: kernel (hidden_size, num_kv_heads, size_per_head) 或 bias (num_kv_heads, size_per_head)
+    """
+    weight = tf.convert_to_tensor(weight)
+    num_heads = weight.shape[-2]
+    if num_heads % num_kv_heads != 0:
+        raise ValueError(
+            'num_heads (%d) must be divisible by num_kv_heads (%d)' % (num_heads, num_kv_heads)
+        )
+    # 头所在的维度拆成 (num_kv_heads, group_size)，对 group_size 取平均
+    grouped_shape = weight.shape[:-2].concatenate(
+        [num_kv_heads, num_heads // num_kv_heads, weight.shape[-1]]
+    )
+    return tf.reduce_mean(tf.reshape(weight, grouped_shape), axis=-2)
+
+
+def mean_pool_fused_kv_heads(weight, num_kv_heads):
+    """
+        对合并投影的权重中 key / value 的部分按组取平均，query 的部分不变
+
+    :param weight: kernel (hidden_size, 3 * num_heads, size_per_head) 或 bias (3 * num_heads, size_per_head)
+    :return: kernel (hidden_size, num_heads + 2 * num_kv_heads, size_per_head) 或对应的 bias
+    """
+    weight = tf.convert_to_tensor(weight)
+    num_heads = weight.shape[-2] // 3
+    query, key, value = multi_head_attention_layer.split_qkv_weight(weight, num_heads, num_heads)
+    return multi_head_attention_layer.merge_qkv_weights(
+        query, mean_pool_kv_heads(key, num_kv_heads), mean_pool_kv_heads(value, num_kv_heads)
+    )
+
+
+def _is_key_value_weight(weight):
+    return any('/%s/' % name in weight.name for name in _KEY_VALUE_LAYER_NAMES)
+
+
+def _is_fused_qkv_weight(weight):
+    return '/%s/' % _FUSED_QKV_LAYER_NAME in weight.name
+
+
+def convert_model_weights(source_model, target_model):
+    """
+        把 source_model 的权重写入 target_model
+
+        两个模型除 num_kv_heads 外结构相同，且都已经构建
+        形状相同的权重直接复制，key / value 投影 (包括合并投影中 key / value 的部分) 的权重按 target_model 的头数取平均
+
+    :param source_model: 普通 multi-head attention 的模型
+    :param target_model: 使用 num_kv_heads 的模型
+    """
+    source_weights, target_weights = source_model.weights, target_model.weights
+    if len(source_weights) != len(target_weights):
+        raise ValueError(
+            'source model has %d weights but target model has %d'
+            % (len(source_weights), len(target_weights))
+        )
+
+    for source, target in zip(source_weights, target_weights):
+        if source.shape == target.shape:
+            target.assign(source)
+        elif _is_key_value_weight(source) and source.shape.rank == target.shape.rank:
+            target.assign(mean_pool_kv_heads(source, num_kv_heads=target.shape[-2]))
+        elif _is_fused_qkv_weight(source) and source.shape.rank == target.shape.rank:
+            num_heads = source.shape[-2] // 3
+            target.assign(mean_pool_fused_kv_heads(source, num_kv_heads=(target.shape[-2] - num_heads) // 2))
+        else:
+            raise ValueError(
+                'can not convert weight %s %s to %s %s'
+                % (source.name, source.shape, target.name, target.shape)
+            )
+
+
+def convert_checkpoint(checkpoint_path, output_path, num_kv_heads, params=None):
+    """
+        转换 transformer_keras 训练得到的 checkpoint
+
+        只转换模型权重，优化器的状态与新的 key / value 形状不再对应，不会被写入
+
+    :param checkpoint_path: 原 checkpoint
+    :param output_path: 输出 checkpoint 的前缀
+    :param num_kv_heads: 转换后的 key / value 头数
+    :param params: 原模型的参数，默认为 transformer_params.PARAMS
+    :return: 写入的 checkpoint 路径
+    """
+    params = (params or PARAMS).copy()
+    source_model = transformerV2.create_model(params, is_train=True)
+    tf.train.Checkpoint(model=source_model).restore(checkpoint_path).expect_partial()
+
+    params['num_kv_heads'] = num_kv_heads
+    target_model = transformerV2.create_model(params, is_train=True)
+
+    convert_model_weights(source_model, target_model)
+    return tf.train.Checkpoint(model=target_model).write(output_path)
+
+
+def define_flags():
+    flags.DEFINE_string(
+        name='checkpoint',
+        default=None,
+        help='checkpoint of the multi-head attention model'
+    )
+    flags.DEFINE_string(
+        name='output',
+        default=None,
+        help='output checkpoint prefix'
+    )
+    flags.DEFINE_integer(
+        name='num_kv_heads',
+        default=1,
+        help='number of key / value heads after conversion'
+    )
+    flags.mark_flags_as_required(['checkpoint', 'output'])
+
+
+def main(_):
+    flags_obj = flags.FLAGS
+    output_path = convert_checkpoint(flags_obj.checkpoint, flags_obj.output, flags_obj.num_kv_heads)
+    logging.info('Write converted checkpoint to %s' % output_path)
+
+
+if __name__ == '__main__':
+    logging.set_verbosity(logging.INFO)
+    define_flags()
+    app.run(main)
@@ -0,0 +1,231 @@
+# -*- coding: utf - 8 -*-
+
+"""
+    lexical shortlist：解码时只在少量候选的目标语言词上计算 softmax
+
+    离线从训练数据统计源语言词与目标语言词在同一个句对中出现的次数，对每个源语言词保留 Dice 系数最大的 top_n 个目标语言词
+        dice(s, t) = 2 * count(s, t) / (count(s) + count(t))
+    直接按共现次数排序时高频词会占满每个源语言词的名额，Dice 系数对高频词做了归一化
+    另外保留目标语言中出现次数最多的 num_frequent 个词 (标点、功能词等)
+
+    解码时对一个 batch 的所有源语言词取出对应的目标语言词，与高频词合并去重，作为这个 batch 的候选词表
+    decoder 的输出只与候选词的 embedding 相乘，beam search 的 top k 也只在候选词上进行，结束后再映射回原词表的 id
+
+    候选词表按 id 排序，并且总是包含 PAD / BOS (0) 和 EOS (1)，二者在候选词表中的下标与原词表相同
+
+    构建方式：
+        python -m models.transformer.lexical_shortlist \\
+            --data_dir=<训练数据 TFRecord 所在目录> --output=<输出文件>.npz \\
+            --inputs_vocab_size=33708 --targets_vocab_size=33708
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import numpy as np
+import tensorflow as tf
+from absl import app
+from absl import flags
+from absl import logging
+from models.transformer import input_pipeline
+
+
+# 候选词表中总是包含的 id，见 transformer.BOS_ID / EOS_ID
+_RESERVED_IDS = (0, 1)
+# 构建时缓存的 (源语言词, 目标语言词) 组合数达到这个值后合并一次
+_MERGE_SIZE = 1 << 24
+
+
+def _unique_rows(ids):
+    """
+        每一行中重复的 id 只保留一个
+
+    :param ids: (batch_size, seq_len)，0 为 padding
+    :return: (batch_size, max_num_unique) int64，每一行的 id 从小到大排列，不足的用 0 填充在前面
+    """
+    ids = np.sort(ids.astype(np.int64), axis=1)
+    ids[:, 1:][ids[:, 1:] == ids[:, :-1]] = 0
+    ids = np.sort(ids, axis=1)
+    max_num_unique = max(int(np.max(np.sum(ids != 0, axis=1), initial=0)), 1)
+    return ids[:, -max_num_unique:]
+
+
+def _merge_counts(keys_list, counts_list):
+    """合并多组 (key, count)，相同的 key 的 count 相加"""
+    keys, inverse = np.unique(np.concatenate(keys_list), return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate(counts_list), minlength=len(keys))
+    return keys, counts.astype(np.int64)
+
+
+class LexicalShortlist(object):
+    """
+        lexical_table: (inputs_vocab_size, top_n)，每个源语言词对应的目标语言词，不足 top_n 个时用 -1 填充
+        frequent_ids: (num_frequent,)，总是保留的高频目标语言词
+    """
+
+    def __init__(self, lexical_table, frequent_ids):
+        self._lexical_table = tf.constant(lexical_table, dtype=tf.int32)
+        self._frequent_ids = tf.constant(
+            np.concatenate([_RESERVED_IDS, frequent_ids]), dtype=tf.int32
+        )
+
+    @property
+    def lexical_table(self):
+        return self._lexical_table
+
+    @property
+    def frequent_ids(self):
+        return self._frequent_ids
+
+    def get_candidate_ids(self, inputs_ids):
+        """
+        :param inputs_ids: (batch_size, inputs_seq_len)，0 为 padding
+        :return: (num_candidates,)，排序后的候选目标语言词 id，前两个为 0 和 1
+        """
+        with tf.name_scope('lexical_shortlist'):
+            inputs_ids = tf.cast(inputs_ids, tf.int32)
+            inputs_ids = tf.boolean_mask(inputs_ids, tf.not_equal(inputs_ids, 0))
+
+            # (num_inputs_tokens * top_n,)
+            candidate_ids = tf.reshape(tf.gather(self._lexical_table, inputs_ids), [-1])
+            candidate_ids = tf.boolean_mask(candidate_ids, candidate_ids >= 0)
+
+            candidate_ids, _ = tf.unique(tf.concat([self._frequent_ids, candidate_ids], axis=0))
+            return tf.sort(candidate_ids)
+
+    @classmethod
+    def build(cls, dataset, inputs_vocab_size, targets_vocab_size, top_n=50, num_frequent=100):
+        """
+            从句对中统计共现次数
+
+            每个 batch 用 numpy 向量化地生成所有句对中 (源语言词, 目标语言词) 的组合，编码为
+            inputs_id * targets_vocab_size + targets_id 后用 np.unique 计数，
+            各个 batch 的结果先缓存，累积到 _MERGE_SIZE 个后再合并，合并的次数与 batch 数无关
+            Dice 系数相同时按目标语言词 id 从小到大排列
+
+        :param dataset: 元素为 (inputs_ids, targets_ids)，可以是 batch 后用 0 填充的
+        :return: LexicalShortlist
+        """
+        inputs_counts = np.zeros([inputs_vocab_size], dtype=np.int64)
+        targets_counts = np.zeros([targets_vocab_size], dtype=np.int64)
+        pair_keys, pair_counts = np.zeros([0], dtype=np.int64), np.zeros([0], dtype=np.int64)
+        buffered_keys, buffered_counts = [], []
+        num_buffered = 0
+
+        for inputs_ids, targets_ids in dataset:
+            # 同一个句对中重复出现的词只计一次
+            inputs_ids = _unique_rows(np.atleast_2d(inputs_ids.numpy()))
+            targets_ids = _unique_rows(np.atleast_2d(targets_ids.numpy()))
+            inputs_counts += np.bincount(inputs_ids.ravel(), minlength=inputs_vocab_size)
+            targets_counts += np.bincount(targets_ids.ravel(), minlength=targets_vocab_size)
+
+            # (batch_size, inputs_len, targets_len)
+            keys = inputs_ids[:, :, np.newaxis] * targets_vocab_size + targets_ids[:, np.newaxis, :]
+            keys = keys[(inputs_ids != 0)[:, :, np.newaxis] & (targets_ids != 0)[:, np.newaxis, :]]
+            keys, counts = np.unique(keys, return_counts=True)
+            buffered_keys.append(keys)
+            buffered_counts.append(counts)
+            num_buffered += len(keys)
+
+            if num_buffered >= _MERGE_SIZE:
+                pair_keys, pair_counts = _merge_counts([pair_keys] + buffered_keys, [pair_counts] + buffered_counts)
+                buffered_keys, buffered_counts = [], []
+                num_buffered = 0
+
+        pair_keys, pair_counts = _merge_counts([pair_keys] + buffered_keys, [pair_counts] + buffered_counts)
+        # padding 不计入
+        inputs_counts[0] = 0
+        targets_counts[0] = 0
+
+        inputs_row, targets_row = pair_keys // targets_vocab_size, pair_keys % targets_vocab_size
+        dice = 2.0 * pair_counts / (inputs_counts[inputs_row] + targets_counts[targets_row])
+        # 按源语言词分组，组内按 Dice 系数从大到小排列，np.lexsort 以最后一个 key 为第一关键字
+        order = np.lexsort((targets_row, -dice, inputs_row))
+        inputs_row, targets_row = inputs_row[order], targets_row[order]
+        # 每个组合在所属源语言词的组内的排名
+        ranks = np.arange(len(inputs_row)) - np.searchsorted(inputs_row, inputs_row, side='left')
+        kept = ranks < top_n
+
+        lexical_table = np.full([inputs_vocab_size, top_n], -1, dtype=np.int32)
+        lexical_table[inputs_row[kept], ranks[kept]] = targets_row[kept]
+
+        frequent_ids = np.argsort(-targets_counts, kind='stable')[:num_frequent].astype(np.int32)
+        return cls(lexical_table, frequent_ids)
+
+    def save(self, path):
+        np.savez(
+            path,
+            lexical_table=self._lexical_table.numpy(),
+            # 保留的 id 在构造时加入，不写入文件
+            frequent_ids=self._frequent_ids.numpy()[len(_RESERVED_IDS):]
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['lexical_table'], data['frequent_ids'])
+
+
+def define_flags():
+    flags.DEFINE_string(
+        name='data_dir',
+        default=None,
+        help='directory of the training TFRecords'
+    )
+    flags.DEFINE_string(
+        name='output',
+        default=None,
+        help='output .npz file'
+    )
+    flags.DEFINE_integer(
+        name='inputs_vocab_size',
+        default=33708,
+        help='inputs vocab size'
+    )
+    flags.DEFINE_integer(
+        name='targets_vocab_size',
+        default=33708,
+        help='targets vocab size'
+    )
+    flags.DEFINE_integer(
+        name='top_n',
+        default=50,
+        help='number of target candidates kept for each source token'
+    )
+    flags.DEFINE_integer(
+        name='num_frequent',
+        default=100,
+        help='number of most frequent target tokens always kept'
+    )
+    flags.DEFINE_integer(
+        name='max_seq_len',
+        default=256,
+        help='max sequence length of the training data'
+    )
+    flags.mark_flags_as_required(['data_dir', 'output'])
+
+
+def main(_):
+    flags_obj = flags.FLAGS
+    dataset = input_pipeline.get_train_dataset(dict(
+        data_dir=flags_obj.data_dir,
+        batch_size=256,
+        max_seq_len=flags_obj.max_seq_len,
+        repeat_dataset=False
+    ))
+    shortlist = LexicalShortlist.build(
+        dataset,
+        inputs_vocab_size=flags_obj.inputs_vocab_size,
+        targets_vocab_size=flags_obj.targets_vocab_size,
+        top_n=flags_obj.top_n,
+        num_frequent=flags_obj.num_frequent
+    )
+    shortlist.save(flags_obj.output)
+    logging.info('Write lexical shortlist to %s' % flags_obj.output)
+
+
+if __name__ == '__main__':
+    logging.set_verbosity(logging.INFO)
+    define_flags()
+    app.run(main)
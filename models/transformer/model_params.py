@@ -39,6 +39,35 @@ BASE_PARAMS = defaultdict(
     extra_decode_len=50,
     beam_size=4,
     alpha=0.6,
+    padded_decode=False,
+    # beam search 时将已经结束的 batch item 移出解码循环，减少无效的 decoder 计算
+    compact_finished_batches=False,
+    # beam search 时 self attention 的 cache 不随 beam 重排，通过 backpointer 表间接读取，需要 padded_decode
+    indirect_cache=False,
+    # 解码时 self attention 的 key / value cache 使用 int8 量化存储，减少内存占用
+    quantize_cache=False,
+    # decoder attention 的 key / value 头数，小于 num_attention_heads 时为 grouped-query attention，None 表示与其相同
+    num_kv_heads=None,
+    # self attention 的 query、key、value 使用一个合并的投影，默认不合并以兼容已有的 checkpoint，
+    # 两者的 checkpoint 可以用 fused_qkv_conversion.py 转换
+    fuse_qkv_projection=False,
+    # encoder / decoder self attention 使用 kernelized linear attention，取值为 'elu' 或 'random'，None 表示 softmax attention
+    # 解码时 self attention 的 cache 只保存 key / value 的累加和，不支持 indirect_cache 和 quantize_cache
+    # 使用时 attention_dropout_rate 必须为 0
+    linear_attention=None,
+    # linear_attention 为 'random' 时随机特征的个数，None 表示 2 * size_per_head
+    num_random_features=None,
+    # lexical shortlist 文件 (见 lexical_shortlist.py)，解码时只在候选词上计算 softmax，None 表示使用完整词表
+    lexical_shortlist_file=None,
+    # encoder 和训练时的 decoder 用一个 tf.while_loop 执行所有层，减少 tracing 时间和 graph 大小
+    # 各层的权重保存为 .../stacked_layer/... 的 (num_hidden_layers, ...) 变量，与展开执行的 checkpoint 不同，
+    # 需要用 utils.restore_checkpoint (或 utils.convert_checkpoint) 和 utils.convert_stacked_checkpoint_weight 读取
+    scan_layers=False,
+    # 解码策略：beam_search / greedy / sampling
+    decode_strategy='beam_search',
+    top_k=0,
+    top_p=1.0,
+    sample_temperature=1.0,
 
     # tpu 相关
     use_tpu=False,
@@ -0,0 +1,242 @@
+# -*- coding: utf - 8 -*-
+
+"""
+    Speculative decoding
+
+    每一轮：
+        1. 小的 draft 模型逐 token 贪心解码，提出 k 个候选 token
+        2. 大模型把上一个 token 和 k 个候选 token 一起输入，通过 look ahead mask 在一次 decoder 前向计算中
+           得到这 k + 1 个位置上的预测
+        3. 候选 token 与大模型的预测从头开始逐个比较，接受前 n 个一致的 token，
+           再加上大模型在第 n + 1 个位置上的预测，本轮共提交 n + 1 个 token
+        4. 两个模型的 cache 截断到已提交的长度，丢弃未被接受的位置
+
+    提交的 token 都是大模型的贪心预测，因此结果与大模型的贪心解码一致
+    大模型每一轮只需要一次 decoder 前向计算，却能提交 1 到 k + 1 个 token
+
+    为了让一个 batch 中的句子保持相同的长度，每一轮接受的 token 数取 batch 中的最小值
+    模型均为 models.transformer.transformer.Transformer，需要使用相同的目标语言词表
+"""
+
+import tensorflow as tf
+from layers import utils
+from ops import beam_search
+from models.transformer.transformer import BOS_ID, EOS_ID
+
+
+class SpeculativeDecoder(tf.Module):
+
+    def __init__(
+            self,
+            model,
+            draft_model,
+            num_speculative_tokens=4,
+            max_decode_len=None,
+            extra_decode_len=50,
+            dtype=tf.float32,
+            **kwargs
+    ):
+        """
+        :param model: 用于验证的大模型
+        :param draft_model: 用于提出候选 token 的小模型，例如使用 TINY_PARAMS 创建的模型
+        :param num_speculative_tokens: 每一轮 draft 模型提出的 token 数 k
+        :param max_decode_len: 最大解码长度，为 None 时使用 inputs_len + extra_decode_len
+        """
+        super(SpeculativeDecoder, self).__init__(**kwargs)
+        if num_speculative_tokens < 1:
+            raise ValueError(
+                'num_speculative_tokens must be positive, got %d' % num_speculative_tokens
+            )
+        self._model = model
+        self._draft_model = draft_model
+        self._num_speculative_tokens = num_speculative_tokens
+        self._max_decode_len = max_decode_len
+        self._extra_decode_len = extra_decode_len
+        self._dtype = dtype
+
+    def predict(self, inputs_ids):
+        """
+        :param inputs_ids: (batch_size, inputs_seq_len)
+        :return: {
+                    'outputs': (batch_size, max_decode_len)，EOS 之后用 0 填充
+                    'scores': (batch_size,)，大模型给出的 log probability 之和
+                    'num_rounds': 大模型 decoder 前向计算的次数
+                 }
+        """
+        k = self._num_speculative_tokens
+        padding_mask = utils.get_padding_mask(inputs_ids, padding_value=0, dtype=self._dtype)
+        max_decode_len = self._max_decode_len or (tf.shape(inputs_ids)[1] + self._extra_decode_len)
+        batch_size = tf.shape(inputs_ids)[0]
+
+        # 最后一轮最多会超出 max_decode_len k 个位置
+        max_len = max_decode_len + k + 1
+        target = self._get_decode_block_fn(self._model, max_len)
+        draft = self._get_decode_block_fn(self._draft_model, max_len)
+
+        target_cache = self._create_cache(self._model, inputs_ids, padding_mask)
+        draft_cache = self._create_cache(self._draft_model, inputs_ids, padding_mask)
+
+        def _continue(ids, log_probs, finished, target_cache, draft_cache, num_rounds):
+            return tf.logical_and(
+                tf.shape(ids)[1] - 1 < max_decode_len,
+                tf.logical_not(tf.reduce_all(finished))
+            )
+
+        def _round(ids, log_probs, finished, target_cache, draft_cache, num_rounds):
+            seq_len = tf.shape(ids)[1]
+
+            # draft 模型先补上 cache 中缺少的位置，最后一个位置的预测即为第一个候选 token
+            draft_len = _cache_length(draft_cache)
+            draft_logits = draft(ids[:, draft_len:], draft_len, draft_cache)
+            draft_ids = [tf.argmax(draft_logits[:, -1], axis=-1, output_type=tf.int32)]
+            for _ in range(k - 1):
+                draft_logits = draft(
+                    tf.expand_dims(draft_ids[-1], axis=1), _cache_length(draft_cache), draft_cache
+                )
+                draft_ids.append(tf.argmax(draft_logits[:, -1], axis=-1, output_type=tf.int32))
+            # (batch_size, k)
+            draft_ids = tf.stack(draft_ids, axis=1)
+
+            # 大模型在一次前向计算中验证 k 个候选 token
+            # (batch_size, k + 1, vocab_size)
+            target_logits = target(
+                tf.concat([ids[:, -1:], draft_ids], axis=1), seq_len - 1, target_cache
+            )
+            target_ids = tf.argmax(target_logits, axis=-1, output_type=tf.int32)
+
+            # 每个句子从头开始连续一致的 token 数，已经结束的句子不参与
+            matches = tf.cast(tf.equal(draft_ids, target_ids[:, :k]), tf.int32)
+            num_accepted = tf.reduce_sum(tf.math.cumprod(matches, axis=1), axis=1)
+            num_accepted = tf.where(finished, k, num_accepted)
+            num_accepted = tf.reduce_min(num_accepted)
+
+            # 本轮提交的 token
+            # (batch_size, num_accepted + 1)
+            new_ids = target_ids[:, :num_accepted + 1]
+            new_log_probs = tf.gather(
+                tf.nn.log_softmax(tf.cast(target_logits[:, :num_accepted + 1], tf.float32)),
+                new_ids,
+                batch_dims=2
+            )
+
+            # EOS 之后的位置用 0 填充，不再累加 log probability
+            # 超出 max_decode_len 的位置最后会被截掉，同样不累加
+            is_eos = tf.equal(new_ids, EOS_ID)
+            beyond_max_len = seq_len + tf.range(num_accepted + 1) > max_decode_len
+            after_eos = tf.logical_or(
+                tf.logical_or(tf.expand_dims(finished, axis=1), beyond_max_len[tf.newaxis, :]),
+                tf.math.cumsum(tf.cast(is_eos, tf.int32), axis=1, exclusive=True) > 0
+            )
+            new_ids = tf.where(after_eos, tf.zeros_like(new_ids), new_ids)
+            new_log_probs = tf.where(after_eos, tf.zeros_like(new_log_probs), new_log_probs)
+            finished = tf.logical_or(
+                finished, tf.reduce_any(tf.logical_and(is_eos, tf.logical_not(after_eos)), axis=1)
+            )
+
+            # 已提交 seq_len + num_accepted + 1 个 token，最后一个 token 还没有输入过 decoder
+            target_cache = _truncate_cache(target_cache, seq_len + num_accepted)
+            draft_cache = _truncate_cache(draft_cache, seq_len + num_accepted)
+
+            return (
+                tf.concat([ids, new_ids], axis=1),
+                log_probs + tf.reduce_sum(new_log_probs, axis=1),
+                finished,
+                target_cache,
+                draft_cache,
+                num_rounds + 1
+            )
+
+        ids, log_probs, _, _, _, num_rounds = tf.while_loop(
+            _continue,
+            _round,
+            loop_vars=[
+                tf.fill([batch_size, 1], BOS_ID),
+                tf.zeros([batch_size], tf.float32),
+                tf.zeros([batch_size], tf.bool),
+                target_cache,
+                draft_cache,
+                tf.constant(0)
+            ],
+            shape_invariants=[
+                tf.TensorShape([None, None]),
+                tf.TensorShape([None]),
+                tf.TensorShape([None]),
+                tf.nest.map_structure(beam_search._get_shape_keep_last_dim, target_cache),
+                tf.nest.map_structure(beam_search._get_shape_keep_last_dim, draft_cache),
+                tf.TensorShape([])
+            ]
+        )
+
+        return {
+            'outputs': ids[:, 1: max_decode_len + 1],
+            'scores': log_probs,
+            'num_rounds': num_rounds
+        }
+
+    def _create_cache(self, model, inputs_ids, padding_mask):
+        encoder_outputs = model.encode(inputs_ids, padding_mask, training=False)
+
+        batch_size = tf.shape(inputs_ids)[0]
+        num_heads = model.decoder_stack.num_kv_heads
+        size_per_head = encoder_outputs.shape[-1] // model.decoder_stack.num_attention_heads
+        cache = {
+            str(layer): {
+                'key': tf.zeros([batch_size, 0, num_heads, size_per_head], dtype=self._dtype),
+                'value': tf.zeros([batch_size, 0, num_heads, size_per_head], dtype=self._dtype)
+            } for layer in range(model.decoder_stack.num_hidden_layers)
+        }
+        for layer, layer_cache in model.decoder_stack.compute_encoder_decoder_cache(encoder_outputs).items():
+            cache[layer].update(layer_cache)
+        cache['encoder_outputs'] = encoder_outputs
+        cache['padding_mask'] = padding_mask
+        return cache
+
+    def _get_decode_block_fn(self, model, max_len):
+        position_embeddings = tf.cast(
+            model.position_embedding(inputs=None, length=max_len), self._dtype
+        )
+        look_ahead_mask = utils.get_look_ahead_mask(max_len, dtype=self._dtype)
+
+        def decode_block(block_ids, start, cache):
+            """
+                将从 start 开始的若干个 token 一起输入 decoder，并写入 cache
+
+            :param block_ids: (batch_size, block_len)
+            :param start: block 中第一个 token 的位置，等于 cache 的长度
+            :return: (batch_size, block_len, vocab_size)
+            """
+            block_len = tf.shape(block_ids)[1]
+            decoder_inputs = model.targets_word_embedding(block_ids, mode='embedding')
+            decoder_inputs += position_embeddings[start: start + block_len]
+
+            # block 内部使用 causal mask，cache 中的位置全部可见
+            # (1, block_len, start + block_len)
+            mask = look_ahead_mask[:, start: start + block_len, :start + block_len]
+
+            decoder_outputs = model.decoder_stack(
+                decoder_inputs,
+                cache['encoder_outputs'],
+                cache['padding_mask'],
+                mask,
+                training=False,
+                cache=cache
+            )
+            return model.targets_word_embedding(decoder_outputs, mode='linear')
+
+        return decode_block
+
+
+def _cache_length(cache):
+    return tf.shape(cache['0']['key'])[1]
+
+
+def _truncate_cache(cache, length):
+    """只截断 self attention 的 key / value，长度不足 length 时保持不变"""
+    new_cache = dict(cache)
+    for layer, layer_cache in cache.items():
+        if isinstance(layer_cache, dict):
+            layer_cache = dict(layer_cache)
+            layer_cache['key'] = layer_cache['key'][:, :length]
+            layer_cache['value'] = layer_cache['value'][:, :length]
+            new_cache[layer] = layer_cache
+    return new_cache
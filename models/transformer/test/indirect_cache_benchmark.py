@@ -0,0 +1,78 @@
+# -*- coding: utf - 8 -*-
+
+"""
+    对比 beam search 时两种 self attention cache 的解码速度
+
+    1. gather: 每一步选出新的 beam 后，所有层的 key / value cache 按父 beam gather 两次
+    2. indirect: cache 固定按 beam 位置存放，只 gather backpointer 表，attention 通过它间接读取
+
+    两者都使用 padded_decode，随机初始化的模型不会提前结束，每个句子都解码到最大长度
+
+    运行方式：
+        python -m models.transformer.test.indirect_cache_benchmark --benchmarks=.
+"""
+
+import time
+import tensorflow as tf
+from models.transformer.test import model_builder
+
+_BATCH_SIZE = 4
+_INPUTS_LEN = 32
+_BEAM_SIZES = (4, 8)
+_DECODE_LENS = (64, 128)
+_VOCAB_SIZE = 8000
+_HIDDEN_SIZE = 256
+_NUM_ITERS = 2
+
+
+def _build_model(beam_size, decode_len, indirect_cache):
+    return model_builder.build_model(
+        inputs_vocab_size=_VOCAB_SIZE,
+        targets_vocab_size=_VOCAB_SIZE,
+        hidden_size=_HIDDEN_SIZE,
+        num_hidden_layers=6,
+        num_attention_heads=8,
+        intermediate_size=_HIDDEN_SIZE * 4,
+        max_decode_len=decode_len,
+        extra_decode_len=0,
+        beam_size=beam_size,
+        padded_decode=True,
+        indirect_cache=indirect_cache
+    )
+
+
+class IndirectCacheBenchmark(tf.test.Benchmark):
+
+    def _run_benchmark(self, indirect_cache):
+        mode = 'indirect' if indirect_cache else 'gather'
+        inputs_ids = tf.random.uniform(
+            [_BATCH_SIZE, _INPUTS_LEN], minval=2, maxval=_VOCAB_SIZE, dtype=tf.int64
+        )
+        for beam_size in _BEAM_SIZES:
+            for decode_len in _DECODE_LENS:
+                model = _build_model(beam_size, decode_len, indirect_cache)
+                predict = tf.function(lambda x: model([x], training=False))
+                # 预热，排除 tracing 时间
+                predict(inputs_ids)['outputs'].numpy()
+
+                start = time.time()
+                for _ in range(_NUM_ITERS):
+                    predict(inputs_ids)['outputs'].numpy()
+                wall_time = (time.time() - start) / _NUM_ITERS
+
+                self.report_benchmark(
+                    iters=_NUM_ITERS,
+                    wall_time=wall_time,
+                    extras={'ms_per_step': wall_time / decode_len * 1000},
+                    name='beam_search_%s_cache_beam_%d_len_%d' % (mode, beam_size, decode_len)
+                )
+
+    def benchmark_gather_cache(self):
+        self._run_benchmark(indirect_cache=False)
+
+    def benchmark_indirect_cache(self):
+        self._run_benchmark(indirect_cache=True)
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -0,0 +1,79 @@
+# -*- coding: utf - 8 -*-
+
+"""
+    对比 beam search 时使用完整目标词表与 lexical shortlist 的解码速度
+
+    词表大小与 BASE_PARAMS 相同，模型与 shortlist 均为随机生成
+    shortlist 每个源语言词保留 _TOP_N 个目标语言词，另外保留 _NUM_FREQUENT 个高频词
+    报告 tokens_per_second 以及每个 batch 的平均候选词数 num_candidates
+
+    运行方式：
+        python -m models.transformer.test.lexical_shortlist_benchmark --benchmarks=.
+"""
+
+import time
+import numpy as np
+import tensorflow as tf
+from models.transformer.model_params import BASE_PARAMS
+from models.transformer.lexical_shortlist import LexicalShortlist
+from models.transformer.test import model_builder
+
+_BATCH_SIZE = 8
+_INPUTS_LEN = 32
+_DECODE_LEN = 32
+_VOCAB_SIZE = BASE_PARAMS['targets_vocab_size']
+_HIDDEN_SIZE = 256
+_TOP_N = 50
+_NUM_FREQUENT = 100
+_NUM_ITERS = 3
+
+
+def _build_model(lexical_shortlist):
+    return model_builder.build_model(
+        inputs_vocab_size=_VOCAB_SIZE,
+        targets_vocab_size=_VOCAB_SIZE,
+        hidden_size=_HIDDEN_SIZE,
+        num_hidden_layers=3,
+        num_attention_heads=4,
+        intermediate_size=_HIDDEN_SIZE * 4,
+        max_decode_len=_DECODE_LEN,
+        extra_decode_len=0,
+        lexical_shortlist=lexical_shortlist
+    )
+
+
+class LexicalShortlistBenchmark(tf.test.Benchmark):
+
+    def _run(self, lexical_shortlist, name):
+        model = _build_model(lexical_shortlist)
+        predict = tf.function(lambda x: model([x], training=False))
+        inputs_ids = tf.random.uniform(
+            [_BATCH_SIZE, _INPUTS_LEN], minval=2, maxval=_VOCAB_SIZE, dtype=tf.int64, seed=1
+        )
+        # 预热，排除 tracing 时间
+        predict(inputs_ids)['outputs'].numpy()
+
+        start = time.time()
+        for _ in range(_NUM_ITERS):
+            predict(inputs_ids)['outputs'].numpy()
+        wall_time = (time.time() - start) / _NUM_ITERS
+
+        extras = {'tokens_per_second': _BATCH_SIZE * _DECODE_LEN / wall_time}
+        if lexical_shortlist is not None:
+            extras['num_candidates'] = int(tf.size(lexical_shortlist.get_candidate_ids(inputs_ids)))
+        self.report_benchmark(iters=_NUM_ITERS, wall_time=wall_time, extras=extras, name=name)
+
+    def benchmark_full_vocab(self):
+        self._run(None, 'beam_search_full_vocab')
+
+    def benchmark_lexical_shortlist(self):
+        random_state = np.random.RandomState(0)
+        lexical_shortlist = LexicalShortlist(
+            random_state.randint(2, _VOCAB_SIZE, size=[_VOCAB_SIZE, _TOP_N]),
+            random_state.randint(2, _VOCAB_SIZE, size=[_NUM_FREQUENT])
+        )
+        self._run(lexical_shortlist, 'beam_search_lexical_shortlist')
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -0,0 +1,58 @@
+# -*- coding: utf - 8 -*-
+
+"""
+    测试和 benchmark 共用的 transformer.Transformer 小模型
+"""
+
+from models.transformer import transformer
+from layers.transformer_layers.encoder_stack import TransformerEncoderStack
+from layers.transformer_layers.decoder_stack import TransformerDecoderStack
+
+
+def build_model(
+        inputs_vocab_size=100,
+        targets_vocab_size=100,
+        hidden_size=16,
+        num_hidden_layers=1,
+        num_attention_heads=2,
+        intermediate_size=None,
+        stack_kwargs=None,
+        decoder_stack_kwargs=None,
+        **kwargs
+):
+    """
+        encoder / decoder 为 pre-norm 的 TransformerEncoderStack / TransformerDecoderStack，默认不使用 dropout
+
+    :param intermediate_size: 为 None 时为 2 * hidden_size
+    :param stack_kwargs: encoder 和 decoder stack 的其他参数
+    :param decoder_stack_kwargs: 只用于 decoder stack 的参数，例如 num_kv_heads
+    :param kwargs: transformer.Transformer 的其他参数，默认为
+        max_decode_len=None, extra_decode_len=5, beam_size=4, alpha=0.6
+    :return: transformer.Transformer
+    """
+    encoder_decoder_kwargs = dict(
+        num_hidden_layers=num_hidden_layers,
+        num_attention_heads=num_attention_heads,
+        intermediate_size=intermediate_size or hidden_size * 2,
+        norm_first=True,
+        norm_epsilon=1e-6
+    )
+    encoder_decoder_kwargs.update(stack_kwargs or {})
+
+    transformer_kwargs = dict(
+        attention_dropout_rate=0.0,
+        hidden_dropout_rate=0.0,
+        max_decode_len=None,
+        extra_decode_len=5,
+        beam_size=4,
+        alpha=0.6
+    )
+    transformer_kwargs.update(kwargs)
+    return transformer.Transformer(
+        inputs_vocab_size=inputs_vocab_size,
+        targets_vocab_size=targets_vocab_size,
+        hidden_size=hidden_size,
+        encoder_stack=TransformerEncoderStack(**encoder_decoder_kwargs),
+        decoder_stack=TransformerDecoderStack(**dict(encoder_decoder_kwargs, **(decoder_stack_kwargs or {}))),
+        **transformer_kwargs
+    )
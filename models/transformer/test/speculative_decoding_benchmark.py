@@ -0,0 +1,101 @@
+# -*- coding: utf - 8 -*-
+
+"""
+    对比大模型 (BASE_PARAMS) 在 greedy、beam search 以及 speculative decoding 下的解码速度
+    speculative decoding 的 draft 模型使用 TINY_PARAMS
+
+    模型均为随机初始化，两个模型的预测互不相关，接受率很低，只能体现每一轮额外的开销
+    因此额外报告 draft 模型与大模型相同 (候选 token 全部被接受) 的情况，作为大模型调用次数减少的上限
+
+    除了 tokens_per_second 之外，还报告 target_calls_per_token，即每个输出 token 需要的大模型 decoder 前向计算次数
+
+    运行方式：
+        python -m models.transformer.test.speculative_decoding_benchmark --benchmarks=.
+"""
+
+import time
+import tensorflow as tf
+from models.transformer.model_params import BASE_PARAMS, TINY_PARAMS
+from models.transformer.speculative_decoding import SpeculativeDecoder
+from models.transformer.test import model_builder
+
+_BATCH_SIZE = 1
+_INPUTS_LEN = 16
+_DECODE_LEN = 32
+_NUM_SPECULATIVE_TOKENS = 4
+_NUM_ITERS = 3
+
+
+def _build_model(params, decode_strategy):
+    return model_builder.build_model(
+        inputs_vocab_size=params['inputs_vocab_size'],
+        targets_vocab_size=params['targets_vocab_size'],
+        hidden_size=params['hidden_size'],
+        num_hidden_layers=params['num_hidden_layers'],
+        num_attention_heads=params['num_attention_heads'],
+        intermediate_size=params['intermediate_size'],
+        max_decode_len=_DECODE_LEN,
+        extra_decode_len=params['extra_decode_len'],
+        beam_size=params['beam_size'],
+        alpha=params['alpha'],
+        decode_strategy=decode_strategy
+    )
+
+
+class SpeculativeDecodingBenchmark(tf.test.Benchmark):
+
+    def _run(self, predict_fn, name):
+        inputs_ids = tf.random.uniform(
+            [_BATCH_SIZE, _INPUTS_LEN], minval=2, maxval=BASE_PARAMS['inputs_vocab_size'], dtype=tf.int64
+        )
+        # 预热，排除 tracing 时间
+        ret = predict_fn(inputs_ids)
+
+        start = time.time()
+        for _ in range(_NUM_ITERS):
+            ret = predict_fn(inputs_ids)
+        wall_time = (time.time() - start) / _NUM_ITERS
+
+        num_tokens = _BATCH_SIZE * _DECODE_LEN
+        num_target_calls = int(ret.get('num_rounds', _DECODE_LEN))
+        self.report_benchmark(
+            iters=_NUM_ITERS,
+            wall_time=wall_time,
+            extras={
+                'tokens_per_second': num_tokens / wall_time,
+                'target_calls_per_token': num_target_calls / float(_DECODE_LEN)
+            },
+            name=name
+        )
+
+    def benchmark_greedy(self):
+        model = _build_model(BASE_PARAMS, 'greedy')
+        self._run(tf.function(lambda x: model([x], training=False)), 'decode_greedy')
+
+    def benchmark_beam_search(self):
+        model = _build_model(BASE_PARAMS, 'beam_search')
+        self._run(
+            tf.function(lambda x: model([x], training=False)),
+            'decode_beam_search_%d' % BASE_PARAMS['beam_size']
+        )
+
+    def benchmark_speculative(self):
+        model = _build_model(BASE_PARAMS, 'greedy')
+        draft_model = _build_model(TINY_PARAMS, 'greedy')
+        decoder = SpeculativeDecoder(
+            model, draft_model, num_speculative_tokens=_NUM_SPECULATIVE_TOKENS, max_decode_len=_DECODE_LEN
+        )
+        self._run(tf.function(decoder.predict), 'decode_speculative_tiny_draft')
+
+    def benchmark_speculative_all_accepted(self):
+        model = _build_model(BASE_PARAMS, 'greedy')
+        # 使用大模型自身作为 draft，候选 token 全部被接受
+        # draft 的开销与大模型相同，只用于观察大模型调用次数的下限
+        decoder = SpeculativeDecoder(
+            model, model, num_speculative_tokens=_NUM_SPECULATIVE_TOKENS, max_decode_len=_DECODE_LEN
+        )
+        self._run(tf.function(decoder.predict), 'decode_speculative_all_accepted')
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -0,0 +1,72 @@
+# -*- coding: utf - 8 -*-
+
+import os
+import tensorflow as tf
+from absl.testing import parameterized
+from layers import utils
+from models.transformer import fused_qkv_conversion
+from models.transformer.transformer_params import PARAMS
+
+
+class FusedQKVConversionTest(tf.test.TestCase, parameterized.TestCase):
+
+    @parameterized.parameters(
+        dict(fuse_qkv_projection=True, num_kv_heads=None),
+        dict(fuse_qkv_projection=True, num_kv_heads=2),
+        dict(fuse_qkv_projection=False, num_kv_heads=2)
+    )
+    def test_convert_checkpoint(self, fuse_qkv_projection, num_kv_heads):
+        params = PARAMS.copy()
+        params.update(
+            hidden_size=16,
+            num_hidden_layers=2,
+            intermediate_size=32,
+            num_attention_heads=4,
+            num_kv_heads=num_kv_heads,
+            inputs_vocab_size=41,
+            targets_vocab_size=61,
+            hidden_dropout_rate=0.0,
+            attention_dropout_rate=0.0,
+            fuse_qkv_projection=not fuse_qkv_projection,
+            dtype=tf.float32
+        )
+        model = fused_qkv_conversion.transformerV2.create_model(params, is_train=True)
+        checkpoint_path = tf.train.Checkpoint(model=model).write(
+            os.path.join(self.get_temp_dir(), 'source')
+        )
+
+        output_path = fused_qkv_conversion.convert_checkpoint(
+            checkpoint_path, os.path.join(self.get_temp_dir(), 'converted'), fuse_qkv_projection, params=params
+        )
+
+        params['fuse_qkv_projection'] = fuse_qkv_projection
+        converted_model = fused_qkv_conversion.transformerV2.create_model(params, is_train=True)
+        tf.train.Checkpoint(model=converted_model).restore(output_path).expect_partial()
+        # transformerV2 的 encoder 和 decoder 各有一个共用的 self attention，
+        # 合并后 query、key、value 的 3 个 kernel 和 3 个 bias 变为 1 个 kernel 和 1 个 bias
+        num_fused_weights = 2 * 4
+        self.assertLen(
+            converted_model.weights,
+            len(model.weights) - num_fused_weights if fuse_qkv_projection else len(model.weights) + num_fused_weights
+        )
+
+        inputs_ids = tf.constant([[3, 4, 5, 1, 0], [7, 8, 1, 0, 0]], dtype=tf.int64)
+        targets_ids = tf.constant([[6, 9, 1], [2, 1, 0]], dtype=tf.int64)
+        self.assertAllClose(
+            model([inputs_ids, targets_ids], training=False),
+            converted_model([inputs_ids, targets_ids], training=False)
+        )
+
+    def test_convert_checkpoint_with_missing_weight(self):
+        source = tf.train.Checkpoint(kernel=tf.Variable(tf.zeros([2, 3])))
+        checkpoint_path = source.write(os.path.join(self.get_temp_dir(), 'source'))
+
+        target = tf.train.Checkpoint(kernel=tf.Variable(tf.zeros([2, 4])))
+        with self.assertRaises(ValueError):
+            utils.convert_checkpoint(
+                checkpoint_path, os.path.join(self.get_temp_dir(), 'target'), target, convert_fns=[]
+            )
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -0,0 +1,135 @@
+# -*- coding: utf - 8 -*-
+
+import os
+import numpy as np
+import tensorflow as tf
+from absl.testing import parameterized
+from layers.attention_layers import multi_head_attention_layer
+from models.transformer import kv_heads_conversion
+from models.transformer.transformer_params import PARAMS
+from models.transformer.test import model_builder
+
+
+class KVHeadsConversionTest(tf.test.TestCase, parameterized.TestCase):
+
+    def test_mean_pool_kv_heads(self):
+        # (hidden_size, num_heads, size_per_head)
+        kernel = np.random.normal(size=[6, 4, 3]).astype(np.float32)
+        pooled = kv_heads_conversion.mean_pool_kv_heads(kernel, num_kv_heads=2)
+        self.assertAllClose(np.stack([kernel[:, 0:2].mean(1), kernel[:, 2:4].mean(1)], axis=1), pooled)
+
+        # (num_heads, size_per_head)
+        bias = np.random.normal(size=[4, 3]).astype(np.float32)
+        self.assertAllClose(bias.mean(0, keepdims=True), kv_heads_conversion.mean_pool_kv_heads(bias, 1))
+        # num_kv_heads 与 num_heads 相同时不变
+        self.assertAllClose(bias, kv_heads_conversion.mean_pool_kv_heads(bias, 4))
+
+        with self.assertRaises(ValueError):
+            kv_heads_conversion.mean_pool_kv_heads(bias, 3)
+
+        # 合并投影中只有 key / value 的部分按组取平均
+        fused_kernel = np.concatenate([kernel, kernel + 1, kernel + 2], axis=-2)
+        pooled = kernel.mean(1, keepdims=True)
+        self.assertAllClose(
+            np.concatenate([kernel, pooled + 1, pooled + 2], axis=-2),
+            kv_heads_conversion.mean_pool_fused_kv_heads(fused_kernel, num_kv_heads=1)
+        )
+
+    @parameterized.parameters(
+        dict(padded_decode=False, indirect_cache=False, fuse_qkv_projection=False),
+        dict(padded_decode=True, indirect_cache=False, fuse_qkv_projection=False),
+        dict(padded_decode=True, indirect_cache=True, fuse_qkv_projection=False),
+        dict(padded_decode=False, indirect_cache=False, fuse_qkv_projection=True)
+    )
+    def test_convert_model_weights(self, padded_decode, indirect_cache, fuse_qkv_projection):
+        inputs_ids = tf.constant([[3, 4, 5, 1, 0], [7, 8, 1, 0, 0]], dtype=tf.int64)
+
+        model = self._build_model(None, padded_decode, indirect_cache, fuse_qkv_projection=fuse_qkv_projection)
+        grouped_model = self._build_model(1, padded_decode, indirect_cache, fuse_qkv_projection=fuse_qkv_projection)
+        model([inputs_ids], training=False)
+        grouped_model([inputs_ids], training=False)
+
+        # 同一组内的 key / value 头相同时，转换前后的模型等价
+        for weight in model.weights:
+            if kv_heads_conversion._is_key_value_weight(weight):
+                num_heads = weight.shape[-2]
+                pooled = kv_heads_conversion.mean_pool_kv_heads(weight, num_kv_heads=1)
+                weight.assign(tf.repeat(pooled, num_heads, axis=-2))
+            elif kv_heads_conversion._is_fused_qkv_weight(weight):
+                num_heads = weight.shape[-2] // 3
+                query, key, value = multi_head_attention_layer.split_qkv_weight(weight, num_heads, num_heads)
+                weight.assign(multi_head_attention_layer.merge_qkv_weights(query, *[
+                    tf.repeat(kv_heads_conversion.mean_pool_kv_heads(w, num_kv_heads=1), num_heads, axis=-2)
+                    for w in (key, value)
+                ]))
+        kv_heads_conversion.convert_model_weights(model, grouped_model)
+
+        ret = model([inputs_ids], training=False)
+        grouped_ret = grouped_model([inputs_ids], training=False)
+        self.assertAllEqual(ret['outputs'], grouped_ret['outputs'])
+        self.assertAllClose(ret['scores'], grouped_ret['scores'])
+
+    def test_convert_model_weights_with_different_models(self):
+        inputs_ids = tf.constant([[3, 4, 5, 1, 0]], dtype=tf.int64)
+        model = self._build_model(None)
+        other_model = self._build_model(None, num_hidden_layers=2)
+        model([inputs_ids], training=False)
+        other_model([inputs_ids], training=False)
+        with self.assertRaises(ValueError):
+            kv_heads_conversion.convert_model_weights(model, other_model)
+
+    @parameterized.parameters(False, True)
+    def test_convert_checkpoint(self, fuse_qkv_projection):
+        params = PARAMS.copy()
+        params.update(
+            hidden_size=16,
+            num_hidden_layers=2,
+            intermediate_size=32,
+            num_attention_heads=4,
+            inputs_vocab_size=41,
+            targets_vocab_size=61,
+            fuse_qkv_projection=fuse_qkv_projection,
+            dtype=tf.float32
+        )
+        model = kv_heads_conversion.transformerV2.create_model(params, is_train=True)
+        checkpoint_path = tf.train.Checkpoint(model=model).write(
+            os.path.join(self.get_temp_dir(), 'source')
+        )
+
+        output_path = kv_heads_conversion.convert_checkpoint(
+            checkpoint_path, os.path.join(self.get_temp_dir(), 'grouped'), num_kv_heads=2, params=params
+        )
+
+        params['num_kv_heads'] = 2
+        grouped_model = kv_heads_conversion.transformerV2.create_model(params, is_train=True)
+        tf.train.Checkpoint(model=grouped_model).restore(output_path).expect_partial()
+        for weight, grouped_weight in zip(model.weights, grouped_model.weights):
+            if weight.shape != grouped_weight.shape and kv_heads_conversion._is_fused_qkv_weight(weight):
+                # decoder self attention 的合并投影中 key / value 的部分被转换
+                self.assertEqual(4 + 2 * 2, grouped_weight.shape[-2])
+                self.assertAllClose(kv_heads_conversion.mean_pool_fused_kv_heads(weight, 2), grouped_weight)
+            elif weight.shape != grouped_weight.shape:
+                # 只有 decoder 的 key / value 投影被转换
+                self.assertTrue(kv_heads_conversion._is_key_value_weight(weight))
+                self.assertEqual(2, grouped_weight.shape[-2])
+                self.assertAllClose(kv_heads_conversion.mean_pool_kv_heads(weight, 2), grouped_weight)
+            else:
+                self.assertAllClose(weight, grouped_weight)
+
+    def _build_model(
+            self, num_kv_heads, padded_decode=False, indirect_cache=False, num_hidden_layers=1, fuse_qkv_projection=False
+    ):
+        return model_builder.build_model(
+            inputs_vocab_size=100,
+            targets_vocab_size=101,
+            num_hidden_layers=num_hidden_layers,
+            intermediate_size=32,
+            stack_kwargs=dict(use_bias=True, fuse_qkv_projection=fuse_qkv_projection),
+            decoder_stack_kwargs=dict(num_kv_heads=num_kv_heads),
+            padded_decode=padded_decode,
+            indirect_cache=indirect_cache
+        )
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -0,0 +1,136 @@
+# -*- coding: utf - 8 -*-
+
+import os
+import collections
+from unittest import mock
+import numpy as np
+import tensorflow as tf
+from models.transformer import lexical_shortlist
+from models.transformer.lexical_shortlist import LexicalShortlist
+from models.transformer.test import model_builder
+
+_VOCAB_SIZE = 50
+
+
+class LexicalShortlistTest(tf.test.TestCase):
+
+    def test_build(self):
+        dataset = tf.data.Dataset.from_tensor_slices((
+            tf.constant([[3, 4, 1, 0], [3, 5, 1, 0], [6, 1, 0, 0]], tf.int64),
+            tf.constant([[7, 8, 1, 0], [7, 9, 1, 0], [10, 1, 0, 0]], tf.int64)
+        )).batch(2)
+        shortlist = LexicalShortlist.build(
+            dataset, inputs_vocab_size=12, targets_vocab_size=12, top_n=2, num_frequent=1
+        )
+
+        # 3 与 7 总是同时出现，排在同样共现两次但更高频的 EOS 之前
+        self.assertAllEqual([7, 1], shortlist.lexical_table[3])
+        self.assertAllEqual([10, 1], shortlist.lexical_table[6])
+        # 没有出现过的源语言词为 -1
+        self.assertAllEqual([-1, -1], shortlist.lexical_table[11])
+        # EOS 在每个句子中都出现，是唯一保留的高频词
+        self.assertAllEqual([0, 1, 1], shortlist.frequent_ids)
+
+        # 排除 padding，合并去重后排序
+        candidate_ids = shortlist.get_candidate_ids(tf.constant([[6, 1, 0], [11, 0, 0]]))
+        self.assertAllEqual([0, 1, 7, 10], candidate_ids)
+
+        path = os.path.join(self.get_temp_dir(), 'shortlist.npz')
+        shortlist.save(path)
+        loaded = LexicalShortlist.load(path)
+        self.assertAllEqual(shortlist.lexical_table, loaded.lexical_table)
+        self.assertAllEqual(shortlist.frequent_ids, loaded.frequent_ids)
+
+    def test_build_from_multi_batch_dataset(self):
+        # 每个源语言词有固定的译词，另外混入随机的噪声词、重复的词和长短不一的 padding
+        rng = np.random.RandomState(0)
+        vocab_size, num_pairs = 60, 500
+        translation = np.concatenate([[0, 1], rng.permutation(np.arange(2, vocab_size))])
+        inputs, targets = [], []
+        for _ in range(num_pairs):
+            inputs_row = rng.randint(2, vocab_size, size=rng.randint(1, 12))
+            targets_row = np.concatenate([translation[inputs_row], rng.randint(2, vocab_size, size=rng.randint(4))])
+            rng.shuffle(targets_row)
+            inputs.append(np.append(inputs_row, 1))
+            targets.append(np.append(targets_row, 1))
+        dataset = tf.data.Dataset.from_generator(
+            lambda: zip(inputs, targets), (tf.int64, tf.int64), ([None], [None])
+        ).padded_batch(64)
+
+        # 缓存很小时每个 batch 之后都会合并，结果不变
+        for merge_size in [1 << 24, 100]:
+            with mock.patch.object(lexical_shortlist, '_MERGE_SIZE', merge_size):
+                shortlist = LexicalShortlist.build(
+                    dataset, inputs_vocab_size=vocab_size, targets_vocab_size=vocab_size, top_n=5, num_frequent=3
+                )
+
+            # 逐个句对计数作为对照，Dice 系数相同时按 id 从小到大排列
+            cooccurrence = collections.defaultdict(collections.Counter)
+            inputs_counts, targets_counts = collections.Counter(), collections.Counter()
+            for inputs_row, targets_row in zip(inputs, targets):
+                inputs_counts.update(set(inputs_row))
+                targets_counts.update(set(targets_row))
+                for inputs_id in set(inputs_row):
+                    cooccurrence[inputs_id].update(set(targets_row))
+            expected_table = np.full([vocab_size, 5], -1)
+            for inputs_id, counter in cooccurrence.items():
+                ranked = sorted(
+                    counter,
+                    key=lambda t: (-2.0 * counter[t] / (inputs_counts[inputs_id] + targets_counts[t]), t)
+                )[:5]
+                expected_table[inputs_id, :len(ranked)] = ranked
+            self.assertAllEqual(expected_table, shortlist.lexical_table)
+
+        # 出现过的源语言词的第一个候选就是它的译词
+        seen_ids = np.unique(np.concatenate(inputs))
+        seen_ids = seen_ids[seen_ids >= 2]
+        self.assertAllEqual(translation[seen_ids], tf.gather(shortlist.lexical_table[:, 0], seen_ids))
+        # EOS 出现在每个句子中，是出现次数最多的词
+        self.assertEqual(1, shortlist.frequent_ids[2])
+
+    def test_decode_with_full_shortlist(self):
+        inputs_ids = tf.constant([[3, 4, 5, 1, 0], [7, 8, 1, 0, 0]], dtype=tf.int64)
+
+        # 候选词表为完整词表时与不使用 shortlist 的结果一致
+        full_shortlist = LexicalShortlist(
+            np.full([_VOCAB_SIZE, 1], -1), np.arange(_VOCAB_SIZE)
+        )
+        for decode_strategy in ['beam_search', 'greedy']:
+            model = self._build_model(None, decode_strategy)
+            shortlist_model = self._build_model(full_shortlist, decode_strategy)
+            model([inputs_ids], training=False)
+            shortlist_model([inputs_ids], training=False)
+            shortlist_model.set_weights(model.get_weights())
+
+            ret = model([inputs_ids], training=False)
+            shortlist_ret = shortlist_model([inputs_ids], training=False)
+            self.assertAllEqual(ret['outputs'], shortlist_ret['outputs'])
+            self.assertAllClose(ret['scores'], shortlist_ret['scores'])
+
+    def test_decode_with_shortlist(self):
+        inputs_ids = tf.constant([[3, 4, 5, 1, 0], [7, 8, 1, 0, 0]], dtype=tf.int64)
+        lexical_table = np.random.randint(2, _VOCAB_SIZE, size=[_VOCAB_SIZE, 3])
+        shortlist = LexicalShortlist(lexical_table, [2])
+        candidate_ids = shortlist.get_candidate_ids(inputs_ids)
+
+        for padded_decode in [False, True]:
+            model = self._build_model(shortlist, padded_decode=padded_decode)
+            outputs = model([inputs_ids], training=False)['outputs']
+            # 解码结果映射回原词表，只包含候选词
+            self.assertAllInSet(outputs, candidate_ids.numpy())
+
+    def _build_model(self, lexical_shortlist, decode_strategy='beam_search', padded_decode=False):
+        return model_builder.build_model(
+            inputs_vocab_size=_VOCAB_SIZE,
+            targets_vocab_size=_VOCAB_SIZE,
+            intermediate_size=32,
+            max_decode_len=8 if padded_decode else None,
+            beam_size=3,
+            padded_decode=padded_decode,
+            lexical_shortlist=lexical_shortlist,
+            decode_strategy=decode_strategy
+        )
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -0,0 +1,62 @@
+# -*- coding: utf - 8 -*-
+
+import tensorflow as tf
+from models.transformer.speculative_decoding import SpeculativeDecoder
+from models.transformer.test import model_builder
+
+
+def _build_model(hidden_size, num_hidden_layers):
+    return model_builder.build_model(
+        inputs_vocab_size=30,
+        targets_vocab_size=20,
+        hidden_size=hidden_size,
+        num_hidden_layers=num_hidden_layers,
+        extra_decode_len=6,
+        beam_size=1,
+        decode_strategy='greedy'
+    )
+
+
+class SpeculativeDecoderTest(tf.test.TestCase):
+
+    def setUp(self):
+        super(SpeculativeDecoderTest, self).setUp()
+        tf.random.set_seed(0)
+        self.inputs_ids = tf.constant([[3, 4, 5, 1, 0], [7, 8, 1, 0, 0], [9, 1, 0, 0, 0]], dtype=tf.int64)
+        self.model = _build_model(hidden_size=16, num_hidden_layers=2)
+        self.draft_model = _build_model(hidden_size=8, num_hidden_layers=1)
+        self.model([self.inputs_ids], training=False)
+        self.draft_model([self.inputs_ids], training=False)
+
+    def _assert_same_as_greedy(self, ret):
+        expected = self.model([self.inputs_ids], training=False)
+        expected_outputs = expected['outputs']
+        decode_len = tf.shape(expected_outputs)[1]
+        self.assertAllEqual(expected_outputs, ret['outputs'][:, :decode_len])
+        self.assertAllEqual(tf.zeros_like(ret['outputs'][:, decode_len:]), ret['outputs'][:, decode_len:])
+        self.assertAllClose(expected['scores'], ret['scores'], atol=1e-4)
+
+    def test_same_as_greedy(self):
+        for k in [1, 3]:
+            decoder = SpeculativeDecoder(
+                self.model, self.draft_model, num_speculative_tokens=k, extra_decode_len=6
+            )
+            self._assert_same_as_greedy(tf.function(decoder.predict)(self.inputs_ids))
+
+    def test_all_accepted(self):
+        # draft 模型与大模型相同时候选 token 全部被接受，每一轮提交 k + 1 个 token
+        decoder = SpeculativeDecoder(
+            self.model, self.model, num_speculative_tokens=3, extra_decode_len=6
+        )
+        ret = decoder.predict(self.inputs_ids)
+        self._assert_same_as_greedy(ret)
+        # 最大解码长度为 5 + 6 = 11，需要 3 轮
+        self.assertEqual(3, int(ret['num_rounds']))
+
+    def test_invalid_num_speculative_tokens(self):
+        with self.assertRaises(ValueError):
+            SpeculativeDecoder(self.model, self.draft_model, num_speculative_tokens=0)
+
+
+if __name__ == '__main__':
+    tf.test.main()
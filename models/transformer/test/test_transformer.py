@@ -1,5 +1,6 @@
 # -*- coding: utf - 8 -*-
 
+import os
 import numpy as np
 import tensorflow as tf
 from absl import logging
@@ -7,9 +8,10 @@ from absl.testing import parameterized
 from tensorflow.python.distribute import combinations
 from tensorflow.python.distribute import strategy_combinations
 from models.transformer import transformer
-from layers.transformer_layers.encoder_stack import TransformerEncoderStack
-from layers.transformer_layers.decoder_stack import TransformerDecoderStack
+from layers import utils
+from layers.attention_layers import linear_attention_layer
 from models.transformer import model_params
+from models.transformer.test import model_builder
 
 
 class TransformerTest(tf.test.TestCase, parameterized.TestCase):
@@ -49,37 +51,238 @@ class TransformerTest(tf.test.TestCase, parameterized.TestCase):
         self.assertEqual(outputs[1].shape.as_list(), [None])
         self.assertEqual(outputs[1].dtype, tf.float32)
 
-    def _build_model(self, max_decode_len):
-        num_hidden_layers = 1
-        num_attention_heads = 2
-        intermediate_size = 32
-        inputs_vocab_size = 100
-        targets_vocab_size = 101
-        hidden_size = 16
-        encoder_decoder_kwargs = dict(
-            num_hidden_layers=num_hidden_layers,
-            num_attention_heads=num_attention_heads,
-            intermediate_size=intermediate_size,
-            intermediate_activation='relu',
-            hidden_dropout_rate=0.1,
-            attention_dropout_rate=0.1,
-            use_bias=False,
-            norm_first=True,
-            norm_epsilon=1e-6
+    def test_padded_decode(self):
+        inputs_ids = tf.constant([[3, 4, 5, 1, 0], [7, 8, 1, 0, 0]], dtype=tf.int64)
+
+        model = self._build_model(max_decode_len=None, padded_decode=False)
+        padded_model = self._build_model(max_decode_len=None, padded_decode=True)
+        model([inputs_ids], training=False)
+        padded_model([inputs_ids], training=False)
+        padded_model.set_weights(model.get_weights())
+
+        # 预分配 cache 与 concat 增长的 cache 解码结果一致
+        ret = model([inputs_ids], training=False)
+        padded_ret = padded_model([inputs_ids], training=False)
+        self.assertAllEqual(ret['outputs'], padded_ret['outputs'])
+        self.assertAllClose(ret['scores'], padded_ret['scores'])
+
+    @parameterized.parameters('beam_search', 'greedy')
+    def test_padded_decode_with_xla(self, decode_strategy):
+        inputs_ids = tf.constant([[3, 4, 5, 1, 0], [7, 8, 1, 0, 0]], dtype=tf.int64)
+
+        model = self._build_model(max_decode_len=6, padded_decode=True, decode_strategy=decode_strategy)
+        ret = model([inputs_ids], training=False)
+        self.assertEqual([2, 6], ret['outputs'].shape.as_list())
+
+        # 解码过程中形状固定，可以整体使用 XLA 编译
+        compiled_predict = tf.function(
+            lambda x: model([x], training=False), experimental_compile=True
         )
-        encoder_stack = TransformerEncoderStack(**encoder_decoder_kwargs)
-        decoder_stack = TransformerDecoderStack(**encoder_decoder_kwargs)
+        compiled_ret = compiled_predict(inputs_ids)
+        self.assertAllEqual(ret['outputs'], compiled_ret['outputs'])
+        self.assertAllClose(ret['scores'], compiled_ret['scores'])
+
+    def test_compact_finished_batches(self):
+        inputs_ids = tf.constant([[3, 4, 5, 1, 0], [7, 8, 1, 0, 0], [9, 1, 0, 0, 0]], dtype=tf.int64)
+
+        model = self._build_model(max_decode_len=None)
+        compact_model = self._build_model(max_decode_len=None, compact_finished_batches=True)
+        padded_compact_model = self._build_model(
+            max_decode_len=None, padded_decode=True, compact_finished_batches=True
+        )
+        model([inputs_ids], training=False)
+        for m in [compact_model, padded_compact_model]:
+            m([inputs_ids], training=False)
+            m.set_weights(model.get_weights())
+
+        # 移除已结束的 batch item 不影响解码结果
+        ret = model([inputs_ids], training=False)
+        for m in [compact_model, padded_compact_model]:
+            compact_ret = m([inputs_ids], training=False)
+            self.assertAllEqual(ret['outputs'], compact_ret['outputs'])
+            self.assertAllClose(ret['scores'], compact_ret['scores'])
+
+    @parameterized.parameters(False, True)
+    def test_indirect_cache(self, compact_finished_batches):
+        inputs_ids = tf.constant([[3, 4, 5, 1, 0], [7, 8, 1, 0, 0], [9, 1, 0, 0, 0]], dtype=tf.int64)
+
+        model = self._build_model(max_decode_len=None, padded_decode=True)
+        indirect_model = self._build_model(
+            max_decode_len=None,
+            padded_decode=True,
+            indirect_cache=True,
+            compact_finished_batches=compact_finished_batches
+        )
+        model([inputs_ids], training=False)
+        indirect_model([inputs_ids], training=False)
+        indirect_model.set_weights(model.get_weights())
+
+        # cache 不随 beam 重排，通过 backpointer 表读取，解码结果一致
+        ret = model([inputs_ids], training=False)
+        indirect_ret = indirect_model([inputs_ids], training=False)
+        self.assertAllEqual(ret['outputs'], indirect_ret['outputs'])
+        self.assertAllClose(ret['scores'], indirect_ret['scores'])
+
+    def test_indirect_cache_requires_padded_decode(self):
+        with self.assertRaises(ValueError):
+            self._build_model(max_decode_len=None, indirect_cache=True)
+
+    @parameterized.parameters(
+        dict(padded_decode=False, indirect_cache=False),
+        dict(padded_decode=True, indirect_cache=False),
+        dict(padded_decode=True, indirect_cache=True)
+    )
+    def test_quantize_cache(self, padded_decode, indirect_cache):
+        inputs_ids = tf.constant([[3, 4, 5, 1, 0], [7, 8, 1, 0, 0]], dtype=tf.int64)
+
+        model = self._build_model(max_decode_len=None, padded_decode=padded_decode)
+        quantized_model = self._build_model(
+            max_decode_len=None,
+            padded_decode=padded_decode,
+            indirect_cache=indirect_cache,
+            quantize_cache=True
+        )
+        model([inputs_ids], training=False)
+        quantized_model([inputs_ids], training=False)
+        quantized_model.set_weights(model.get_weights())
+
+        # int8 量化的 cache 只带来很小的误差
+        ret = model([inputs_ids], training=False)
+        quantized_ret = quantized_model([inputs_ids], training=False)
+        self.assertAllEqual(ret['outputs'], quantized_ret['outputs'])
+        self.assertAllClose(ret['scores'], quantized_ret['scores'], atol=1e-2)
 
-        return transformer.Transformer(
-            inputs_vocab_size=inputs_vocab_size,
-            targets_vocab_size=targets_vocab_size,
-            hidden_size=hidden_size,
+    def test_greedy_and_sampling_decode(self):
+        inputs_ids = tf.constant([[3, 4, 5, 1, 0], [7, 8, 1, 0, 0]], dtype=tf.int64)
+
+        greedy_model = self._build_model(max_decode_len=None, decode_strategy='greedy')
+        sampling_model = self._build_model(max_decode_len=None, decode_strategy='sampling', top_k=1)
+        greedy_model([inputs_ids], training=False)
+        sampling_model([inputs_ids], training=False)
+        sampling_model.set_weights(greedy_model.get_weights())
+
+        greedy_ret = greedy_model([inputs_ids], training=False)
+        self.assertEqual(greedy_ret['outputs'].shape[0], 2)
+        self.assertEqual(greedy_ret['scores'].shape, (2,))
+
+        # top_k 为 1 的采样与 greedy 解码结果一致
+        sampling_ret = sampling_model([inputs_ids], training=False)
+        self.assertAllEqual(greedy_ret['outputs'], sampling_ret['outputs'])
+        self.assertAllClose(greedy_ret['scores'], sampling_ret['scores'])
+
+    @parameterized.parameters(
+        dict(linear_attention='elu', padded_decode=False),
+        dict(linear_attention='elu', padded_decode=True),
+        dict(linear_attention='random', padded_decode=False)
+    )
+    def test_linear_attention(self, linear_attention, padded_decode):
+        inputs_ids = tf.constant([[3, 4, 5, 1, 0], [7, 8, 1, 0, 0]], dtype=tf.int64)
+        model = self._build_model(
+            max_decode_len=None,
+            padded_decode=padded_decode,
+            decode_strategy='greedy',
+            linear_attention=linear_attention
+        )
+        outputs = model([inputs_ids], training=False)['outputs']
+        self.assertIsInstance(
+            model.decoder_stack.decoder_layers[0].self_attention, linear_attention_layer.CacheLinearAttention
+        )
+
+        # 逐步解码时使用累加和，与一次计算整个序列的 causal linear attention 一致
+        targets_ids = tf.concat([tf.zeros_like(outputs[:, :1]), outputs], axis=1)
+        logits = model([inputs_ids, tf.cast(targets_ids, tf.int64)], training=False)
+        for i in range(outputs.shape[0]):
+            decoded = outputs[i].numpy().tolist()
+            length = decoded.index(1) + 1 if 1 in decoded else len(decoded)
+            self.assertAllEqual(decoded[:length], tf.argmax(logits[i, :length], axis=-1).numpy())
+
+    def test_linear_attention_with_indirect_cache_fails(self):
+        with self.assertRaises(ValueError):
+            self._build_model(
+                max_decode_len=None, padded_decode=True, indirect_cache=True, linear_attention='elu'
+            )
+
+    def test_scan_layers(self):
+        inputs_ids = tf.constant([[3, 4, 5, 1, 0], [7, 8, 1, 0, 0]], dtype=tf.int64)
+        targets_ids = tf.constant([[6, 7, 1], [9, 1, 0]], dtype=tf.int64)
+        model = self._build_model(max_decode_len=None, decode_strategy='greedy', num_hidden_layers=3)
+        scan_model = self._build_model(
+            max_decode_len=None, decode_strategy='greedy', num_hidden_layers=3, scan_layers=True
+        )
+        logits = model([inputs_ids, targets_ids], training=False)
+        outputs = model([inputs_ids], training=False)
+
+        # 读取逐层的 checkpoint 时按名字转换为 stacked 的权重
+        checkpoint_path = tf.train.Checkpoint(model=model).write(
+            os.path.join(self.get_temp_dir(), 'unrolled')
+        )
+        scan_model([inputs_ids, targets_ids], training=False)
+        self.assertTrue(utils.restore_checkpoint(
+            tf.train.Checkpoint(model=scan_model), checkpoint_path, [utils.convert_stacked_checkpoint_weight]
+        ))
+        self.assertEqual(scan_model.encoder_stack.stacked_layer.weights[0].shape[0], 3)
+
+        self.assertAllClose(logits, scan_model([inputs_ids, targets_ids], training=False))
+        scan_outputs = scan_model([inputs_ids], training=False)
+        self.assertAllEqual(outputs['outputs'], scan_outputs['outputs'])
+        self.assertAllClose(outputs['scores'], scan_outputs['scores'])
+
+        # 再转换回逐层的权重，结构相同时直接 restore
+        scan_path = tf.train.Checkpoint(model=scan_model).write(os.path.join(self.get_temp_dir(), 'scan'))
+        unrolled_model = self._build_model(max_decode_len=None, decode_strategy='greedy', num_hidden_layers=3)
+        unrolled_model([inputs_ids, targets_ids], training=False)
+        unrolled_path = utils.convert_checkpoint(
+            scan_path,
+            os.path.join(self.get_temp_dir(), 'unrolled_converted'),
+            tf.train.Checkpoint(model=unrolled_model),
+            convert_fns=[utils.convert_stacked_checkpoint_weight]
+        )
+        self.assertFalse(utils.restore_checkpoint(
+            tf.train.Checkpoint(model=unrolled_model), unrolled_path, [utils.convert_stacked_checkpoint_weight]
+        ))
+        self.assertAllClose(logits, unrolled_model([inputs_ids, targets_ids], training=False))
+        self.assertTrue(scan_model.encoder_stack.get_config()['scan_layers'])
+
+    def test_invalid_decode_strategy(self):
+        with self.assertRaises(ValueError):
+            self._build_model(max_decode_len=None, decode_strategy='unknown')
+
+    def _build_model(
+            self,
+            max_decode_len,
+            padded_decode=False,
+            decode_strategy='beam_search',
+            top_k=0,
+            compact_finished_batches=False,
+            indirect_cache=False,
+            quantize_cache=False,
+            linear_attention=None,
+            num_hidden_layers=1,
+            scan_layers=False
+    ):
+        return model_builder.build_model(
+            inputs_vocab_size=100,
+            targets_vocab_size=101,
+            num_hidden_layers=num_hidden_layers,
+            intermediate_size=32,
+            stack_kwargs=dict(
+                intermediate_activation='relu',
+                hidden_dropout_rate=0.1,
+                # linear attention 不支持 attention dropout
+                attention_dropout_rate=0.1 if linear_attention is None else 0.0,
+                use_bias=False,
+                linear_attention=linear_attention,
+                scan_layers=scan_layers
+            ),
+            attention_dropout_rate=0.01,
             hidden_dropout_rate=0.01,
             max_decode_len=max_decode_len,
-            beam_size=4,
-            alpha=0.6,
-            encoder_stack=encoder_stack,
-            decoder_stack=decoder_stack
+            padded_decode=padded_decode,
+            compact_finished_batches=compact_finished_batches,
+            indirect_cache=indirect_cache,
+            quantize_cache=quantize_cache,
+            decode_strategy=decode_strategy,
+            top_k=top_k
         )
 
 
@@ -4,6 +4,7 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import absolute_import
 
+import numpy as np
 import tensorflow as tf
 from models.transformer.transformerV2 import create_model
 from models.transformer.transformer_params import PARAMS
@@ -53,6 +54,20 @@ class TransformerV2Test(tf.test.TestCase):
         self.assertEqual(outputs[1].shape.as_list(), [None])
         self.assertEqual(outputs[1].dtype, tf.float32)
 
+    def test_scan_layers(self):
+        params = self.params.copy()
+        params['hidden_dropout_rate'] = 0.0
+        params['attention_dropout_rate'] = 0.0
+        inputs = np.array([[3, 4, 5, 1], [6, 7, 1, 0]])
+        targets = np.array([[3, 4, 1], [5, 1, 0]])
+        model = create_model(params, is_train=True)
+        params['scan_layers'] = True
+        scan_model = create_model(params, is_train=True)
+        self.assertEqual(len(model.weights), len(scan_model.weights))
+
+        scan_model.set_weights(model.get_weights())
+        self.assertAllClose(model([inputs, targets]), scan_model([inputs, targets]))
+
 
 if __name__ == '__main__':
     tf.test.main()
@@ -0,0 +1,163 @@
+# -*- coding: utf - 8 -*-
+
+import os
+import tempfile
+import numpy as np
+import tensorflow as tf
+from models.transformer import translate
+from models.transformer.transformer_params import PARAMS
+from tokenizations import sub_tokenization
+
+
+class _CharTokenizer(object):
+    """按字符 tokenize，id 从 len(RESERVED_TOKENS) 开始"""
+
+    def encode(self, text):
+        return [ord(c) - ord('a') + len(sub_tokenization.RESERVED_TOKENS) for c in text]
+
+    def decode(self, ids):
+        return ''.join(chr(i - len(sub_tokenization.RESERVED_TOKENS) + ord('a')) for i in ids)
+
+
+class _EchoModel(object):
+    """将输入原样作为翻译结果输出，并记录每个 batch 的形状"""
+
+    def __init__(self):
+        self.batch_shapes = []
+
+    def predict_on_batch(self, inputs_ids):
+        self.batch_shapes.append(inputs_ids.shape)
+        return inputs_ids, np.zeros([inputs_ids.shape[0]], dtype=np.float32)
+
+
+class TranslateTest(tf.test.TestCase):
+
+    def setUp(self):
+        super(TranslateTest, self).setUp()
+        self.lines = ['abc', 'a', 'abcdefgh', 'ab', 'abcdef', 'abcd', 'b', 'cdefg']
+        self.input_file = os.path.join(tempfile.mkdtemp(), 'inputs.txt')
+        with tf.io.gfile.GFile(self.input_file, 'w') as f:
+            f.write('\n'.join(self.lines) + '\n')
+
+    def test_get_sorted_inputs(self):
+        with tf.io.gfile.GFile(self.input_file, 'w') as f:
+            f.write('a b c\na\na b c d\na b\n')
+        sorted_inputs, sorted_keys = translate._get_sorted_inputs(self.input_file)
+        self.assertEqual(['a b c d', 'a b c', 'a b', 'a'], sorted_inputs)
+        self.assertEqual([1, 3, 0, 2], sorted_keys)
+
+    def test_batch_by_token_budget(self):
+        encoded_inputs = [[1] * 6, [1] * 5, [1] * 3, [1] * 3, [1] * 2, [1]]
+        self.assertEqual(
+            [(0, 1), (1, 2), (2, 4), (4, 6)],
+            translate._batch_by_token_budget(encoded_inputs, max_tokens_per_batch=6)
+        )
+        self.assertEqual(
+            [(0, 1), (1, 2), (2, 3), (3, 4), (4, 5), (5, 6)],
+            translate._batch_by_token_budget(encoded_inputs, max_tokens_per_batch=6, max_batch_size=1)
+        )
+
+    def test_translate_file(self):
+        model = _EchoModel()
+        output_file = os.path.join(tempfile.mkdtemp(), 'outputs.txt')
+        translations = translate.translate_file(
+            model, _CharTokenizer(), self.input_file, output_file, max_tokens_per_batch=12
+        )
+
+        # 结果恢复为原来的顺序
+        self.assertEqual(self.lines, translations)
+        with tf.io.gfile.GFile(output_file) as f:
+            self.assertEqual(self.lines, f.read().split('\n')[:-1])
+
+        # 每个 batch 补齐后不超过 token 预算，且所有句子都被翻译
+        for batch_size, max_len in model.batch_shapes:
+            self.assertLessEqual(batch_size * max_len, 12)
+        self.assertEqual(len(self.lines), sum(shape[0] for shape in model.batch_shapes))
+
+    def test_translation_cache_lru(self):
+        cache = translate.TranslationCache('model', max_size=2)
+        decode_params = dict(beam_size=4, alpha=0.6, extra_decode_len=50)
+        key_a = cache.make_key([3, 4, 1], decode_params)
+        key_b = cache.make_key([5, 1], decode_params)
+        key_c = cache.make_key([6, 1], decode_params)
+
+        # 解码参数不同时 key 不同
+        self.assertNotEqual(key_a, cache.make_key([3, 4, 1], dict(decode_params, beam_size=1)))
+
+        self.assertIsNone(cache.get(key_a))
+        cache.put(key_a, [7, 1])
+        cache.put(key_b, [8, 1])
+        self.assertEqual([7, 1], cache.get(key_a))
+        # key_b 最久未使用，被淘汰
+        cache.put(key_c, [9, 1])
+        self.assertIsNone(cache.get(key_b))
+        self.assertEqual([9, 1], cache.get(key_c))
+        self.assertEqual({'size': 2, 'memory_hits': 2, 'disk_hits': 0, 'misses': 2, 'hit_rate': 0.5},
+                         cache.stats())
+
+    def test_translation_cache_disk(self):
+        cache_file = os.path.join(tempfile.mkdtemp(), 'translation_cache')
+        cache = translate.TranslationCache('model', max_size=1, cache_file=cache_file)
+        key_a = cache.make_key([3, 1], {})
+        key_b = cache.make_key([4, 1], {})
+        cache.put(key_a, [7, 1])
+        cache.put(key_b, [8, 1])
+        cache.close()
+
+        cache = translate.TranslationCache('model', max_size=1, cache_file=cache_file)
+        self.assertEqual([7, 1], cache.get(key_a))
+        self.assertEqual([7, 1], cache.get(key_a))
+        self.assertEqual(1, cache.disk_hits)
+        self.assertEqual(1, cache.memory_hits)
+        cache.close()
+
+        # 其他模型使用同一个文件时不会读到这些结果
+        cache = translate.TranslationCache('retrained_model', max_size=1, cache_file=cache_file)
+        self.assertIsNone(cache.get(cache.make_key([3, 1], {})))
+        cache.close()
+
+    def test_decode_params_and_checkpoint_id(self):
+        params = PARAMS.copy()
+        decode_params = translate.get_decode_params(params)
+        self.assertEqual(params['beam_size'], decode_params['beam_size'])
+        self.assertNotIn('hidden_size', decode_params)
+        params['beam_size'] = 1
+        self.assertNotEqual(decode_params, translate.get_decode_params(params))
+
+        variable = tf.Variable([1.0, 2.0])
+        checkpoint_path = tf.train.Checkpoint(variable=variable).write(os.path.join(self.get_temp_dir(), 'a'))
+        self.assertEqual(translate.get_checkpoint_id(checkpoint_path), translate.get_checkpoint_id(checkpoint_path))
+        # 同一路径下权重不同的 checkpoint 标识不同
+        variable.assign([1.0, 3.0])
+        other_path = tf.train.Checkpoint(variable=variable).write(os.path.join(self.get_temp_dir(), 'b'))
+        self.assertNotEqual(translate.get_checkpoint_id(checkpoint_path), translate.get_checkpoint_id(other_path))
+
+    def test_translate_file_with_cache(self):
+        cache = translate.TranslationCache('model')
+        decode_params = translate.get_decode_params(PARAMS)
+        model = _EchoModel()
+        translate.translate_file(model, _CharTokenizer(), self.input_file, cache=cache, decode_params=decode_params)
+        self.assertEqual(len(self.lines), cache.misses)
+
+        # 第二次所有句子都命中缓存，不再调用模型
+        model = _EchoModel()
+        translations = translate.translate_file(
+            model, _CharTokenizer(), self.input_file, cache=cache, decode_params=decode_params
+        )
+        self.assertEqual(self.lines, translations)
+        self.assertEqual([], model.batch_shapes)
+        self.assertEqual(len(self.lines), cache.hits)
+
+        model = _EchoModel()
+        self.assertEqual('abc', translate.translate_from_text(
+            model, _CharTokenizer(), 'abc', cache=cache, decode_params=decode_params
+        ))
+        self.assertEqual([], model.batch_shapes)
+
+        # 使用缓存时必须给定解码参数
+        with self.assertRaises(ValueError):
+            translate.translate_file(model, _CharTokenizer(), self.input_file, cache=cache)
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -0,0 +1,69 @@
+# -*- coding: utf - 8 -*-
+
+import tensorflow as tf
+from models.transformer import transformer
+from models.transformer.translation_server import ContinuousBatchingTranslator
+from models.transformer.test import model_builder
+
+
+class ContinuousBatchingTranslatorTest(tf.test.TestCase):
+
+    def setUp(self):
+        super(ContinuousBatchingTranslatorTest, self).setUp()
+        self.model = model_builder.build_model(
+            inputs_vocab_size=50,
+            targets_vocab_size=60,
+            num_hidden_layers=2,
+            intermediate_size=32,
+            beam_size=1,
+            decode_strategy='greedy'
+        )
+        self.inputs = [[3, 4, 5, 1], [7, 8, 1], [9, 1], [10, 11, 12, 13, 14, 1], [20, 21, 1]]
+
+    def _expected_outputs(self, inputs_ids):
+        ret = self.model([tf.constant([inputs_ids], dtype=tf.int64)], training=False)
+        outputs = list(ret['outputs'][0].numpy())
+        if transformer.EOS_ID in outputs:
+            outputs = outputs[:outputs.index(transformer.EOS_ID) + 1]
+        return outputs, float(ret['scores'][0])
+
+    def test_run_until_complete(self):
+        expected = [self._expected_outputs(inputs_ids) for inputs_ids in self.inputs]
+
+        # slot 数小于请求数，后面的请求需要等待前面的请求结束后加入
+        translator = ContinuousBatchingTranslator(
+            self.model, max_batch_size=2, max_inputs_len=8, extra_decode_len=5
+        )
+        requests = [translator.submit(inputs_ids) for inputs_ids in self.inputs]
+        finished = translator.run_until_complete()
+
+        self.assertLen(finished, len(self.inputs))
+        for request, (outputs, score) in zip(requests, expected):
+            self.assertTrue(request.done)
+            self.assertEqual(outputs, request.outputs)
+            self.assertAllClose(score, request.score, atol=1e-4)
+        self.assertEqual(0, translator.num_active)
+
+    def test_background_serving(self):
+        expected = [self._expected_outputs(inputs_ids)[0] for inputs_ids in self.inputs]
+
+        translator = ContinuousBatchingTranslator(
+            self.model, max_batch_size=3, max_inputs_len=8, extra_decode_len=5
+        )
+        translator.start()
+        try:
+            requests = [translator.submit(inputs_ids) for inputs_ids in self.inputs]
+            for request, outputs in zip(requests, expected):
+                self.assertTrue(request.wait(timeout=60))
+                self.assertEqual(outputs, request.outputs)
+        finally:
+            translator.stop()
+
+    def test_inputs_too_long(self):
+        translator = ContinuousBatchingTranslator(self.model, max_batch_size=2, max_inputs_len=3)
+        with self.assertRaises(ValueError):
+            translator.submit([3, 4, 5, 1])
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -0,0 +1,99 @@
+# -*- coding: utf - 8 -*-
+
+import os
+import numpy as np
+import tensorflow as tf
+from models.transformer import vocab_trimming
+from models.transformer.model_params import TINY_PARAMS
+
+
+class _FakeTokenizer(object):
+
+    def encode(self, line):
+        return [int(token) for token in line.split()]
+
+    def decode(self, ids):
+        return ' '.join(str(i) for i in ids)
+
+
+class VocabTrimmingTest(tf.test.TestCase):
+
+    def setUp(self):
+        super(VocabTrimmingTest, self).setUp()
+        self.params = TINY_PARAMS.copy()
+        self.params.update(
+            inputs_vocab_size=30,
+            targets_vocab_size=30,
+            num_hidden_layers=1,
+            dtype=tf.float32
+        )
+
+    def test_collect_used_ids(self):
+        self._write_records([[3, 4, 1], [5, 1]], [[7, 9, 1], [9, 12, 1]])
+
+        kept_ids = vocab_trimming.collect_used_ids(os.path.join(self.get_temp_dir(), '*.tfrecord'))
+        # PAD 总是被保留
+        self.assertAllEqual([0, 1, 7, 9, 12], kept_ids)
+
+        vocab_file = os.path.join(self.get_temp_dir(), 'vocab.txt')
+        with tf.io.gfile.GFile(vocab_file, mode='w') as f:
+            f.write(''.join('token_%d\n' % i for i in range(self.params['targets_vocab_size'])))
+        trimmed_vocab_file = os.path.join(self.get_temp_dir(), 'trimmed_vocab.txt')
+        vocab_trimming.write_trimmed_vocab(vocab_file, kept_ids, trimmed_vocab_file)
+        with tf.io.gfile.GFile(trimmed_vocab_file) as f:
+            self.assertEqual(['token_%d' % i for i in kept_ids], f.read().split())
+
+        id_map_file = os.path.join(self.get_temp_dir(), 'id_map.txt')
+        vocab_trimming.write_id_map(kept_ids, id_map_file)
+        tokenizer = vocab_trimming.RemappedTokenizer.from_id_map_file(_FakeTokenizer(), id_map_file)
+        self.assertEqual([3, 4], tokenizer.encode('3 4'))
+        # 新 id 映射回原 id
+        self.assertEqual('7 12 1', tokenizer.decode([2, 4, 1]))
+
+    def test_trim_checkpoint(self):
+        kept_ids = np.array([0, 1, 4, 7, 12, 29], dtype=np.int32)
+        model = vocab_trimming.transformer.create_model(self.params, is_train=True)
+        checkpoint_path = tf.train.Checkpoint(model=model).write(
+            os.path.join(self.get_temp_dir(), 'source')
+        )
+        output_path = vocab_trimming.trim_checkpoint(
+            checkpoint_path, os.path.join(self.get_temp_dir(), 'trimmed'), kept_ids, params=self.params
+        )
+
+        params = self.params.copy()
+        params['targets_vocab_size'] = len(kept_ids)
+        trimmed_model = vocab_trimming.transformer.create_model(params, is_train=True)
+        tf.train.Checkpoint(model=trimmed_model).restore(output_path).expect_partial()
+
+        # 目标语言只使用保留的 id 时，裁剪后的 logits 等于原 logits 中保留的列
+        inputs_ids = tf.constant([[3, 4, 5, 1, 0], [20, 8, 1, 0, 0]], dtype=tf.int64)
+        targets_ids = tf.constant([[0, 7, 12, 1], [0, 29, 1, 0]], dtype=tf.int64)
+        # 训练模型内部固定使用 training=True，直接调用内部的 Transformer 以关闭 dropout
+        logits = model.get_layer('transformer')([inputs_ids, targets_ids], training=False)
+        trimmed_logits = trimmed_model.get_layer('transformer')(
+            [inputs_ids, np.searchsorted(kept_ids, targets_ids.numpy())], training=False
+        )
+        self.assertEqual([2, 3, len(kept_ids)], trimmed_logits.shape.as_list())
+        self.assertAllClose(tf.gather(logits, kept_ids, axis=-1), trimmed_logits)
+
+    def test_trim_model_weights_with_different_models(self):
+        model = vocab_trimming.transformer.create_model(self.params, is_train=True)
+        params = self.params.copy()
+        params['num_hidden_layers'] = 2
+        other_model = vocab_trimming.transformer.create_model(params, is_train=True)
+        with self.assertRaises(ValueError):
+            vocab_trimming.trim_model_weights(model, other_model, np.arange(30))
+
+    def _write_records(self, inputs, targets):
+        path = os.path.join(self.get_temp_dir(), 'test-train-data-1-of-1.tfrecord')
+        with tf.io.TFRecordWriter(path) as writer:
+            for inputs_ids, targets_ids in zip(inputs, targets):
+                features = {
+                    'inputs_ids': tf.train.Feature(int64_list=tf.train.Int64List(value=inputs_ids)),
+                    'targets_ids': tf.train.Feature(int64_list=tf.train.Int64List(value=targets_ids))
+                }
+                writer.write(tf.train.Example(features=tf.train.Features(feature=features)).SerializeToString())
+
+
+if __name__ == '__main__':
+    tf.test.main()
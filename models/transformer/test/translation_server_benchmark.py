@@ -0,0 +1,157 @@
+# -*- coding: utf - 8 -*-
+
+"""
+    本地压测 ContinuousBatchingTranslator，并与按固定 batch 调用 Transformer 的方式对比
+
+    请求按泊松过程到达，输入长度随机
+    1. static: 空闲时取出已到达的请求 (最多 max_batch_size 个) 组成一个 batch，整个 batch 解码结束后才处理下一批
+    2. continuous: 请求在有空闲 slot 时加入解码 batch，结束后立即离开
+
+    报告吞吐 (requests/s, tokens/s) 以及延迟的 p50 / p99，延迟从请求到达开始计算
+
+    运行方式：
+        python -m models.transformer.test.translation_server_benchmark --benchmarks=.
+"""
+
+import time
+import numpy as np
+import tensorflow as tf
+from models.transformer import transformer
+from models.transformer.translation_server import ContinuousBatchingTranslator
+from models.transformer.test import model_builder
+
+_NUM_REQUESTS = 64
+_REQUESTS_PER_SECOND = 8.0
+_MAX_BATCH_SIZE = 16
+_MIN_INPUTS_LEN = 4
+_MAX_INPUTS_LEN = 32
+_EXTRA_DECODE_LEN = 8
+_VOCAB_SIZE = 8000
+_HIDDEN_SIZE = 256
+
+
+def _build_model():
+    model = model_builder.build_model(
+        inputs_vocab_size=_VOCAB_SIZE,
+        targets_vocab_size=_VOCAB_SIZE,
+        hidden_size=_HIDDEN_SIZE,
+        num_hidden_layers=3,
+        num_attention_heads=4,
+        intermediate_size=_HIDDEN_SIZE * 4,
+        extra_decode_len=_EXTRA_DECODE_LEN,
+        beam_size=1,
+        decode_strategy='greedy'
+    )
+    model([tf.ones([1, _MAX_INPUTS_LEN], dtype=tf.int64)], training=False)
+    return model
+
+
+def _generate_load(seed=0):
+    """
+    :return: [(到达时间, inputs_ids)]，到达时间相对于压测开始
+    """
+    rng = np.random.RandomState(seed)
+    arrivals = np.cumsum(rng.exponential(1.0 / _REQUESTS_PER_SECOND, size=_NUM_REQUESTS))
+    lengths = rng.randint(_MIN_INPUTS_LEN, _MAX_INPUTS_LEN + 1, size=_NUM_REQUESTS)
+    return [
+        (arrival, list(rng.randint(2, _VOCAB_SIZE, size=length - 1)) + [transformer.EOS_ID])
+        for arrival, length in zip(arrivals, lengths)
+    ]
+
+
+class TranslationServerBenchmark(tf.test.Benchmark):
+
+    def _report(self, mode, latencies, num_tokens, wall_time):
+        latencies = np.array(latencies)
+        self.report_benchmark(
+            iters=_NUM_REQUESTS,
+            wall_time=wall_time,
+            extras={
+                'requests_per_second': _NUM_REQUESTS / wall_time,
+                'tokens_per_second': num_tokens / wall_time,
+                'latency_p50_ms': np.percentile(latencies, 50) * 1000,
+                'latency_p99_ms': np.percentile(latencies, 99) * 1000
+            },
+            name='translation_server_%s' % mode
+        )
+
+    def benchmark_static_batching(self):
+        model = _build_model()
+        predict = tf.function(
+            lambda inputs_ids: model([inputs_ids], training=False),
+            experimental_relax_shapes=True
+        )
+        load = _generate_load()
+
+        # 预热
+        predict(tf.ones([_MAX_BATCH_SIZE, _MAX_INPUTS_LEN], dtype=tf.int64))
+
+        latencies = []
+        num_tokens = 0
+        next_request = 0
+        start = time.time()
+        while next_request < len(load):
+            now = time.time() - start
+            if load[next_request][0] > now:
+                time.sleep(load[next_request][0] - now)
+                now = time.time() - start
+            batch = []
+            while next_request < len(load) and load[next_request][0] <= now and len(batch) < _MAX_BATCH_SIZE:
+                batch.append(load[next_request])
+                next_request += 1
+
+            inputs_len = max(len(inputs_ids) for _, inputs_ids in batch)
+            inputs_ids = np.zeros([len(batch), inputs_len], dtype=np.int64)
+            for row, (_, ids) in enumerate(batch):
+                inputs_ids[row, :len(ids)] = ids
+            outputs = predict(tf.constant(inputs_ids))['outputs'].numpy()
+
+            finish_time = time.time() - start
+            for row, (arrival, ids) in enumerate(batch):
+                latencies.append(finish_time - arrival)
+                # batch 按最长的句子解码，只统计该请求自身最大长度以内的 token
+                outputs_ids = list(outputs[row][:len(ids) + _EXTRA_DECODE_LEN])
+                if transformer.EOS_ID in outputs_ids:
+                    outputs_ids = outputs_ids[:outputs_ids.index(transformer.EOS_ID) + 1]
+                num_tokens += len(outputs_ids)
+
+        self._report('static', latencies, num_tokens, time.time() - start)
+
+    def benchmark_continuous_batching(self):
+        model = _build_model()
+        translator = ContinuousBatchingTranslator(
+            model,
+            max_batch_size=_MAX_BATCH_SIZE,
+            max_inputs_len=_MAX_INPUTS_LEN,
+            extra_decode_len=_EXTRA_DECODE_LEN
+        )
+        load = _generate_load()
+
+        # 预热
+        translator.submit(load[0][1])
+        translator.run_until_complete()
+
+        requests = []
+        next_request = 0
+        start = time.time()
+        while next_request < len(load) or translator.num_active > 0 or translator.num_pending > 0:
+            now = time.time() - start
+            while next_request < len(load) and load[next_request][0] <= now:
+                request = translator.submit(load[next_request][1])
+                # 延迟从请求到达时开始计算
+                request.submit_time = start + load[next_request][0]
+                requests.append(request)
+                next_request += 1
+            if translator.num_active == 0 and translator.num_pending == 0:
+                time.sleep(load[next_request][0] - now)
+                continue
+            translator.step()
+
+        num_tokens = sum(len(request.outputs) for request in requests)
+        self._report(
+            'continuous', [request.latency for request in requests], num_tokens, time.time() - start
+        )
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -0,0 +1,93 @@
+# -*- coding: utf - 8 -*-
+
+"""
+    对比 padded_decode 的解码在 CPU 上使用 / 不使用 XLA 编译时的吞吐
+
+    padded_decode 时 cache、已解码的序列都预分配为固定长度，每一步按下标写入
+    整个解码循环的形状固定，可以通过 tf.function(experimental_compile=True) 整体编译
+    同时报告 concat 增长 cache 的解码作为参照
+
+    运行方式：
+        python -m models.transformer.test.xla_decode_benchmark --benchmarks=.
+"""
+
+import time
+import tensorflow as tf
+from models.transformer.test import model_builder
+
+_BATCH_SIZE = 8
+_INPUTS_LEN = 16
+_DECODE_LEN = 32
+_VOCAB_SIZE = 8000
+_HIDDEN_SIZE = 256
+_NUM_ITERS = 5
+
+
+def _build_model(padded_decode, decode_strategy):
+    return model_builder.build_model(
+        inputs_vocab_size=_VOCAB_SIZE,
+        targets_vocab_size=_VOCAB_SIZE,
+        hidden_size=_HIDDEN_SIZE,
+        num_hidden_layers=3,
+        num_attention_heads=4,
+        intermediate_size=_HIDDEN_SIZE * 4,
+        max_decode_len=_DECODE_LEN,
+        extra_decode_len=0,
+        padded_decode=padded_decode,
+        decode_strategy=decode_strategy
+    )
+
+
+class XlaDecodeBenchmark(tf.test.Benchmark):
+
+    def _run(self, padded_decode, compile, decode_strategy):
+        model = _build_model(padded_decode, decode_strategy)
+        predict = tf.function(lambda x: model([x], training=False), experimental_compile=compile)
+        inputs_ids = tf.random.uniform(
+            [_BATCH_SIZE, _INPUTS_LEN], minval=2, maxval=_VOCAB_SIZE, dtype=tf.int64
+        )
+
+        # 预热，排除 tracing 和编译的时间
+        start = time.time()
+        predict(inputs_ids)['outputs'].numpy()
+        warmup_time = time.time() - start
+
+        start = time.time()
+        for _ in range(_NUM_ITERS):
+            predict(inputs_ids)['outputs'].numpy()
+        wall_time = (time.time() - start) / _NUM_ITERS
+
+        # 随机初始化的模型不会提前结束，每个句子都解码 _DECODE_LEN 个 token
+        self.report_benchmark(
+            iters=_NUM_ITERS,
+            wall_time=wall_time,
+            extras={
+                'tokens_per_second': _BATCH_SIZE * _DECODE_LEN / wall_time,
+                'warmup_time': warmup_time
+            },
+            name='decode_%s_%s_%s' % (
+                decode_strategy, 'padded' if padded_decode else 'concat', 'xla' if compile else 'no_xla'
+            )
+        )
+
+    def benchmark_greedy_concat(self):
+        self._run(padded_decode=False, compile=False, decode_strategy='greedy')
+
+    def benchmark_greedy_padded(self):
+        self._run(padded_decode=True, compile=False, decode_strategy='greedy')
+
+    def benchmark_greedy_padded_xla(self):
+        self._run(padded_decode=True, compile=True, decode_strategy='greedy')
+
+    def benchmark_beam_search_concat(self):
+        self._run(padded_decode=False, compile=False, decode_strategy='beam_search')
+
+    def benchmark_beam_search_padded(self):
+        self._run(padded_decode=True, compile=False, decode_strategy='beam_search')
+
+    def benchmark_beam_search_padded_xla(self):
+        self._run(padded_decode=True, compile=True, decode_strategy='beam_search')
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -4,15 +4,25 @@ import math
 import tensorflow as tf
 from layers.embedding_layers import word_embedding_layer
 from layers.embedding_layers import transformer_position_embedding_layer
+from layers.attention_layers import multi_head_attention_layer
+from layers.attention_layers import linear_attention_layer
 from layers.transformer_layers.encoder_stack import TransformerEncoderStack
 from layers.transformer_layers.decoder_stack import TransformerDecoderStack
 from layers import utils
 from ops import beam_search
+from ops import sampling_search
 from metrics import transformer_metrics
+from models.transformer.lexical_shortlist import LexicalShortlist
 
 BOS_ID = 0
 EOS_ID = 1
 
+_DECODE_STRATEGIES = ('beam_search', 'greedy', 'sampling')
+# indirect cache 模式下不随 beam 重排的 cache 项，即 self attention 的 key / value 以及量化时的 scale
+_INDIRECT_CACHE_KEYS = ('key', 'value', 'key_scale', 'value_scale')
+# beam search 时所有 beam 共用、不复制 beam_size 份的 cache 项
+_SHARED_CACHE_KEYS = ('encoder_outputs', 'padding_mask', 'encoder_decoder_key', 'encoder_decoder_value')
+
 
 def create_model(params, is_train):
     encoder_decoder_kwargs = dict(
@@ -26,8 +36,14 @@ def create_model(params, is_train):
         norm_first=True,
         norm_epsilon=1e-6
     )
+    encoder_decoder_kwargs.update(
+        linear_attention=params['linear_attention'],
+        num_random_features=params['num_random_features'],
+        fuse_qkv_projection=params['fuse_qkv_projection'],
+        scan_layers=params['scan_layers']
+    )
     encoder_stack = TransformerEncoderStack(**encoder_decoder_kwargs)
-    decoder_stack = TransformerDecoderStack(**encoder_decoder_kwargs)
+    decoder_stack = TransformerDecoderStack(num_kv_heads=params['num_kv_heads'], **encoder_decoder_kwargs)
 
     model_kwargs = dict(
         inputs_vocab_size=params['inputs_vocab_size'],
@@ -41,6 +57,17 @@ def create_model(params, is_train):
         alpha=params['alpha'],
         encoder_stack=encoder_stack,
         decoder_stack=decoder_stack,
+        padded_decode=params['padded_decode'],
+        compact_finished_batches=params['compact_finished_batches'],
+        indirect_cache=params['indirect_cache'],
+        quantize_cache=params['quantize_cache'],
+        lexical_shortlist=(
+            LexicalShortlist.load(params['lexical_shortlist_file']) if params['lexical_shortlist_file'] else None
+        ),
+        decode_strategy=params['decode_strategy'],
+        top_k=params['top_k'],
+        top_p=params['top_p'],
+        sample_temperature=params['sample_temperature'],
         dtype=params['dtype'],
         name='transformer'
     )
@@ -94,9 +121,42 @@ class Transformer(tf.keras.Model):
             alpha,
             encoder_stack,
             decoder_stack,
+            padded_decode=False,
+            compact_finished_batches=False,
+            indirect_cache=False,
+            quantize_cache=False,
+            lexical_shortlist=None,
+            decode_strategy='beam_search',
+            top_k=0,
+            top_p=1.0,
+            sample_temperature=1.0,
             dtype=tf.float32,
             **kwargs
     ):
+        """
+        :param padded_decode: 解码时是否使用预分配的固定长度 cache
+            若为 True，每层的 key / value cache 初始化为 (batch_size, max_decode_len, num_heads, size_per_head)
+            每一步按下标写入，而不是通过 concat 增长
+            解码过程中所有张量的形状固定，需要指定 max_decode_len，可以在 tf.function 中使用 XLA 编译
+            输出的长度固定为 max_decode_len，EOS 之后用 0 填充
+        :param compact_finished_batches: beam search 时是否将已经结束的 batch item 移出解码循环
+        :param indirect_cache: beam search 时 self attention 的 key / value cache 是否不随 beam 重排
+            每个 beam 通过 backpointer 表间接读取 cache，需要 padded_decode，详见 SequenceBeamSearch
+        :param quantize_cache: 解码时 self attention 的 key / value cache 是否使用 int8 量化存储，详见 CacheAttention
+        :param lexical_shortlist: LexicalShortlist，不为 None 时解码只在根据输入选出的候选词上计算 logits 和 top k
+        :param decode_strategy: 解码策略，'beam_search'、'greedy' 或 'sampling'
+        :param top_k: sampling 时只考虑概率最大的 top_k 个 token，<= 0 表示不限制
+        :param top_p: sampling 时只考虑累积概率达到 top_p 的 token，>= 1.0 表示不限制
+        :param sample_temperature: sampling 时 logits 的 temperature
+        """
+        if decode_strategy not in _DECODE_STRATEGIES:
+            raise ValueError(
+                'decode_strategy must be one of %s, got %s' % (_DECODE_STRATEGIES, decode_strategy)
+            )
+        if indirect_cache and not padded_decode:
+            raise ValueError('indirect_cache requires padded_decode')
+        if (indirect_cache or quantize_cache) and decoder_stack.linear_attention is not None:
+            raise ValueError('indirect_cache and quantize_cache are not supported with linear_attention')
         super(Transformer, self).__init__(**kwargs)
 
         self._inputs_vocab_size = inputs_vocab_size
@@ -108,6 +168,15 @@ class Transformer(tf.keras.Model):
         self._extra_decode_len = extra_decode_len
         self._beam_size = beam_size
         self._alpha = alpha
+        self._padded_decode = padded_decode
+        self._compact_finished_batches = compact_finished_batches
+        self._indirect_cache = indirect_cache
+        self._quantize_cache = quantize_cache
+        self._lexical_shortlist = lexical_shortlist
+        self._decode_strategy = decode_strategy
+        self._top_k = top_k
+        self._top_p = top_p
+        self._sample_temperature = sample_temperature
         self._dtype = dtype
 
         # word embedding
@@ -158,7 +227,10 @@ class Transformer(tf.keras.Model):
             encoder_outputs = self.encode(inputs_ids, padding_mask, training)
 
             if targets_ids is None:
-                return self.predict(encoder_outputs, padding_mask, training)
+                candidate_ids = None
+                if self._lexical_shortlist is not None:
+                    candidate_ids = self._lexical_shortlist.get_candidate_ids(inputs_ids)
+                return self.predict(encoder_outputs, padding_mask, training, candidate_ids=candidate_ids)
             else:
                 decoder_outputs = self.decode(targets_ids, encoder_outputs, padding_mask, training)
                 logits = self.targets_word_embedding(decoder_outputs, mode='linear')
@@ -202,7 +274,8 @@ class Transformer(tf.keras.Model):
             if training:
                 decoder_inputs = self.pre_decoder_dropout(decoder_inputs)
 
-            targets_seq_len = tf.shape(targets_ids)[1]
+            # 去掉最后一个 token 后的长度
+            targets_seq_len = tf.shape(decoder_inputs)[1]
             # (1, seq_len, seq_len)
             look_ahead_mask = utils.get_look_ahead_mask(targets_seq_len)
 
@@ -216,50 +289,62 @@ class Transformer(tf.keras.Model):
 
             return decoder_outputs
 
-    def predict(self, encoder_outputs, padding_mask, training):
+    def predict(self, encoder_outputs, padding_mask, training, candidate_ids=None):
+        """
+        :param candidate_ids: (num_candidates,)，lexical shortlist 选出的候选词，详见 LexicalShortlist
+            不为 None 时解码在候选词表上进行，decoded ids 为候选词表中的下标，输出前再映射回原词表
+            候选词表的前两个为 BOS 和 EOS，下标与原词表相同
+        """
         max_decode_len = self._max_decode_len or (
                 tf.shape(encoder_outputs)[1] + self._extra_decode_len
         )
 
-        decode_next_logits_fn = self._get_decode_next_logits_fn(max_decode_len, training=training)
+        decode_next_logits_fn = self._get_decode_next_logits_fn(
+            max_decode_len, training=training, candidate_ids=candidate_ids
+        )
 
         batch_size = tf.shape(encoder_outputs)[0]
         initial_ids = tf.fill((batch_size,), BOS_ID)
         initial_ids = tf.cast(initial_ids, tf.int32)
 
-        init_decode_length = 0
-        num_heads = self.decoder_stack.num_attention_heads
-        size_per_head = self._hidden_size // num_heads
-
-        cache = {
-            str(layer): {
-                'key':
-                    tf.zeros(
-                        shape=(batch_size, init_decode_length, num_heads, size_per_head),
-                        dtype=self._dtype
-                    ),
-                'value':
-                    tf.zeros(
-                        shape=(batch_size, init_decode_length, num_heads, size_per_head),
-                        dtype=self._dtype
-                    )
-            } for layer in range(self.decoder_stack.num_hidden_layers)
-        }
+        # 预分配模式下直接分配 max_decode_len 长度的 cache
+        init_decode_length = max_decode_len if self._padded_decode else 0
+        # grouped-query attention 时 cache 只保存 num_kv_heads 个头
+        size_per_head = self._hidden_size // self.decoder_stack.num_attention_heads
+
+        if self.decoder_stack.linear_attention is not None:
+            # linear attention 的 cache 只保存累加和，大小与解码长度无关
+            feature_size = linear_attention_layer.get_feature_size(
+                self.decoder_stack.linear_attention, size_per_head, self.decoder_stack.num_random_features
+            )
+            cache = {
+                str(layer): linear_attention_layer.create_cache(
+                    batch_size, self.decoder_stack.num_attention_heads, size_per_head, feature_size
+                ) for layer in range(self.decoder_stack.num_hidden_layers)
+            }
+        else:
+            cache = {
+                str(layer): multi_head_attention_layer.create_cache(
+                    batch_size, init_decode_length, self.decoder_stack.num_kv_heads, size_per_head,
+                    dtype=self._dtype, quantized=self._quantize_cache
+                ) for layer in range(self.decoder_stack.num_hidden_layers)
+            }
+
+        # encoder-decoder attention 的 key / value 在解码过程中不变
+        # 在这里对每一层只计算一次，beam search 时所有 beam 共用
+        encoder_decoder_cache = self.decoder_stack.compute_encoder_decoder_cache(encoder_outputs)
+        for layer, layer_cache in encoder_decoder_cache.items():
+            cache[layer].update(layer_cache)
 
         cache['encoder_outputs'] = encoder_outputs
         cache['padding_mask'] = padding_mask
 
-        decoded_ids, scores = beam_search.sequence_beam_search(
-            decode_next_logits_fn=decode_next_logits_fn,
-            initial_ids=initial_ids,
-            initial_cache=cache,
-            vocab_size=self._targets_vocab_size,
-            beam_size=self._beam_size,
-            alpha=self._alpha,
-            max_decode_length=max_decode_len,
-            eos_id=EOS_ID,
-            dtype=self._dtype
+        vocab_size = self._targets_vocab_size if candidate_ids is None else tf.size(candidate_ids)
+        decoded_ids, scores = self._search(
+            decode_next_logits_fn, initial_ids, cache, max_decode_len, vocab_size
         )
+        if candidate_ids is not None:
+            decoded_ids = tf.gather(candidate_ids, decoded_ids)
 
         top_decoded_ids = decoded_ids[:, 0, 1:]
         top_scores = scores[:, 0]
@@ -269,7 +354,51 @@ class Transformer(tf.keras.Model):
             'scores': top_scores
         }
 
-    def _get_decode_next_logits_fn(self, max_decode_len, training):
+    def _search(self, decode_next_logits_fn, initial_ids, cache, max_decode_len, vocab_size):
+        """
+            按照 decode_strategy 选择解码方式
+            返回的结果均带有 beam 维度，greedy 和 sampling 的 beam 维度大小为 1
+        """
+        if self._decode_strategy == 'greedy':
+            return sampling_search.sequence_greedy_search(
+                decode_next_logits_fn=decode_next_logits_fn,
+                initial_ids=initial_ids,
+                initial_cache=cache,
+                max_decode_length=max_decode_len,
+                eos_id=EOS_ID,
+                padded_decode=self._padded_decode,
+                dtype=self._dtype
+            )
+        if self._decode_strategy == 'sampling':
+            return sampling_search.sequence_sampling_search(
+                decode_next_logits_fn=decode_next_logits_fn,
+                initial_ids=initial_ids,
+                initial_cache=cache,
+                max_decode_length=max_decode_len,
+                eos_id=EOS_ID,
+                top_k=self._top_k,
+                top_p=self._top_p,
+                temperature=self._sample_temperature,
+                padded_decode=self._padded_decode,
+                dtype=self._dtype
+            )
+        return beam_search.sequence_beam_search(
+            decode_next_logits_fn=decode_next_logits_fn,
+            initial_ids=initial_ids,
+            initial_cache=cache,
+            vocab_size=vocab_size,
+            beam_size=self._beam_size,
+            alpha=self._alpha,
+            max_decode_length=max_decode_len,
+            eos_id=EOS_ID,
+            padded_decode=self._padded_decode,
+            compact_finished_batches=self._compact_finished_batches,
+            indirect_cache_keys=_INDIRECT_CACHE_KEYS if self._indirect_cache else None,
+            shared_cache_keys=_SHARED_CACHE_KEYS,
+            dtype=self._dtype
+        )
+
+    def _get_decode_next_logits_fn(self, max_decode_len, training, candidate_ids=None):
         """
             在函数内返回函数形成闭包，以保存 position_embeddings 和 look_ahead_mask
         """
@@ -291,6 +420,7 @@ class Transformer(tf.keras.Model):
         def decode_next_logits(decoded_targets_ids, i, cache):
             """
             :param decoded_targets_ids: (batch_size * beam_size, i + 1)
+                padded_decode 时为 (batch_size * beam_size, 1)，只包含当前位置的 ids
             :param i: 已经解码 i 个 token
             :param cache: 缓存了各层的 attention
             :return:
@@ -299,27 +429,49 @@ class Transformer(tf.keras.Model):
             # 取出上一个词，用来预测下一个词
             # (batch_size * beam_size, 1)
             last_targets_ids = decoded_targets_ids[:, -1:]
+            if candidate_ids is not None:
+                # 候选词表中的下标映射回原词表
+                last_targets_ids = tf.gather(candidate_ids, last_targets_ids)
             last_targets_embeddings = self.targets_word_embedding(
                 last_targets_ids,
                 mode='embedding'
             )
-            last_targets_embeddings += position_embeddings[i: i+1]
-            last_targets_mask = look_ahead_mask[:, i: i + 1, :i + 1]
+            # 使用 tf.slice 使切片的大小在编译时已知，以便使用 XLA 编译
+            last_targets_embeddings += tf.slice(position_embeddings, [i, 0], [1, self._hidden_size])
+
+            # 预分配模式下 cache 长度固定为 max_decode_len
+            # mask 需要覆盖所有位置，以屏蔽还未解码的部分
+            if self._padded_decode:
+                last_targets_mask = tf.slice(look_ahead_mask, [0, i, 0], [1, 1, max_decode_len])
+            else:
+                last_targets_mask = look_ahead_mask[:, i: i + 1, :i + 1]
 
             padding_mask = cache.get('padding_mask')
 
+            # indirect cache 模式下由 beam search 提供，(batch_size * beam_size, max_decode_len)
+            cache_indirection = cache.get(beam_search.CACHE_INDIRECTION)
+            if cache_indirection is not None:
+                cache_indirection = tf.reshape(
+                    cache_indirection, [-1, self._beam_size, max_decode_len]
+                )
+
             decoder_outputs = self.decoder_stack(
                 last_targets_embeddings,
                 cache.get('encoder_outputs'),
                 padding_mask,
                 last_targets_mask,
                 training=training,
-                cache=cache
+                cache=cache,
+                decode_loop_step=i if self._padded_decode else None,
+                cache_indirection=cache_indirection,
+                # beam search 时 encoder 相关的 cache 只有 batch_size 份，对 beam 广播
+                beam_size=self._beam_size if self._decode_strategy == 'beam_search' else None
             )
 
             logits = self.targets_word_embedding(
                 decoder_outputs,
-                mode='linear'
+                mode='linear',
+                vocab_ids=candidate_ids
             )
             logits = tf.squeeze(logits, axis=[1])
             return logits, cache
@@ -338,6 +490,15 @@ class Transformer(tf.keras.Model):
             'beam_size': self._beam_size,
             'encoder_stack': self.encoder_stack,
             'decoder_stack': self.decoder_stack,
+            'padded_decode': self._padded_decode,
+            'compact_finished_batches': self._compact_finished_batches,
+            'indirect_cache': self._indirect_cache,
+            'quantize_cache': self._quantize_cache,
+            'lexical_shortlist': self._lexical_shortlist,
+            'decode_strategy': self._decode_strategy,
+            'top_k': self._top_k,
+            'top_p': self._top_p,
+            'sample_temperature': self._sample_temperature,
             'dtype': self._dtype
         }
         base_config = super(Transformer, self).get_config()
@@ -9,12 +9,23 @@ from layers.embedding_layers.word_embedding_layer import WordEmbedding
 from layers.embedding_layers.transformer_position_embedding_layer import TransformerPositionEmbedding
 from layers.transformer_layers import encoder_layer, decoder_layer
 from layers.feed_forward_layers import feed_forward_net_layer
+from layers.attention_layers import multi_head_attention_layer
 from metrics import transformer_metrics as metrics
 from ops import beam_search
+from ops import sampling_search
 from layers import utils
+from models.transformer.lexical_shortlist import LexicalShortlist
 
 EOS_ID = 1
 
+_DECODE_STRATEGIES = ('beam_search', 'greedy', 'sampling')
+# indirect cache 模式下不随 beam 重排的 cache 项，即 self attention 的 key / value 以及量化时的 scale
+_INDIRECT_CACHE_KEYS = ('key', 'value', 'key_scale', 'value_scale')
+# beam search 时所有 beam 共用、不复制 beam_size 份的 cache 项
+_SHARED_CACHE_KEYS = (
+    'encoder_outputs', 'encoder_decoder_attention_mask', 'encoder_decoder_key', 'encoder_decoder_value'
+)
+
 
 def create_model(params, is_train):
     with tf.name_scope('model'):
@@ -58,6 +69,8 @@ class Transformer(tf.keras.Model):
         self._hidden_size = params['hidden_size']
         self._num_hidden_layers = params['num_hidden_layers']
         self._num_attention_heads = params['num_attention_heads']
+        self._num_kv_heads = params['num_kv_heads'] or params['num_attention_heads']
+        self._fuse_qkv_projection = params['fuse_qkv_projection']
         self._intermediate_size = params['intermediate_size']
         self._intermediate_activation = utils.get_activation(params['intermediate_activation'])
         self._extra_decode_len = params['extra_decode_len']
@@ -68,8 +81,31 @@ class Transformer(tf.keras.Model):
         self._norm_epsilon = params['norm_epsilon']
         self._dtype = params['dtype']
         self._padded_decode = params['padded_decode']
+        # beam search 时是否将已经结束的 batch item 移出解码循环
+        self._compact_finished_batches = params['compact_finished_batches']
+        # beam search 时 self attention 的 cache 是否不随 beam 重排，需要 padded_decode
+        self._indirect_cache = params['indirect_cache']
+        if self._indirect_cache and not self._padded_decode:
+            raise ValueError('indirect_cache requires padded_decode')
+        # 解码时 self attention 的 key / value cache 是否使用 int8 量化存储
+        self._quantize_cache = params['quantize_cache']
+        # encoder 和训练时的 decoder 是否用一个 tf.while_loop 执行所有层，详见 utils.scan_layers
+        self._scan_layers = params['scan_layers']
+        # 解码时只在根据输入选出的候选词上计算 logits 和 top k
+        self._lexical_shortlist = (
+            LexicalShortlist.load(params['lexical_shortlist_file']) if params['lexical_shortlist_file'] else None
+        )
         self._beam_size = params['beam_size']
         self._alpha = params['alpha']
+        # 解码策略：'beam_search'、'greedy' 或 'sampling'
+        self._decode_strategy = params['decode_strategy']
+        if self._decode_strategy not in _DECODE_STRATEGIES:
+            raise ValueError(
+                'decode_strategy must be one of %s, got %s' % (_DECODE_STRATEGIES, self._decode_strategy)
+            )
+        self._top_k = params['top_k']
+        self._top_p = params['top_p']
+        self._sample_temperature = params['sample_temperature']
         self._kernel_initializer = tf.keras.initializers.get(params['kernel_initializer'])
         self._bias_initializer = tf.keras.initializers.get(params['bias_initializer'])
         self._kernel_regularizer = tf.keras.regularizers.get(params['kernel_regularizer'])
@@ -110,6 +146,7 @@ class Transformer(tf.keras.Model):
             use_bias=self._use_bias,
             norm_first=self._norm_first,
             norm_epsilon=self._norm_first,
+            fuse_qkv_projection=self._fuse_qkv_projection,
             **common_args
         )
         self.encoder_layers = [self.encoder_layer] * self._num_hidden_layers
@@ -124,6 +161,8 @@ class Transformer(tf.keras.Model):
             use_bias=self._use_bias,
             norm_first=self._norm_first,
             norm_epsilon=self._norm_epsilon,
+            num_kv_heads=self._num_kv_heads,
+            fuse_qkv_projection=self._fuse_qkv_projection,
             **common_args
         )
         self.decoder_layers = [self.decoder_layer] * self._num_hidden_layers
@@ -142,7 +181,10 @@ class Transformer(tf.keras.Model):
             encoder_outputs = self.encode(inputs, inputs_padding_mask, training)
 
             if targets is None:
-                return self.predict(encoder_outputs, inputs_padding_mask, training)
+                candidate_ids = None
+                if self._lexical_shortlist is not None:
+                    candidate_ids = self._lexical_shortlist.get_candidate_ids(inputs)
+                return self.predict(encoder_outputs, inputs_padding_mask, training, candidate_ids=candidate_ids)
             else:
                 decoder_outputs = self.decode(targets, encoder_outputs, inputs_padding_mask, training)
                 logits = self.targets_embedding_softmax_layer(decoder_outputs, mode='linear')
@@ -172,6 +214,17 @@ class Transformer(tf.keras.Model):
                     encoder_inputs, rate=self._hidden_dropout_rate
                 )
 
+            if self._scan_layers:
+                # 所有层共用 encoder_layer，循环体中直接调用
+                return utils.scan_layers(
+                    lambda _, encoder_outputs: self.encoder_layer(
+                        inputs=[encoder_outputs, inputs_padding_mask],
+                        training=training
+                    ),
+                    encoder_inputs,
+                    self._num_hidden_layers
+                )
+
             encoder_outputs = encoder_inputs
             for n, layer in enumerate(self.encoder_layers):
 
@@ -223,6 +276,22 @@ class Transformer(tf.keras.Model):
             targets_seq_len = tf.shape(decoder_inputs)[1]
             targets_look_ahead_mask = utils.get_look_ahead_mask(targets_seq_len)
 
+            if self._scan_layers:
+                # 所有层共用 decoder_layer，循环体中直接调用
+                return utils.scan_layers(
+                    lambda _, decoder_outputs: self.decoder_layer(
+                        inputs=[
+                            decoder_outputs,
+                            encoder_outputs,
+                            inputs_padding_mask,
+                            targets_look_ahead_mask
+                        ],
+                        training=training
+                    )[0],
+                    decoder_inputs,
+                    self._num_hidden_layers
+                )
+
             decoder_outputs = decoder_inputs
             for n, layer in enumerate(self.decoder_layers):
 
@@ -240,18 +309,20 @@ class Transformer(tf.keras.Model):
 
             return decoder_outputs
 
-    def predict(self, encoder_outputs, encoder_decoder_attention_mask, training):
+    def predict(self, encoder_outputs, encoder_decoder_attention_mask, training, candidate_ids=None):
         """
         :param encoder_outputs: (batch_size, inputs_seq_len, hidden_size)
         :param encoder_decoder_attention_mask: (batch_size, 1, seq_len)
         :param training:
+        :param candidate_ids: (num_candidates,)，lexical shortlist 选出的候选词，详见 LexicalShortlist
+            不为 None 时解码在候选词表上进行，输出前再映射回原词表
         :return:
         """
 
         encoder_outputs = tf.cast(encoder_outputs, self._dtype)
         if self._padded_decode:
-            batch_size = encoder_outputs.shape.as_list()[0]
-            inputs_seq_len = encoder_outputs.shape.as_list()[1]
+            # 优先使用静态形状，未知时退回动态形状
+            batch_size, inputs_seq_len, _ = utils.get_shape_list(encoder_outputs, expected_rank=3)
         else:
             batch_size = tf.shape(encoder_outputs)[0]
             inputs_seq_len = tf.shape(encoder_outputs)[1]
@@ -261,43 +332,39 @@ class Transformer(tf.keras.Model):
 
         auto_regressive_decode_fn = self._get_auto_regressive_decode_fn(
             max_decode_len,
-            training=training
+            training=training,
+            candidate_ids=candidate_ids
         )
 
         # 初始只有一个 [PAD]
-        # (batch_size, 1)
-        initial_ids = tf.zeros(shape=(batch_size, 1), dtype=tf.int32)
+        # (batch_size,)
+        # beam search 会在内部扩展出 beam 维度和长度维度
+        initial_ids = tf.zeros(shape=(batch_size,), dtype=tf.int32)
         # 0: 未解码任何一个字符
         init_decode_len = max_decode_len if self._padded_decode else 0
         size_per_head = self._hidden_size // self._num_attention_heads
 
         cache = {
-            'layer_%d' % layer: {
-                'key': tf.zeros(
-                    [batch_size, init_decode_len, self._num_attention_heads, size_per_head],
-                    dtype=self._dtype
-                ),
-                'value': tf.zeros(
-                    [batch_size, init_decode_len, self._num_attention_heads, size_per_head],
-                    dtype=self._dtype
-                )
-            } for layer in range(self._num_hidden_layers)
+            'layer_%d' % layer: multi_head_attention_layer.create_cache(
+                batch_size, init_decode_len, self._num_kv_heads, size_per_head,
+                dtype=self._dtype, quantized=self._quantize_cache
+            ) for layer in range(self._num_hidden_layers)
         }
 
+        # encoder-decoder attention 的 key / value 在解码过程中不变
+        # 在这里对每一层只计算一次，beam search 时所有 beam 共用
+        for n, layer in enumerate(self.decoder_layers):
+            cache['layer_%d' % n].update(layer.compute_encoder_decoder_cache(encoder_outputs))
+
         cache['encoder_outputs'] = encoder_outputs
         cache['encoder_decoder_attention_mask'] = encoder_decoder_attention_mask
 
-        decoded_ids, scores = beam_search.sequence_beam_search(
-            decode_next_logits_fn=auto_regressive_decode_fn,
-            initial_ids=initial_ids,
-            initial_cache=cache,
-            vocab_size=self._targets_vocab_size,
-            beam_size=self._beam_size,
-            alpha=self._alpha,
-            max_decode_length=max_decode_len,
-            eos_id=EOS_ID,
-            dtype=self._dtype
+        vocab_size = self._targets_vocab_size if candidate_ids is None else tf.size(candidate_ids)
+        decoded_ids, scores = self._search(
+            auto_regressive_decode_fn, initial_ids, cache, max_decode_len, vocab_size
         )
+        if candidate_ids is not None:
+            decoded_ids = tf.gather(candidate_ids, decoded_ids)
 
         top_decoded_ids = decoded_ids[:, 0, 1:]
         top_scores = scores[:, 0]
@@ -307,7 +374,51 @@ class Transformer(tf.keras.Model):
             'scores': top_scores
         }
 
-    def _get_auto_regressive_decode_fn(self, max_decode_len, training):
+    def _search(self, auto_regressive_decode_fn, initial_ids, cache, max_decode_len, vocab_size):
+        """
+            按照 decode_strategy 选择解码方式
+            返回的结果均带有 beam 维度，greedy 和 sampling 的 beam 维度大小为 1
+        """
+        if self._decode_strategy == 'greedy':
+            return sampling_search.sequence_greedy_search(
+                decode_next_logits_fn=auto_regressive_decode_fn,
+                initial_ids=initial_ids,
+                initial_cache=cache,
+                max_decode_length=max_decode_len,
+                eos_id=EOS_ID,
+                padded_decode=self._padded_decode,
+                dtype=self._dtype
+            )
+        if self._decode_strategy == 'sampling':
+            return sampling_search.sequence_sampling_search(
+                decode_next_logits_fn=auto_regressive_decode_fn,
+                initial_ids=initial_ids,
+                initial_cache=cache,
+                max_decode_length=max_decode_len,
+                eos_id=EOS_ID,
+                top_k=self._top_k,
+                top_p=self._top_p,
+                temperature=self._sample_temperature,
+                padded_decode=self._padded_decode,
+                dtype=self._dtype
+            )
+        return beam_search.sequence_beam_search(
+            decode_next_logits_fn=auto_regressive_decode_fn,
+            initial_ids=initial_ids,
+            initial_cache=cache,
+            vocab_size=vocab_size,
+            beam_size=self._beam_size,
+            alpha=self._alpha,
+            max_decode_length=max_decode_len,
+            eos_id=EOS_ID,
+            padded_decode=self._padded_decode,
+            compact_finished_batches=self._compact_finished_batches,
+            indirect_cache_keys=_INDIRECT_CACHE_KEYS if self._indirect_cache else None,
+            shared_cache_keys=_SHARED_CACHE_KEYS,
+            dtype=self._dtype
+        )
+
+    def _get_auto_regressive_decode_fn(self, max_decode_len, training, candidate_ids=None):
         # (max_decode_len + 1, hidden_size)
         # +1 是因为有 BOS
         # 会在整个解码的过程中用到，解码第 i 个 word 的时候用第 i 个
@@ -326,6 +437,7 @@ class Transformer(tf.keras.Model):
         def auto_regressive_decode_fn(ids, i, cache):
             """
             :param ids: (batch_size * beam_size, i + 1)
+                padded_decode 时为 (batch_size * beam_size, 1)，只包含当前位置的 ids
             :param i: 解码第一个字符的时候 i = 0
             :param cache:
             :return:
@@ -334,15 +446,30 @@ class Transformer(tf.keras.Model):
             # 取出前一个字符
             # (batch_size * beam_size, 1)
             decoder_input = ids[:, -1:]
+            if candidate_ids is not None:
+                # 候选词表中的下标映射回原词表
+                decoder_input = tf.gather(candidate_ids, decoder_input)
 
             # (batch_size * beam_size, 1, hidden_size)
             decoder_input = self.targets_embedding_softmax_layer(decoder_input)
 
             # 位置编码
-            decoder_input += position_embeddings[i: i + 1]
+            # 使用 tf.slice 使切片的大小在编译时已知，以便使用 XLA 编译
+            decoder_input += tf.slice(position_embeddings, [i, 0], [1, self._hidden_size])
 
             # 取出当前位置的 mask
-            self_attention_mask = targets_look_ahead_mask[0, i:i + 1, :i + 1]
+            # 预分配模式下 cache 长度固定为 max_decode_len，mask 需要覆盖所有位置
+            if self._padded_decode:
+                self_attention_mask = tf.slice(targets_look_ahead_mask, [0, i, 0], [1, 1, max_decode_len])[0]
+            else:
+                self_attention_mask = targets_look_ahead_mask[0, i:i + 1, :i + 1]
+
+            # indirect cache 模式下由 beam search 提供，(batch_size * beam_size, max_decode_len)
+            cache_indirection = cache.get(beam_search.CACHE_INDIRECTION)
+            if cache_indirection is not None:
+                cache_indirection = tf.reshape(
+                    cache_indirection, [-1, self._beam_size, max_decode_len]
+                )
 
             decoder_outputs = decoder_input
             for n, layer in enumerate(self.decoder_layers):
@@ -358,9 +485,15 @@ class Transformer(tf.keras.Model):
                             self_attention_mask
                         ],
                         training=training,
-                        cache=layer_cache
+                        cache=layer_cache,
+                        decode_loop_step=i if self._padded_decode else None,
+                        cache_indirection=cache_indirection,
+                        # beam search 时 encoder 相关的 cache 只有 batch_size 份，对 beam 广播
+                        beam_size=self._beam_size if self._decode_strategy == 'beam_search' else None
                     )
-            logits = self.targets_embedding_softmax_layer(decoder_outputs, mode='linear')
+            logits = self.targets_embedding_softmax_layer(
+                decoder_outputs, mode='linear', vocab_ids=candidate_ids
+            )
             logits = tf.squeeze(logits, axis=[1])
             return logits, cache
 
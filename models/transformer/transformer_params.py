@@ -44,6 +44,29 @@ PARAMS = defaultdict(
     extra_decode_len=50,
     beam_size=4,
     alpha=0.6,
+    padded_decode=False,
+    # beam search 时将已经结束的 batch item 移出解码循环，减少无效的 decoder 计算
+    compact_finished_batches=False,
+    # beam search 时 self attention 的 cache 不随 beam 重排，通过 backpointer 表间接读取，需要 padded_decode
+    indirect_cache=False,
+    # 解码时 self attention 的 key / value cache 使用 int8 量化存储，减少内存占用
+    quantize_cache=False,
+    # decoder attention 的 key / value 头数，小于 num_attention_heads 时为 grouped-query attention，None 表示与其相同
+    num_kv_heads=None,
+    # self attention 的 query、key、value 使用一个合并的投影，默认不合并以兼容已有的 checkpoint，
+    # 两者的 checkpoint 可以用 fused_qkv_conversion.py 转换
+    fuse_qkv_projection=False,
+    # lexical shortlist 文件 (见 lexical_shortlist.py)，解码时只在候选词上计算 softmax，None 表示使用完整词表
+    lexical_shortlist_file=None,
+    # encoder 和训练时的 decoder 用一个 tf.while_loop 执行所有层，减少 tracing 时间和 graph 大小
+    # transformerV2 的各层共用一个层对象，不改变 checkpoint
+    # (transformer.Transformer 的 stack 会改变 checkpoint，见 model_params.py)
+    scan_layers=False,
+    # 解码策略：beam_search / greedy / sampling
+    decode_strategy='beam_search',
+    top_k=0,
+    top_p=1.0,
+    sample_temperature=1.0,
 
     # common
     kernel_initializer='glorot_uniform',
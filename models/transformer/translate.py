@@ -4,6 +4,11 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import division
 
+import json
+import shelve
+import hashlib
+import threading
+import collections
 import tensorflow as tf
 from absl import logging
 import numpy as np
@@ -20,6 +25,130 @@ _EXTRA_DECODE_LENGTH = 100
 _BEAM_SIZE = 4
 _ALPHA = 0.6
 
+# 影响翻译结果的模型参数，作为翻译结果缓存的 key 的一部分，见 get_decode_params
+_DECODE_PARAM_KEYS = (
+    'beam_size',
+    'alpha',
+    'extra_decode_len',
+    'decode_strategy',
+    'top_k',
+    'top_p',
+    'sample_temperature',
+    'quantize_cache',
+    'lexical_shortlist_file'
+)
+
+
+def get_decode_params(params):
+    """
+    :param params: 创建模型的参数，见 transformer_params.PARAMS
+    :return: 其中影响翻译结果的解码参数，用于 TranslationCache.make_key
+    """
+    return {key: params[key] for key in _DECODE_PARAM_KEYS if key in params}
+
+
+def get_checkpoint_id(checkpoint_path):
+    """
+        checkpoint 的标识，用作 TranslationCache 的 model_id
+
+        由 checkpoint 的 .index 文件的内容得到，其中包含所有权重的 checksum，
+        同一路径下重新训练得到的 checkpoint 的标识不同
+    """
+    with tf.io.gfile.GFile(checkpoint_path + '.index', 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class TranslationCache(object):
+    """
+        翻译结果缓存，key 为模型的标识、源语言的 ids 以及解码参数，value 为目标语言的 ids
+        命中缓存的句子不再经过 encoder 和 beam search
+
+        内存中为容量为 max_size 的 LRU
+        给定 cache_file 时结果同时写入磁盘 (shelve)，内存中被淘汰或进程重启后仍可从磁盘读取，
+        不同的模型共用 cache_file 时按 model_id 区分
+        可以在多个线程中使用
+    """
+
+    def __init__(self, model_id, max_size=100000, cache_file=None):
+        """
+        :param model_id: 模型的标识，例如 get_checkpoint_id 得到的 checkpoint 的标识，
+            模型的权重变化后需要使用新的标识，否则会读到旧模型的翻译结果
+        """
+        self._model_id = model_id
+        self._max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = shelve.open(cache_file) if cache_file is not None else None
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def make_key(self, inputs_ids, decode_params):
+        """
+        :param decode_params: 模型的解码参数，见 get_decode_params
+        """
+        return json.dumps(
+            {'model_id': self._model_id, 'inputs_ids': [int(i) for i in inputs_ids], 'decode_params': decode_params},
+            sort_keys=True
+        )
+
+    @property
+    def hits(self):
+        return self.memory_hits + self.disk_hits
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """未命中时返回 None"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return self._entries[key]
+
+            if self._disk is not None and key in self._disk:
+                outputs = self._disk[key]
+                self._put_in_memory(key, outputs)
+                self.disk_hits += 1
+                return outputs
+
+            self.misses += 1
+            return None
+
+    def put(self, key, outputs):
+        with self._lock:
+            self._put_in_memory(key, outputs)
+            if self._disk is not None:
+                self._disk[key] = outputs
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate
+        }
+
+    def close(self):
+        with self._lock:
+            if self._disk is not None:
+                self._disk.close()
+                self._disk = None
+
+    def _put_in_memory(self, key, outputs):
+        self._entries[key] = outputs
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
 
 def _trim_and_decode(ids, sub_tokenizer):
     try:
@@ -33,25 +162,78 @@ def _encode_and_add_eos(line, sub_tokenizer):
     return sub_tokenizer.encode(line) + [sub_tokenization.EOS_ID]
 
 
-def translate_from_text(model, sub_tokenizer, txt):
-    encoded_txt = _encode_and_add_eos(txt, sub_tokenizer)
-    result = model.predict(encoded_txt)
-    outputs = result['outputs']
+def _predict_batch(model, encoded_inputs):
+    """
+        补齐后调用 model.predict_on_batch
+
+    :param model: create_model(params, is_train=False) 得到的模型，输出为 [outputs, scores]
+    :param encoded_inputs: [ids]
+    :return: [ids]，每个句子的翻译结果，截断到 EOS (包含 EOS)
+    """
+    max_len = max(len(ids) for ids in encoded_inputs)
+    inputs_ids = np.zeros([len(encoded_inputs), max_len], dtype=np.int64)
+    for row, ids in enumerate(encoded_inputs):
+        inputs_ids[row, :len(ids)] = ids
+
+    outputs, _ = model.predict_on_batch(inputs_ids)
+    results = []
+    for ids in np.asarray(outputs):
+        ids = [int(i) for i in ids]
+        if sub_tokenization.EOS_ID in ids:
+            ids = ids[:ids.index(sub_tokenization.EOS_ID) + 1]
+        results.append(ids)
+    return results
+
+
+def _check_decode_params(cache, decode_params):
+    if cache is not None and decode_params is None:
+        raise ValueError('decode_params is required when cache is used, see get_decode_params')
+
+
+def translate_from_text(model, sub_tokenizer, txt, cache=None, decode_params=None):
+    """
+    :param cache: TranslationCache，为 None 时不使用缓存
+    :param decode_params: 模型的解码参数 (见 get_decode_params)，作为缓存 key 的一部分，使用缓存时必须给定
+    """
+    _check_decode_params(cache, decode_params)
+    encoded_txt = _encode_and_add_eos(txt.strip(), sub_tokenizer)
+
+    outputs = None
+    if cache is not None:
+        key = cache.make_key(encoded_txt, decode_params)
+        outputs = cache.get(key)
+    if outputs is None:
+        outputs = _predict_batch(model, [encoded_txt])[0]
+        if cache is not None:
+            cache.put(key, outputs)
+
     logging.info('Original: "%s"' % txt)
-    translate_from_input(outputs, sub_tokenizer)
+    return translate_from_input(outputs, sub_tokenizer)
 
 
 def translate_from_input(outputs, sub_tokenizer):
     translation = _trim_and_decode(outputs, sub_tokenizer)
     logging.info('Translation: "%s"' % translation)
+    return translation
 
 
-def _get_sorted_inputs(filename):
+def _read_inputs(filename):
     with tf.io.gfile.GFile(filename) as f:
         records = f.read().split('\n')
         inputs = [record.strip() for record in records]
         if not inputs[-1]:
             inputs.pop()
+    return inputs
+
+
+def _get_sorted_inputs(filename):
+    """
+        按照单词数从多到少排序
+
+    :return: sorted_inputs: 排序后的句子
+             sorted_keys: 原来第 i 个句子在 sorted_inputs 中的下标
+    """
+    inputs = _read_inputs(filename)
 
     input_lens = [(i, len(line.split())) for i, line in enumerate(inputs)]
     sorted_input_lens = sorted(input_lens, key=lambda x: x[1], reverse=True)
@@ -60,5 +242,95 @@ def _get_sorted_inputs(filename):
     sorted_keys = [0] * len(sorted_input_lens)
     for i, (index, _) in enumerate(sorted_input_lens):
         sorted_inputs[i] = inputs[index]
-        sorted_inputs[index] = i
+        sorted_keys[index] = i
     return sorted_inputs, sorted_keys
+
+
+def _batch_by_token_budget(encoded_inputs, max_tokens_per_batch, max_batch_size=None):
+    """
+        将按长度排好序的句子划分为多个 batch
+        每个 batch 补齐到其中最长的句子，补齐后的 token 数不超过 max_tokens_per_batch
+        单个句子超过 max_tokens_per_batch 时单独成为一个 batch
+
+    :param encoded_inputs: [ids]，按长度从长到短排序
+    :return: [(start, end)]，每个 batch 在 encoded_inputs 中的范围
+    """
+    batches = []
+    start = 0
+    while start < len(encoded_inputs):
+        # 已排序，batch 中第一个句子最长
+        max_len = len(encoded_inputs[start])
+        batch_size = max(1, max_tokens_per_batch // max_len)
+        if max_batch_size is not None:
+            batch_size = min(batch_size, max_batch_size)
+        end = min(start + batch_size, len(encoded_inputs))
+        batches.append((start, end))
+        start = end
+    return batches
+
+
+def translate_file(
+        model,
+        sub_tokenizer,
+        input_file,
+        output_file=None,
+        max_tokens_per_batch=4096,
+        max_batch_size=None,
+        cache=None,
+        decode_params=None
+):
+    """
+        翻译整个文件，每行一个句子
+
+        1. tokenize 所有句子，按 token 数从多到少排序
+        2. 按照 token 预算划分 batch，长度相近的句子在同一个 batch 中，减少补齐的 token
+        3. 对每个 batch 调用 model.predict_on_batch
+        4. 将结果恢复为原来的顺序
+
+    :param model: create_model(params, is_train=False) 得到的模型，输出为 [outputs, scores]
+    :param max_tokens_per_batch: 每个 batch 补齐后的 token 数上限
+    :param max_batch_size: 每个 batch 句子数的上限，为 None 时不限制
+    :param cache: TranslationCache，命中缓存的句子不再经过模型，为 None 时不使用缓存
+    :param decode_params: 模型的解码参数 (见 get_decode_params)，作为缓存 key 的一部分，使用缓存时必须给定
+    :return: 翻译结果，与输入文件的行一一对应
+    """
+    _check_decode_params(cache, decode_params)
+    inputs = _read_inputs(input_file)
+    encoded_inputs = [_encode_and_add_eos(line, sub_tokenizer) for line in inputs]
+
+    translations = [None] * len(inputs)
+
+    # 需要经过模型翻译的句子
+    indices = range(len(inputs))
+    if cache is not None:
+        keys = [cache.make_key(ids, decode_params) for ids in encoded_inputs]
+        indices = []
+        for i, key in enumerate(keys):
+            outputs = cache.get(key)
+            if outputs is None:
+                indices.append(i)
+            else:
+                translations[i] = _trim_and_decode(outputs, sub_tokenizer)
+
+    # sorted_indices[i] 为排序后第 i 个句子原来的下标
+    sorted_indices = sorted(indices, key=lambda i: len(encoded_inputs[i]), reverse=True)
+    sorted_encoded_inputs = [encoded_inputs[i] for i in sorted_indices]
+
+    batches = _batch_by_token_budget(sorted_encoded_inputs, max_tokens_per_batch, max_batch_size)
+    for batch_idx, (start, end) in enumerate(batches):
+        batch = sorted_encoded_inputs[start: end]
+        outputs = _predict_batch(model, batch)
+        for row, index in enumerate(sorted_indices[start: end]):
+            translations[index] = _trim_and_decode(outputs[row], sub_tokenizer)
+            if cache is not None:
+                cache.put(keys[index], outputs[row])
+
+        logging.info('Translated batch %d / %d, batch_size: %d, max_len: %d'
+                     % (batch_idx + 1, len(batches), len(batch), len(batch[0])))
+
+    if output_file is not None:
+        with tf.io.gfile.GFile(output_file, 'w') as f:
+            for translation in translations:
+                f.write('%s\n' % translation)
+
+    return translations
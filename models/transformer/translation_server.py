@@ -0,0 +1,346 @@
+# -*- coding: utf - 8 -*-
+
+"""
+    基于 continuous batching 的翻译服务
+
+    model.predict 每次调用处理一个固定的 batch，batch 中最长的句子解码结束之前
+    其余已经结束的句子仍然占用计算，新的请求也必须等待整个 batch 结束
+
+    这里维护一个大小为 max_batch_size 的解码 batch，每个位置 (slot) 对应一个请求：
+        1. 有空闲 slot 时，等待中的请求经过 encoder 后加入解码 batch
+        2. 每一步对所有 slot 做一次 decoder 前向计算，每个 slot 处于各自的解码位置
+        3. 解码出 EOS 或达到最大长度的请求立即离开 batch，释放 slot
+
+    cache 与 SequenceBeamSearch 预分配模式下的 cache 结构相同：
+        {
+            layer_idx: {
+                'key': (max_batch_size, max_decode_len, num_kv_heads, size_per_head),
+                'value': (max_batch_size, max_decode_len, num_kv_heads, size_per_head),
+                'encoder_decoder_key': (max_batch_size, max_inputs_len, num_kv_heads, size_per_head),
+                'encoder_decoder_value': (max_batch_size, max_inputs_len, num_kv_heads, size_per_head)
+            },
+            'encoder_outputs': (max_batch_size, max_inputs_len, hidden_size),
+            'padding_mask': (max_batch_size, 1, max_inputs_len)
+        }
+    每一步的 decode_loop_step 为 (max_batch_size,)，即每个 slot 当前的解码位置
+
+    每个请求使用贪心解码
+"""
+
+import time
+import queue
+import threading
+import collections
+import numpy as np
+import tensorflow as tf
+from layers import utils
+from models.transformer.transformer import BOS_ID, EOS_ID
+
+
+class TranslationRequest(object):
+    """一条翻译请求，解码结束后 outputs 中为目标语言的 ids，以 EOS 结尾或达到最大长度"""
+
+    def __init__(self, inputs_ids, max_decode_len):
+        self.inputs_ids = list(inputs_ids)
+        self.max_decode_len = max_decode_len
+        self.outputs = []
+        self.score = 0.0
+        self.submit_time = time.time()
+        self.finish_time = None
+        self._finished = threading.Event()
+
+    @property
+    def done(self):
+        return self._finished.is_set()
+
+    @property
+    def latency(self):
+        if self.finish_time is None:
+            return None
+        return self.finish_time - self.submit_time
+
+    def wait(self, timeout=None):
+        """等待解码结束，返回是否已经结束"""
+        return self._finished.wait(timeout)
+
+    def _finish(self):
+        self.finish_time = time.time()
+        self._finished.set()
+
+
+class ContinuousBatchingTranslator(object):
+
+    def __init__(
+            self,
+            model,
+            max_batch_size=32,
+            max_inputs_len=256,
+            extra_decode_len=50,
+            dtype=tf.float32
+    ):
+        """
+        :param model: models.transformer.transformer.Transformer，需要已经加载好权重
+        :param max_batch_size: 同时解码的请求数
+        :param max_inputs_len: 输入 ids 的最大长度
+        :param extra_decode_len: 每个请求最多解码 len(inputs_ids) + extra_decode_len 个 token
+        """
+        self._model = model
+        self._max_batch_size = max_batch_size
+        self._max_inputs_len = max_inputs_len
+        self._extra_decode_len = extra_decode_len
+        self._max_decode_len = max_inputs_len + extra_decode_len
+        self._dtype = dtype
+
+        self._pending = queue.Queue()
+        self._waiting = collections.deque()
+
+        # 每个 slot 上的请求，None 表示空闲
+        self._slots = [None] * max_batch_size
+        # 每个 slot 上一步解码出的 id 以及当前的解码位置
+        self._last_ids = np.full([max_batch_size], BOS_ID, dtype=np.int32)
+        self._positions = np.zeros([max_batch_size], dtype=np.int32)
+
+        # (max_decode_len, hidden_size)
+        self._position_embeddings = tf.cast(
+            model.position_embedding(inputs=None, length=self._max_decode_len), dtype
+        )
+
+        self._cache = self._create_cache()
+
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    @property
+    def num_active(self):
+        return sum(request is not None for request in self._slots)
+
+    @property
+    def num_pending(self):
+        return self._pending.qsize() + len(self._waiting)
+
+    def submit(self, inputs_ids):
+        """
+            提交一条请求，可以在其他线程中调用
+
+        :param inputs_ids: 源语言的 ids，以 EOS 结尾
+        :return: TranslationRequest
+        """
+        if len(inputs_ids) > self._max_inputs_len:
+            raise ValueError(
+                'inputs_ids is longer than max_inputs_len: %d > %d'
+                % (len(inputs_ids), self._max_inputs_len)
+            )
+        request = TranslationRequest(inputs_ids, len(inputs_ids) + self._extra_decode_len)
+        self._pending.put(request)
+        return request
+
+    def translate(self, inputs_ids, timeout=None):
+        """提交请求并等待结果，需要先调用 start"""
+        request = self.submit(inputs_ids)
+        request.wait(timeout)
+        return request.outputs
+
+    def step(self):
+        """
+            将等待中的请求加入空闲 slot，然后对所有 slot 解码一步
+
+        :return: 这一步结束的请求
+        """
+        self._admit()
+        if self.num_active == 0:
+            return []
+
+        next_ids, next_log_probs, self._cache = self._decode_step(
+            tf.constant(self._last_ids), tf.constant(self._positions), self._cache
+        )
+        next_ids = next_ids.numpy()
+        next_log_probs = next_log_probs.numpy()
+
+        finished = []
+        for slot, request in enumerate(self._slots):
+            if request is None:
+                continue
+            next_id = int(next_ids[slot])
+            request.outputs.append(next_id)
+            request.score += float(next_log_probs[slot])
+            self._last_ids[slot] = next_id
+            self._positions[slot] += 1
+
+            if next_id == EOS_ID or len(request.outputs) >= request.max_decode_len:
+                request._finish()
+                finished.append(request)
+                self._release(slot)
+
+        return finished
+
+    def run_until_complete(self):
+        """在当前线程中解码，直到所有已提交的请求都结束"""
+        finished = []
+        while self.num_active > 0 or self.num_pending > 0:
+            finished.extend(self.step())
+        return finished
+
+    def start(self):
+        """在后台线程中持续解码"""
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+    def _serve_forever(self):
+        while not self._stop_event.is_set():
+            if self.num_active == 0 and not self._waiting:
+                # 没有正在解码的请求时阻塞等待，避免空转
+                try:
+                    self._waiting.append(self._pending.get(timeout=0.1))
+                except queue.Empty:
+                    continue
+            self.step()
+
+    def _release(self, slot):
+        self._slots[slot] = None
+        self._last_ids[slot] = BOS_ID
+        self._positions[slot] = 0
+
+    def _admit(self):
+        free_slots = [slot for slot, request in enumerate(self._slots) if request is None]
+        requests = []
+        while len(requests) < len(free_slots):
+            if self._waiting:
+                requests.append(self._waiting.popleft())
+                continue
+            try:
+                requests.append(self._pending.get_nowait())
+            except queue.Empty:
+                break
+        if not requests:
+            return
+
+        slots = free_slots[:len(requests)]
+        inputs_len = max(len(request.inputs_ids) for request in requests)
+        inputs_ids = np.zeros([len(requests), inputs_len], dtype=np.int64)
+        for row, request in enumerate(requests):
+            inputs_ids[row, :len(request.inputs_ids)] = request.inputs_ids
+
+        self._cache = self._prefill(
+            tf.constant(inputs_ids), tf.constant(slots, dtype=tf.int32), self._cache
+        )
+
+        for slot, request in zip(slots, requests):
+            self._slots[slot] = request
+            self._last_ids[slot] = BOS_ID
+            self._positions[slot] = 0
+
+    def _create_cache(self):
+        decoder_stack = self._model.decoder_stack
+        hidden_size = self._position_embeddings.shape[-1]
+        num_heads = decoder_stack.num_kv_heads
+        size_per_head = hidden_size // decoder_stack.num_attention_heads
+
+        def _zeros(seq_len):
+            return tf.zeros(
+                [self._max_batch_size, seq_len, num_heads, size_per_head], dtype=self._dtype
+            )
+
+        cache = {
+            str(layer): {
+                'key': _zeros(self._max_decode_len),
+                'value': _zeros(self._max_decode_len),
+                'encoder_decoder_key': _zeros(self._max_inputs_len),
+                'encoder_decoder_value': _zeros(self._max_inputs_len)
+            } for layer in range(decoder_stack.num_hidden_layers)
+        }
+        cache['encoder_outputs'] = tf.zeros(
+            [self._max_batch_size, self._max_inputs_len, hidden_size], dtype=self._dtype
+        )
+        # 空闲 slot 的 encoder 输出全部被屏蔽
+        cache['padding_mask'] = tf.ones([self._max_batch_size, 1, self._max_inputs_len], dtype=self._dtype)
+        return cache
+
+    @tf.function(experimental_relax_shapes=True)
+    def _prefill(self, inputs_ids, slots, cache):
+        """
+            对新加入的请求做 encoder 计算，并将 encoder-decoder attention 的 key / value 写入对应的 slot
+
+        :param inputs_ids: (num_requests, inputs_len)
+        :param slots: (num_requests,)
+        """
+        cache = dict(cache)
+        padding_mask = utils.get_padding_mask(inputs_ids, padding_value=0, dtype=self._dtype)
+        encoder_outputs = self._model.encode(inputs_ids, padding_mask, training=False)
+
+        entries = self._model.decoder_stack.compute_encoder_decoder_cache(encoder_outputs)
+
+        pad_len = self._max_inputs_len - tf.shape(inputs_ids)[1]
+        # (num_requests, 1)
+        indices = tf.expand_dims(slots, axis=1)
+
+        def _write(target, tensor, axis=1, constant_values=0):
+            # 在 inputs_len 维度补齐到 max_inputs_len 后写入对应的 slot
+            paddings = [[0, 0]] * len(tensor.shape)
+            paddings[axis] = [0, pad_len]
+            tensor = tf.pad(tensor, paddings, constant_values=constant_values)
+            return tf.tensor_scatter_nd_update(target, indices, tensor)
+
+        for layer in range(self._model.decoder_stack.num_hidden_layers):
+            layer_cache = dict(cache[str(layer)])
+            for name, tensor in entries[str(layer)].items():
+                layer_cache[name] = _write(layer_cache[name], tensor)
+            cache[str(layer)] = layer_cache
+
+        cache['encoder_outputs'] = _write(cache['encoder_outputs'], encoder_outputs)
+        cache['padding_mask'] = _write(cache['padding_mask'], padding_mask, axis=2, constant_values=1)
+        return cache
+
+    @tf.function
+    def _decode_step(self, last_ids, positions, cache):
+        """
+        :param last_ids: (max_batch_size,) 每个 slot 上一步解码出的 id
+        :param positions: (max_batch_size,) 每个 slot 当前的解码位置
+        :return: next_ids: (max_batch_size,)
+                 next_log_probs: (max_batch_size,)
+                 cache
+        """
+        # decoder_stack 会修改 cache，tf.function 不允许修改传入的参数
+        cache = {
+            key: dict(value) if isinstance(value, dict) else value
+            for key, value in cache.items()
+        }
+        # (max_batch_size, 1, hidden_size)
+        decoder_inputs = self._model.targets_word_embedding(
+            tf.expand_dims(last_ids, axis=1), mode='embedding'
+        )
+        decoder_inputs += tf.expand_dims(tf.gather(self._position_embeddings, positions), axis=1)
+
+        # 屏蔽每个 slot 当前位置之后的部分
+        # (max_batch_size, 1, max_decode_len)
+        look_ahead_mask = tf.cast(
+            tf.range(self._max_decode_len)[tf.newaxis, :] > positions[:, tf.newaxis], self._dtype
+        )
+        look_ahead_mask = tf.expand_dims(look_ahead_mask, axis=1)
+
+        decoder_outputs = self._model.decoder_stack(
+            decoder_inputs,
+            cache['encoder_outputs'],
+            cache['padding_mask'],
+            look_ahead_mask,
+            training=False,
+            cache=cache,
+            decode_loop_step=positions
+        )
+
+        # (max_batch_size, vocab_size)
+        logits = self._model.targets_word_embedding(decoder_outputs, mode='linear')
+        logits = tf.cast(tf.squeeze(logits, axis=1), tf.float32)
+
+        next_ids = tf.argmax(logits, axis=-1, output_type=tf.int32)
+        next_log_probs = tf.gather(tf.nn.log_softmax(logits, axis=-1), next_ids, batch_dims=1)
+        return next_ids, next_log_probs, cache
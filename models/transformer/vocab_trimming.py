@@ -0,0 +1,199 @@
+# -*- coding: utf - 8 -*-
+
+"""
+    裁剪目标语言词表
+
+    目标语言词表通常与源语言共用，而实际的语言对只用到其中一小部分 id
+    从 translate_data_processor.convert_corpus_to_features 写出的 TFRecord 中统计实际出现的目标语言 id，
+    只保留这些 id，得到更小的目标语言词表，target word embedding 以及与之共享权重的 softmax 随之变小
+
+    新词表中的 id 按原 id 从小到大排列，保留的 id 总是包含 PAD (0) 和 EOS (1)，二者的 id 不变
+    输出：
+        1. 裁剪后的词表文件，第 i 行为新 id i 对应的 token，可以直接用于构建目标语言的 tokenizer
+        2. id_map.txt，第 i 行为新 id i 对应的原 id，RemappedTokenizer 用它把模型输出的新 id 映射回原 id
+        3. 裁剪后的 checkpoint，需要把 params 中的 targets_vocab_size 设置为新词表的大小
+
+    运行方式：
+        python -m models.transformer.vocab_trimming \\
+            --data_dir=<TFRecord 所在目录> --checkpoint=<checkpoint> \\
+            --targets_vocab_file=<原目标语言词表> --output_dir=<输出目录>
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import os
+import numpy as np
+import tensorflow as tf
+from absl import app
+from absl import flags
+from absl import logging
+from models.transformer import transformer
+from models.transformer.model_params import BASE_PARAMS
+from tokenizations import sub_tokenization
+
+
+_ID_MAP_FILE = 'id_map.txt'
+
+
+def collect_used_ids(file_pattern, reserved_ids=(sub_tokenization.PAD_ID, sub_tokenization.EOS_ID)):
+    """
+    :param file_pattern: TFRecord 文件
+    :param reserved_ids: 无论是否出现都保留的 id
+    :return: 排序后的 id，np.int32
+    """
+    dataset = tf.data.TFRecordDataset(tf.io.gfile.glob(file_pattern))
+    dataset = dataset.map(
+        lambda example: tf.io.parse_single_example(
+            example, {'targets_ids': tf.io.VarLenFeature(tf.int64)}
+        )['targets_ids'].values
+    )
+
+    used = set(reserved_ids)
+    for targets_ids in dataset:
+        used.update(targets_ids.numpy().tolist())
+    return np.array(sorted(used), dtype=np.int32)
+
+
+def write_trimmed_vocab(vocab_file, kept_ids, output_vocab_file):
+    with tf.io.gfile.GFile(vocab_file) as f:
+        tokens = [line.rstrip('\n') for line in f]
+    with tf.io.gfile.GFile(output_vocab_file, mode='w') as f:
+        for i in kept_ids:
+            f.write(tokens[i] + '\n')
+
+
+def write_id_map(kept_ids, path):
+    with tf.io.gfile.GFile(path, mode='w') as f:
+        for i in kept_ids:
+            f.write('%d\n' % i)
+
+
+def load_id_map(path):
+    with tf.io.gfile.GFile(path) as f:
+        return np.array([int(line) for line in f], dtype=np.int32)
+
+
+def trim_model_weights(source_model, target_model, kept_ids):
+    """
+        把 source_model 的权重写入 target_model
+
+        两个模型除 targets_vocab_size 外结构相同，且都已经构建
+        形状相同的权重直接复制，第一维为目标语言词表的权重 (target word embedding / softmax) 只取 kept_ids 对应的行
+
+    :param kept_ids: 保留的原 id，新 id i 对应原 id kept_ids[i]
+    """
+    source_weights, target_weights = source_model.weights, target_model.weights
+    if len(source_weights) != len(target_weights):
+        raise ValueError(
+            'source model has %d weights but target model has %d'
+            % (len(source_weights), len(target_weights))
+        )
+
+    for source, target in zip(source_weights, target_weights):
+        if source.shape == target.shape:
+            target.assign(source)
+        elif source.shape[1:] == target.shape[1:] and target.shape[0] == len(kept_ids):
+            target.assign(tf.gather(source, kept_ids))
+        else:
+            raise ValueError(
+                'can not trim weight %s %s to %s %s'
+                % (source.name, source.shape, target.name, target.shape)
+            )
+
+
+def trim_checkpoint(checkpoint_path, output_path, kept_ids, params=None, create_model_fn=None):
+    """
+        裁剪 checkpoint 中的目标语言词表
+
+        只写入模型权重，不包括优化器的状态
+
+    :param params: 原模型的参数，默认为 model_params.BASE_PARAMS
+    :param create_model_fn: 默认为 transformer.create_model
+    :return: 写入的 checkpoint 路径
+    """
+    params = (params or BASE_PARAMS).copy()
+    create_model_fn = create_model_fn or transformer.create_model
+
+    source_model = create_model_fn(params, is_train=True)
+    tf.train.Checkpoint(model=source_model).restore(checkpoint_path).expect_partial()
+
+    params['targets_vocab_size'] = len(kept_ids)
+    target_model = create_model_fn(params, is_train=True)
+
+    trim_model_weights(source_model, target_model, kept_ids)
+    return tf.train.Checkpoint(model=target_model).write(output_path)
+
+
+class RemappedTokenizer(object):
+    """
+        包装原来的 tokenizer，用于裁剪目标语言词表后的模型
+
+        encode 用于源语言，保持不变
+        decode 用于模型输出的目标语言 id，先映射回原 id 再交给原来的 tokenizer
+    """
+
+    def __init__(self, tokenizer, id_map):
+        self._tokenizer = tokenizer
+        self._id_map = np.asarray(id_map)
+
+    @classmethod
+    def from_id_map_file(cls, tokenizer, path):
+        return cls(tokenizer, load_id_map(path))
+
+    def encode(self, *args, **kwargs):
+        return self._tokenizer.encode(*args, **kwargs)
+
+    def decode(self, ids, *args, **kwargs):
+        return self._tokenizer.decode(self._id_map[np.asarray(ids, dtype=np.int64)].tolist(), *args, **kwargs)
+
+
+def define_flags():
+    flags.DEFINE_string(
+        name='data_dir',
+        default=None,
+        help='directory of the translation TFRecords'
+    )
+    flags.DEFINE_string(
+        name='checkpoint',
+        default=None,
+        help='checkpoint of the model trained with the full targets vocab'
+    )
+    flags.DEFINE_string(
+        name='targets_vocab_file',
+        default=None,
+        help='full targets vocab file'
+    )
+    flags.DEFINE_string(
+        name='output_dir',
+        default=None,
+        help='directory for the trimmed vocab, id map and checkpoint'
+    )
+    flags.mark_flags_as_required(['data_dir', 'checkpoint', 'targets_vocab_file', 'output_dir'])
+
+
+def main(_):
+    flags_obj = flags.FLAGS
+    tf.io.gfile.makedirs(flags_obj.output_dir)
+
+    kept_ids = collect_used_ids(os.path.join(flags_obj.data_dir, '*.tfrecord'))
+    write_trimmed_vocab(
+        flags_obj.targets_vocab_file,
+        kept_ids,
+        os.path.join(flags_obj.output_dir, os.path.basename(flags_obj.targets_vocab_file))
+    )
+    write_id_map(kept_ids, os.path.join(flags_obj.output_dir, _ID_MAP_FILE))
+    output_path = trim_checkpoint(
+        flags_obj.checkpoint, os.path.join(flags_obj.output_dir, 'model'), kept_ids
+    )
+    logging.info(
+        'Keep %d targets ids, write trimmed checkpoint to %s, set targets_vocab_size to %d'
+        % (len(kept_ids), output_path, len(kept_ids))
+    )
+
+
+if __name__ == '__main__':
+    logging.set_verbosity(logging.INFO)
+    define_flags()
+    app.run(main)
@@ -1,7 +1,197 @@
 # -*- coding: utf - 8 -*-
 
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
 import tensorflow as tf
+from layers.embedding_layers.word_embedding_layer import WordEmbedding
+from layers.embedding_layers.bert_position_embedding_layer import BertPositionEmbedding
+from layers.transformer_layers.encoder_layer import TransformerEncoderLayer
+from layers.attention_layers.self_attention_mask import SelfAttentionMask
+from layers.attention_layers.einsum_dense import EinsumDense
+from activations.gelu import gelu
 
 
 class ALBertEncoder(tf.keras.Model):
-    pass
+    """
+        ALBERT encoder
+
+        与 BertEncoder 相比：
+            1. factorized embedding：word embedding 的维度为较小的 embedding_size，再投影到 hidden_size，
+               embedding 的参数从 vocab_size * hidden_size 减少为 vocab_size * embedding_size + embedding_size * hidden_size
+            2. 跨层参数共享：所有层共用同一个 TransformerEncoderLayer，参数量与层数无关
+
+        输入与输出与 BertEncoder 相同
+    """
+    def __init__(
+            self,
+            vocab_size,
+            embedding_size=128,
+            hidden_size=768,
+            num_layers=12,
+            num_attention_heads=12,
+            max_seq_len=512,
+            type_vocab_size=16,
+            intermediate_size=3072,
+            activation=gelu,
+            hidden_dropout_rate=0.1,
+            attention_dropout_rate=0.1,
+            initializer=tf.keras.initializers.TruncatedNormal(stddev=0.02),
+            return_all_encoder_outputs=False,
+            **kwargs
+    ):
+        """
+        :param embedding_size: word embedding 的维度，为 None 时与 hidden_size 相同
+        :param num_layers: 共享的 TransformerEncoderLayer 重复计算的次数
+        """
+        activation = tf.keras.activations.get(activation)
+        initializer = tf.keras.initializers.get(initializer)
+
+        self._self_setattr_tracking = False
+        self._config_dict = {
+            'vocab_size': vocab_size,
+            'embedding_size': embedding_size,
+            'hidden_size': hidden_size,
+            'num_layers': num_layers,
+            'num_attention_heads': num_attention_heads,
+            'max_seq_len': max_seq_len,
+            'type_vocab_size': type_vocab_size,
+            'intermediate_size': intermediate_size,
+            'activation': tf.keras.activations.serialize(activation),
+            'hidden_dropout_rate': hidden_dropout_rate,
+            'attention_dropout_rate': attention_dropout_rate,
+            'initializer': tf.keras.initializers.serialize(initializer),
+            'return_all_encoder_outputs': return_all_encoder_outputs
+        }
+        # (batch_size, seq_len)
+        inputs_ids = tf.keras.layers.Input(
+            shape=(None,), dtype=tf.int32, name='inputs_ids'
+        )
+
+        # (batch_size, seq_len)
+        inputs_mask = tf.keras.layers.Input(
+            shape=(None,), dtype=tf.int32, name='inputs_mask'
+        )
+
+        # (batch_size, seq_len)
+        inputs_type_ids = tf.keras.layers.Input(
+            shape=(None,), dtype=tf.int32, name='inputs_type_ids'
+        )
+
+        if embedding_size is None:
+            embedding_size = hidden_size
+
+        # word embedding
+        # (batch_size, seq_len, embedding_size)
+        self._embedding_layer = WordEmbedding(
+            vocab_size=vocab_size,
+            embedding_size=embedding_size,
+            initializer=initializer,
+            name='word_embedding'
+        )
+        word_embeddings = self._embedding_layer(inputs_ids)
+
+        # position embedding
+        self._position_embedding_layer = BertPositionEmbedding(
+            initializer=initializer,
+            use_dynamic_slicing=True,
+            max_seq_len=max_seq_len,
+            name='position_embedding'
+        )
+        position_embeddings = self._position_embedding_layer(word_embeddings)
+
+        # type embedding
+        self._type_embedding_layer = WordEmbedding(
+            vocab_size=type_vocab_size,
+            embedding_size=embedding_size,
+            initializer=initializer,
+            use_one_hot=True,
+            name='type_embedding'
+        )
+        type_embeddings = self._type_embedding_layer(inputs_type_ids)
+
+        embeddings = tf.keras.layers.Add()(
+            [word_embeddings, position_embeddings, type_embeddings]
+        )
+        embeddings = tf.keras.layers.LayerNormalization(
+            name='embedding/layer_norm',
+            axis=-1,
+            epsilon=1e-12,
+            dtype=tf.float32
+        )(embeddings)
+        embeddings = tf.keras.layers.Dropout(rate=hidden_dropout_rate)(embeddings)
+
+        # 将 embedding_size 投影到 hidden_size
+        # (batch_size, seq_len, hidden_size)
+        self._embedding_projection = EinsumDense(
+            '...x,xy->...y',
+            output_shape=hidden_size,
+            bias_axes='y',
+            kernel_initializer=initializer,
+            name='embedding_projection'
+        )
+        data = self._embedding_projection(embeddings)
+
+        # (batch_size, 1, seq_len)
+        attention_mask = SelfAttentionMask(compact=True)([data, inputs_mask])
+
+        # 所有层共用同一个 layer
+        self._transformer_layer = TransformerEncoderLayer(
+            num_attention_heads=num_attention_heads,
+            intermediate_size=intermediate_size,
+            intermediate_activation=activation,
+            hidden_dropout_rate=hidden_dropout_rate,
+            attention_dropout_rate=attention_dropout_rate,
+            kernel_initializer=initializer,
+            name='transformer'
+        )
+        encoder_outputs = []
+        for _ in range(num_layers):
+            data = self._transformer_layer([data, attention_mask])
+            encoder_outputs.append(data)
+
+        first_token_tensor = tf.keras.layers.Lambda(
+            lambda x: tf.squeeze(x[:, 0:1, :], axis=1)
+        )(encoder_outputs[-1])
+        self._pooler_layer = tf.keras.layers.Dense(
+            units=hidden_size,
+            activation='tanh',
+            kernel_initializer=initializer,
+            name='pooler_transform'
+        )
+        # (batch_size, hidden_size)
+        cls_output = self._pooler_layer(first_token_tensor)
+
+        if return_all_encoder_outputs:
+            outputs = [encoder_outputs, cls_output]
+        else:
+            outputs = [encoder_outputs[-1], cls_output]
+
+        super(ALBertEncoder, self).__init__(
+            inputs=[inputs_ids, inputs_mask, inputs_type_ids],
+            outputs=outputs,
+            **kwargs
+        )
+
+    def get_embedding_table(self):
+        return self._embedding_layer.embeddings
+
+    def get_embedding_layer(self):
+        return self._embedding_layer
+
+    def get_config(self):
+        return self._config_dict
+
+    @property
+    def transformer_layers(self):
+        """共享的 layer，与 BertEncoder 的接口保持一致"""
+        return [self._transformer_layer]
+
+    @property
+    def pooler_layer(self):
+        return self._pooler_layer
+
+    @classmethod
+    def from_config(cls, config, custom_objects=None):
+        return cls(**config)
@@ -5,6 +5,7 @@ from __future__ import division
 from __future__ import print_function
 
 import tensorflow as tf
+from layers import utils
 from layers.embedding_layers.word_embedding_layer import WordEmbedding
 from layers.embedding_layers.bert_position_embedding_layer import BertPositionEmbedding
 from layers.transformer_layers.encoder_layer import TransformerEncoderLayer
@@ -13,6 +14,17 @@ from layers.attention_layers.einsum_dense import EinsumDense
 from activations.gelu import gelu
 
 
+def _get_per_layer_values(value, num_layers, name):
+    """value 为列表时需要与层数相同，否则所有层使用同一个值"""
+    if isinstance(value, (list, tuple)):
+        if len(value) != num_layers:
+            raise ValueError(
+                '%s should have %d elements, got %d' % (name, num_layers, len(value))
+            )
+        return list(value)
+    return [value] * num_layers
+
+
 class BertEncoder(tf.keras.Model):
     def __init__(
             self,
@@ -31,8 +43,31 @@ class BertEncoder(tf.keras.Model):
             output_range=None,
             embedding_size=None,
             embedding_layer=None,
+            attention_chunk_size=None,
+            attention_window_size=None,
+            num_global_tokens=1,
+            unpadded=False,
+            num_output_positions=None,
             **kwargs
     ):
+        """
+        :param attention_chunk_size: 分块计算 self attention 的块大小，用于长文档，详见 MultiHeadAttention
+            可以是一个整数 (所有层相同)，也可以是长度为 num_layers 的列表分别指定每一层，None 表示不分块
+        :param attention_window_size: 局部窗口 + 全局 token 的稀疏 self attention 的窗口大小，
+            详见 SlidingWindowAttention，与 attention_chunk_size 相同，可以按层指定，None 表示使用完整的 self attention
+        :param num_global_tokens: 稀疏 self attention 中序列开头的全局 token 数，默认只有 [CLS]
+        :param unpadded: 是否去掉 padding 计算，embedding 之后只保留 inputs_mask 为 0 的 token，
+            layer norm、全连接层和投影只对这些 token 计算，encoder 输出时恢复 padding (padding 位置的输出为 0)
+            详见 TransformerEncoderLayer
+        :param output_range: 最后一层只计算前 output_range 个位置，输出的 sequence output 为 (batch_size, output_range, hidden_size)
+            例如分类只需要 [CLS] 时为 1
+        :param num_output_positions: 不为 None 时增加输入 output_positions (batch_size, num_output_positions)，
+            例如 masked_lm_positions，最后一层只计算 [CLS] 和这些位置，
+            输出的 sequence output 为 (batch_size, num_output_positions, hidden_size)，第 j 个即 output_positions[:, j] 的输出
+        """
+        attention_chunk_sizes = _get_per_layer_values(attention_chunk_size, num_layers, 'attention_chunk_size')
+        attention_window_sizes = _get_per_layer_values(attention_window_size, num_layers, 'attention_window_size')
+
         activation = tf.keras.activations.get(activation)
         initializer = tf.keras.initializers.get(initializer)
 
@@ -51,7 +86,12 @@ class BertEncoder(tf.keras.Model):
             'initializer': tf.keras.initializers.serialize(initializer),
             'return_all_encoder_outputs': return_all_encoder_outputs,
             'output_range': output_range,
-            'embedding_size': embedding_size
+            'embedding_size': embedding_size,
+            'attention_chunk_size': attention_chunk_size,
+            'attention_window_size': attention_window_size,
+            'num_global_tokens': num_global_tokens,
+            'unpadded': unpadded,
+            'num_output_positions': num_output_positions
         }
         # 定义输入 words_ids, 类型为 int32
         # (batch_size, seq_len)
@@ -70,6 +110,19 @@ class BertEncoder(tf.keras.Model):
         inputs_type_ids = tf.keras.layers.Input(
             shape=(None,), dtype=tf.int32, name='inputs_type_ids'
         )
+        inputs = [inputs_ids, inputs_mask, inputs_type_ids]
+
+        if num_output_positions is not None:
+            # (batch_size, num_output_positions)
+            output_positions = tf.keras.layers.Input(
+                shape=(num_output_positions,), dtype=tf.int32, name='output_positions'
+            )
+            inputs.append(output_positions)
+            # 总是计算 [CLS]，用于 pooler
+            # (batch_size, 1 + num_output_positions)
+            last_layer_positions = tf.keras.layers.Lambda(
+                lambda x: tf.concat([tf.zeros_like(x[:, :1]), x], axis=1)
+            )(output_positions)
 
         # word embedding
         if embedding_size is None:
@@ -133,14 +186,30 @@ class BertEncoder(tf.keras.Model):
 
         self._transformer_encoder_layers = []
         data = embeddings
-        attention_mask = SelfAttentionMask()([data, inputs_mask])
+        # (batch_size, 1, seq_len)，只保存 key 的 padding 信息，在 softmax 时才 broadcast
+        attention_mask = SelfAttentionMask(compact=True)([data, inputs_mask])
         encoder_outputs = []
 
+        if unpadded:
+            # (num_tokens, 2)
+            token_indices = tf.keras.layers.Lambda(utils.get_token_indices)(inputs_mask)
+            # (1, num_tokens, hidden_size)
+            data = tf.keras.layers.Lambda(
+                lambda x: utils.pack_tokens(x[0], x[1])
+            )([data, token_indices])
+            # (batch_size, seq_len, hidden_size)
+            unpack_layer = tf.keras.layers.Lambda(
+                lambda x: utils.unpack_tokens(x[0], x[1], tf.shape(x[2])[0], tf.shape(x[2])[1])
+            )
+
         for i in range(num_layers):
-            if i == num_layers - 1 and output_range is not None:
+            is_last_layer = i == num_layers - 1
+            if is_last_layer and output_range is not None:
                 transformer_output_range = output_range
             else:
                 transformer_output_range = None
+            # 最后一层只计算部分位置
+            sparse_outputs = is_last_layer and (output_range is not None or num_output_positions is not None)
 
             layer = TransformerEncoderLayer(
                 num_attention_heads=num_attention_heads,
@@ -148,17 +217,34 @@ class BertEncoder(tf.keras.Model):
                 intermediate_activation=activation,
                 hidden_dropout_rate=hidden_dropout_rate,
                 attention_dropout_rate=attention_dropout_rate,
-                # output_range=transformer_output_range,
+                output_range=transformer_output_range,
                 kernel_initializer=initializer,
+                attention_chunk_size=attention_chunk_sizes[i],
+                attention_window_size=attention_window_sizes[i],
+                num_global_tokens=num_global_tokens,
                 name='transformer/layer_%d' % i
             )
             self._transformer_encoder_layers.append(layer)
-            data = layer([data, attention_mask])
+            if unpadded and not sparse_outputs:
+                data = layer([data, attention_mask, token_indices])
+                encoder_outputs.append(unpack_layer([data, token_indices, inputs_mask]))
+                continue
+
+            # 只计算部分位置时不能去掉 padding，先恢复 padding
+            if unpadded:
+                data = unpack_layer([data, token_indices, inputs_mask])
+            if is_last_layer and num_output_positions is not None:
+                data = layer([data, attention_mask], output_positions=last_layer_positions)
+            else:
+                data = layer([data, attention_mask])
             encoder_outputs.append(data)
 
         first_token_tensor = tf.keras.layers.Lambda(
             lambda x: tf.squeeze(x[:, 0:1, :], axis=1)
         )(encoder_outputs[-1])
+        if num_output_positions is not None:
+            # 去掉 [CLS]
+            encoder_outputs[-1] = tf.keras.layers.Lambda(lambda x: x[:, 1:])(encoder_outputs[-1])
         self._pooler_layer = tf.keras.layers.Dense(
             units=hidden_size,
             activation='tanh',
@@ -174,7 +260,7 @@ class BertEncoder(tf.keras.Model):
             outputs = [encoder_outputs[-1], cls_output]
 
         super(BertEncoder, self).__init__(
-            inputs=[inputs_ids, inputs_mask, inputs_type_ids],
+            inputs=inputs,
             outputs=outputs,
             **kwargs
         )
@@ -0,0 +1,87 @@
+# -*- coding: utf - 8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.keras import keras_parameterized
+from networks.encoders import albert_encoder
+from networks.encoders import bert_encoder
+
+
+class ALBertEncoderTest(keras_parameterized.TestCase):
+    def test_network_creation(self):
+        hidden_size = 32
+        seq_len = 21
+        test_network = albert_encoder.ALBertEncoder(
+            vocab_size=100,
+            embedding_size=8,
+            hidden_size=hidden_size,
+            num_attention_heads=2,
+            num_layers=3
+        )
+
+        words_ids = tf.keras.Input(shape=(seq_len,), dtype=tf.int32)
+        mask = tf.keras.Input(shape=(seq_len,), dtype=tf.int32)
+        type_ids = tf.keras.Input(shape=(seq_len,), dtype=tf.int32)
+        data, pooled = test_network([words_ids, mask, type_ids])
+
+        self.assertLen(test_network.transformer_layers, 1)
+        self.assertIsInstance(test_network.pooler_layer, tf.keras.layers.Dense)
+        self.assertAllEqual([None, seq_len, hidden_size], data.shape.as_list())
+        self.assertAllEqual([None, hidden_size], pooled.shape.as_list())
+        self.assertAllEqual([100, 8], test_network.get_embedding_table().shape.as_list())
+
+    def test_parameter_sharing(self):
+        kwargs = dict(
+            vocab_size=1000, hidden_size=32, num_attention_heads=2, intermediate_size=64, type_vocab_size=2
+        )
+        test_network = albert_encoder.ALBertEncoder(embedding_size=8, num_layers=6, **kwargs)
+        shallow_network = albert_encoder.ALBertEncoder(embedding_size=8, num_layers=1, **kwargs)
+        bert_network = bert_encoder.BertEncoder(num_layers=6, **kwargs)
+
+        # 参数量与层数无关
+        self.assertEqual(shallow_network.count_params(), test_network.count_params())
+        self.assertLess(test_network.count_params(), bert_network.count_params() / 4)
+
+        # 每一层的输出不同
+        all_outputs_network = albert_encoder.ALBertEncoder(
+            embedding_size=8, num_layers=3, return_all_encoder_outputs=True, **kwargs
+        )
+        word_ids = np.random.randint(1000, size=(2, 7))
+        mask = np.zeros((2, 7), dtype=np.int32)
+        type_ids = np.zeros((2, 7), dtype=np.int32)
+        all_outputs, _ = all_outputs_network([word_ids, mask, type_ids], training=False)
+        self.assertLen(all_outputs, 3)
+        self.assertNotAllClose(all_outputs[0], all_outputs[1])
+
+    def test_checkpoint(self):
+        kwargs = dict(
+            vocab_size=100, embedding_size=8, hidden_size=32, num_attention_heads=2, num_layers=2
+        )
+        test_network = albert_encoder.ALBertEncoder(**kwargs)
+        new_network = albert_encoder.ALBertEncoder(**kwargs)
+
+        word_ids = np.random.randint(100, size=(2, 7))
+        mask = np.random.randint(2, size=(2, 7))
+        type_ids = np.random.randint(16, size=(2, 7))
+        path = tf.train.Checkpoint(model=test_network).save(os.path.join(self.get_temp_dir(), 'ckpt'))
+        tf.train.Checkpoint(model=new_network).restore(path).assert_existing_objects_matched()
+        self.assertAllClose(
+            test_network([word_ids, mask, type_ids], training=False),
+            new_network([word_ids, mask, type_ids], training=False)
+        )
+
+    def test_serialize_deserialize(self):
+        test_network = albert_encoder.ALBertEncoder(
+            vocab_size=100, embedding_size=8, hidden_size=32, num_attention_heads=2, num_layers=2, activation='relu'
+        )
+        new_network = albert_encoder.ALBertEncoder.from_config(test_network.get_config())
+        self.assertAllEqual(test_network.get_config(), new_network.get_config())
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -69,6 +69,95 @@ class BertEncoderTest(keras_parameterized.TestCase):
         self.assertAllEqual(tf.float32, all_encoder_outputs[-1].dtype)
         self.assertAllEqual(tf.float32, pooled.dtype)
 
+    def test_attention_chunk_size(self):
+        kwargs = dict(vocab_size=100, hidden_size=32, num_attention_heads=2, num_layers=3)
+        test_network = bert_encoder.BertEncoder(**kwargs)
+        # 只有后两层分块计算
+        chunked_network = bert_encoder.BertEncoder(attention_chunk_size=[None, 8, 4], **kwargs)
+        chunked_network.set_weights(test_network.get_weights())
+        self.assertEqual(
+            [None, 8, 4],
+            [layer.get_config()['attention_chunk_size'] for layer in chunked_network.transformer_layers]
+        )
+
+        batch_size, seq_len = 3, 21
+        word_ids = np.random.randint(100, size=(batch_size, seq_len))
+        mask = np.random.randint(2, size=(batch_size, seq_len))
+        type_ids = np.random.randint(16, size=(batch_size, seq_len))
+        outputs = test_network([word_ids, mask, type_ids], training=False)
+        chunked_outputs = chunked_network([word_ids, mask, type_ids], training=False)
+        self.assertAllClose(outputs, chunked_outputs, atol=1e-5)
+
+        with self.assertRaises(ValueError):
+            bert_encoder.BertEncoder(attention_chunk_size=[8, 8], **kwargs)
+
+    def test_attention_window_size(self):
+        kwargs = dict(vocab_size=100, hidden_size=32, num_attention_heads=2, num_layers=3)
+        test_network = bert_encoder.BertEncoder(**kwargs)
+        # 窗口覆盖整个序列时与完整的 self attention 等价
+        sparse_network = bert_encoder.BertEncoder(attention_window_size=[None, 32, 32], **kwargs)
+        sparse_network.set_weights(test_network.get_weights())
+
+        batch_size, seq_len = 3, 21
+        word_ids = np.random.randint(100, size=(batch_size, seq_len))
+        mask = np.random.randint(2, size=(batch_size, seq_len))
+        mask[:, 0] = 0
+        type_ids = np.random.randint(16, size=(batch_size, seq_len))
+        outputs = test_network([word_ids, mask, type_ids], training=False)
+        self.assertAllClose(outputs, sparse_network([word_ids, mask, type_ids], training=False), atol=1e-5)
+
+        # 窗口较小时只检查能够正常运行
+        sparse_network = bert_encoder.BertEncoder(attention_window_size=4, num_global_tokens=2, **kwargs)
+        data, pooled = sparse_network([word_ids, mask, type_ids], training=False)
+        self.assertEqual([batch_size, seq_len, 32], data.shape.as_list())
+
+    def test_unpadded(self):
+        kwargs = dict(vocab_size=100, hidden_size=32, num_attention_heads=2, num_layers=3)
+        test_network = bert_encoder.BertEncoder(**kwargs)
+        unpadded_network = bert_encoder.BertEncoder(unpadded=True, return_all_encoder_outputs=True, **kwargs)
+        unpadded_network.set_weights(test_network.get_weights())
+        self.assertTrue(unpadded_network.get_config()['unpadded'])
+
+        batch_size, seq_len = 3, 21
+        word_ids = np.random.randint(100, size=(batch_size, seq_len))
+        mask = np.zeros((batch_size, seq_len), dtype=np.int32)
+        mask[1, 15:] = 1
+        mask[2, 3:] = 1
+        type_ids = np.random.randint(16, size=(batch_size, seq_len))
+        data, pooled = test_network([word_ids, mask, type_ids], training=False)
+        all_unpadded_data, unpadded_pooled = unpadded_network([word_ids, mask, type_ids], training=False)
+
+        # padding 位置的输出为 0
+        valid = (1 - mask)[:, :, np.newaxis]
+        self.assertEqual(3, len(all_unpadded_data))
+        self.assertAllClose(data * valid, all_unpadded_data[-1], atol=1e-5)
+        self.assertAllClose(pooled, unpadded_pooled, atol=1e-5)
+
+    @parameterized.parameters(False, True)
+    def test_sparse_last_layer(self, unpadded):
+        kwargs = dict(vocab_size=100, hidden_size=32, num_attention_heads=2, num_layers=3, unpadded=unpadded)
+        test_network = bert_encoder.BertEncoder(**kwargs)
+        range_network = bert_encoder.BertEncoder(output_range=1, **kwargs)
+        positions_network = bert_encoder.BertEncoder(num_output_positions=4, **kwargs)
+        range_network.set_weights(test_network.get_weights())
+        positions_network.set_weights(test_network.get_weights())
+
+        batch_size, seq_len = 3, 21
+        word_ids = np.random.randint(100, size=(batch_size, seq_len))
+        mask = np.zeros((batch_size, seq_len), dtype=np.int32)
+        mask[1, 15:] = 1
+        type_ids = np.random.randint(16, size=(batch_size, seq_len))
+        positions = np.random.randint(15, size=(batch_size, 4))
+        data, pooled = test_network([word_ids, mask, type_ids], training=False)
+
+        range_data, range_pooled = range_network([word_ids, mask, type_ids], training=False)
+        self.assertAllClose(data[:, :1], range_data, atol=1e-5)
+        self.assertAllClose(pooled, range_pooled, atol=1e-5)
+
+        positions_data, positions_pooled = positions_network([word_ids, mask, type_ids, positions], training=False)
+        self.assertAllClose(tf.gather(data, positions, batch_dims=1), positions_data, atol=1e-5)
+        self.assertAllClose(pooled, positions_pooled, atol=1e-5)
+
     @parameterized.named_parameters(
         ("all_sequence", None, 21),
         ("output_range", 1, 1),
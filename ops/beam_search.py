@@ -40,6 +40,12 @@ def inf(dtype):
         raise AssertionError("Invalid dtype: %s" % dtype)
 
 
+# indirect cache 模式下，symbols_to_logits_fn 从 cache 中这个 key 读取每个 beam 的 backpointer 表
+CACHE_INDIRECTION = "cache_indirection"
+# 计算 log softmax 的归一化项时每次处理的 vocab 大小
+_LOG_NORMALIZER_CHUNK_SIZE = 4096
+
+
 class _StateKeys(object):
     """Keys to dictionary storing the state of the beam search loop."""
 
@@ -70,6 +76,27 @@ class _StateKeys(object):
     # True -> finished sequence, False -> filler. Shape [batch_size, beam_size]
     FINISHED_FLAGS = "FINISHED_FLAGS"
 
+    # 以下状态只在 compact_finished_batches 为 True 时使用
+    # 当前仍在解码的 batch item 在原始 batch 中的位置。Shape [batch_size]
+    BATCH_INDEX = "BATCH_INDEX"
+    # 已经结束的 batch item 的结果，按原始位置存放，长度补齐到 max_decode_length + 1
+    # Shape [original_batch_size, beam_size, max_decode_length + 1]
+    RESULT_SEQ = "RESULT_SEQ"
+    # Shape [original_batch_size, beam_size]
+    RESULT_SCORES = "RESULT_SCORES"
+
+    # 以下状态只在 indirect_cache_keys 不为空时使用
+    # 不随 beam 重排的 cache，第 j 行保存第 j 个 beam 位置在各个解码步写入的内容
+    # 结构与 ALIVE_CACHE 相同，只包含 indirect_cache_keys 中的项
+    INDIRECT_CACHE = "INDIRECT_CACHE"
+    # 每个 alive 序列在每个位置的内容保存在 INDIRECT_CACHE 的哪一行 (batch 内的 beam 下标)
+    # Shape [batch_size, beam_size, max_decode_length]
+    CACHE_INDIRECTION = "CACHE_INDIRECTION"
+
+    # 只在 shared_cache_keys 不为空时使用
+    # 每个 batch item 只保存一份、所有 beam 共用的 cache，例如 encoder 的输出，没有 beam 维度
+    SHARED_CACHE = "SHARED_CACHE"
+
 
 def _expand_to_same_rank(tensor, target):
     """Expands a given tensor to target's rank to be broadcastable.
@@ -106,13 +133,40 @@ class SequenceBeamSearch(tf.Module):
                  alpha,
                  max_decode_length,
                  eos_id,
+                 padded_decode=False,
+                 compact_finished_batches=False,
+                 indirect_cache_keys=None,
+                 shared_cache_keys=None,
                  dtype=tf.float32):
+        """
+        :param padded_decode: 是否使用固定形状的解码
+            若为 True，cache 为预分配的固定长度 cache，alive_seq 和 finished_seq 也预分配为 max_decode_length + 1
+            每一步按下标写入，symbols_to_logits_fn 只接收当前的 ids (batch_size * beam_size, 1)
+            整个解码过程中所有 state 的形状不变，可以使用 XLA 编译
+        :param compact_finished_batches: 是否在每一步将已经结束的 batch item 移出 alive state 和 cache
+            某个 batch item 的 finished 序列不可能再被超越时即视为结束，其结果按原始位置写入结果缓冲区
+            剩余的 batch item 继续解码，不再为已结束的 item 做 decoder 前向计算
+        :param indirect_cache_keys: 不随 beam 重排的 cache 项的名字，例如 ('key', 'value')，需要 padded_decode
+            默认情况下每一步选出新的 beam 后，整个 cache 都要按父 beam gather 两次
+            对于 self attention 的 key / value，每一步只会按下标写入当前位置，之前的位置不再改变
+            因此这些项固定按 beam 位置存放，只维护一个 backpointer 表 (batch_size, beam_size, max_decode_length)
+            重排 beam 时只 gather 这个 int 表，symbols_to_logits_fn 通过 cache[CACHE_INDIRECTION] 间接读取
+        :param shared_cache_keys: 在解码过程中不变、同一个 batch item 的所有 beam 都相同的 cache 项的名字
+            例如 encoder 的输出和 padding mask，这些项不扩展到 beam_size 份，也不随 beam gather
+            传给 symbols_to_logits_fn 时仍为 (batch_size, ...)，由 symbols_to_logits_fn 在使用时对 beam 广播
+        """
+        if indirect_cache_keys and not padded_decode:
+            raise ValueError('indirect_cache_keys requires padded_decode')
         self.symbols_to_logits_fn = symbols_to_logits_fn
         self.vocab_size = vocab_size
         self.beam_size = beam_size
         self.alpha = alpha
         self.max_decode_length = max_decode_length
         self.eos_id = eos_id
+        self.padded_decode = padded_decode
+        self.compact_finished_batches = compact_finished_batches
+        self.indirect_cache_keys = tuple(indirect_cache_keys or ())
+        self.shared_cache_keys = tuple(shared_cache_keys or ())
         self.dtype = tf.as_dtype(dtype)
 
     def search(self, initial_ids, initial_cache):
@@ -147,37 +201,47 @@ class SequenceBeamSearch(tf.Module):
             alive_seq = state[_StateKeys.ALIVE_SEQ]
             alive_log_probs = state[_StateKeys.ALIVE_LOG_PROBS]
             alive_cache = state[_StateKeys.ALIVE_CACHE]
+            # 开启 compact_finished_batches 时 batch_size 会随解码而减小
+            batch_size = tf.shape(alive_seq)[0]
 
             beams_to_keep = 2 * self.beam_size
 
             # Get logits for the next candidate IDs for the alive sequences. Get the
             # new cache values at the same time.
-            flat_ids = _flatten_beam_dim(alive_seq)  # [batch_size * beam_size]
+            if self.padded_decode:
+                # 序列长度固定，只取出当前位置的 ids
+                # [batch_size * beam_size, 1]
+                flat_ids = _flatten_beam_dim(tf.slice(alive_seq, [0, 0, i], [batch_size, self.beam_size, 1]))
+            else:
+                flat_ids = _flatten_beam_dim(alive_seq)  # [batch_size * beam_size]
+            if self.indirect_cache_keys:
+                alive_cache = _merge_cache(
+                    alive_cache, state[_StateKeys.INDIRECT_CACHE])
+                alive_cache[CACHE_INDIRECTION] = state[_StateKeys.CACHE_INDIRECTION]
             flat_cache = tf.nest.map_structure(_flatten_beam_dim, alive_cache)
+            if self.shared_cache_keys:
+                flat_cache = _merge_cache(flat_cache, state[_StateKeys.SHARED_CACHE])
 
             flat_logits, flat_cache = self.symbols_to_logits_fn(
                 flat_ids, i, flat_cache)
+            if self.shared_cache_keys:
+                # 共用的部分保持不变，直接使用 state 中的
+                flat_cache, _ = _split_cache(flat_cache, self.shared_cache_keys)
 
             # Unflatten logits to shape [batch_size, beam_size, vocab_size]
             logits = _unflatten_beam_dim(flat_logits, batch_size, self.beam_size)
             new_cache = tf.nest.map_structure(
                 lambda t: _unflatten_beam_dim(t, batch_size, self.beam_size),
                 flat_cache)
+            new_indirect_cache = None
+            if self.indirect_cache_keys:
+                # 不随 beam 重排的部分单独取出，只 gather backpointer 表
+                new_cache, new_indirect_cache = _split_cache(
+                    new_cache, self.indirect_cache_keys)
 
-            # Convert logits to normalized log probs
-            candidate_log_probs = _log_prob_from_logits(logits)
-
-            # Calculate new log probabilities if each of the alive sequences were
-            # extended # by the the candidate IDs.
-            # Shape [batch_size, beam_size, vocab_size]
-            log_probs = candidate_log_probs + tf.expand_dims(alive_log_probs, axis=2)
-
-            # Each batch item has beam_size * vocab_size candidate sequences. For each
-            # batch item, get the k candidates with the highest log probabilities.
-            flat_log_probs = tf.reshape(log_probs,
-                                        [-1, self.beam_size * self.vocab_size])
-            topk_log_probs, topk_indices = tf.nn.top_k(
-                flat_log_probs, k=beams_to_keep)
+            # 两阶段 top-k，不构造 (batch_size, beam_size * vocab_size) 的 log probs
+            topk_log_probs, topk_indices = _two_stage_top_k(
+                logits, alive_log_probs, beams_to_keep)
 
             # Extract the alive sequences that generate the highest log probabilities
             # after being extended.
@@ -188,9 +252,17 @@ class SequenceBeamSearch(tf.Module):
 
             # Append the most probable IDs to the topk sequences
             topk_ids = topk_indices % self.vocab_size
-            topk_seq = tf.concat(
-                [topk_seq, tf.expand_dims(topk_ids, axis=2)], axis=2)
-            return topk_seq, topk_log_probs, topk_ids, new_cache
+            if self.padded_decode:
+                # 写入第 i + 1 个位置
+                # [max_decode_length + 1, batch_size, 2 * beam_size]
+                topk_seq = tf.transpose(topk_seq, perm=[2, 0, 1])
+                topk_seq = tf.tensor_scatter_nd_update(
+                    topk_seq, [[i + 1]], tf.expand_dims(topk_ids, axis=0))
+                topk_seq = tf.transpose(topk_seq, perm=[1, 2, 0])
+            else:
+                topk_seq = tf.concat(
+                    [topk_seq, tf.expand_dims(topk_ids, axis=2)], axis=2)
+            return topk_seq, topk_log_probs, topk_ids, new_cache, new_indirect_cache
 
         def _get_new_alive_state(new_seq, new_log_probs, new_finished_flags,
                                  new_cache):
@@ -211,6 +283,8 @@ class SequenceBeamSearch(tf.Module):
                  Log probabilities of top alive sequences
                  Dict cache storing decoder states for top alive sequences}
             """
+            batch_size = tf.shape(new_seq)[0]
+
             # To prevent finished sequences from being considered, set log probs to
             # -inf.
             new_log_probs += tf.cast(new_finished_flags,
@@ -220,11 +294,15 @@ class SequenceBeamSearch(tf.Module):
                 [new_seq, new_log_probs, new_cache], new_log_probs, batch_size,
                 self.beam_size)
 
-            return {
+            alive_state = {
                 _StateKeys.ALIVE_SEQ: top_alive_seq,
                 _StateKeys.ALIVE_LOG_PROBS: top_alive_log_probs,
                 _StateKeys.ALIVE_CACHE: top_alive_cache
             }
+            if self.indirect_cache_keys:
+                alive_state[_StateKeys.CACHE_INDIRECTION] = top_alive_cache.pop(
+                    CACHE_INDIRECTION)
+            return alive_state
 
         def _get_new_finished_state(state, new_seq, new_log_probs,
                                     new_finished_flags):
@@ -249,13 +327,16 @@ class SequenceBeamSearch(tf.Module):
             finished_seq = state[_StateKeys.FINISHED_SEQ]
             finished_scores = state[_StateKeys.FINISHED_SCORES]
             finished_flags = state[_StateKeys.FINISHED_FLAGS]
+            batch_size = tf.shape(finished_seq)[0]
 
             # First append a column of 0-ids to finished_seq to increment the length.
             # New shape of finished_seq: [batch_size, beam_size, i + 1]
-            finished_seq = tf.concat(
-                [finished_seq,
-                 tf.zeros([batch_size, self.beam_size, 1], tf.int32)],
-                axis=2)
+            # padded_decode 时 finished_seq 已经是最大长度
+            if not self.padded_decode:
+                finished_seq = tf.concat(
+                    [finished_seq,
+                     tf.zeros([batch_size, self.beam_size, 1], tf.int32)],
+                    axis=2)
 
             # Calculate new seq scores from log probabilities.
             length_norm = _length_normalization(self.alpha, i + 1, dtype=self.dtype)
@@ -300,7 +381,8 @@ class SequenceBeamSearch(tf.Module):
               new state dictionary.
             """
             # 解码下一个 token
-            new_seq, new_log_probs, topk_ids, new_cache = _grow_alive_seq(state)
+            new_seq, new_log_probs, topk_ids, new_cache, new_indirect_cache = (
+                _grow_alive_seq(state))
 
             # 更新状态
             new_finished_flags = tf.equal(topk_ids, self.eos_id)
@@ -317,6 +399,18 @@ class SequenceBeamSearch(tf.Module):
             new_state = {_StateKeys.CUR_INDEX: state[_StateKeys.CUR_INDEX] + 1}
             new_state.update(alive_state)
             new_state.update(finished_state)
+            if self.shared_cache_keys:
+                new_state[_StateKeys.SHARED_CACHE] = state[_StateKeys.SHARED_CACHE]
+            if self.indirect_cache_keys:
+                new_state[_StateKeys.INDIRECT_CACHE] = new_indirect_cache
+                # 下一步第 j 个 beam 将自己的内容写入第 j 行
+                new_state[_StateKeys.CACHE_INDIRECTION] = _set_cache_indirection(
+                    new_state[_StateKeys.CACHE_INDIRECTION], new_state[_StateKeys.CUR_INDEX])
+            if self.compact_finished_batches:
+                new_state[_StateKeys.BATCH_INDEX] = state[_StateKeys.BATCH_INDEX]
+                new_state[_StateKeys.RESULT_SEQ] = state[_StateKeys.RESULT_SEQ]
+                new_state[_StateKeys.RESULT_SCORES] = state[_StateKeys.RESULT_SCORES]
+                new_state = self._compact_finished_batches(new_state)
             return [new_state]
 
         finished_state = tf.nest.map_structure(
@@ -330,8 +424,78 @@ class SequenceBeamSearch(tf.Module):
             )
         )
         finished_state = finished_state[0]
+        if self.compact_finished_batches:
+            return self._process_compacted_state(finished_state)
         return self._process_finished_state(finished_state)
 
+    def _compact_finished_batches(self, state):
+        """
+            将已经结束的 batch item 的结果写入 RESULT_SEQ / RESULT_SCORES
+            并从 alive state、finished state 和 cache 中移除
+        """
+        batch_finished = self._batch_finished(state)
+        finished_indices = tf.where(batch_finished)[:, 0]
+        alive_indices = tf.where(tf.logical_not(batch_finished))[:, 0]
+
+        state = self._write_results(state, finished_indices)
+
+        keys = [_StateKeys.ALIVE_SEQ, _StateKeys.ALIVE_LOG_PROBS, _StateKeys.ALIVE_CACHE,
+                _StateKeys.FINISHED_SEQ, _StateKeys.FINISHED_SCORES, _StateKeys.FINISHED_FLAGS,
+                _StateKeys.BATCH_INDEX]
+        if self.indirect_cache_keys:
+            keys += [_StateKeys.INDIRECT_CACHE, _StateKeys.CACHE_INDIRECTION]
+        if self.shared_cache_keys:
+            keys.append(_StateKeys.SHARED_CACHE)
+        for key in keys:
+            state[key] = tf.nest.map_structure(
+                lambda t: tf.gather(t, alive_indices), state[key]
+            )
+        return state
+
+    def _write_results(self, state, indices):
+        """
+            将 indices 对应的 batch item 的最终结果按原始位置写入结果缓冲区
+
+        :param indices: 当前 state 中需要写入结果的 batch item 下标
+        """
+        rows = {
+            key: tf.gather(state[key], indices)
+            for key in [_StateKeys.ALIVE_SEQ, _StateKeys.ALIVE_LOG_PROBS, _StateKeys.FINISHED_SEQ,
+                        _StateKeys.FINISHED_SCORES, _StateKeys.FINISHED_FLAGS]
+        }
+        seq, scores = self._process_finished_state(rows)
+
+        # 补齐到 max_decode_length + 1，之后补齐的部分会被截掉
+        seq = tf.pad(
+            seq, [[0, 0], [0, 0], [0, self.max_decode_length + 1 - tf.shape(seq)[2]]]
+        )
+
+        # (num_rows, 1)
+        positions = tf.expand_dims(tf.gather(state[_StateKeys.BATCH_INDEX], indices), axis=1)
+
+        state = dict(state)
+        state[_StateKeys.RESULT_SEQ] = tf.tensor_scatter_nd_update(
+            state[_StateKeys.RESULT_SEQ], positions, seq
+        )
+        state[_StateKeys.RESULT_SCORES] = tf.tensor_scatter_nd_update(
+            state[_StateKeys.RESULT_SCORES], positions, scores
+        )
+        return state
+
+    def _process_compacted_state(self, finished_state):
+        """写入达到最大长度时仍未结束的 batch item，并截掉结果中补齐的部分"""
+        remaining = tf.range(tf.shape(finished_state[_StateKeys.BATCH_INDEX])[0])
+        finished_state = self._write_results(finished_state, remaining)
+
+        if self.padded_decode:
+            # 与不移除 batch item 时相同，保持 max_decode_length + 1 的长度
+            return finished_state[_StateKeys.RESULT_SEQ], finished_state[_StateKeys.RESULT_SCORES]
+        i = finished_state[_StateKeys.CUR_INDEX]
+        return (
+            finished_state[_StateKeys.RESULT_SEQ][:, :, :i + 1],
+            finished_state[_StateKeys.RESULT_SCORES]
+        )
+
     def _process_finished_state(self, finished_state):
         alive_seq = finished_state[_StateKeys.ALIVE_SEQ]
         alive_log_probs = finished_state[_StateKeys.ALIVE_LOG_PROBS]
@@ -359,11 +523,12 @@ class SequenceBeamSearch(tf.Module):
         """
         for key, value in initial_cache.items():
             for inner_value in tf.nest.flatten(value):
-                if inner_value.dtype != self.dtype:
+                # 量化的 cache 等整数类型的项不做检查
+                if inner_value.dtype.is_floating and inner_value.dtype != self.dtype:
                     raise TypeError(
                         "initial_cache element for key '%s' has dtype %s that does not "
                         "match SequenceBeamSearch's dtype of %s. Value: %s" %
-                        (key, value.dtype.name, self.dtype.name, inner_value))
+                        (key, inner_value.dtype.name, self.dtype.name, inner_value))
 
         # Current loop index (starts at 0)
         cur_index = tf.constant(0)
@@ -374,6 +539,9 @@ class SequenceBeamSearch(tf.Module):
         # (batch_size, beam_size, 1, 1)
         # 增加一维表示 TODO
         alive_seq = tf.expand_dims(alive_seq, axis=2)
+        if self.padded_decode:
+            # (batch_size, beam_size, max_decode_length + 1)
+            alive_seq = tf.pad(alive_seq, [[0, 0], [0, 0], [0, self.max_decode_length]])
 
         # Create tensor for storing initial log probabilities.
         # Assume initial_ids are prob 1.0
@@ -385,12 +553,25 @@ class SequenceBeamSearch(tf.Module):
         # (batch_size, beam_size)
         alive_log_probs = tf.tile(initial_log_probs, [batch_size, 1])
 
+        shared_cache = None
+        if self.shared_cache_keys:
+            # 共用的部分不扩展 beam 维度
+            initial_cache, shared_cache = _split_cache(initial_cache, self.shared_cache_keys)
+
         # Expand all values stored in the dictionary to the beam size, so that each
         # beam has a separate cache.
         alive_cache = tf.nest.map_structure(
             # (batch_size, decoded_len, num_heads, size) -> (batch_size, beam_size, decoded_len, num_heads, size)
             lambda t: _expand_to_beam_size(t, self.beam_size), initial_cache)
 
+        if self.padded_decode:
+            cache_shape_fn = _get_known_shape
+        else:
+            cache_shape_fn = _get_shape_keep_last_dim
+        if self.compact_finished_batches:
+            # batch_size 会随解码而减小
+            cache_shape_fn = _with_unknown_batch_dim(cache_shape_fn)
+
         # Initialize tensor storing finished sequences with filler values.
         # (batch_size, beam_size, 1, 1)
         finished_seq = tf.zeros(tf.shape(alive_seq), tf.int32)
@@ -415,22 +596,63 @@ class SequenceBeamSearch(tf.Module):
             _StateKeys.FINISHED_FLAGS: finished_flags
         }
 
-        state_shape_invariants = {
-            _StateKeys.CUR_INDEX:
-                tf.TensorShape([]),
-            _StateKeys.ALIVE_SEQ:
-                tf.TensorShape([None, self.beam_size, None]),
-            _StateKeys.ALIVE_LOG_PROBS:
-                tf.TensorShape([None, self.beam_size]),
-            _StateKeys.ALIVE_CACHE:
-                tf.nest.map_structure(_get_shape_keep_last_dim, alive_cache),
-            _StateKeys.FINISHED_SEQ:
-                tf.TensorShape([None, self.beam_size, None]),
-            _StateKeys.FINISHED_SCORES:
-                tf.TensorShape([None, self.beam_size]),
-            _StateKeys.FINISHED_FLAGS:
-                tf.TensorShape([None, self.beam_size])
-        }
+        if self.shared_cache_keys:
+            state[_StateKeys.SHARED_CACHE] = shared_cache
+        if self.indirect_cache_keys:
+            alive_cache, indirect_cache = _split_cache(alive_cache, self.indirect_cache_keys)
+            state[_StateKeys.ALIVE_CACHE] = alive_cache
+            state[_StateKeys.INDIRECT_CACHE] = indirect_cache
+            # 初始时每个 beam 都从自己的行读取
+            # (batch_size, beam_size, max_decode_length)
+            state[_StateKeys.CACHE_INDIRECTION] = tf.tile(
+                tf.range(self.beam_size)[tf.newaxis, :, tf.newaxis],
+                [batch_size, 1, self.max_decode_length]
+            )
+
+        if self.padded_decode and not self.compact_finished_batches:
+            # 所有 state 的形状在解码过程中保持不变
+            state_shape_invariants = tf.nest.map_structure(_get_known_shape, state)
+        else:
+            state_shape_invariants = {
+                _StateKeys.CUR_INDEX:
+                    tf.TensorShape([]),
+                _StateKeys.ALIVE_SEQ:
+                    tf.TensorShape([None, self.beam_size, None]),
+                _StateKeys.ALIVE_LOG_PROBS:
+                    tf.TensorShape([None, self.beam_size]),
+                _StateKeys.ALIVE_CACHE:
+                    tf.nest.map_structure(cache_shape_fn, alive_cache),
+                _StateKeys.FINISHED_SEQ:
+                    tf.TensorShape([None, self.beam_size, None]),
+                _StateKeys.FINISHED_SCORES:
+                    tf.TensorShape([None, self.beam_size]),
+                _StateKeys.FINISHED_FLAGS:
+                    tf.TensorShape([None, self.beam_size])
+            }
+            if self.shared_cache_keys:
+                state_shape_invariants[_StateKeys.SHARED_CACHE] = tf.nest.map_structure(
+                    cache_shape_fn, shared_cache)
+            if self.indirect_cache_keys:
+                state_shape_invariants.update({
+                    _StateKeys.INDIRECT_CACHE:
+                        tf.nest.map_structure(cache_shape_fn, state[_StateKeys.INDIRECT_CACHE]),
+                    _StateKeys.CACHE_INDIRECTION:
+                        tf.TensorShape([None, self.beam_size, self.max_decode_length])
+                })
+
+        if self.compact_finished_batches:
+            state.update({
+                _StateKeys.BATCH_INDEX: tf.range(batch_size, dtype=tf.int64),
+                _StateKeys.RESULT_SEQ: tf.zeros(
+                    [batch_size, self.beam_size, self.max_decode_length + 1], tf.int32
+                ),
+                _StateKeys.RESULT_SCORES: tf.zeros([batch_size, self.beam_size], self.dtype)
+            })
+            state_shape_invariants.update({
+                _StateKeys.BATCH_INDEX: tf.TensorShape([None]),
+                _StateKeys.RESULT_SEQ: tf.TensorShape([None, self.beam_size, None]),
+                _StateKeys.RESULT_SCORES: tf.TensorShape([None, self.beam_size])
+            })
 
         return state, state_shape_invariants
 
@@ -451,12 +673,29 @@ class SequenceBeamSearch(tf.Module):
           terminate.
         """
         i = state[_StateKeys.CUR_INDEX]
+
+        not_at_max_decode_length = tf.less(i, self.max_decode_length)
+
+        # 开启 compact_finished_batches 时已结束的 batch item 已被移除
+        # 所有 batch item 都被移除后 reduce_all 为 True，循环结束
+        worst_finished_score_better_than_best_alive_score = tf.reduce_all(
+            self._batch_finished(state))
+
+        return tf.logical_and(
+            not_at_max_decode_length,
+            tf.logical_not(worst_finished_score_better_than_best_alive_score))
+
+    def _batch_finished(self, state):
+        """
+            每个 batch item 是否已经结束：
+            finished 序列中得分最低的也比 alive 序列中得分最高的可能得分要好
+
+        :return: bool tensor, shape [batch_size]
+        """
         alive_log_probs = state[_StateKeys.ALIVE_LOG_PROBS]
         finished_scores = state[_StateKeys.FINISHED_SCORES]
         finished_flags = state[_StateKeys.FINISHED_FLAGS]
 
-        not_at_max_decode_length = tf.less(i, self.max_decode_length)
-
         # Calculate largest length penalty (the larger penalty, the better score).
         max_length_norm = _length_normalization(
             self.alpha, self.max_decode_length, dtype=self.dtype)
@@ -474,12 +713,7 @@ class SequenceBeamSearch(tf.Module):
                 (1.0 - tf.cast(finished_batches, self.dtype)) * -inf(self.dtype)
         )
 
-        worst_finished_score_better_than_best_alive_score = tf.reduce_all(
-            tf.greater(lowest_finished_scores, best_alive_scores))
-
-        return tf.logical_and(
-            not_at_max_decode_length,
-            tf.logical_not(worst_finished_score_better_than_best_alive_score))
+        return tf.greater(lowest_finished_scores, best_alive_scores)
 
 
 def sequence_beam_search(
@@ -491,10 +725,16 @@ def sequence_beam_search(
         alpha,
         max_decode_length,
         eos_id,
+        padded_decode=False,
+        compact_finished_batches=False,
+        indirect_cache_keys=None,
+        shared_cache_keys=None,
         dtype="float32"
 ):
     sbs = SequenceBeamSearch(decode_next_logits_fn, vocab_size, beam_size, alpha,
-                             max_decode_length, eos_id, dtype)
+                             max_decode_length, eos_id, padded_decode,
+                             compact_finished_batches, indirect_cache_keys,
+                             shared_cache_keys, dtype)
     return sbs.search(initial_ids, initial_cache)
 
 
@@ -502,6 +742,84 @@ def _log_prob_from_logits(logits):
     return logits - tf.reduce_logsumexp(logits, axis=2, keepdims=True)
 
 
+def _log_normalizer(logits, chunk_size=_LOG_NORMALIZER_CHUNK_SIZE):
+    """
+        log softmax 的归一化项 logsumexp(logits)，计算为 max + log(sum(exp(logits - max)))
+
+        sum(exp(logits - max)) 在 vocab 上按块依次累加，临时张量只有 (batch_size, beam_size, chunk_size)
+        不会生成与 logits 同样大小的 exp(logits - max)
+        每一块的大小固定 (最后一块与前一块重叠，重叠部分不计入)，可以使用 XLA 编译
+
+    :param logits: (batch_size, beam_size, vocab_size)
+    :return: (batch_size, beam_size, 1)
+    """
+    batch_size, beam_size, vocab_size = _shape_list(logits)
+    if isinstance(vocab_size, int):
+        chunk_size = min(chunk_size, vocab_size)
+    else:
+        chunk_size = tf.minimum(chunk_size, vocab_size)
+    num_chunks = (vocab_size + chunk_size - 1) // chunk_size
+
+    # (batch_size, beam_size, 1)
+    max_logits = tf.reduce_max(logits, axis=2, keepdims=True)
+
+    def body(i, sum_exp):
+        chunk_start = i * chunk_size
+        start = tf.minimum(chunk_start, vocab_size - chunk_size)
+        # (batch_size, beam_size, chunk_size)
+        exp_logits = tf.exp(tf.slice(logits, [0, 0, start], [batch_size, beam_size, chunk_size]) - max_logits)
+        is_new = tf.cast(start + tf.range(chunk_size) >= chunk_start, logits.dtype)
+        return i + 1, sum_exp + tf.reduce_sum(exp_logits * is_new, axis=2, keepdims=True)
+
+    # parallel_iterations=1 保证同一时间只有一块的临时张量
+    _, sum_exp = tf.while_loop(
+        lambda i, _: i < num_chunks,
+        body,
+        loop_vars=(tf.constant(0), tf.zeros_like(max_logits)),
+        parallel_iterations=1
+    )
+    return max_logits + tf.math.log(sum_exp)
+
+
+def _two_stage_top_k(logits, alive_log_probs, k):
+    """
+        从 beam_size * vocab_size 个候选中选出 log probability 最大的 k 个
+
+        第一阶段在每个 beam 内部对 vocab 取 top k (vocab_size 小于 k 时取全部)，第二阶段在这些候选中取 top k
+        全局的 top k 一定包含在各个 beam 的 top k 中，因此结果与直接在全部候选上取 top k 相同
+        归一化只需要每个 beam 的 logsumexp (见 _log_normalizer)，只对选出的候选计算 log probability
+
+    :param logits: (batch_size, beam_size, vocab_size)
+    :param alive_log_probs: (batch_size, beam_size)
+    :param k: 需要的候选数
+    :return: topk_log_probs: (batch_size, k)
+             topk_indices: (batch_size, k)，在 beam_size * vocab_size 上的下标，与直接取 top k 时一致
+    """
+    shape = _shape_list(logits)
+    beam_size, vocab_size = shape[1], shape[2]
+    # 每个 beam 内的候选数，vocab_size 只在运行时已知时 (例如 lexical shortlist) 为 tensor
+    beam_k = min(k, vocab_size) if isinstance(vocab_size, int) else tf.minimum(k, vocab_size)
+
+    # (batch_size, beam_size, beam_k)
+    beam_topk_logits, beam_topk_ids = tf.nn.top_k(logits, k=beam_k)
+    # (batch_size, beam_size, 1)
+    log_normalizer = _log_normalizer(logits)
+    beam_topk_log_probs = (
+            beam_topk_logits - log_normalizer + tf.expand_dims(alive_log_probs, axis=2)
+    )
+
+    # (batch_size, beam_size * beam_k)
+    flat_log_probs = tf.reshape(beam_topk_log_probs, [-1, beam_size * beam_k])
+    topk_log_probs, candidate_indices = tf.nn.top_k(flat_log_probs, k=k)
+
+    # 将候选下标映射回 beam_size * vocab_size 上的下标
+    topk_ids = tf.gather(
+        tf.reshape(beam_topk_ids, [-1, beam_size * beam_k]), candidate_indices, batch_dims=1
+    )
+    topk_indices = candidate_indices // beam_k * vocab_size + topk_ids
+    return topk_log_probs, topk_indices
+
+
 def _length_normalization(alpha, length, dtype=tf.float32):
     return tf.pow(((5. + tf.cast(length, dtype)) / 6.), alpha)
 
@@ -536,6 +854,68 @@ def _get_shape_keep_last_dim(tensor):
     return tf.TensorShape(shape_list)
 
 
+def _get_known_shape(tensor):
+    """Returns the static shape of tensor, unknown dims are left as None.
+
+    Used as shape invariant for preallocated caches, whose shape never changes
+    during decoding.
+    """
+    return tf.TensorShape(tensor.shape)
+
+
+def _with_unknown_batch_dim(shape_fn):
+    """Wraps shape_fn so that the returned shape has an unknown batch dim."""
+    def _shape_fn(tensor):
+        return tf.TensorShape([None]).concatenate(shape_fn(tensor)[1:])
+    return _shape_fn
+
+
+def _split_cache(cache, keys):
+    """
+        将 cache 中名字在 keys 中的项单独取出，cache 为 {name: tensor or dict} 的嵌套字典
+
+    :return: (其余的项, keys 中的项)，两者结构与 cache 相同，不包含空的字典
+    """
+    rest, selected = {}, {}
+    for name, value in cache.items():
+        if isinstance(value, dict):
+            value_rest, value_selected = _split_cache(value, keys)
+            if value_rest:
+                rest[name] = value_rest
+            if value_selected:
+                selected[name] = value_selected
+        elif name in keys:
+            selected[name] = value
+        else:
+            rest[name] = value
+    return rest, selected
+
+
+def _merge_cache(cache, other):
+    """_split_cache 的逆操作"""
+    merged = dict(cache)
+    for name, value in other.items():
+        if isinstance(value, dict):
+            merged[name] = _merge_cache(merged.get(name, {}), value)
+        else:
+            merged[name] = value
+    return merged
+
+
+def _set_cache_indirection(cache_indirection, i):
+    """
+        第 i 个位置的内容由每个 beam 自己写入，backpointer 指向自己所在的行
+
+    :param cache_indirection: [batch_size, beam_size, max_decode_length]
+    """
+    batch_size, beam_size, max_decode_length = _shape_list(cache_indirection)
+    is_current = tf.equal(tf.range(max_decode_length), i)[tf.newaxis, tf.newaxis, :]
+    own_rows = tf.broadcast_to(
+        tf.range(beam_size)[tf.newaxis, :, tf.newaxis], [batch_size, beam_size, max_decode_length]
+    )
+    return tf.where(is_current, own_rows, cache_indirection)
+
+
 def _get_shape(tensor):
     return tf.TensorShape(_shape_list(tensor))
 
@@ -0,0 +1,293 @@
+# -*- coding: utf - 8 -*-
+
+"""
+    贪心解码以及 top-k / top-p / temperature 采样解码
+
+    与 beam_search.SequenceBeamSearch 使用相同的 symbols_to_logits_fn 和 cache 约定：
+        symbols_to_logits_fn(ids, i, cache) -> (logits, cache)
+            ids: (batch_size, i + 1)
+            i: 当前解码步
+            logits: (batch_size, vocab_size)
+
+    每一步只需要一次 decoder 前向计算，没有 beam 维度，也不需要对 cache 做 gather
+    适合对延迟要求较高的场景
+"""
+
+import tensorflow as tf
+from ops import beam_search
+
+
+class _StateKeys(object):
+    """解码循环中 state 字典的 key"""
+
+    # 当前解码步
+    CUR_INDEX = "CUR_INDEX"
+
+    # 已解码的序列，shape: (batch_size, CUR_INDEX + 1)
+    # 已结束的序列在 EOS 之后用 0 填充
+    ALIVE_SEQ = "ALIVE_SEQ"
+
+    # 已解码序列的 log probability 之和，shape: (batch_size,)
+    ALIVE_LOG_PROBS = "ALIVE_LOG_PROBS"
+
+    # symbols_to_logits_fn 使用的 cache
+    ALIVE_CACHE = "ALIVE_CACHE"
+
+    # 序列是否已经解码出 EOS，shape: (batch_size,)
+    FINISHED_FLAGS = "FINISHED_FLAGS"
+
+
+def sample_top_k(logits, top_k, dtype=tf.float32):
+    """
+        只保留每一行中最大的 top_k 个 logits，其余位置设置为一个很小的值
+
+    :param logits: (batch_size, vocab_size)
+    :param top_k: int, <= 0 时不做处理
+    :return: (batch_size, vocab_size)
+    """
+    if top_k <= 0:
+        return logits
+    top_k_logits = tf.math.top_k(logits, k=top_k).values
+    min_logits = top_k_logits[:, -1:]
+    return tf.where(
+        logits < min_logits,
+        tf.ones_like(logits) * -beam_search.inf(dtype),
+        logits
+    )
+
+
+def sample_top_p(logits, top_p, dtype=tf.float32):
+    """
+        nucleus sampling: 只保留累积概率达到 top_p 的最小 token 集合
+
+    :param logits: (batch_size, vocab_size)
+    :param top_p: float, >= 1.0 时不做处理
+    :return: (batch_size, vocab_size)
+    """
+    if top_p >= 1.0:
+        return logits
+
+    # 按 logits 从大到小排序
+    sorted_indices = tf.argsort(logits, direction='DESCENDING')
+    sorted_logits = tf.gather(logits, sorted_indices, batch_dims=1)
+
+    # exclusive 累积概率，保证概率最大的 token 一定会被保留
+    cumulative_probs = tf.math.cumsum(
+        tf.nn.softmax(sorted_logits, axis=-1), axis=-1, exclusive=True
+    )
+    sorted_logits = tf.where(
+        cumulative_probs > top_p,
+        tf.ones_like(sorted_logits) * -beam_search.inf(dtype),
+        sorted_logits
+    )
+
+    # 恢复原来的顺序
+    return tf.gather(sorted_logits, tf.argsort(sorted_indices), batch_dims=1)
+
+
+class SequenceSampler(tf.Module):
+    """
+        逐 token 的自回归解码
+
+        greedy 为 True 时每一步取概率最大的 token
+        否则先用 temperature 缩放 logits，再经过 top_k / top_p 过滤后进行采样
+    """
+
+    def __init__(self,
+                 symbols_to_logits_fn,
+                 max_decode_length,
+                 eos_id,
+                 greedy=True,
+                 top_k=0,
+                 top_p=1.0,
+                 temperature=1.0,
+                 padded_decode=False,
+                 seed=None,
+                 dtype=tf.float32):
+        """
+        :param greedy: 是否使用贪心解码，为 True 时忽略 top_k / top_p / temperature
+        :param top_k: 采样时只考虑概率最大的 top_k 个 token，<= 0 表示不限制
+        :param top_p: 采样时只考虑累积概率达到 top_p 的 token，>= 1.0 表示不限制
+        :param temperature: 采样前 logits 除以 temperature
+        :param padded_decode: 是否使用固定形状的解码，详见 SequenceBeamSearch
+            ALIVE_SEQ 预分配为 (batch_size, max_decode_length + 1)，每一步按下标写入
+        :param seed: 采样的随机种子
+        """
+        if not greedy and temperature <= 0:
+            raise ValueError('temperature must be positive when sampling, got %s' % temperature)
+
+        self.symbols_to_logits_fn = symbols_to_logits_fn
+        self.max_decode_length = max_decode_length
+        self.eos_id = eos_id
+        self.greedy = greedy
+        self.top_k = top_k
+        self.top_p = top_p
+        self.temperature = temperature
+        self.padded_decode = padded_decode
+        self.seed = seed
+        self.dtype = tf.as_dtype(dtype)
+
+    def search(self, initial_ids, initial_cache):
+        """
+        :param initial_ids: (batch_size,)
+        :param initial_cache: {'key': key, 'value': value, ...}
+        :return: decoded_ids: (batch_size, 1, decoded_len + 1)
+                 scores: (batch_size, 1)
+                 与 sequence_beam_search 保持一致，带有大小为 1 的 beam 维度
+        """
+        state, state_shapes = self._create_initial_state(initial_ids, initial_cache)
+
+        def _search_step(state):
+            i = state[_StateKeys.CUR_INDEX]
+            alive_seq = state[_StateKeys.ALIVE_SEQ]
+            alive_log_probs = state[_StateKeys.ALIVE_LOG_PROBS]
+            alive_cache = state[_StateKeys.ALIVE_CACHE]
+            finished_flags = state[_StateKeys.FINISHED_FLAGS]
+
+            if self.padded_decode:
+                # 只取出当前位置的 ids，(batch_size, 1)
+                ids = tf.slice(alive_seq, [0, i], [tf.shape(alive_seq)[0], 1])
+            else:
+                ids = alive_seq
+
+            # (batch_size, vocab_size)
+            logits, new_cache = self.symbols_to_logits_fn(ids, i, alive_cache)
+            logits = tf.cast(logits, self.dtype)
+
+            next_ids = self._sample_next_ids(logits)
+
+            # 已经结束的序列之后只填充 0，且不再累加 log probability
+            next_ids = tf.where(finished_flags, tf.zeros_like(next_ids), next_ids)
+            log_probs = tf.nn.log_softmax(logits, axis=-1)
+            next_log_probs = tf.gather(log_probs, next_ids, batch_dims=1)
+            next_log_probs = tf.where(
+                finished_flags, tf.zeros_like(next_log_probs), next_log_probs
+            )
+
+            if self.padded_decode:
+                # 写入第 i + 1 个位置
+                alive_seq = tf.transpose(tf.tensor_scatter_nd_update(
+                    tf.transpose(alive_seq), [[i + 1]], tf.expand_dims(next_ids, axis=0)
+                ))
+            else:
+                alive_seq = tf.concat([alive_seq, tf.expand_dims(next_ids, axis=1)], axis=1)
+
+            new_state = {
+                _StateKeys.CUR_INDEX: i + 1,
+                _StateKeys.ALIVE_SEQ: alive_seq,
+                _StateKeys.ALIVE_LOG_PROBS: alive_log_probs + next_log_probs,
+                _StateKeys.ALIVE_CACHE: new_cache,
+                _StateKeys.FINISHED_FLAGS: tf.logical_or(
+                    finished_flags, tf.equal(next_ids, self.eos_id)
+                )
+            }
+            return [new_state]
+
+        finished_state = tf.nest.map_structure(
+            tf.stop_gradient,
+            tf.while_loop(
+                self._continue_search,
+                _search_step,
+                loop_vars=[state],
+                shape_invariants=[state_shapes],
+                parallel_iterations=1
+            )
+        )
+        finished_state = finished_state[0]
+
+        decoded_ids = tf.expand_dims(finished_state[_StateKeys.ALIVE_SEQ], axis=1)
+        scores = tf.expand_dims(finished_state[_StateKeys.ALIVE_LOG_PROBS], axis=1)
+        return decoded_ids, scores
+
+    def _sample_next_ids(self, logits):
+        """
+        :param logits: (batch_size, vocab_size)
+        :return: (batch_size,)
+        """
+        if self.greedy:
+            return tf.argmax(logits, axis=-1, output_type=tf.int32)
+
+        logits = logits / tf.cast(self.temperature, self.dtype)
+        logits = sample_top_k(logits, self.top_k, self.dtype)
+        logits = sample_top_p(logits, self.top_p, self.dtype)
+        next_ids = tf.random.categorical(logits, num_samples=1, dtype=tf.int32, seed=self.seed)
+        return tf.squeeze(next_ids, axis=1)
+
+    def _create_initial_state(self, initial_ids, initial_cache):
+        batch_size = tf.shape(initial_ids)[0]
+
+        # (batch_size, 1)
+        alive_seq = tf.expand_dims(initial_ids, axis=1)
+        if self.padded_decode:
+            # (batch_size, max_decode_length + 1)
+            alive_seq = tf.pad(alive_seq, [[0, 0], [0, self.max_decode_length]])
+
+        state = {
+            _StateKeys.CUR_INDEX: tf.constant(0),
+            _StateKeys.ALIVE_SEQ: alive_seq,
+            _StateKeys.ALIVE_LOG_PROBS: tf.zeros([batch_size], dtype=self.dtype),
+            _StateKeys.ALIVE_CACHE: initial_cache,
+            _StateKeys.FINISHED_FLAGS: tf.zeros([batch_size], tf.bool)
+        }
+
+        if self.padded_decode:
+            # 所有 state 的形状在解码过程中保持不变
+            return state, tf.nest.map_structure(beam_search._get_known_shape, state)
+
+        state_shape_invariants = {
+            _StateKeys.CUR_INDEX: tf.TensorShape([]),
+            _StateKeys.ALIVE_SEQ: tf.TensorShape([None, None]),
+            _StateKeys.ALIVE_LOG_PROBS: tf.TensorShape([None]),
+            _StateKeys.ALIVE_CACHE: tf.nest.map_structure(
+                beam_search._get_shape_keep_last_dim, initial_cache
+            ),
+            _StateKeys.FINISHED_FLAGS: tf.TensorShape([None])
+        }
+
+        return state, state_shape_invariants
+
+    def _continue_search(self, state):
+        """解码到最大长度或者所有序列都已经结束时停止"""
+        i = state[_StateKeys.CUR_INDEX]
+        finished_flags = state[_StateKeys.FINISHED_FLAGS]
+        return tf.logical_and(
+            tf.less(i, self.max_decode_length),
+            tf.logical_not(tf.reduce_all(finished_flags))
+        )
+
+
+def sequence_greedy_search(
+        decode_next_logits_fn,
+        initial_ids,
+        initial_cache,
+        max_decode_length,
+        eos_id,
+        padded_decode=False,
+        dtype="float32"
+):
+    sampler = SequenceSampler(
+        decode_next_logits_fn, max_decode_length, eos_id,
+        greedy=True, padded_decode=padded_decode, dtype=dtype
+    )
+    return sampler.search(initial_ids, initial_cache)
+
+
+def sequence_sampling_search(
+        decode_next_logits_fn,
+        initial_ids,
+        initial_cache,
+        max_decode_length,
+        eos_id,
+        top_k=0,
+        top_p=1.0,
+        temperature=1.0,
+        padded_decode=False,
+        seed=None,
+        dtype="float32"
+):
+    sampler = SequenceSampler(
+        decode_next_logits_fn, max_decode_length, eos_id,
+        greedy=False, top_k=top_k, top_p=top_p, temperature=temperature,
+        padded_decode=padded_decode, seed=seed, dtype=dtype
+    )
+    return sampler.search(initial_ids, initial_cache)
@@ -0,0 +1,59 @@
+# -*- coding: utf - 8 -*-
+
+"""
+    对比 beam search 单步选取候选的两种方式在不同词表大小下的延迟和峰值内存
+
+    1. full: 对全部 logits 做 log_softmax，reshape 为 (batch_size, beam_size * vocab_size) 后取 top k
+    2. two_stage: 先在每个 beam 内取 top k，再在 beam_size * k 个候选中取 top k，
+       归一化项按 vocab 分块累加 (见 beam_search._log_normalizer)
+
+    峰值内存取自 run_op_benchmark 报告的 allocator_maximum_num_bytes_*，包括 logits 本身
+    full 还需要一个与 logits 同样大小的 log probability，two_stage 只需要一块 (batch_size, beam_size, chunk_size) 的临时张量
+
+    运行方式：
+        python -m ops.test.beam_search_benchmark --benchmarks=.
+"""
+
+import tensorflow as tf
+from ops import beam_search
+
+_BATCH_SIZE = 32
+_BEAM_SIZE = 4
+_VOCAB_SIZES = (8000, 16000, 33000, 64000)
+_NUM_ITERS = 50
+
+
+def _full_top_k(logits, alive_log_probs, k):
+    """beam search 原来的做法，作为对照"""
+    vocab_size = logits.shape[2]
+    log_probs = beam_search._log_prob_from_logits(logits) + tf.expand_dims(alive_log_probs, axis=2)
+    flat_log_probs = tf.reshape(log_probs, [-1, _BEAM_SIZE * vocab_size])
+    return tf.nn.top_k(flat_log_probs, k=k)
+
+
+class BeamSearchTopKBenchmark(tf.test.Benchmark):
+
+    def _run_benchmark(self, top_k_fn, mode):
+        for vocab_size in _VOCAB_SIZES:
+            with tf.Graph().as_default(), tf.compat.v1.Session() as sess:
+                logits = tf.Variable(tf.random.normal([_BATCH_SIZE, _BEAM_SIZE, vocab_size]))
+                alive_log_probs = tf.Variable(tf.random.normal([_BATCH_SIZE, _BEAM_SIZE]))
+                topk_log_probs, topk_indices = top_k_fn(logits, alive_log_probs, 2 * _BEAM_SIZE)
+                sess.run(tf.compat.v1.global_variables_initializer())
+
+                self.run_op_benchmark(
+                    sess,
+                    [topk_log_probs, topk_indices],
+                    min_iters=_NUM_ITERS,
+                    name='beam_search_top_k_%s_vocab_%d' % (mode, vocab_size)
+                )
+
+    def benchmark_full_top_k(self):
+        self._run_benchmark(_full_top_k, 'full')
+
+    def benchmark_two_stage_top_k(self):
+        self._run_benchmark(beam_search._two_stage_top_k, 'two_stage')
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -0,0 +1,137 @@
+# -*- coding: utf - 8 -*-
+
+"""
+    对比 beam search 时 float 与 int8 量化的 self attention cache
+
+    与 test_beam_search 相同，直接调用 sequence_beam_search，symbols_to_logits_fn 为随机初始化的 decoder
+    cache 为预分配模式，报告：
+        1. tokens_per_second: 解码吞吐
+        2. cache_mb: 所有层 self attention cache (包括 scale) 占用的内存
+        3. exact_match: 最优序列与 float cache 完全一致的比例 (只在 int8 时报告)
+        4. score_abs_diff: 最优序列得分与 float cache 的平均绝对误差 (只在 int8 时报告)
+
+    运行方式：
+        python -m ops.test.quantized_cache_benchmark --benchmarks=.
+"""
+
+import time
+import numpy as np
+import tensorflow as tf
+from layers import utils
+from layers.attention_layers import multi_head_attention_layer
+from layers.embedding_layers.word_embedding_layer import WordEmbedding
+from layers.transformer_layers.decoder_stack import TransformerDecoderStack
+from ops import beam_search
+
+_BATCH_SIZES = (16, 64)
+_BEAM_SIZE = 4
+_DECODE_LEN = 64
+_INPUTS_LEN = 32
+_VOCAB_SIZE = 1000
+_HIDDEN_SIZE = 256
+_NUM_HIDDEN_LAYERS = 4
+_NUM_ATTENTION_HEADS = 8
+_EOS_ID = 1
+_NUM_ITERS = 3
+
+
+class QuantizedCacheBenchmark(tf.test.Benchmark):
+
+    def _build_search_fn(self, quantized):
+        tf.random.set_seed(0)
+        embedding = WordEmbedding(vocab_size=_VOCAB_SIZE, embedding_size=_HIDDEN_SIZE)
+        decoder_stack = TransformerDecoderStack(
+            num_hidden_layers=_NUM_HIDDEN_LAYERS,
+            num_attention_heads=_NUM_ATTENTION_HEADS,
+            intermediate_size=_HIDDEN_SIZE * 4
+        )
+        look_ahead_mask = utils.get_look_ahead_mask(_DECODE_LEN)
+
+        def symbols_to_logits_fn(ids, i, cache):
+            decoder_inputs = embedding(ids[:, -1:], mode='embedding')
+            decoder_outputs = decoder_stack(
+                decoder_inputs,
+                cache['encoder_outputs'],
+                cache['padding_mask'],
+                tf.slice(look_ahead_mask, [0, i, 0], [1, 1, _DECODE_LEN]),
+                training=False,
+                cache=cache,
+                decode_loop_step=i,
+                beam_size=_BEAM_SIZE
+            )
+            return tf.squeeze(embedding(decoder_outputs, mode='linear'), axis=1), cache
+
+        @tf.function
+        def search(encoder_outputs):
+            batch_size = tf.shape(encoder_outputs)[0]
+            cache = {
+                str(layer): multi_head_attention_layer.create_cache(
+                    batch_size, _DECODE_LEN, _NUM_ATTENTION_HEADS, _HIDDEN_SIZE // _NUM_ATTENTION_HEADS,
+                    quantized=quantized
+                ) for layer in range(_NUM_HIDDEN_LAYERS)
+            }
+            cache['encoder_outputs'] = encoder_outputs
+            cache['padding_mask'] = tf.zeros([batch_size, 1, _INPUTS_LEN])
+            return beam_search.sequence_beam_search(
+                symbols_to_logits_fn,
+                initial_ids=tf.zeros([batch_size], tf.int32),
+                initial_cache=cache,
+                vocab_size=_VOCAB_SIZE,
+                beam_size=_BEAM_SIZE,
+                alpha=0.6,
+                max_decode_length=_DECODE_LEN,
+                eos_id=_EOS_ID,
+                padded_decode=True,
+                shared_cache_keys=('encoder_outputs', 'padding_mask')
+            )
+
+        return search
+
+    def _run_benchmark(self, quantized):
+        mode = 'int8' if quantized else 'float32'
+        for batch_size in _BATCH_SIZES:
+            encoder_outputs = tf.random.normal([batch_size, _INPUTS_LEN, _HIDDEN_SIZE], seed=1)
+            search = self._build_search_fn(quantized)
+            # 预热，排除 tracing 时间
+            ids, scores = search(encoder_outputs)
+
+            start = time.time()
+            for _ in range(_NUM_ITERS):
+                ids, scores = search(encoder_outputs)
+                ids.numpy()
+            wall_time = (time.time() - start) / _NUM_ITERS
+
+            # (batch_size * beam_size, decode_len, num_heads, size_per_head)
+            num_elements = batch_size * _BEAM_SIZE * _DECODE_LEN * _HIDDEN_SIZE
+            # key 和 value，int8 时另外每个头一个 float32 的 scale
+            bytes_per_layer = 2 * (num_elements + num_elements // (_HIDDEN_SIZE // _NUM_ATTENTION_HEADS) * 4) \
+                if quantized else 2 * num_elements * 4
+            extras = {
+                'tokens_per_second': batch_size * _DECODE_LEN / wall_time,
+                'cache_mb': bytes_per_layer * _NUM_HIDDEN_LAYERS / 2 ** 20
+            }
+            if quantized:
+                float_ids, float_scores = self._build_search_fn(quantized=False)(encoder_outputs)
+                extras['exact_match'] = float(np.mean(np.all(
+                    ids[:, 0].numpy() == float_ids[:, 0].numpy(), axis=-1
+                )))
+                extras['score_abs_diff'] = float(np.mean(np.abs(
+                    scores[:, 0].numpy() - float_scores[:, 0].numpy()
+                )))
+
+            self.report_benchmark(
+                iters=_NUM_ITERS,
+                wall_time=wall_time,
+                extras=extras,
+                name='beam_search_%s_cache_batch_%d' % (mode, batch_size)
+            )
+
+    def benchmark_float_cache(self):
+        self._run_benchmark(quantized=False)
+
+    def benchmark_int8_cache(self):
+        self._run_benchmark(quantized=True)
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -58,6 +58,97 @@ class BeamSearchTest(tf.test.TestCase):
             y
         )
 
+    def test_two_stage_top_k(self):
+        alive_log_probs = tf.random.normal([3, 4], seed=2)
+        # vocab_size 大于、小于 k
+        for vocab_size in (50, 5):
+            logits = tf.random.normal([3, 4, vocab_size], seed=1)
+            log_probs = beam_search._log_prob_from_logits(logits) + tf.expand_dims(alive_log_probs, axis=2)
+            expected_log_probs, expected_indices = tf.nn.top_k(tf.reshape(log_probs, [3, 4 * vocab_size]), k=8)
+
+            topk_log_probs, topk_indices = beam_search._two_stage_top_k(logits, alive_log_probs, 8)
+            self.assertAllClose(expected_log_probs, topk_log_probs)
+            self.assertAllEqual(expected_indices, topk_indices)
+
+            # vocab_size 只在运行时已知
+            dynamic_fn = tf.function(
+                lambda x, y: beam_search._two_stage_top_k(x, y, 8),
+                input_signature=[tf.TensorSpec([None, 4, None], tf.float32), tf.TensorSpec([None, 4], tf.float32)]
+            )
+            topk_log_probs, topk_indices = dynamic_fn(logits, alive_log_probs)
+            self.assertAllClose(expected_log_probs, topk_log_probs)
+            self.assertAllEqual(expected_indices, topk_indices)
+
+    def test_log_normalizer(self):
+        logits = tf.random.normal([3, 4, 50], seed=1) * 10.0
+        expected = tf.reduce_logsumexp(logits, axis=2, keepdims=True)
+        # 块大小整除、不整除、大于 vocab_size
+        for chunk_size in (10, 16, 64):
+            self.assertAllClose(expected, beam_search._log_normalizer(logits, chunk_size=chunk_size))
+
+        # vocab_size 只在运行时已知
+        dynamic_fn = tf.function(
+            lambda x: beam_search._log_normalizer(x, chunk_size=16),
+            input_signature=[tf.TensorSpec([None, None, None], tf.float32)]
+        )
+        self.assertAllClose(expected, dynamic_fn(logits))
+
+    def _search(self, compact_finished_batches, shared_cache=False):
+        vocab_size = 6
+        eos_id = 1
+        # 每个 batch item 在不同的解码步结束
+        eos_steps = tf.constant([[1.], [6.], [3.], [9.]])
+
+        def symbols_to_logits_fn(ids, i, cache):
+            # cache 会随着 beam search 被 gather，因此每个 batch item 都能取到自己的 eos_step
+            eos_step = cache['eos_step']
+            batch_size = tf.shape(ids)[0]
+            if shared_cache:
+                # 共用的 cache 没有 beam 维度，需要自己对 beam 广播
+                eos_step = tf.repeat(eos_step, batch_size // tf.shape(eos_step)[0], axis=0)
+            step = tf.cast(i, tf.float32)
+            base = tf.math.log(tf.constant([[0.05, 0.0, 0.4, 0.3, 0.15, 0.1]]))
+            eos_logits = tf.where(step >= eos_step, 5.0, -5.0)
+            logits = tf.tile(base, [batch_size, 1]) + tf.cast(
+                tf.reshape(ids[:, -1] % vocab_size, [-1, 1]) == tf.range(vocab_size), tf.float32
+            ) * 0.3
+            logits = tf.concat([logits[:, :1], eos_logits, logits[:, 2:]], axis=1)
+            return logits, cache
+
+        return beam_search.sequence_beam_search(
+            symbols_to_logits_fn,
+            initial_ids=tf.zeros([4], tf.int32),
+            initial_cache={'eos_step': eos_steps},
+            vocab_size=vocab_size,
+            beam_size=3,
+            alpha=0.6,
+            max_decode_length=8,
+            eos_id=eos_id,
+            compact_finished_batches=compact_finished_batches,
+            shared_cache_keys=('eos_step',) if shared_cache else None
+        )
+
+    def test_compact_finished_batches(self):
+        ids, scores = self._search(compact_finished_batches=False)
+        compact_ids, compact_scores = self._search(compact_finished_batches=True)
+        self.assertAllEqual(ids, compact_ids)
+        self.assertAllClose(scores, compact_scores)
+
+    def test_compact_finished_batches_in_function(self):
+        ids, scores = self._search(compact_finished_batches=False)
+        compact_ids, compact_scores = tf.function(self._search)(compact_finished_batches=True)
+        self.assertAllEqual(ids, compact_ids)
+        self.assertAllClose(scores, compact_scores)
+
+    def test_shared_cache(self):
+        ids, scores = self._search(compact_finished_batches=False)
+        for compact_finished_batches in [False, True]:
+            shared_ids, shared_scores = self._search(
+                compact_finished_batches=compact_finished_batches, shared_cache=True
+            )
+            self.assertAllEqual(ids, shared_ids)
+            self.assertAllClose(scores, shared_scores)
+
 
 if __name__ == '__main__':
     tf.test.main()
@@ -0,0 +1,89 @@
+# -*- coding: utf - 8 -*-
+
+import numpy as np
+import tensorflow as tf
+from ops import sampling_search
+
+_VOCAB_SIZE = 5
+_EOS_ID = 1
+
+
+def _get_symbols_to_logits_fn(next_ids):
+    """
+        按照 next_ids 依次给出 logits，第 i 步 next_ids[i] 的 logit 最大
+        同时在 cache 中记录调用次数
+    """
+    logits_table = tf.one_hot(next_ids, _VOCAB_SIZE, on_value=5.0, off_value=0.0)
+
+    def symbols_to_logits_fn(ids, i, cache):
+        batch_size = tf.shape(ids)[0]
+        logits = tf.tile(logits_table[i: i + 1], [batch_size, 1])
+        cache['steps'] = cache['steps'] + 1.0
+        return logits, cache
+
+    return symbols_to_logits_fn
+
+
+class SamplingSearchTest(tf.test.TestCase):
+
+    def test_sample_top_k(self):
+        logits = tf.constant([[1.0, 4.0, 3.0, 2.0]])
+        filtered = sampling_search.sample_top_k(logits, 2)
+        self.assertAllEqual([[False, True, True, False]], filtered > -1e6)
+        self.assertAllEqual(logits, sampling_search.sample_top_k(logits, 0))
+
+    def test_sample_top_p(self):
+        # softmax 后概率约为 [0.64, 0.24, 0.09, 0.03]
+        logits = tf.constant([[3.0, 2.0, 1.0, 0.0]])
+        filtered = sampling_search.sample_top_p(logits, 0.7)
+        self.assertAllEqual([[True, True, False, False]], filtered > -1e6)
+        filtered = sampling_search.sample_top_p(logits, 0.1)
+        self.assertAllEqual([[True, False, False, False]], filtered > -1e6)
+        self.assertAllEqual(logits, sampling_search.sample_top_p(logits, 1.0))
+
+    def test_greedy_search(self):
+        symbols_to_logits_fn = _get_symbols_to_logits_fn([3, 4, _EOS_ID, 2, 2])
+        initial_ids = tf.zeros([2], dtype=tf.int32)
+        initial_cache = {'steps': tf.zeros([2, 1])}
+        decoded_ids, scores = sampling_search.sequence_greedy_search(
+            symbols_to_logits_fn, initial_ids, initial_cache, max_decode_length=5, eos_id=_EOS_ID
+        )
+        # 所有序列都解码出 EOS 之后提前结束
+        self.assertAllEqual([[[0, 3, 4, _EOS_ID]]] * 2, decoded_ids)
+        self.assertEqual(scores.shape, (2, 1))
+        expected_log_prob = 3 * (5.0 - np.log(np.exp(5.0) + _VOCAB_SIZE - 1))
+        self.assertAllClose([[expected_log_prob]] * 2, scores)
+
+    def test_greedy_search_max_decode_length(self):
+        symbols_to_logits_fn = _get_symbols_to_logits_fn([3, 4, 2, 2, 2])
+        decoded_ids, _ = sampling_search.sequence_greedy_search(
+            symbols_to_logits_fn,
+            tf.zeros([1], dtype=tf.int32),
+            {'steps': tf.zeros([1, 1])},
+            max_decode_length=3,
+            eos_id=_EOS_ID
+        )
+        self.assertAllEqual([[[0, 3, 4, 2]]], decoded_ids)
+
+    def test_sampling_search_top_k_one_is_greedy(self):
+        symbols_to_logits_fn = _get_symbols_to_logits_fn([3, 4, _EOS_ID])
+        decoded_ids, _ = sampling_search.sequence_sampling_search(
+            symbols_to_logits_fn,
+            tf.zeros([3], dtype=tf.int32),
+            {'steps': tf.zeros([3, 1])},
+            max_decode_length=3,
+            eos_id=_EOS_ID,
+            top_k=1,
+            temperature=2.0
+        )
+        self.assertAllEqual([[[0, 3, 4, _EOS_ID]]] * 3, decoded_ids)
+
+    def test_sampling_requires_positive_temperature(self):
+        with self.assertRaises(ValueError):
+            sampling_search.SequenceSampler(
+                None, max_decode_length=3, eos_id=_EOS_ID, greedy=False, temperature=0.0
+            )
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -1 +1,8 @@
 # -*- coding: utf - 8 -*-
+
+# 保留的 token，与 models.transformer 中的 BOS_ID / EOS_ID 一致
+PAD = '<pad>'
+PAD_ID = 0
+EOS = '<EOS>'
+EOS_ID = 1
+RESERVED_TOKENS = [PAD, EOS]